@@ -0,0 +1,232 @@
+"""
+NERD - indexes of arrays in a record, used by perform_update (update_ops.py).
+
+Operations array_update, array_upsert and array_remove look up an item of an
+array of objects by values of some of its fields (e.g. events by date, node and
+cat), add_to_set and extend_set check whether a value is present in an array.
+With large arrays (events of busy IPs have thousands of items) and many such
+operations in one task, linear scans make the task quadratic.
+
+ArrayIndex caches, for the time of processing one task, a dict (values of the
+query fields) -> position of the first matching item for each array and set of
+fields used, and a set of values of each array used by add_to_set/extend_set.
+An index is built the first time it's needed and then kept up to date by
+perform_update:
+  - appended items are added to all indexes of the array,
+  - removal of the last item just removes its entry, removal of any other item
+    (which moves the following ones) drops the indexes of the array - they are
+    rebuilt when needed again (use array_remove_many to remove more items at
+    once),
+  - change of an indexed field of an item (by array_update actions) drops
+    the indexes of given fields.
+Changes done by other means are detected by the length of the array (and
+replacing the array by another object) - the index is rebuilt then. Changes of
+items in place which don't change the length (e.g. a field of an item set
+directly by a handler function) are NOT detected, so the index must be dropped
+after such changes - UpdateManager uses a new ArrayIndex after each call of a
+handler.
+
+Arrays containing unhashable values (lists, dicts) in the indexed fields are
+searched linearly as before.
+"""
+
+import operator
+
+_MISSING = object()
+
+_COMPARISONS = {'$lt': operator.lt, '$lte': operator.le, '$gt': operator.gt, '$gte': operator.ge}
+
+
+def match_item(item, query):
+    """
+    Return True if the array item matches the query.
+
+    The query is a dict field -> value (equality) or field -> dict of operators ($lt, $lte, $gt, $gte, $ne, $in, $nin),
+    e.g. {'date': {'$lt': '2020-01-01'}}. Missing fields never match (except with $ne and $nin), neither do values
+    not comparable with the query value and items which are not objects.
+    """
+    if not isinstance(item, dict):
+        return False
+    for field, cond in query.items():
+        value = item.get(field, _MISSING)
+        if isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond):
+            for op, arg in cond.items():
+                if op == '$ne':
+                    if value is not _MISSING and value == arg:
+                        return False
+                elif op == '$nin':
+                    if value is not _MISSING and value in arg:
+                        return False
+                elif value is _MISSING:
+                    return False
+                elif op == '$in':
+                    if value not in arg:
+                        return False
+                elif op in _COMPARISONS:
+                    try:
+                        if not _COMPARISONS[op](value, arg):
+                            return False
+                    except TypeError:
+                        return False
+                else:
+                    raise ValueError("Unsupported operator '{}' in array query".format(op))
+        elif value is _MISSING or value != cond:
+            return False
+    return True
+
+
+def _item_key(item, fields):
+    """Return tuple of values of given fields of the item, None if some of them is missing"""
+    try:
+        return tuple(item[f] for f in fields)
+    except (KeyError, TypeError):
+        return None
+
+
+class _Positions:
+    """Index of an array: key (values of some fields) -> position of the first item with the key"""
+    __slots__ = ('length', 'positions')
+
+    def __init__(self, array, fields):
+        self.length = len(array)
+        positions = {}
+        for i, item in enumerate(array):
+            key = _item_key(item, fields)
+            if key is not None and key not in positions: # (raises TypeError if a value is unhashable)
+                positions[key] = i
+        self.positions = positions
+
+
+class _Values:
+    """Set of values of an array"""
+    __slots__ = ('length', 'values')
+
+    def __init__(self, array):
+        self.length = len(array)
+        self.values = set(array) # (raises TypeError if a value is unhashable)
+
+
+class _Entry:
+    """Indexes of one array"""
+    __slots__ = ('array', 'positions', 'values')
+
+    def __init__(self, array):
+        self.array = array # (reference is kept so id of the array can't be reused by another object)
+        self.positions = {} # fields -> _Positions or None (unhashable values)
+        self.values = _MISSING # _Values or None (unhashable values)
+
+
+class ArrayIndex:
+    """Indexes of arrays in one record (or its sub-objects), valid while processing one task"""
+
+    def __init__(self):
+        self._entries = {} # id(array) -> _Entry
+
+    def _entry(self, array):
+        entry = self._entries.get(id(array))
+        if entry is None or entry.array is not array:
+            entry = self._entries[id(array)] = _Entry(array)
+        return entry
+
+    def find(self, array, query):
+        """Return position of the first item of the array matching the query (dict field -> value), None if no one"""
+        fields = tuple(query)
+        entry = self._entry(array)
+        index = entry.positions.get(fields, _MISSING)
+        if index is not None and (index is _MISSING or index.length != len(array)):
+            try:
+                index = _Positions(array, fields)
+            except TypeError:
+                index = None
+            entry.positions[fields] = index
+        if index is not None:
+            try:
+                return index.positions.get(tuple(query[f] for f in fields))
+            except TypeError: # unhashable value in the query
+                pass
+        for i, item in enumerate(array):
+            if all(item[a] == v for a, v in query.items()):
+                return i
+        return None
+
+    def contains(self, array, value):
+        """Return True if the value is present in the array"""
+        entry = self._entry(array)
+        index = entry.values
+        if index is not None and (index is _MISSING or index.length != len(array)):
+            try:
+                index = _Values(array)
+            except TypeError:
+                index = None
+            entry.values = index
+        if index is not None:
+            try:
+                return value in index.values
+            except TypeError: # unhashable value
+                pass
+        return value in array
+
+    def appended(self, array):
+        """Update indexes after an item was appended to the array"""
+        entry = self._entries.get(id(array))
+        if entry is None or entry.array is not array:
+            return
+        i = len(array) - 1
+        item = array[i]
+        for fields, index in list(entry.positions.items()):
+            if index is None or index.length != i:
+                continue
+            key = _item_key(item, fields)
+            try:
+                if key is not None and key not in index.positions:
+                    index.positions[key] = i
+            except TypeError:
+                entry.positions[fields] = None
+                continue
+            index.length += 1
+        index = entry.values
+        if index is not None and index is not _MISSING and index.length == i:
+            try:
+                index.values.add(item)
+                index.length += 1
+            except TypeError:
+                entry.values = None
+
+    def removed(self, array, i, item):
+        """Update indexes after the item at position i was removed from the array"""
+        entry = self._entries.get(id(array))
+        if entry is None or entry.array is not array:
+            return
+        if i == len(array):
+            # The last item - just remove its entry
+            for fields, index in entry.positions.items():
+                if index is not None and index.length == i + 1:
+                    key = _item_key(item, fields)
+                    if key is not None and index.positions.get(key) == i:
+                        del index.positions[key]
+                    index.length -= 1
+        else:
+            # Positions of the following items changed, rebuild the indexes when needed
+            entry.positions.clear()
+        # A value can't be simply removed from the set (there may be duplicates), rebuild it when needed
+        entry.values = _MISSING
+
+    def keys(self, array, item):
+        """Return keys of the item for all indexes of the array (to be passed to changed())"""
+        entry = self._entries.get(id(array))
+        if entry is None or entry.array is not array:
+            return {}
+        return {fields: _item_key(item, fields) for fields in entry.positions}
+
+    def changed(self, array, item, old_keys):
+        """Update indexes after an item of the array was changed in place (old_keys as returned by keys())"""
+        entry = self._entries.get(id(array))
+        if entry is None or entry.array is not array:
+            return
+        for fields, key in old_keys.items():
+            if _item_key(item, fields) != key:
+                entry.positions.pop(fields, None)
+
+    def reset(self, array):
+        """Drop all indexes of the array (after a change not covered by the methods above)"""
+        self._entries.pop(id(array), None)
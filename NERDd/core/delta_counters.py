@@ -0,0 +1,75 @@
+"""
+NERD - accumulation of changes of numeric counters in records (e.g. "_ref_cnt").
+
+Some counters are changed very often by small steps, typically reference
+counters of BGP prefixes, IP blocks and organizations, which are incremented
+for each new IP address and decremented for each removed one. Sending a task
+for each such change means a full load/handlers/store cycle of a few hot
+records for every IP.
+
+Instead, changes are accumulated in memory (per worker process) and sent
+periodically as one task per record with the sum of all changes since the last
+flush (changes cancelling each other out produce no task at all). Handlers
+watching the counter are therefore called once per flush, not once per change.
+
+The tasks are processed by UpdateManager as any other tasks, so they can't
+interfere with other updates of the same record. Positive sums use the 'add'
+operation (creating the record if it doesn't exist), negative ones '*sub'
+(ignored if the record doesn't exist anymore).
+
+Changes not flushed yet are lost if the process is killed, counters should be
+periodically reconciled (see scripts/reconcile_ref_cnt.py).
+"""
+
+import logging
+import threading
+
+
+class DeltaCounters:
+    def __init__(self, update_func):
+        """
+        :param update_func: Function to request an update of a record, with the same parameters as
+                            UpdateManager.update (ekey, update_requests)
+        """
+        self.log = logging.getLogger("DeltaCounters")
+        self._update = update_func
+        self._lock = threading.Lock()
+        self._deltas = {} # (ekey, attr) -> sum of changes since the last flush
+        self._changes = 0 # number of changes since the last flush
+
+    def add(self, ekey, attr, delta=1):
+        """Add delta (may be negative) to the counter 'attr' of given entity."""
+        key = (ekey, attr)
+        with self._lock:
+            self._deltas[key] = self._deltas.get(key, 0) + delta
+            self._changes += 1
+
+    def sub(self, ekey, attr, delta=1):
+        """Subtract delta from the counter 'attr' of given entity."""
+        self.add(ekey, attr, -delta)
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def flush(self):
+        """
+        Send accumulated changes as update requests (one task per record).
+
+        Return the number of tasks sent.
+        """
+        with self._lock:
+            deltas = self._deltas
+            changes = self._changes
+            self._deltas = {}
+            self._changes = 0
+        requests = {} # ekey -> list of update requests
+        for (ekey, attr), delta in deltas.items():
+            if delta > 0:
+                requests.setdefault(ekey, []).append(('add', attr, delta))
+            elif delta < 0:
+                requests.setdefault(ekey, []).append(('*sub', attr, -delta))
+        for ekey, updreq in requests.items():
+            self._update(ekey, updreq)
+        if changes:
+            self.log.debug("Flushed {} counter changes as {} tasks".format(changes, len(requests)))
+        return len(requests)
@@ -0,0 +1,565 @@
+"""
+NERD - embedded entity database (for single-node deployments, tests and benchmarks).
+
+Provides EmbeddedEntityDatabase class -- an implementation of the entity
+database interface (the same as MongoEntityDatabase) storing records locally in
+an SQLite file, so no database server is needed.
+
+Each entity type has its own table with the key, the record (pickled) and
+a column for each indexed field (INDEXED_FIELDS); tokens in '_ttl' dict are
+indexed in a separate table. Queries and aggregation pipelines use a subset of
+the MongoDB query language (see _match and aggregate); conditions on indexed
+fields are used to preselect candidate records in SQL, all conditions are then
+evaluated on the records themselves.
+
+The database file may be opened by more processes (WAL mode), each thread uses
+its own connection.
+"""
+
+import os
+import pickle
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone
+
+# Defaults (may be overridden by config value embedded_db.path)
+DEFAULT_PATH = '/data/nerd_entities.sqlite'
+
+# Fields (top-level, with scalar values) stored in separate indexed columns
+INDEXED_FIELDS = ['_nru1d', '_nru1w', 'rep', 'bgppref', 'ipblock']
+
+# Value stored in an index column if the field has a non-scalar value (such records always pass the SQL preselection)
+COMPLEX_VALUE = '\x00'
+
+PICKLE_PROTOCOL = 4
+
+
+class UnknownEntityType(ValueError):
+    pass
+
+
+class UnsupportedQuery(ValueError):
+    pass
+
+
+def _index_value(value):
+    """Convert a value to the form stored in an index column (None if it can't be stored there)"""
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float, str)):
+        return value
+    return COMPLEX_VALUE
+
+
+# ***** Evaluation of queries (subset of MongoDB query language) *****
+
+_MISSING = object()
+
+
+def _get_values(rec, path):
+    """
+    Return list of values at given (dotted) path in the record, lists on the path are traversed (like in MongoDB).
+    Return empty list if the path doesn't exist.
+    """
+    values = [rec]
+    for part in path.split('.'):
+        next_values = []
+        for v in values:
+            if isinstance(v, dict):
+                if part in v:
+                    next_values.append(v[part])
+            elif isinstance(v, list):
+                if part.isdigit() and int(part) < len(v):
+                    next_values.append(v[int(part)])
+                else:
+                    next_values.extend(item[part] for item in v if isinstance(item, dict) and part in item)
+        values = next_values
+    return values
+
+
+def _expand(values):
+    """Values and, for values which are lists, also their elements (array fields match if any element matches)"""
+    result = []
+    for v in values:
+        result.append(v)
+        if isinstance(v, list):
+            result.extend(v)
+    return result
+
+
+def _compare(a, b, op):
+    try:
+        if op == '$gt':
+            return a > b
+        if op == '$gte':
+            return a >= b
+        if op == '$lt':
+            return a < b
+        if op == '$lte':
+            return a <= b
+    except TypeError:
+        return False # values of different types are not comparable (MongoDB compares only values of the same type)
+    raise UnsupportedQuery("Unsupported operator '{}'".format(op))
+
+
+def _match_condition(values, cond):
+    """Check condition (value or dict of operators) on the list of values of a field"""
+    if isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond):
+        for op, arg in cond.items():
+            if op == '$exists':
+                if bool(values) != bool(arg):
+                    return False
+            elif op == '$eq':
+                if not _match_condition(values, arg):
+                    return False
+            elif op == '$ne':
+                if _match_condition(values, arg):
+                    return False
+            elif op == '$in':
+                if not any(_match_condition(values, a) for a in arg):
+                    return False
+            elif op == '$nin':
+                if any(_match_condition(values, a) for a in arg):
+                    return False
+            elif op in ('$gt', '$gte', '$lt', '$lte'):
+                if not any(_compare(v, arg, op) for v in _expand(values)):
+                    return False
+            elif op == '$not':
+                if _match_condition(values, arg):
+                    return False
+            elif op == '$size':
+                if not any(isinstance(v, list) and len(v) == arg for v in values):
+                    return False
+            elif op == '$elemMatch':
+                if not any(isinstance(v, list) and any(isinstance(item, dict) and _match(item, arg) for item in v)
+                           for v in values):
+                    return False
+            else:
+                raise UnsupportedQuery("Unsupported operator '{}'".format(op))
+        return True
+    # Equality
+    if cond is None:
+        return not values or any(v is None for v in values)
+    return any(v == cond for v in _expand(values))
+
+
+def _match(rec, query):
+    """Return True if the record matches the query"""
+    for key, cond in query.items():
+        if key == '$and':
+            if not all(_match(rec, q) for q in cond):
+                return False
+        elif key == '$or':
+            if not any(_match(rec, q) for q in cond):
+                return False
+        elif key == '$nor':
+            if any(_match(rec, q) for q in cond):
+                return False
+        elif key.startswith('$'):
+            raise UnsupportedQuery("Unsupported operator '{}'".format(key))
+        elif not _match_condition(_get_values(rec, key), cond):
+            return False
+    return True
+
+
+def _sort_key(value):
+    # Order of types similar to MongoDB (missing/None < numbers < strings < other), so mixed values can be sorted
+    if value is _MISSING or value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value.replace(tzinfo=None))
+    return (4, repr(value))
+
+
+def _sort(records, sort):
+    """Sort records according to list of (field, direction) (direction 1 or -1)"""
+    if isinstance(sort, str):
+        sort = [(sort, 1)]
+    elif isinstance(sort, dict):
+        sort = list(sort.items())
+    for field, direction in reversed(sort):
+        records.sort(key=lambda r: _sort_key((_get_values(r, field) or [_MISSING])[0]), reverse=direction < 0)
+    return records
+
+
+def _expr_value(rec, expr):
+    """Evaluate expression of $group/$project stage: "$field" or a constant"""
+    if isinstance(expr, str) and expr.startswith('$'):
+        values = _get_values(rec, expr[1:])
+        return values[0] if values else None
+    if isinstance(expr, dict):
+        return {k: _expr_value(rec, v) for k, v in expr.items()}
+    return expr
+
+
+def _group(records, spec):
+    """$group stage"""
+    groups = {}
+    order = []
+    for rec in records:
+        group_id = _expr_value(rec, spec['_id'])
+        key = repr(group_id)
+        if key not in groups:
+            groups[key] = {'_id': group_id}
+            order.append(key)
+        out = groups[key]
+        for field, acc in spec.items():
+            if field == '_id':
+                continue
+            (op, expr), = acc.items()
+            value = _expr_value(rec, expr)
+            if op == '$sum':
+                out[field] = out.get(field, 0) + (value if isinstance(value, (int, float)) else 0)
+            elif op == '$avg':
+                s, n = out.get(field, (0, 0))
+                out[field] = (s + value, n + 1) if isinstance(value, (int, float)) else (s, n)
+            elif op == '$min':
+                if value is not None and (field not in out or _sort_key(value) < _sort_key(out[field])):
+                    out[field] = value
+            elif op == '$max':
+                if value is not None and (field not in out or _sort_key(value) > _sort_key(out[field])):
+                    out[field] = value
+            elif op == '$push':
+                out.setdefault(field, []).append(value)
+            elif op == '$addToSet':
+                lst = out.setdefault(field, [])
+                if value not in lst:
+                    lst.append(value)
+            elif op == '$first':
+                out.setdefault(field, value)
+            elif op == '$last':
+                out[field] = value
+            else:
+                raise UnsupportedQuery("Unsupported accumulator '{}'".format(op))
+    result = [groups[key] for key in order]
+    for field, acc in spec.items():
+        if field != '_id' and '$avg' in acc:
+            for out in result:
+                s, n = out.get(field, (0, 0))
+                out[field] = s / n if n else None
+    return result
+
+
+def _project(rec, spec):
+    """$project stage (inclusion of fields or computed fields, or exclusion of fields)"""
+    if spec and all(v in (0, False) for v in spec.values()):
+        out = dict(rec)
+        for field in spec:
+            out.pop(field, None)
+        return out
+    out = {}
+    if spec.get('_id', 1):
+        out['_id'] = rec.get('_id')
+    for field, v in spec.items():
+        if field == '_id':
+            continue
+        if v in (1, True):
+            values = _get_values(rec, field)
+            if values:
+                out[field] = values[0]
+        else:
+            out[field] = _expr_value(rec, v)
+    return out
+
+
+class EmbeddedEntityDatabase():
+    """
+    EntityDatabase implemented over a local SQLite file (see the module docstring).
+    """
+    # List of known/supported entity types
+    _supportedTypes = ['ip', 'asn', 'bgppref', 'ipblock', 'org']
+
+    def __init__(self, config):
+        """
+        Open (or create) the database file.
+        """
+        self.log = logging.getLogger("EmbeddedDB")
+        self.path = config.get('embedded_db.path', DEFAULT_PATH)
+        self._local = threading.local()
+        self.log.info("Opening embedded entity database at {}".format(self.path))
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(dirname, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            for etype in self._supportedTypes:
+                conn.execute("CREATE TABLE IF NOT EXISTS {} (id PRIMARY KEY, rec BLOB NOT NULL, {})".format(
+                    etype, ", ".join('"{}"'.format(f) for f in INDEXED_FIELDS)))
+                for field in INDEXED_FIELDS:
+                    conn.execute('CREATE INDEX IF NOT EXISTS "{0}__{1}" ON {0} ("{1}")'.format(etype, field))
+                # Tokens in '_ttl' dict: one row per (record, token name)
+                conn.execute("CREATE TABLE IF NOT EXISTS {0}__ttl (id NOT NULL, name TEXT NOT NULL, value, "
+                             "PRIMARY KEY (id, name))".format(etype))
+                conn.execute("CREATE INDEX IF NOT EXISTS {0}__ttl_value ON {0}__ttl (name, value)".format(etype))
+
+    def _conn(self):
+        """Return connection of the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _check_etype(self, etype):
+        if etype not in self._supportedTypes:
+            raise UnknownEntityType("There is no collection for entity type "+str(etype))
+
+    def getEntityTypes(self):
+        """
+        Return list of known entity types.
+        """
+        return self._supportedTypes
+
+    # ***** Basic operations *****
+
+    def get(self, etype, key):
+        """
+        Return record of given entity.
+
+        Arguments:
+        etype   entity type (str), e.g. 'ip'
+        key     entity identifier (str), e.g. '192.0.2.42'
+
+        Return the record as JSON document or None if it is not present in the database.
+
+        Raise UnknownEntityType if there is not a database collection for given etype.
+        """
+        self._check_etype(etype)
+        row = self._conn().execute("SELECT rec FROM {} WHERE id = ?".format(etype), (key,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def put(self, etype, key, record):
+        """
+        Replace record of given entity by the new one.
+
+        Arguments:
+        etype   entity type (str), e.g. 'ip'
+        key     entity identifier (str), e.g. '192.0.2.42'
+        record  JSON document with properties of the entity to be stored in DB
+        """
+        self.put_many(etype, [(key, record)])
+
+    def delete(self, etype, key):
+        """
+        Delete an entity specified with the key.
+        """
+        self.delete_many(etype, [key])
+
+    # ***** Batch operations *****
+
+    def get_many(self, etype, keys):
+        """
+        Return records of given entities as a dict key -> record (missing entities are not included).
+        """
+        self._check_etype(etype)
+        keys = list(keys)
+        result = {}
+        conn = self._conn()
+        for i in range(0, len(keys), 500): # (SQLite limits number of parameters of a query)
+            chunk = keys[i:i+500]
+            rows = conn.execute("SELECT id, rec FROM {} WHERE id IN ({})".format(etype, ",".join("?" * len(chunk))), chunk)
+            for key, rec in rows:
+                result[key] = pickle.loads(rec)
+        return result
+
+    def put_many(self, etype, items):
+        """
+        Replace records of given entities (iterable of (key, record)) in one transaction.
+        """
+        self._check_etype(etype)
+        rows = []
+        ttl_rows = []
+        keys = []
+        for key, record in items:
+            keys.append((key,))
+            rows.append([key, pickle.dumps(record, PICKLE_PROTOCOL)] +
+                        [_index_value(record[f]) if f in record else None for f in INDEXED_FIELDS])
+            ttl = record.get('_ttl')
+            if isinstance(ttl, dict):
+                ttl_rows.extend((key, name, _index_value(value)) for name, value in ttl.items())
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR REPLACE INTO {} VALUES ({})".format(etype, ",".join("?" * (2 + len(INDEXED_FIELDS)))), rows)
+            conn.executemany("DELETE FROM {}__ttl WHERE id = ?".format(etype), keys)
+            conn.executemany("INSERT INTO {}__ttl VALUES (?, ?, ?)".format(etype), ttl_rows)
+
+    def delete_many(self, etype, keys):
+        """
+        Delete given entities in one transaction.
+        """
+        self._check_etype(etype)
+        keys = [(key,) for key in keys]
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM {} WHERE id = ?".format(etype), keys)
+            conn.executemany("DELETE FROM {}__ttl WHERE id = ?".format(etype), keys)
+
+    # ***** Queries *****
+
+    def _preselect(self, etype, query):
+        """
+        Translate conditions of the query on indexed fields to SQL.
+
+        Return (where_clause, params, exact, columns):
+          records satisfying the clause are a superset of records matching the query,
+          exact is True if all conditions were translated, so the clause selects exactly the matching records except
+          those having a non-scalar value in one of the columns (list of index columns used).
+        """
+        clauses = []
+        params = []
+        columns = []
+        exact = True
+        for field, cond in query.items():
+            if field == '$and':
+                for q in cond:
+                    clause, p, sub_exact, sub_columns = self._preselect(etype, q)
+                    if clause:
+                        clauses.append(clause)
+                        params.extend(p)
+                    columns.extend(sub_columns)
+                    exact = exact and sub_exact
+                continue
+            if field == '_id':
+                column = 'id'
+            elif field in INDEXED_FIELDS:
+                column = '"{}"'.format(field)
+            elif field.startswith('_ttl.') and field.count('.') == 1:
+                column = None
+            else:
+                exact = False
+                continue
+            ops = cond if isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond) else {'$eq': cond}
+            for op, arg in ops.items():
+                sql_op = {'$eq': '=', '$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}.get(op)
+                if op == '$in' and isinstance(arg, (list, tuple)) and all(_index_value(a) not in (None, COMPLEX_VALUE) for a in arg) and arg:
+                    expr = "{{}} IN ({})".format(",".join("?" * len(arg)))
+                    values = [_index_value(a) for a in arg]
+                elif sql_op and _index_value(arg) not in (None, COMPLEX_VALUE):
+                    expr = "{{}} {} ?".format(sql_op)
+                    values = [_index_value(arg)]
+                elif op == '$exists' and column is None:
+                    clauses.append("id {} (SELECT id FROM {}__ttl WHERE name = ?)".format("IN" if arg else "NOT IN", etype))
+                    params.append(field[5:])
+                    continue
+                else:
+                    exact = False
+                    continue # condition can't be evaluated by the index
+                if column == 'id':
+                    clauses.append(expr.format('id'))
+                    params.extend(values)
+                elif column:
+                    clauses.append("({} OR {} = ?)".format(expr.format(column), column))
+                    params.extend(values + [COMPLEX_VALUE])
+                    columns.append(column)
+                else:
+                    clauses.append("id IN (SELECT id FROM {}__ttl WHERE name = ? AND {})".format(etype, expr.format('value')))
+                    params.extend([field[5:]] + values)
+        return " AND ".join(clauses), params, exact, columns
+
+    def _iter_matching(self, etype, query):
+        """Yield records matching the query"""
+        self._check_etype(etype)
+        query = query or {}
+        where, params, _, _ = self._preselect(etype, query)
+        sql = "SELECT rec FROM {}".format(etype) + (" WHERE " + where if where else "")
+        for row in self._conn().execute(sql, params):
+            rec = pickle.loads(row[0])
+            if _match(rec, query):
+                yield rec
+
+    def _iter_matching_keys(self, etype, query):
+        """Yield keys of records matching the query (records are loaded only if the index isn't enough to decide)"""
+        self._check_etype(etype)
+        query = query or {}
+        where, params, exact, columns = self._preselect(etype, query)
+        if not exact:
+            for rec in self._iter_matching(etype, query):
+                yield rec['_id']
+            return
+        # Record is needed only if some of the indexed values used isn't scalar
+        if columns:
+            rec_expr = "CASE WHEN {} THEN rec END".format(" OR ".join("{} = ?".format(c) for c in columns))
+            params = [COMPLEX_VALUE] * len(columns) + params
+        else:
+            rec_expr = "NULL"
+        sql = "SELECT id, {} FROM {}".format(rec_expr, etype) + (" WHERE " + where if where else "")
+        for key, rec in self._conn().execute(sql, params):
+            if rec is None or _match(pickle.loads(rec), query):
+                yield key
+
+    def find(self, etype, mongo_query, **kwargs):
+        """
+        Search entities matching given query (in pymongo format, only a subset of operators is supported).
+
+        Keyword arguments sort, skip and limit are supported.
+        Return list of keys of matching entities.
+        """
+        sort = kwargs.pop('sort', None)
+        skip = kwargs.pop('skip', 0) or 0
+        limit = kwargs.pop('limit', 0) or 0
+        kwargs.pop('projection', None)
+        if kwargs:
+            raise UnsupportedQuery("Unsupported arguments of find(): {}".format(", ".join(kwargs)))
+        if sort:
+            records = _sort(list(self._iter_matching(etype, mongo_query)), sort)
+            keys = [rec['_id'] for rec in records]
+        else:
+            keys = []
+            for key in self._iter_matching_keys(etype, mongo_query):
+                keys.append(key)
+                if limit and len(keys) >= skip + limit:
+                    break
+        return keys[skip:skip + limit] if limit else keys[skip:]
+
+    def aggregate(self, etype, mongo_query):
+        """
+        Aggregates all the records according to an aggregation pipeline (in pymongo format, a stage or list of stages).
+
+        Supported stages: $match, $project, $group, $sort, $skip, $limit, $count.
+        :return: list of resulting documents
+        """
+        pipeline = mongo_query if isinstance(mongo_query, list) else [mongo_query]
+        # The first $match stage is used to select records (using indexes)
+        if pipeline and '$match' in pipeline[0]:
+            docs = list(self._iter_matching(etype, pipeline[0]['$match']))
+            pipeline = pipeline[1:]
+        else:
+            docs = list(self._iter_matching(etype, {}))
+        for stage in pipeline:
+            (op, spec), = stage.items()
+            if op == '$match':
+                docs = [d for d in docs if _match(d, spec)]
+            elif op == '$project':
+                docs = [_project(d, spec) for d in docs]
+            elif op == '$group':
+                docs = _group(docs, spec)
+            elif op == '$sort':
+                docs = _sort(docs, spec)
+            elif op == '$skip':
+                docs = docs[spec:]
+            elif op == '$limit':
+                docs = docs[:spec]
+            elif op == '$count':
+                docs = [{spec: len(docs)}] if docs else []
+            else:
+                raise UnsupportedQuery("Unsupported aggregation stage '{}'".format(op))
+        return docs
+
+    def count(self, etype, mongo_query=None):
+        """Return number of entities matching given query (all entities if no query is given)"""
+        if not mongo_query:
+            self._check_etype(etype)
+            return self._conn().execute("SELECT COUNT(*) FROM {}".format(etype)).fetchone()[0]
+        return sum(1 for _ in self._iter_matching_keys(etype, mongo_query))
@@ -0,0 +1,98 @@
+"""
+NERD - local task queue of a worker thread with merging of tasks of the same entity.
+
+When a task arrives for an entity which already has a task waiting in the
+queue, its update requests are appended to the waiting ones (order is
+preserved), so all of them are processed by one load/handlers/store cycle.
+
+Requests are not merged (a new "batch" of the same entity is started instead)
+when it could change the result:
+  - after a '!DELETE' event (later requests would be discarded together with
+    the record, while separately they would create a new record),
+  - into a batch of only weak operations (starting with '*', they are ignored
+    if the record doesn't exist) if the new task contains normal operations
+    (which would create the record, so the weak ones would be applied too).
+Batches of an entity are processed one by one, in order.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class PendingTask:
+    """Task(s) of one entity waiting in the queue"""
+    __slots__ = ('etype', 'eid', 'batches', 'msg_ids', 'srcs', 't_enqueued', '_last_weak_only', '_last_closed')
+
+    def __init__(self, etype, eid, t_enqueued):
+        self.etype = etype
+        self.eid = eid
+        self.batches = [] # lists of update requests, each list is processed by one call of _process_update_req
+        self.msg_ids = [] # message IDs (to be acknowledged) of all tasks merged here
+        self.srcs = [] # sources of all tasks merged here
+        self.t_enqueued = t_enqueued # time the first task was put into the queue
+        self._last_weak_only = False
+        self._last_closed = True
+
+    def add(self, msg_id, updreq, src):
+        """Add a task (merge its requests to the last batch if possible)"""
+        weak_only = all(r[0][0] == '*' for r in updreq)
+        closes = any(r[0] == 'event' and r[1] == '!DELETE' for r in updreq)
+        if self._last_closed or (self._last_weak_only and not weak_only):
+            self.batches.append(list(updreq))
+            self._last_weak_only = weak_only
+        else:
+            self.batches[-1].extend(updreq)
+            self._last_weak_only = self._last_weak_only and weak_only
+        self._last_closed = closes
+        self.msg_ids.append(msg_id)
+        self.srcs.append(src)
+
+    @property
+    def n_tasks(self):
+        return len(self.msg_ids)
+
+
+class EntityTaskQueue:
+    """
+    Thread-safe queue of PendingTasks, ordered by arrival of the first task of each entity.
+
+    maxsize limits the number of different entities waiting (put blocks when full), tasks of an entity already
+    waiting are always accepted.
+    """
+    def __init__(self, maxsize=10):
+        self.maxsize = maxsize
+        self._entries = OrderedDict() # (etype, eid) -> PendingTask
+        self._cond = threading.Condition()
+
+    def put(self, msg_id, etype, eid, updreq, src):
+        """Add a task, return True if it was merged to a waiting task of the same entity."""
+        key = (etype, eid)
+        with self._cond:
+            entry = self._entries.get(key)
+            merged = entry is not None
+            if not merged:
+                while len(self._entries) >= self.maxsize:
+                    self._cond.wait()
+                    entry = self._entries.get(key) # (a task of the entity might have been added in the meantime)
+                    if entry is not None:
+                        merged = True
+                        break
+                if entry is None:
+                    entry = PendingTask(etype, eid, time.perf_counter())
+                    self._entries[key] = entry
+                    self._cond.notify_all()
+            entry.add(msg_id, updreq, src)
+            return merged
+
+    def get(self, timeout=None):
+        """Remove and return the oldest PendingTask, return None if there is none within the timeout."""
+        with self._cond:
+            if not self._entries and not self._cond.wait_for(lambda: self._entries, timeout):
+                return None
+            _, entry = self._entries.popitem(last=False)
+            self._cond.notify_all()
+            return entry
+
+    def __len__(self):
+        return len(self._entries)
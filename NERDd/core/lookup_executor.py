@@ -0,0 +1,229 @@
+"""
+NERD lookup executor - performs lookups to external services (HTTP APIs etc.)
+on behalf of modules, so worker threads never wait for the network.
+
+A module registers a "provider" (an external service) and then, instead of
+querying the service directly in a handler, it submits a blocking function
+doing the query. The handler returns immediately, the function is run later by
+a pool of threads of the provider and the update requests it returns are sent
+back as a new task of the entity (via UpdateManager.update) as weak operations,
+so they never create a record (e.g. one deleted during the lookup).
+
+The lookups are scheduled by an asyncio event loop running in a separate thread,
+which enforces per-provider limits:
+- concurrency - max number of lookups running at once,
+- rate - max number of lookups started per second,
+- max_pending - max number of lookups waiting; new ones are dropped when reached
+  (they are usually repeated later by a periodic trigger anyway).
+Successful results are cached for 'cache_ttl' seconds and the same lookup is not
+submitted twice while it is waiting or running. Each provider also has a shared
+requests.Session (connection pool) for modules using HTTP.
+
+Parameters of each provider are read from 'lookups.providers.<name>.<param>'
+in the configuration, defaults for all providers from 'lookups.<param>' (see
+register_provider).
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+import requests
+import requests.adapters
+
+import g
+
+# Default values of provider parameters (if not set in config)
+DEFAULT_PARAMS = {
+    'concurrency': 4, # max number of lookups running at once
+    'rate': 0,        # max number of lookups started per second (0 = unlimited)
+    'cache_ttl': 3600, # time (in seconds) to cache successful results
+    'cache_size': 10000, # max number of cached results
+    'max_pending': 1000, # max number of lookups waiting or running
+}
+
+
+class Provider():
+    """State of one external service (limits, thread pool, cache, HTTP session)"""
+    def __init__(self, name, concurrency, rate, cache_ttl, cache_size, max_pending):
+        self.name = name
+        self.concurrency = concurrency
+        self.min_interval = 1.0 / rate if rate else 0.0
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.max_pending = max_pending
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(concurrency)
+        self.semaphore = None # created in the event loop thread (asyncio primitives are bound to a loop)
+        self.next_start = 0.0 # loop time when next lookup may be started (rate limiting)
+        self.cache = collections.OrderedDict() # cache_key -> (update_requests, expiration_time)
+        self.pending = set() # cache_keys of lookups waiting or running
+        self._session = None
+
+        # Metrics
+        self.submitted = 0
+        self.cache_hits = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def get_session(self):
+        """Return requests.Session shared by all lookups of the provider (created on first call)"""
+        if self._session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    async def wait_for_rate_limit(self, loop):
+        """Sleep until the next lookup may be started according to the rate limit"""
+        if not self.min_interval:
+            return
+        now = loop.time()
+        start = max(now, self.next_start)
+        self.next_start = start + self.min_interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class LookupExecutor():
+    """
+    Executor of lookups to external services submitted by modules.
+
+    Usage in a module:
+      __init__:  g.lookups.register_provider('myservice')
+      handler:   return g.lookups.submit('myservice', ekey, self.query_myservice, key)
+    where query_myservice(key) performs the (blocking) query and returns a list
+    of update requests of the entity, or None on error (result is not cached
+    then).
+    """
+    def __init__(self, config):
+        self.log = logging.getLogger("LookupExecutor")
+        #self.log.setLevel("DEBUG")
+        self.config = config
+        self._providers = {}
+        self._lock = threading.Lock() # protects caches and sets of pending lookups of all providers
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+
+    def register_provider(self, name, **defaults):
+        """
+        Register a provider (external service) of lookups.
+
+        Each parameter is taken from the first place where it's set:
+        - configuration of the provider ('lookups.providers.<name>.<param>'),
+        - keyword arguments (e.g. concurrency=1 for a service not allowing
+          parallel queries),
+        - common configuration of all providers ('lookups.<param>'),
+        - DEFAULT_PARAMS.
+        Return the Provider object.
+        """
+        params = {}
+        for param, default in DEFAULT_PARAMS.items():
+            if param in defaults:
+                default = defaults[param]
+            else:
+                default = self.config.get('lookups.' + param, default)
+            params[param] = self.config.get('lookups.providers.{}.{}'.format(name, param), default)
+        provider = Provider(name, **params)
+        self._providers[name] = provider
+        self.log.debug("Registered provider '{}' ({})".format(name, params))
+        return provider
+
+    def get_session(self, name):
+        """Return requests.Session (with a connection pool) shared by all lookups of given provider"""
+        return self._providers[name].get_session()
+
+    def submit(self, name, ekey, func, *args):
+        """
+        Submit a lookup to given provider.
+
+        func(*args) is called by a thread of the provider, it should return a
+        list of update requests (sent as a new task of entity 'ekey') or None
+        on error.
+
+        If there is a cached result of the same lookup (the same provider, ekey
+        and args), it is returned (so the handler can return it directly),
+        otherwise None is returned.
+        """
+        provider = self._providers[name]
+        cache_key = (ekey, args)
+        with self._lock:
+            cached = provider.cache.get(cache_key)
+            if cached is not None and cached[1] > time.time():
+                provider.cache_hits += 1
+                return cached[0]
+            if cache_key in provider.pending:
+                return None # the same lookup is already waiting or running
+            if len(provider.pending) >= provider.max_pending:
+                provider.dropped += 1
+                if provider.dropped % 1000 == 1:
+                    self.log.warning("Too many pending lookups to '{}', {} lookups dropped so far".format(name, provider.dropped))
+                return None
+            provider.pending.add(cache_key)
+            provider.submitted += 1
+        asyncio.run_coroutine_threadsafe(self._run_lookup(provider, ekey, cache_key, func, args), self._loop)
+        return None
+
+    async def _run_lookup(self, provider, ekey, cache_key, func, args):
+        """Run the lookup in a thread pool of the provider (respecting its limits), cache and send the result"""
+        if provider.semaphore is None:
+            provider.semaphore = asyncio.Semaphore(provider.concurrency)
+        result = None
+        try:
+            async with provider.semaphore:
+                await provider.wait_for_rate_limit(self._loop)
+                result = await self._loop.run_in_executor(provider.pool, func, *args)
+        except Exception as e:
+            provider.errors += 1
+            self.log.exception("Error in lookup to '{}' for {}: {}".format(provider.name, ekey, e))
+        finally:
+            with self._lock:
+                provider.pending.discard(cache_key)
+                if result is not None and provider.cache_ttl:
+                    provider.cache[cache_key] = (result, time.time() + provider.cache_ttl)
+                    provider.cache.move_to_end(cache_key)
+                    while len(provider.cache) > provider.cache_size:
+                        provider.cache.popitem(last=False)
+        if result:
+            # Send as weak operations - the record may have been deleted while the lookup was running
+            # and the result must not create it again
+            g.um.update(ekey, [(r[0] if r[0].startswith('*') else '*' + r[0],) + tuple(r[1:]) for r in result])
+
+    def get_stats(self):
+        """Return dict provider_name -> dict of metrics"""
+        with self._lock:
+            return {
+                name: {
+                    'submitted': p.submitted,
+                    'cache_hits': p.cache_hits,
+                    'dropped': p.dropped,
+                    'errors': p.errors,
+                    'pending': len(p.pending),
+                }
+                for name, p in self._providers.items()
+            }
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def start(self):
+        """Run the event loop thread"""
+        self.log.debug("Starting lookup executor ({} providers)".format(len(self._providers)))
+        self._thread = threading.Thread(target=self._run_loop, name="LookupExecutor")
+        self._thread.start()
+
+    def stop(self):
+        """Stop the event loop thread, pending lookups are discarded"""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        for provider in self._providers.values():
+            provider.pool.shutdown(wait=False)
+        for name, stats in self.get_stats().items():
+            self.log.info("Provider '{}': {submitted} lookups, {cache_hits} cache hits, {dropped} dropped, {errors} errors, "
+                          "{pending} pending at exit".format(name, **stats))
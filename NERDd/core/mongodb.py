@@ -9,12 +9,9 @@ import logging
 import pymongo
 from operator import itemgetter
 
+import common.mongo
 from common.utils import ipstr2int, int2ipstr
 
-# Defaults (may be overridden by config values mongodb.host, mongodb.port, mongodb.dbname)
-DEFAULT_MONGO_HOST = 'localhost:27017'
-DEFAULT_MONGO_DBNAME = 'nerd'
-
 class UnknownEntityType(ValueError):
     pass
 
@@ -25,31 +22,22 @@ class MongoEntityDatabase():
     # List of known/supported entity types - currently only IP addresses (both IPv4 and IPv6 are treated the same)
     _supportedTypes = ['ip', 'asn', 'bgppref', 'ipblock', 'org']
 
-    def __init__(self, config):
+    def __init__(self, config, role='worker'):
         """
         Connect to Mongo database.
+
+        Client options are taken from config according to the role (see common/mongo.py).
         """
         self.log = logging.getLogger("MongoDB")
-        host = config.get('mongodb.host', DEFAULT_MONGO_HOST)
-        rs = config.get('mongodb.rs', None)
-        dbname = config.get('mongodb.dbname', DEFAULT_MONGO_DBNAME)
-        if isinstance(host, list) and not rs: # Multiple hosts but no replica-set
-            assert rs is not None, "Replica-set name ('mongo.rs' parameter) must be set if multiple MongoDB hosts are specified."
-        if rs: # Replica-set
-            self.log.info("Connecting to MongoDB replica set '{}' at {} (DB '{}')".format(rs, host, dbname))
-            self._mongo_client = pymongo.MongoClient(host, replicaset=rs)
-            self._db = self._mongo_client[dbname]
-        else: # Standalone
-            self.log.info("Connecting to standalone MongoDB instance at {} (DB '{}')".format(host, dbname))
-            self._mongo_client = pymongo.MongoClient(host)
-            self._db = self._mongo_client[dbname]
-    
-    def __del__(self):
+        self._role = role
+        self._mongo_client = common.mongo.get_client(config, role)
+        self._db = common.mongo.get_database(config, role)
+
+    def get_pool_stats(self):
         """
-        Destructor. Close connection to database.
+        Return statistics of the connection pool (dict "host:port" -> counters, see common.mongo.pool_stats).
         """
-        self._mongo_client.close()
-    
+        return common.mongo.pool_stats(self._role)
 
     def getEntityTypes(self):
         """
@@ -138,6 +126,79 @@ class MongoEntityDatabase():
 
         self._db[etype].delete_one({'_id': key})
 
+    def get_many(self, etype, keys):
+        """
+        Return records of given entities as a dict key -> record (missing entities are not included).
+        """
+        if etype not in self._supportedTypes:
+            raise UnknownEntityType("There is no collection for entity type "+str(etype))
+        keys = list(keys)
+        if etype == 'ip':
+            keys = [ipstr2int(key) for key in keys]
+        result = {}
+        for record in self._db[etype].find({'_id': {'$in': keys}}):
+            if etype == 'ip':
+                record['_id'] = int2ipstr(record['_id'])
+            if 'hostname' in record and record['hostname'] is not None:
+                record['hostname'] = record['hostname'][::-1]
+            result[record['_id']] = record
+        return result
+
+    def put_many(self, etype, items):
+        """
+        Replace records of given entities (iterable of (key, record)) using one bulk write.
+        """
+        if etype not in self._supportedTypes:
+            raise UnknownEntityType("There is no collection for entity type "+str(etype))
+        requests = []
+        for key, record in items:
+            if etype == 'ip':
+                key = ipstr2int(key)
+                record['_id'] = ipstr2int(record['_id'])
+            if record and 'hostname' in record and record['hostname'] is not None:
+                record['hostname'] = record['hostname'][::-1]
+            requests.append(pymongo.ReplaceOne({'_id': key}, record, upsert=True))
+        if requests:
+            self._db[etype].bulk_write(requests, ordered=False)
+
+    def delete_many(self, etype, keys):
+        """
+        Delete given entities.
+        """
+        if etype not in self._supportedTypes:
+            raise UnknownEntityType("There is no collection for entity type "+str(etype))
+        keys = list(keys)
+        if etype == 'ip':
+            keys = [ipstr2int(key) for key in keys]
+        self._db[etype].delete_many({'_id': {'$in': keys}})
+
+    def update_many(self, etype, mongo_query, update):
+        """
+        Update all records matching given query directly in the database (by one update_many).
+
+        The records are NOT processed by NERDd worker, so no handlers are called, and the change may be lost if a
+        worker is just processing the same record (it writes the whole record back). Use only for attributes which no
+        handler depends on.
+
+        :param etype: entity type (str), e.g. 'ip'
+        :param mongo_query: query in pymongo format
+        :param update: update document in pymongo format (e.g. {'$pull': {...}})
+        :return: number of modified records
+        """
+        if etype not in self._supportedTypes:
+            raise UnknownEntityType("There is no collection for entity type " + str(etype))
+        return self._db[etype].update_many(mongo_query, update).modified_count
+
+    def create_index(self, etype, keys, **kwargs):
+        """
+        Create an index on the collection of given entity type (nothing is done if the same index already exists).
+
+        Parameters are passed to pymongo's Collection.create_index.
+        """
+        if etype not in self._supportedTypes:
+            raise UnknownEntityType("There is no collection for entity type " + str(etype))
+        return self._db[etype].create_index(keys, **kwargs)
+
     def aggregate(self, etype, mongo_query):
         """
         Aggregates all the records, which do meet certain condition (monqo query)
@@ -0,0 +1,111 @@
+"""
+NERD - dynamic assignment of entities to worker threads.
+
+The key space is split into a number of virtual partitions (by hash of the
+entity key), each partition is assigned to one worker thread. All tasks of an
+entity go to the thread owning its partition, so they are processed in order.
+
+Time spent processing tasks of each partition is measured and the partitions
+are periodically rebalanced - when the busiest thread has much more work than
+the least busy one, some of its partitions are moved. A partition is moved only
+if it has no task waiting or being processed (it is "drained"), so ordering of
+tasks of each entity is preserved.
+"""
+
+import threading
+
+
+class PartitionMap:
+    def __init__(self, num_partitions, num_threads, threshold=1.5):
+        """
+        :param num_partitions: Number of virtual partitions (should be much higher than number of threads)
+        :param num_threads: Number of worker threads
+        :param threshold: Rebalance only if load of the busiest thread is higher than threshold * average load
+        """
+        self.num_partitions = num_partitions
+        self.num_threads = num_threads
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._owner = [p % num_threads for p in range(num_partitions)] # partition -> thread index
+        self._pending = [0] * num_partitions # number of tasks of the partition waiting or being processed
+        self._time = [0.0] * num_partitions # processing time since the last rebalancing
+        self._time_total = [0.0] * num_partitions # processing time since the last call of get_stats()
+        self._tasks_total = [0] * num_partitions
+        self._migrations = 0
+
+    def partition(self, etype, eid):
+        return hash((etype, eid)) % self.num_partitions
+
+    def assign(self, etype, eid):
+        """Return (partition, thread index) for a new task of given entity, the task is counted as pending."""
+        p = self.partition(etype, eid)
+        with self._lock:
+            self._pending[p] += 1
+            return p, self._owner[p]
+
+    def done(self, partition, n_tasks, duration):
+        """Mark n_tasks tasks of the partition as processed (in given time)."""
+        with self._lock:
+            self._pending[partition] -= n_tasks
+            self._time[partition] += duration
+            self._tasks_total[partition] += n_tasks
+
+    def rebalance(self):
+        """
+        Move drained partitions from the busiest threads to the least busy ones (according to processing time since
+        the last call). Return list of moves (partition, from thread, to thread).
+        """
+        moves = []
+        with self._lock:
+            times = self._time
+            self._time = [0.0] * self.num_partitions
+            for p, t in enumerate(times):
+                self._time_total[p] += t
+            loads = [0.0] * self.num_threads
+            for p, t in enumerate(times):
+                loads[self._owner[p]] += t
+            avg = sum(loads) / self.num_threads
+            if avg == 0:
+                return moves
+            while True:
+                busiest = max(range(self.num_threads), key=loads.__getitem__)
+                idlest = min(range(self.num_threads), key=loads.__getitem__)
+                if loads[busiest] <= self.threshold * avg:
+                    break
+                # Move the heaviest drained partition which makes the two threads more balanced
+                gap = loads[busiest] - loads[idlest]
+                candidates = [p for p in range(self.num_partitions)
+                              if self._owner[p] == busiest and self._pending[p] == 0 and 0 < times[p] < gap]
+                if not candidates:
+                    break
+                p = max(candidates, key=times.__getitem__)
+                self._owner[p] = idlest
+                loads[busiest] -= times[p]
+                loads[idlest] += times[p]
+                moves.append((p, busiest, idlest))
+            self._migrations += len(moves)
+        return moves
+
+    def get_stats(self, top=5):
+        """
+        Return statistics since the last call: dict with processing time per thread, the hottest partitions
+        (list of (partition, share of total processing time, number of tasks)) and number of migrations.
+        (Processing time is counted at rebalancing, i.e. time since the last rebalancing isn't included yet.)
+        """
+        with self._lock:
+            times = self._time_total
+            tasks = self._tasks_total
+            thread_times = [0.0] * self.num_threads
+            for p, t in enumerate(times):
+                thread_times[self._owner[p]] += t
+            migrations = self._migrations
+            self._time_total = [0.0] * self.num_partitions
+            self._tasks_total = [0] * self.num_partitions
+            self._migrations = 0
+        total = sum(times) or 1.0
+        hottest = sorted(range(self.num_partitions), key=lambda p: -times[p])[:top]
+        return {
+            'thread_times': thread_times,
+            'hottest': [(p, times[p] / total, tasks[p]) for p in hottest if times[p] > 0],
+            'migrations': migrations,
+        }
@@ -0,0 +1,120 @@
+"""
+NERD - statistics of task processing in UpdateManager.
+
+Each worker thread records into its own TaskStats object (so no locking is
+needed), UpdateManager merges them periodically into per-process statistics:
+  - latency histogram of each handler function
+  - latency histograms of loading and storing records (DB get/put)
+  - histograms of time tasks waited in the thread's queue and of the total time of tasks
+  - number of tasks received (more tasks of the same entity may be merged and processed at once)
+  - number of handler calls and repeated calls of the same handler per task
+
+Histograms have fixed (logarithmic) buckets, so adding a value is just a
+bisection and an increment.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict, Counter
+
+# Upper bounds of histogram buckets (in seconds), the last bucket is for everything above
+BUCKET_BOUNDS = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0)
+
+
+class Histogram:
+    """Histogram of durations (in seconds) with fixed buckets (BUCKET_BOUNDS)"""
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, t):
+        self.counts[bisect_left(BUCKET_BOUNDS, t)] += 1
+        self.total += t
+        if t > self.max:
+            self.max = t
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        """Return upper bound of the bucket containing p-th percentile (max value for the last bucket)"""
+        n = self.count
+        if n == 0:
+            return 0.0
+        threshold = n * p / 100
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= threshold:
+                return BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self):
+        n = self.count
+        return {
+            'count': n,
+            'total': self.total,
+            'avg': self.total / n if n else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'buckets': self.counts,
+        }
+
+
+class TaskStats:
+    """Statistics of tasks processed by one worker thread (or merged from more threads)"""
+
+    def __init__(self):
+        self.handlers = defaultdict(Histogram) # handler function -> latency histogram
+        self.db_get = Histogram()
+        self.db_put = Histogram()
+        self.queue_wait = Histogram()
+        self.task = Histogram()
+        self.received = 0
+        self.iterations = Counter() # number of handler calls -> number of tasks
+        self.repeated_calls = Counter() # number of repeated calls of a handler -> number of tasks
+        self.slow_tasks = 0
+
+    def merge(self, other):
+        for func, hist in list(other.handlers.items()):
+            self.handlers[func].merge(hist)
+        self.db_get.merge(other.db_get)
+        self.db_put.merge(other.db_put)
+        self.queue_wait.merge(other.queue_wait)
+        self.task.merge(other.task)
+        self.received += other.received
+        self.iterations.update(other.iterations)
+        self.repeated_calls.update(other.repeated_calls)
+        self.slow_tasks += other.slow_tasks
+
+    def to_dict(self, func_name):
+        """Return statistics as a dict (serializable to JSON), handler functions are converted by func_name()"""
+        n_tasks = sum(self.iterations.values())
+        return {
+            'tasks': self.task.to_dict(),
+            'tasks_received': self.received,
+            'merge_ratio': self.received / self.task.count if self.task.count else 0.0,
+            'slow_tasks': self.slow_tasks,
+            'queue_wait': self.queue_wait.to_dict(),
+            'db_get': self.db_get.to_dict(),
+            'db_put': self.db_put.to_dict(),
+            'iterations': {
+                'avg': sum(k * v for k, v in self.iterations.items()) / n_tasks if n_tasks else 0.0,
+                'max': max(self.iterations, default=0),
+            },
+            'repeated_calls': {
+                'avg': sum(k * v for k, v in self.repeated_calls.items()) / n_tasks if n_tasks else 0.0,
+                'max': max(self.repeated_calls, default=0),
+            },
+            'handlers': {func_name(func): hist.to_dict() for func, hist in self.handlers.items()},
+        }
@@ -6,17 +6,23 @@ records, including chain reaction of updates caused by other updates.
 """
 # TODO: split this class into two separate classes
 #  - "task distribution" and "performing tasks (doing changes, calling callbacks, etc.)"
-import sys
 import os
 import threading
-import queue
 from datetime import datetime
 import time
-from collections import deque, Iterable, OrderedDict, Counter
+from collections.abc import Iterable
 import logging
+import json
+import heapq
+from contextlib import contextmanager
 
 import g
-import core.scheduler
+from core.task_stats import TaskStats
+from core.entity_queue import EntityTaskQueue
+from core.partitions import PartitionMap
+from core.delta_counters import DeltaCounters
+from core.array_index import ArrayIndex
+from core.update_ops import compile_op
 from common.task_queue import TaskQueueReader, TaskQueueWriter
 
 ENTITY_TYPES = ['ip', 'asn', 'bgppref', 'ipblock', 'org']
@@ -37,7 +43,9 @@ ENTITY_TYPES = ['ip', 'asn', 'bgppref', 'ipblock', 'org']
 #      - ('array_update', key, query, actions) - apply given actions to specified array item under key, see below for details.
 #      - ('array_upsert', key, query, actions) - apply given actions to specified array item under key (insert new item if no one matches), see below for details.
 #      - ('array_remove', key, query) - remove array item satisfying given query (do nothing if no one matches).
+#      - ('array_remove_many', key, query) - remove all array items satisfying given query, which may contain comparison operators, e.g. {'date': {'$lt': '2020-01-01'}} (see core/array_index.py:match_item)
 #      - ('event', !name)    - do nothing with record, only trigger functions hooked on the event name
+#  Operations are implemented in core/update_ops.py (perform_update).
 #  The tuple is passed to functions watching for updates of given keys / events
 #  with given name. Event names must begin with '!' (attribute keys mustn't).
 #  Update manager performs the requested update and calls functions hooked on 
@@ -80,154 +88,119 @@ def get_func_name(func_or_method):
 
 
 
-def perform_update(rec, updreq):
+class HandlerPlan:
     """
-    Update a record according to given update request.
-    
-    updreq - n-tuple (op, key, params...)
-    
-    Return array with specifications of performed updates - pairs (updated_key,
-    new_value) or None.
-    (None is returned when nothing was changed, e.g. because op=add_to_set and
-    value was already present, or removal of non-existent item was requested)
+    Handler functions of one entity type compiled into the order in which they are called.
+
+    Function A must be called before function B if A may change an attribute which triggers B (directly or
+    transitively), since B should see the final values. Functions are therefore numbered in a topological order
+    of this dependency graph (independent functions in the order of registration), and when processing a task,
+    the triggered function with the lowest number is always called first.
+
+    Attributes:
+    funcs -- list of functions in the order (index = rank)
+    rank -- function -> rank
+    attr2func -- attribute/event -> list of functions it triggers (snapshot from the time of compilation)
+    may_change -- attribute/event -> set of attributes that may be changed by a chain reaction of its update
+    cycles -- list of lists of functions which depend on each other in a cycle (these are called in registration order)
+    max_calls -- max number of handler calls per task (protection against endless loops)
     """
-    op = updreq[0]
-    key = updreq[1]
-    
-    # Process keys with hierarchy, i.e. containing dots (like "events.scan.count")
-    # rec will be the inner-most subobject ("events.scan"), key the last attribute ("count")
-    # If path doesn't exist in the hierarchy, it's created
-    while '.' in key:
-        first_key, key = key.split('.',1)
-        if first_key.isdecimal(): # index of array
-            rec = rec[int(first_key)]
-        else: # key of object/dict
-            if first_key not in rec:
-                rec[first_key] = {}
-            rec = rec[first_key]
-    
-    if op == 'set':
-        rec[key] = updreq[2]
-    
-    elif op == 'append':
-        if key not in rec:
-            rec[key] = [updreq[2]]
-        else:
-            rec[key].append(updreq[2])
-
-    elif op == 'add_to_set':
-        value = updreq[2]
-        if key not in rec:
-            rec[key] = [value]
-        elif value not in rec[key]:
-            rec[key].append(value)
-        else:
-            return None
-    
-    elif op == 'extend_set':
-        value = updreq[2]
-        if key not in rec:
-            rec[key] = list(value)
-        else:
-            changed = False
-            for val in value:
-                if val not in rec[key]:
-                    rec[key].append(val)
-                    changed = True
-            if not changed:
-                return None
-
-    elif op == 'rem_from_set':
-        if key in rec:
-            rec[key] = list(set(rec[key]) - set(updreq[2]))
-
-    elif op == 'add':
-        if key not in rec:
-            rec[key] = updreq[2]
-        else:
-            rec[key] += updreq[2]
-    
-    elif op == 'sub':
-        if key not in rec:
-            rec[key] = -updreq[2]
-        else:
-            rec[key] -= updreq[2]
-    
-    elif op == 'setmax':
-        if key not in rec:
-            rec[key] = updreq[2]
-        else:
-            rec[key] = max(updreq[2], rec[key])
-    
-    elif op == 'setmin':
-        if key not in rec:
-            rec[key] = updreq[2]
-        else:
-            rec[key] = min(updreq[2], rec[key])
-    
-    elif op == 'remove':
-        if key in rec:
-            del rec[key]
-            return [(updreq[1], None)]
-        return None
-    
-    elif op == 'next_step':
-        key_base = updreq[2]
-        minimum = updreq[3]
-        step = updreq[4]
-        base = rec[key_base]
-        rec[key] = base + ((minimum - base) // step + 1) * step
-    
-    elif op == 'array_update' or op == 'array_upsert':
-        query = updreq[2]
-        actions = updreq[3]
-        if key not in rec:
-            if op == 'array_upsert':
-                rec[key] = []
-            else:
-                return None # Array doesn't exist and insert not requested
-        array = rec[key]
-        # Find the matching item in the array
-        for i,item in enumerate(array):
-            if all(item[a] == v for a,v in query.items()):
-                break
-        else:
-            if op == 'array_upsert':
-                i = len(array)
-                item = query
-                array.append(query)
-            else:
-                return None # No matching element found and insert not requested
-        # Now, "item" is the selected array item ("i" its index), apply all actions to it
-        updates_performed = []
-        for action in actions:
-            upds = perform_update(item, action) # recursion
-            # List of all actions must be returned, convert relative keys to absolute
-            for inner_key, new_val in upds:
-                updates_performed.append((key + '[' + str(i) + '].' + inner_key, new_val))
-        return updates_performed
-    
-    elif op == 'array_remove':
-        query = updreq[2]
-        if key not in rec:
-            return None
-        array = rec[key]
-        # Find the matching item in the array
-        for i,item in enumerate(array):
-            if all(item[a] == v for a,v in query.items()):
-                break
-        else:
-            return None
-        # Remove it
-        del array[i]
-        return [(key + '[' + str(i) + ']', None)]
-    
-    else:
-        print("ERROR: perform_update: Unknown operation {}".format(op), file=sys.stderr)
-        return None
-    
-    # Return tuple (updated attribute, new value)
-    return [(updreq[1], rec[key])] 
+    def __init__(self, attr2func, func2attr, func_triggers, func_order):
+        self.attr2func = dict(attr2func) # (lists are replaced on registration, not modified, so shallow copy is enough)
+        funcs = sorted(func_triggers, key=func_order.__getitem__)
+
+        # Dependency graph: function -> functions triggered by attributes it may change
+        successors = {}
+        for func in funcs:
+            succ = set()
+            for attr in func2attr[func]:
+                succ.update(attr2func.get(attr, ()))
+            succ.discard(func) # (a function changing its own trigger doesn't trigger itself)
+            successors[func] = succ
+
+        # Kahn's algorithm, ties broken by registration order
+        in_degree = {func: 0 for func in funcs}
+        for succ in successors.values():
+            for func in succ:
+                in_degree[func] += 1
+        position = {func: i for i, func in enumerate(funcs)} # (functions themselves aren't comparable)
+        heap = [(func_order[func], position[func], func) for func in funcs if in_degree[func] == 0]
+        heapq.heapify(heap)
+        ordered = []
+        while heap:
+            _, _, func = heapq.heappop(heap)
+            ordered.append(func)
+            for succ in successors[func]:
+                in_degree[succ] -= 1
+                if in_degree[succ] == 0:
+                    heapq.heappush(heap, (func_order[succ], position[succ], succ))
+        # Functions left are in cycles (or depend on a cycle)
+        remaining = [func for func in funcs if in_degree[func] > 0]
+        self.cycles = self._find_cycles(remaining, successors)
+        self.funcs = ordered + remaining
+        self.rank = {func: i for i, func in enumerate(self.funcs)}
+        self.max_calls = max(20, 2 * len(self.funcs))
+
+        # Transitive closure of possible changes for each attribute/event
+        self.may_change = {}
+        for attr in attr2func:
+            may_change = set()
+            visited = set()
+            funcs_to_call = set(attr2func[attr])
+            while funcs_to_call:
+                func = funcs_to_call.pop()
+                visited.add(func)
+                may_change.update(func2attr[func])
+                for changed in func2attr[func]:
+                    funcs_to_call.update(f for f in attr2func.get(changed, ()) if f not in visited)
+            self.may_change[attr] = frozenset(may_change)
+
+    @staticmethod
+    def _find_cycles(funcs, successors):
+        """Return strongly connected components with more than one function (Tarjan's algorithm, iterative)"""
+        nodes = set(funcs)
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+        counter = 0
+        for root in funcs:
+            if root in index:
+                continue
+            work = [(root, iter(successors[root] & nodes))]
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, it = work[-1]
+                for succ in it:
+                    if succ not in index:
+                        index[succ] = lowlink[succ] = counter
+                        counter += 1
+                        stack.append(succ)
+                        on_stack.add(succ)
+                        work.append((succ, iter(successors[succ] & nodes)))
+                        break
+                    elif succ in on_stack:
+                        lowlink[node] = min(lowlink[node], index[succ])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member is node:
+                                break
+                        if len(component) > 1:
+                            cycles.append(component)
+        return cycles
 
 
 class UpdateManager:
@@ -275,6 +248,16 @@ class UpdateManager:
         # Mapping of functions to set of attributes the function watches, i.e.
         # is called when the attribute is changed
         self._func_triggers = {etype: {} for etype in ENTITY_TYPES}
+
+        # Order of handler functions: function -> (rank of registering module, sequence number)
+        # (modules may be initialized in parallel, handlers are kept sorted by the order of modules anyway)
+        self._func_order = {}
+        self._registration_seq = 0
+        self._registration_lock = threading.Lock()
+        self._registration_rank = threading.local()
+
+        # Compiled handler plans (etype -> HandlerPlan), created on first use after (each) registration of handlers
+        self._plans = {}
         
         # List of worker threads for processing the update requests
         self._worker_threads = []
@@ -282,14 +265,30 @@ class UpdateManager:
 
         # Internal queues for each worker
         # TODO - rozhodnout jak velké maxsize by to mělo být (a jestli je to vůbec nutné, možná není, pokud bude na úrovni RMQ omezen počet nepotvrzených zpráv)
-        self._queues = [queue.Queue(10) for _ in range(self.num_threads)]
+        # Tasks of the same entity waiting in a queue are merged and processed together (see core/entity_queue.py)
+        self._queues = [EntityTaskQueue(10) for _ in range(self.num_threads)]
+
+        # Entities are assigned to threads by virtual partitions, which are moved between threads according to their
+        # load (so a few heavy entities don't overload one thread while others are idle), see core/partitions.py
+        self._partitions = PartitionMap(g.config.get('worker_partitions', 256), self.num_threads,
+                                        g.config.get('rebalance_threshold', 1.5))
+        g.scheduler.register(self._rebalance, second="*/10")
 
         # Connections to main task queue
         # Reader - reads tasks from a pair of queues (one pair per process) and distributes them to worker threads
-        self._task_queue_reader = TaskQueueReader(self._distribute_task, self.process_index, self.rabbit_params)
+        # (number of messages received but not acknowledged yet is limited, so tasks don't pile up in local buffers;
+        # by default 4 per worker thread, since tasks are acknowledged as soon as a worker thread takes them)
+        self._task_queue_reader = TaskQueueReader(self._distribute_task, self.process_index, self.rabbit_params,
+                                                  prefetch_count=self.rabbit_params.get('prefetch_count', 4 * self.num_threads),
+                                                  ack_interval=self.rabbit_params.get('ack_interval', 0.1))
         # Writer - allows modules to write new tasks
         self._task_queue_writer = TaskQueueWriter(self.num_processes, self.rabbit_params)
 
+        # Counters changed very often (e.g. reference counters) - changes are accumulated and sent as one task per
+        # record every few seconds (see core/delta_counters.py)
+        self.counters = DeltaCounters(self.update)
+        g.scheduler.register(self.counters.flush, second="*/{}".format(config.get('counters_flush_interval', 5)))
+
         # Object to store thread-local data (e.g. worker-thread index) (each thread sees different object contents)
         self._current_thread_data = threading.local()
 
@@ -302,9 +301,16 @@ class UpdateManager:
         self.elog_op = g.ecl.get_group("rec_ops", True) # True = return DummyEventGroup if there's no configuration for given group name
         self.elog_by_src = g.ecl.get_group("tasks_by_src", True)
 
-        # This is here for performance debugging - measuring the time spent in each handler function
-#        self.t_handlers = Counter()
-#        self.logging_scheduler.register(self.log_t_handlers, second="*/60")
+        # Statistics of task processing (handler latencies, DB access times, queue wait, ...), one object per worker
+        # thread, merged and exported every minute (see core/task_stats.py)
+        self._stats = [TaskStats() for _ in range(self.num_threads)]
+        self._stats_start = time.time()
+        self.stats_file = config.get('um_stats.file', None) # JSON file with statistics of the last minute ("{}" is replaced by process index)
+        self.stats_log_top = config.get('um_stats.log_top', 10) # number of slowest handlers to log
+        # Tasks taking longer than this (seconds) are logged with the full chain of handler calls
+        self.slow_task_threshold = config.get('um_stats.slow_task_threshold', 1.0)
+        self.elog_handlers = g.ecl.get_group("handler_calls", True)
+        g.scheduler.register(self._export_stats, second=0)
 
 
     def register_handler(self, func, etype, triggers, changes):
@@ -334,13 +340,52 @@ class UpdateManager:
         if changes is not None and (not isinstance(changes, Iterable) or isinstance(changes, str)):
             raise TypeError('Argument "changes" must be iterable and must not be str.')
         
-        self._func2attr[etype][func] = tuple(changes) if changes is not None else ()
-        self._func_triggers[etype][func] = set(triggers)
-        for attr in triggers:
-            if attr in self._attr2func[etype]:
-                self._attr2func[etype][attr].append(func)
-            else:
-                self._attr2func[etype][attr] = [func]
+        with self._registration_lock:
+            self._registration_seq += 1
+            order = (getattr(self._registration_rank, 'rank', float('inf')), self._registration_seq)
+            self._func_order[func] = order
+            self._func2attr[etype][func] = tuple(changes) if changes is not None else ()
+            self._func_triggers[etype][func] = set(triggers)
+            for attr in triggers:
+                # Lists are replaced, not modified in place, since handlers may be registered while worker threads
+                # are already processing tasks (by a module with slow initialization)
+                funcs = self._attr2func[etype].get(attr, []) + [func]
+                funcs.sort(key=self._func_order.__getitem__)
+                self._attr2func[etype][attr] = funcs
+            # Plans must be recompiled
+            self._plans = {}
+
+    def _get_plan(self, etype):
+        """
+        Return HandlerPlan of given entity type (compile it if handlers changed since the last call).
+        """
+        plan = self._plans.get(etype)
+        if plan is None:
+            with self._registration_lock:
+                plan = self._plans.get(etype)
+                if plan is None:
+                    plan = HandlerPlan(self._attr2func[etype], self._func2attr[etype], self._func_triggers[etype],
+                                       self._func_order)
+                    for cycle in plan.cycles:
+                        self.log.warning("Cycle in dependencies of '{}' handlers (they may be called repeatedly or see "
+                                         "outdated values): {}".format(etype, ", ".join(map(get_func_name, cycle))))
+                    self._plans[etype] = plan
+        return plan
+
+    @contextmanager
+    def registration_order(self, rank):
+        """
+        Context manager setting the rank of a module for handlers registered within it (in the current thread).
+
+        Handlers hooked to the same attribute are called in the order of ranks of their modules (and in order of
+        registration within a module), regardless of the order in which modules were initialized. Handlers registered
+        outside of this context are put after all others.
+        """
+        self._registration_rank.rank = rank
+        try:
+            yield
+        finally:
+            del self._registration_rank.rank
 
 
     def update(self, ekey, update_requests): # TODO: rename to "request update"
@@ -362,6 +407,10 @@ class UpdateManager:
 
     def start(self):
         """Run the worker threads and start consuming from TaskQueue."""
+        # Compile handler plans now (so dependency cycles are reported at start-up)
+        for etype in ENTITY_TYPES:
+            self._get_plan(etype)
+
         self.log.info("Connecting to RabbitMQ")
         self._task_queue_reader.connect()
         self._task_queue_writer.connect()
@@ -396,6 +445,9 @@ class UpdateManager:
         for worker in self._worker_threads:
             worker.join()
 
+        # Send the remaining changes of counters
+        self.counters.flush()
+
         self._task_queue_reader.disconnect()
         self._task_queue_writer.disconnect()
 
@@ -414,9 +466,16 @@ class UpdateManager:
         :param eid: entity identifier (e.g. '1.2.3.4', 2852)
         :param updreq: list of update requests (n-tuples)
         """
-        # Distribute tasks to worker threads by hash of (etype,ekey)
-        index = hash((etype, eid)) % self.num_threads
-        self._queues[index].put((msg_id, etype, eid, updreq, src))
+        # Distribute tasks to worker threads by partition of (etype,ekey)
+        _, index = self._partitions.assign(etype, eid)
+        self._queues[index].put(msg_id, etype, eid, updreq, src)
+
+
+    def _rebalance(self):
+        """Move partitions from overloaded worker threads to less loaded ones (called by scheduler)."""
+        moves = self._partitions.rebalance()
+        if moves:
+            self.log.debug("Partitions moved (partition, from thread, to thread): {}".format(moves))
 
 
     def _worker_func(self, thread_index):
@@ -426,10 +485,11 @@ class UpdateManager:
         Run as a separate thread. Read its local task queue and calls
         "_process_task" function to process each task.
 
-        Tasks are assigned to workers based on hash of entity key, so each
-        entity is always processed by the same worker. Therefore, all requests
-        modifying a particular entity are done sequentially and no locking is
-        necessary.
+        Tasks are assigned to workers based on partition of entity key, so each
+        entity is always processed by the same worker (a partition is moved to
+        another worker only when it has no tasks waiting). Therefore, all
+        requests modifying a particular entity are done sequentially and no
+        locking is necessary.
         """
         # Store index to thread-local variable
         self._current_thread_data.index = thread_index
@@ -440,36 +500,43 @@ class UpdateManager:
         # Exit immediately after self.running is set to False, it's not a problem if there are any more tasks waiting
         # in the queue - they won't be acknowledged so they will be re-delivered after restart.
         while self.running:
-            # Get message from thread's local queue
-            try:
-                task = my_queue.get(block=True, timeout=1)
-            except queue.Empty:
+            # Get (merged) task from thread's local queue
+            task = my_queue.get(timeout=1)
+            if task is None:
                 continue # check self.running again
 
-            msg_id, etype, eid, updreq, src = task
-
-            self.elog_by_src.log(src)
+            etype, eid = task.etype, task.eid
+            stats = self._stats[thread_index]
+            t_start = time.perf_counter()
+            stats.queue_wait.add(t_start - task.t_enqueued)
+            stats.received += task.n_tasks
 
-            # Acknowledge receipt of the task (regardless of success/failre of its processing)
-            self._task_queue_reader.ack(msg_id)
+            for src in task.srcs:
+                self.elog_by_src.log(src)
 
-            # FIXME: (TEMPORARY) Quick fix to check IP address (should be fixed in MISP receiver, which sometimes sends prefixes instead of IP addresses)
-            if etype == "ip" and "/" in eid:
-                self.log.error("Prefix instead of IP, skipping task: {}".format(task))
-                continue
+            # Acknowledge receipt of the task(s) (regardless of success/failre of its processing)
+            for msg_id in task.msg_ids:
+                self._task_queue_reader.ack(msg_id)
 
-            # Process the task
-            # self.log.debug("Processing task {}: {}/{} {}".format(msg_id, etype, eid, updreq))
-            start_time = datetime.now()
             try:
-                created = self._process_update_req(etype, eid, updreq.copy())
-            except Exception:
-                self.log.error("Error has occurred during processing task: {}".format(task))
-                raise
-            duration = (datetime.now() - start_time).total_seconds()
-            #self.log.debug("Task {} finished in {:.3f} seconds.".format(msg_id, duration))
-            if duration > 1.0:
-                self.log.debug("Task {} took {} seconds: {}/{} {}{}".format(msg_id, duration, etype, eid, updreq, " (new record created)" if created else ""))
+                # FIXME: (TEMPORARY) Quick fix to check IP address (should be fixed in MISP receiver, which sometimes sends prefixes instead of IP addresses)
+                if etype == "ip" and "/" in eid:
+                    self.log.error("Prefix instead of IP, skipping task: {}/{} {}".format(etype, eid, task.batches))
+                    continue
+
+                # Process the task (usually there's just one batch of requests, see core/entity_queue.py)
+                # self.log.debug("Processing task {}: {}/{} {}".format(task.msg_ids, etype, eid, task.batches))
+                for updreq in task.batches:
+                    try:
+                        self._process_update_req(etype, eid, updreq, stats)
+                    except Exception:
+                        self.log.error("Error has occurred during processing task: {}/{} {}".format(etype, eid, updreq))
+                        raise
+            finally:
+                duration = time.perf_counter() - t_start
+                stats.task.add(duration)
+                # (the partition may be moved to another thread once all its tasks are done)
+                self._partitions.done(self._partitions.partition(etype, eid), task.n_tasks, duration)
 
 
     def _watchdog(self):
@@ -518,29 +585,15 @@ class UpdateManager:
 
     # ############### Task processing functions ###############
 
-    # TODO cache results (clear cache when register_handler is called)
     def get_all_possible_changes(self, etype, attr):
         """
         Returns all attributes (as a set) that may be changed by a "chain reaction"
         of changes triggered by update of given attribute (or event).
-        
-        Warning: There must be no loops in the sequence of attributes and  
-        triggered functions.
         """
-        may_change = set() # Attributes that may be changed
-        funcs_to_call = set(self._attr2func[etype].get(attr, ()))
-        f2a = self._func2attr[etype]
-        a2f = self._attr2func[etype]
-        while funcs_to_call:
-            func = funcs_to_call.pop()
-            attrs_to_change = f2a[func]
-            may_change.update(attrs_to_change)
-            for attr in attrs_to_change:
-                funcs_to_call |= set(a2f.get(attr, ()))
-        return may_change
+        return self._get_plan(etype).may_change.get(attr, frozenset())
     
     
-    def _process_update_req(self, etype, eid, update_requests):
+    def _process_update_req(self, etype, eid, update_requests, stats=None):
         """
         Main processing function - update attributes or trigger an event.
         
@@ -548,35 +601,41 @@ class UpdateManager:
         etype - entity type 
         eid - entity ID
         update_requests - list of n-tuples as described above
+        stats - TaskStats object to record statistics to (optional)
         
         Return True if a new record was created, False otherwise.
         """ 
         # Load record corresponding to the key from database.
         # If record doesn't exist, create new.
         # Also create associated auxiliary objects:
-        #   call_queue - queue of functions that should be called to update the record.
-        #     queue.Queue of tuples (function, list_of_update_spec), where list_of_update_spec is a list of
-        #     updates (2-tuples (key, new_value) or (event, param) which triggered the function.
-        #   may_change - set of attributes that may be changed by planned function calls
-
-#        t1 = time.time()
+        #   pending - functions that should be called to update the record, dict function -> list_of_update_spec,
+        #     where list_of_update_spec is a list of updates (2-tuples (key, new_value) or (event, param) which
+        #     triggered the function.
+        #   pending_ranks - heap of ranks of pending functions (in HandlerPlan), the lowest one is called first, so
+        #     each function is called after all functions which may change its triggers
+
+        if stats is None:
+            stats = TaskStats() # (statistics are thrown away)
+        t1 = time.perf_counter()
+        # Calls of handlers (function, duration, triggering updates, number of returned requests) for logging of slow tasks
+        call_chain = []
+        orig_requests = update_requests
+
+        # Compile requests (op, key) into UpdateOps (cached, see core/update_ops.py), so they are interpreted only once
+        # Requests to process are kept as pairs (UpdateOp, update request)
+        requests_to_process = [(compile_op(updreq[0], updreq[1]), updreq) for updreq in update_requests]
 
         # Check whether a new record should not be created in case every operation is 'weak' (starts with '*')
-        weak_op = True
-        for ndx, updreq in enumerate(update_requests):
-            op = updreq[0]
-            if op[0] != '*':
-                weak_op = False
-            else:
-                # Remove starting symbol '*'
-                update_requests[ndx] = [updreq[0][1:]] + updreq[1:] # first item without first char + all other items
+        weak_op = all(compiled.weak for compiled, _ in requests_to_process)
 
         # Fetch the record from database or create a new one
         new_rec_created = False
         rec = self.db.get(etype, eid)
+        t_load = time.perf_counter() - t1
+        stats.db_get.add(t_load)
         if rec is None:
             if weak_op:
-                update_requests.clear()
+                requests_to_process.clear()
                 self.log.debug("Received only weak operations for non-existent entity {} of type {}. Aborting record creation.".format(etype, eid))
             else:
                 now = datetime.utcnow()
@@ -588,42 +647,39 @@ class UpdateManager:
                 new_rec_created = True
                 # New record was created -> add "!NEW" event to update_request
                 #self.log.debug("New record ({},{}) was created, injecting event '!NEW'".format(etype,eid))
-                update_requests.insert(0,('event','!NEW'))
+                requests_to_process.insert(0, (compile_op('event', '!NEW'), ('event','!NEW')))
                 self.elog_op.log(etype+'_created')
         
         # Short-circuit if update_requests is empty (used to only create a record if it doesn't exist)
-        if not update_requests:
+        if not requests_to_process:
             self.elog_op.log(etype+'_noop') # task with no operations or only weak operations and the record doesn't exist
             return False
         
-        requests_to_process = update_requests
-        
-#        t2 = time.time()
-#        t_handlers = {}
-        
         # *** Now we have the record, process the requested updates ***
         
         # auxiliary objects
-        call_queue = deque() # planned calls of handler functions due to their hooking to attribute updates  
-        may_change = set() # which attributes may change after performing all calls in call_queue
+        plan = self._get_plan(etype)
+        attr2func = plan.attr2func
+        pending = {}
+        pending_ranks = []
+        called = set()
+        array_index = ArrayIndex() # indexes of large arrays in the record (e.g. events), see core/array_index.py
         
-        loop_counter = 0 # counter used to stop when looping too long - probably some cycle in attribute dependencies
+        n_calls = 0 # counter used to stop when looping too long - probably some cycle in attribute dependencies
+        repeated_calls = 0 # number of calls of functions which were already called within this task
         
         deletion = False
-        # *** call_queue loop ***
+        # *** pending calls loop ***
         while True:
             # *** If any update requests are pending, process them ***
-            # (i.e. perform requested changes, add calls to hooked functions to
-            # the call_queue and update the set of attributes that may change)
+            # (i.e. perform requested changes and add calls to hooked functions to pending calls)
             if requests_to_process:
-                # Process update requests (perform updates, put hooked functions to call_queue and update may_change set)
                 #self.log.debug("UpdateManager: New update requests for ({},{}): {}".format(etype, eid, requests_to_process))
-                for updreq in requests_to_process:
-                    op = updreq[0]
-                    attr = updreq[1]
-                    assert(op != 'event' or attr[0] == '!') # if op=event, attr must begin with '!'
+                for compiled, updreq in requests_to_process:
+                    attr = compiled.key
+                    assert(not compiled.is_event or attr[0] == '!') # if op=event, attr must begin with '!'
                     
-                    if op == 'event':
+                    if compiled.is_event:
                         #self.log.debug("Initial update: Event ({}:{}).{} (param={})".format(etype,eid,attr,val))
                         updated = [(attr, None)]
 
@@ -631,69 +687,53 @@ class UpdateManager:
                         if attr == '!DELETE':
                             deletion = True
                             requests_to_process.clear()
-                            call_queue.clear()
-                            for func in self._attr2func[etype].get(attr, []):
-                                call_queue.append((func, updated))
+                            pending.clear()
+                            pending_ranks.clear()
+                            for func in attr2func.get(attr, []):
+                                pending[func] = list(updated)
+                                heapq.heappush(pending_ranks, plan.rank[func])
                             break
                     else:
                         #self.log.debug("Initial update: Attribute update: ({}:{}).{} [{}] {}".format(etype,eid,attr,op,val))
-                        updated = perform_update(rec, updreq)
+                        updated = compiled.apply(rec, updreq, array_index)
                         if not updated:
                             #self.log.debug("Attribute value wasn't changed.")
                             continue
                     
-                    # Add to the call_queue all functions directly hooked to the attribute/event
-                    for func in self._attr2func[etype].get(attr, []):
-                        # If the function is already in the queue...
-                        for f,updates in call_queue:
-                            if f == func:
-                                # ... just add upd to list of updates that triggered it
-                                # TODO FIXME: what if one attribute is updated several times? It should be in the list only once, with the latest value.
-                                updates.extend(updated)
-                                break
-                        # Otherwise put the function to the queue
+                    # Add to pending calls all functions directly hooked to the attribute/event
+                    for func in attr2func.get(attr, []):
+                        updates = pending.get(func)
+                        if updates is None:
+                            pending[func] = list(updated)
+                            heapq.heappush(pending_ranks, plan.rank[func])
                         else:
-                            call_queue.append((func, updated))
-                
-                    # Compute all attribute changes that may occur due to this event and add 
-                    # them to the set of attributes to change
-                    #self.log.debug("get_all_possible_changes: {} -> {}".format(str(attr), repr(self.get_all_possible_changes(etype, attr))))
-                    may_change |= self.get_all_possible_changes(etype, attr)
-                    #self.log.debug("may_change: {}".format(may_change))
+                            # TODO FIXME: what if one attribute is updated several times? It should be in the list only once, with the latest value.
+                            updates.extend(updated)
                 
                 # All requests were processed, clear the list
                 requests_to_process.clear()
             
-            if not call_queue:
+            if not pending_ranks:
                 break # No more work to do
             
-            # *** Do all function calls planned in the call queue ***
+            # *** Call the pending function which is first in the plan ***
             
-#             self.log.debug("call_queue loop iteration {}:\n  call_queue: {}\n  may_change: {}".format(
-#                 loop_counter,
-#                 list(map(lambda x: (get_func_name(x[0]), x[1]), call_queue)),
-#                 may_change)
-#             )
             # safety check against infinite looping
-            loop_counter += 1
-            if loop_counter > 20:
-                self.log.warning("Too many iterations when updating ({}:{}), something went wrong! Update chain stopped.".format(etype,eid))
+            n_calls += 1
+            if n_calls > plan.max_calls:
+                self.log.warning("Too many handler calls when updating ({}:{}), something went wrong! Update chain stopped.".format(etype,eid))
                 break
             
-            func, updates = call_queue.popleft()
-            
-            # If the function watches some attributes that may be updated later due 
-            # to expected subsequent events, postpone its call.
-            if may_change & self._func_triggers[etype][func]:  # nonempty intersection of two sets
-                # Put the function call back to the end of the queue
-                #self.log.debug("call_queue: Postponing call of {}({})".format(get_func_name(func), updates))
-                call_queue.append((func, updates))
-                continue
+            func = plan.funcs[heapq.heappop(pending_ranks)]
+            updates = pending.pop(func)
+            if func in called:
+                repeated_calls += 1
+            called.add(func)
             
             # Call the event handler function.
             # Set of requested updates of the record should be returned
             #self.log.debug("Calling: {}(({}, {}), rec, {})".format(get_func_name(func), etype, eid, updates))
-#            t_handler1 = time.time()
+            t_handler1 = time.perf_counter()
             try:
                 reqs = func((etype, eid), rec, updates)
                 # self.log.info("{}(({}, {}), rec, {})".format(get_func_name(func), etype, eid, updates) )
@@ -702,29 +742,23 @@ class UpdateManager:
                     .format(get_func_name(func), etype, eid, updates) )
                 g.ecl['errors'].log('error_in_module')
                 reqs = []
-#            t_handler2 = time.time()
-#            t_handlers[get_func_name(func)] = t_handler2 - t_handler1
+            t_handler = time.perf_counter() - t_handler1
+            stats.handlers[func].add(t_handler)
+            # The handler might have changed arrays of the record in place (e.g. a field of an item), which can't be
+            # detected by the array index, so it's dropped (indexes are rebuilt if some of its requests needs them)
+            array_index = ArrayIndex()
+            call_chain.append((func, t_handler, updates, len(reqs) if reqs else 0))
 
             # Set requested updates to requests_to_process
             if reqs:
-                requests_to_process.extend(reqs)
-            
-            # TODO FIXME - toto asi predpoklada, ze urcity atribut muze byt menen jen jednou handler funkci
-            # (coz jsem mozna nekde zadal jako nutnou podminku; kazdopadne jestli to tak je, musi to byt nekde velmi jasne uvedeno) 
-            # Remove set of possible attribute changes of that function from
-            # may_change (they were either already changed (or are in requests_to_process) or they won't be changed)
-            #self.log.debug("Removing {} from may_change.".format(self._func2attr[etype][func]))
-            may_change -= set(self._func2attr[etype][func])
-            #self.log.debug("New may_change: {}".format(may_change))
-        
-        #self.log.debug("call_queue loop end")
-        # FIXME: Temporarily disabled, removing from may_change doesn't work well, the whole algorithm must be reworked
-        #assert(len(may_change) == 0)
+                requests_to_process.extend((compile_op(updreq[0], updreq[1]), updreq) for updreq in reqs)
         
         # Set ts_last_update
         rec['ts_last_update'] = datetime.utcnow()
+        stats.iterations[n_calls] += 1
+        stats.repeated_calls[repeated_calls] += 1
         
-#        t3 = time.time()
+        t3 = time.perf_counter()
 
         # Remove or update processed database record
         if deletion:
@@ -734,14 +768,16 @@ class UpdateManager:
         else:
             self.db.put(etype, eid, rec)
             self.elog_op.log(etype+'_updated') # normal record update
-
-        
-#        t4 = time.time()
-#        #if t4 - t1 > 1.0:
-#        #    self.log.info("Entity ({}:{}): load: {:.3f}s, process: {:.3f}s, store: {:.3f}s".format(etype, eid, t2-t1, t3-t2, t4-t3))
-#        #    self.log.info("  handlers:" + ", ".join("{}: {:.3f}s".format(fname, t) for fname, t in t_handlers))
-#
-#        self.t_handlers.update(t_handlers)
+        t4 = time.perf_counter()
+        stats.db_put.add(t4 - t3)
+
+        if t4 - t1 > self.slow_task_threshold:
+            stats.slow_tasks += 1
+            self.log.info("Slow task ({:.3f}s) {}/{} {}{}: load {:.3f}s, store {:.3f}s, {} calls ({} repeated), handlers:\n".format(
+                t4 - t1, etype, eid, orig_requests, " (new record created)" if new_rec_created else "",
+                t_load, t4 - t3, n_calls, repeated_calls) +
+                "\n".join("  {:.3f}s {} <- {} -> {} requests".format(t, get_func_name(func), updates, n_reqs)
+                          for func, t, updates, n_reqs in call_chain))
         
         return new_rec_created
 
@@ -765,11 +801,77 @@ class UpdateManager:
         s += "\nattr2func:\n"
         for k,v in self._attr2func[etype].items():
             s += "{} -> {}\n".format(k,list(map(get_func_name,v)))
+        plan = self._get_plan(etype)
+        s += "\ncall order:\n"
+        for i, func in enumerate(plan.funcs):
+            s += "{} {}\n".format(i, get_func_name(func))
+        for cycle in plan.cycles:
+            s += "cycle: {}\n".format(list(map(get_func_name, cycle)))
         return s
 
-    def log_t_handlers(self):
-        print("Handler function running times:")
-        for name, t in self.t_handlers.most_common(10):
-            print("{:50s} {:7.3f}".format(name, t))
-        self.t_handlers = Counter()
+    def get_stats(self):
+        """
+        Return statistics of task processing of all worker threads since the last export (TaskStats object).
+        """
+        merged = TaskStats()
+        for stats in self._stats:
+            merged.merge(stats)
+        return merged
+
+    def _export_stats(self):
+        """
+        Merge statistics of all worker threads and start collecting new ones.
 
+        The statistics of the last interval are logged (slowest handlers), written to a JSON file (if configured)
+        and handler call counts are logged to EventCountLogger (group "handler_calls").
+        Called by scheduler every minute.
+        """
+        # Replace the list, so workers start using new objects (at most one task per thread may be counted in the
+        # old objects after they are merged, it's lost)
+        old_stats, self._stats = self._stats, [TaskStats() for _ in range(self.num_threads)]
+        t_start, self._stats_start = self._stats_start, time.time()
+        merged = TaskStats()
+        for stats in old_stats:
+            merged.merge(stats)
+
+        if merged.task.count == 0:
+            return
+        queue_wait = merged.queue_wait.to_dict()
+        self.log.info("{} tasks received, {} processed (merge ratio {:.2f}) in {:.0f}s ({} slow): task p50/p99 {:.3f}/{:.3f}s, queue wait p50/p99 {:.3f}/{:.3f}s, "
+                      "DB get avg {:.4f}s, DB put avg {:.4f}s".format(
+            merged.received, merged.task.count, merged.received / merged.task.count,
+            self._stats_start - t_start, merged.slow_tasks,
+            merged.task.percentile(50), merged.task.percentile(99), queue_wait['p50'], queue_wait['p99'],
+            merged.db_get.to_dict()['avg'], merged.db_put.to_dict()['avg']))
+        slowest = sorted(merged.handlers.items(), key=lambda item: -item[1].total)[:self.stats_log_top]
+        if slowest:
+            self.log.info("Handlers with the highest total time: " + ", ".join(
+                "{} {:.2f}s/{}x (p99 {:.3f}s)".format(get_func_name(func), hist.total, hist.count, hist.percentile(99))
+                for func, hist in slowest))
+
+        partition_stats = self._partitions.get_stats()
+        self.log.info("Processing time by thread: {}, {} partitions moved, the hottest partitions: {}".format(
+            " ".join("{:.1f}s".format(t) for t in partition_stats['thread_times']),
+            partition_stats['migrations'],
+            ", ".join("{} ({:.0%}, {} tasks)".format(p, share, n) for p, share, n in partition_stats['hottest'])))
+        self.log.info("Task queue: {received} received, {buffered} buffered, {in_flight} in flight, "
+                      "{waiting_ack} waiting for ack, {acked} acked in {ack_frames} acks".format(
+            **self._task_queue_reader.get_stats()))
+
+        for func, hist in merged.handlers.items():
+            # (dots in event names make problems with Munin)
+            self.elog_handlers.log(get_func_name(func).replace('.', '_'), hist.count)
+
+        if self.stats_file:
+            data = merged.to_dict(get_func_name)
+            data['start'] = t_start
+            data['end'] = self._stats_start
+            data['process_index'] = self.process_index
+            data['partitions'] = partition_stats
+            filename = self.stats_file.replace('{}', str(self.process_index))
+            try:
+                with open(filename + '.tmp', 'w') as f:
+                    json.dump(data, f)
+                os.replace(filename + '.tmp', filename)
+            except OSError as e:
+                self.log.error("Can't write statistics to {}: {}".format(filename, e))
@@ -0,0 +1,289 @@
+"""
+NERD - compiled update requests.
+
+An update request (see the specification in update_manager.py) is a tuple
+(op, key, params...). Instead of interpreting op and key again on each call of
+perform_update, the pair (op, key) is compiled once into an UpdateOp object:
+  - the function implementing the operation,
+  - the path of the key split to components (integer components are indexes
+    to arrays),
+  - flag of a weak operation (op starting with '*', the op itself is without it),
+  - flag of an event (events are handled by UpdateManager, they can't be
+    applied to a record).
+UpdateOps are cached by (op, key), so usually each request is just looked up
+in a dict and applied: op.apply(rec, updreq, index). The parameters are always
+taken from the request itself.
+
+(The cache is cleared when it reaches MAX_CACHED items, for the case some
+keys contain variable parts.)
+"""
+
+import sys
+
+from core.array_index import match_item
+
+MAX_CACHED = 10000
+
+_cache = {} # (op, key) -> UpdateOp
+
+
+class UpdateOp:
+    """Compiled (op, key) pair of an update request"""
+    __slots__ = ('op', 'key', 'path', 'last', 'func', 'weak', 'is_event')
+
+    def __init__(self, op, key):
+        self.weak = op.startswith('*')
+        if self.weak:
+            op = op[1:]
+        self.op = op
+        self.key = key
+        self.is_event = (op == 'event')
+        # Keys with hierarchy, i.e. containing dots (like "events.scan.count"), are split to path of sub-objects
+        # ("events", "scan") and the last attribute ("count"), numerical components are indexes of arrays
+        *path, self.last = key.split('.')
+        self.path = tuple(int(k) if k.isdecimal() else k for k in path)
+        self.func = _OPS.get(op, _op_unknown)
+
+    def apply(self, rec, updreq, index=None):
+        """
+        Perform the update (updreq must have the op and key this object was compiled from) on the record.
+
+        Return list of performed updates or None, see perform_update.
+        """
+        # Find the inner-most subobject, if path doesn't exist in the hierarchy, it's created
+        for k in self.path:
+            if k.__class__ is int: # index of array
+                if index is not None:
+                    index.reset(rec) # (item may be changed in place)
+                rec = rec[k]
+            else: # key of object/dict
+                if k not in rec:
+                    rec[k] = {}
+                rec = rec[k]
+        return self.func(rec, self.last, updreq, index)
+
+    def __repr__(self):
+        return "UpdateOp({!r}, {!r})".format('*' + self.op if self.weak else self.op, self.key)
+
+
+def compile_op(op, key):
+    """Return UpdateOp for given op and key (from cache if possible)"""
+    try:
+        return _cache[op, key]
+    except KeyError:
+        pass
+    if len(_cache) >= MAX_CACHED:
+        _cache.clear()
+    compiled = _cache[op, key] = UpdateOp(op, key)
+    return compiled
+
+
+def perform_update(rec, updreq, index=None):
+    """
+    Update a record according to given update request.
+
+    updreq - n-tuple (op, key, params...), op may be weak (starting with '*'), it's performed in the same way
+    index - ArrayIndex used to find items in arrays (should be the same object for all updates of the record within
+            a task), arrays are searched linearly if it's None
+
+    Return array with specifications of performed updates - pairs (updated_key,
+    new_value) or None.
+    (None is returned when nothing was changed, e.g. because op=add_to_set and
+    value was already present, or removal of non-existent item was requested)
+    """
+    return compile_op(updreq[0], updreq[1]).apply(rec, updreq, index)
+
+
+def _find_item(array, query, index=None):
+    """Return position of the first item of array whose values match those in query dict, None if there is no one"""
+    if index is not None:
+        return index.find(array, query)
+    for i,item in enumerate(array):
+        if all(item[a] == v for a,v in query.items()):
+            return i
+    return None
+
+
+# ***** Implementation of operations *****
+# Each function gets the inner-most subobject of the record, the last component of the key, the whole update request
+# and ArrayIndex (or None), returns list of performed updates or None.
+
+def _op_set(rec, key, updreq, index):
+    rec[key] = updreq[2]
+    return [(updreq[1], rec[key])]
+
+def _op_append(rec, key, updreq, index):
+    if key not in rec:
+        rec[key] = [updreq[2]]
+    else:
+        rec[key].append(updreq[2])
+    return [(updreq[1], rec[key])]
+
+def _op_add_to_set(rec, key, updreq, index):
+    value = updreq[2]
+    if key not in rec:
+        rec[key] = [value]
+    elif not (index.contains(rec[key], value) if index is not None else value in rec[key]):
+        rec[key].append(value)
+        if index is not None:
+            index.appended(rec[key])
+    else:
+        return None
+    return [(updreq[1], rec[key])]
+
+def _op_extend_set(rec, key, updreq, index):
+    value = updreq[2]
+    if key not in rec:
+        rec[key] = list(value)
+    else:
+        changed = False
+        for val in value:
+            if not (index.contains(rec[key], val) if index is not None else val in rec[key]):
+                rec[key].append(val)
+                if index is not None:
+                    index.appended(rec[key])
+                changed = True
+        if not changed:
+            return None
+    return [(updreq[1], rec[key])]
+
+def _op_rem_from_set(rec, key, updreq, index):
+    if key not in rec:
+        return None
+    rec[key] = list(set(rec[key]) - set(updreq[2]))
+    return [(updreq[1], rec[key])]
+
+def _op_add(rec, key, updreq, index):
+    if key not in rec:
+        rec[key] = updreq[2]
+    else:
+        rec[key] += updreq[2]
+    return [(updreq[1], rec[key])]
+
+def _op_sub(rec, key, updreq, index):
+    if key not in rec:
+        rec[key] = -updreq[2]
+    else:
+        rec[key] -= updreq[2]
+    return [(updreq[1], rec[key])]
+
+def _op_setmax(rec, key, updreq, index):
+    if key not in rec:
+        rec[key] = updreq[2]
+    else:
+        rec[key] = max(updreq[2], rec[key])
+    return [(updreq[1], rec[key])]
+
+def _op_setmin(rec, key, updreq, index):
+    if key not in rec:
+        rec[key] = updreq[2]
+    else:
+        rec[key] = min(updreq[2], rec[key])
+    return [(updreq[1], rec[key])]
+
+def _op_remove(rec, key, updreq, index):
+    if key in rec:
+        del rec[key]
+        return [(updreq[1], None)]
+    return None
+
+def _op_next_step(rec, key, updreq, index):
+    key_base = updreq[2]
+    minimum = updreq[3]
+    step = updreq[4]
+    base = rec[key_base]
+    rec[key] = base + ((minimum - base) // step + 1) * step
+    return [(updreq[1], rec[key])]
+
+def _op_array_update(rec, key, updreq, index, upsert=False):
+    query = updreq[2]
+    actions = updreq[3]
+    if key not in rec:
+        if upsert:
+            rec[key] = []
+        else:
+            return None # Array doesn't exist and insert not requested
+    array = rec[key]
+    # Find the matching item in the array
+    i = _find_item(array, query, index)
+    if i is None:
+        if upsert:
+            i = len(array)
+            array.append(query)
+            if index is not None:
+                index.appended(array)
+        else:
+            return None # No matching element found and insert not requested
+    item = array[i]
+    # Now, "item" is the selected array item ("i" its index), apply all actions to it
+    old_keys = index.keys(array, item) if index is not None else None
+    updates_performed = []
+    for action in actions:
+        upds = compile_op(action[0], action[1]).apply(item, action, index) # recursion
+        # List of all actions must be returned, convert relative keys to absolute
+        for inner_key, new_val in upds:
+            updates_performed.append((key + '[' + str(i) + '].' + inner_key, new_val))
+    if old_keys:
+        index.changed(array, item, old_keys)
+    return updates_performed
+
+def _op_array_upsert(rec, key, updreq, index):
+    return _op_array_update(rec, key, updreq, index, upsert=True)
+
+def _op_array_remove(rec, key, updreq, index):
+    query = updreq[2]
+    if key not in rec:
+        return None
+    array = rec[key]
+    # Find the matching item in the array
+    i = _find_item(array, query, index)
+    if i is None:
+        return None
+    # Remove it
+    item = array.pop(i)
+    if index is not None:
+        index.removed(array, i, item)
+    return [(key + '[' + str(i) + ']', None)]
+
+def _op_array_remove_many(rec, key, updreq, index):
+    query = updreq[2]
+    if key not in rec:
+        return None
+    array = rec[key]
+    # Remove all matching items in one pass (positions in the returned keys are those before the removal)
+    kept = []
+    removed = []
+    for i,item in enumerate(array):
+        if match_item(item, query):
+            removed.append(i)
+        else:
+            kept.append(item)
+    if not removed:
+        return None
+    array[:] = kept
+    if index is not None:
+        index.reset(array)
+    return [(key + '[' + str(i) + ']', None) for i in removed]
+
+def _op_unknown(rec, key, updreq, index):
+    print("ERROR: perform_update: Unknown operation {}".format(updreq[0]), file=sys.stderr)
+    return None
+
+
+_OPS = {
+    'set': _op_set,
+    'append': _op_append,
+    'add_to_set': _op_add_to_set,
+    'extend_set': _op_extend_set,
+    'rem_from_set': _op_rem_from_set,
+    'add': _op_add,
+    'sub': _op_sub,
+    'setmax': _op_setmax,
+    'setmin': _op_setmin,
+    'remove': _op_remove,
+    'next_step': _op_next_step,
+    'array_update': _op_array_update,
+    'array_upsert': _op_array_upsert,
+    'array_remove': _op_array_remove,
+    'array_remove_many': _op_array_remove_many,
+}
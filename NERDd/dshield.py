@@ -12,6 +12,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(
 
 from common.config import read_config
 from common.task_queue import TaskQueueWriter
+from common.task_aggregator import TaskAggregator
 
 # parse arguments
 parser = argparse.ArgumentParser(
@@ -43,6 +44,9 @@ dshield_ttl_days = config.get('record_life_length.dshield', 7)
 num_processes = config.get('worker_processes')
 tq_writer = TaskQueueWriter(num_processes, rabbit_config)
 tq_writer.connect()
+# tasks of the same IP are merged before they are sent
+task_aggregator = TaskAggregator(tq_writer, config.get('task_aggregation.max_age', 1.0),
+                                 config.get('task_aggregation.max_entities', 1000))
 
 # Logging
 LOGFORMAT = "%(asctime)-15s,%(name)s [%(levelname)s] %(message)s"
@@ -90,7 +94,7 @@ def process_feed(feed_data):
     for ip_addr in ips:
         if (ips[ip_addr]["reports"] < min_reports) or (ips[ip_addr]["targets"] < min_targets):
             continue
-        tq_writer.put_task('ip', ip_addr, [
+        task_aggregator.put_task('ip', ip_addr, [
                                             ('array_upsert', 'dshield', {'date' : date_str},
                                              [('set', 'reports', ips[ip_addr]["reports"]),
                                               ('set', 'targets', ips[ip_addr]["targets"])]),
@@ -98,6 +102,8 @@ def process_feed(feed_data):
                                             ('setmax', 'last_activity', current_time)
                                           ], "dshield")
         count += 1
+    task_aggregator.flush()
+    task_aggregator.log_stats()
     logger.info(f"updated {count} IPs ...")
     logger.info("Tasks created")
 
@@ -26,7 +26,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(
 import NERDd.core.mongodb as mongodb
 from common.config import read_config
 from common.task_queue import TaskQueueWriter
-from common.utils import int2ipstr
+from common.utils import ipstr2int
 
 running_flag = True
 zmq_alive = False
@@ -65,6 +65,9 @@ inactive_ip_lifetime = config.get('record_life_length.misp', 180)
 
 rabbit_config = config.get("rabbitmq")
 db = mongodb.MongoEntityDatabase(config)
+# index of IP records by MISP event IDs (reverse lookup of IPs of an event, see install/mongo_prepare_db.js)
+db.create_index('ip', 'misp_events.event_id', name='misp_event_id',
+                partialFilterExpression={'misp_events.event_id': {'$exists': True}}, background=True)
 
 # rabbitMQ
 num_processes = config.get('worker_processes')
@@ -256,6 +259,21 @@ def remove_misp_event(ip_addr, event_id):
                                            {'misp_instance': misp_url, 'event_id': event_id})], "misp_receiver")
 
 
+def remove_misp_event_from_all(event_id):
+    """
+    Removes one specific 'misp_event' from all IP records containing it
+    Records are found using index on 'misp_events.event_id' and updated directly in the database by one update (no
+    module depends on 'misp_events', so no tasks are needed; possible inconsistencies are fixed by misp_updater)
+    :param event_id: event_id of the 'misp_event'
+    :return: number of updated IP records
+    """
+    misp_event = {'misp_instance': misp_url, 'event_id': event_id}
+    # (top-level condition on 'misp_events.event_id' is needed to use the partial index, $elemMatch alone doesn't
+    # imply its filter expression)
+    return db.update_many('ip', {'misp_events.event_id': event_id, 'misp_events': {'$elemMatch': misp_event}},
+                          {'$pull': {'misp_events': misp_event}})
+
+
 def upsert_new_event(event, attrib, sighting_list, role=None):
     """
     Creates new 'misp_event' dict and send it to NERD as upsert to already inserted 'misp_events' or creates new list
@@ -295,20 +313,13 @@ def process_sighting_notification(sighting):
             sighting_list.append({'type': sighting_rec['Sighting']['type']})
 
         ip_addr = get_ip_address(sighting['Attribute'])
-        rec = db.get("ip", ip_addr)
-        # find correct 'misp_event' and rewrite sightings via update request
-        if rec:
-            just_update = False
-            for ev in rec['misp_events']:
-                if misp_url == ev['misp_instance'] and sighting['event_id'] == ev['event_id']:
-                    # correct 'misp_event' found, rewrite sightings is enough
-                    just_update = True
-            if just_update:
-                # ip record found, just rewrite sightings
-                tq_writer.put_task("ip", ip_addr, [('array_upsert', 'misp_events', {'misp_instance': misp_url,
-                                                    'event_id': sighting['event_id']}, [('set', 'sightings',
-                                                    get_sightings_for_nerd(sighting_list))])], "misp_receiver")
-                return
+        # find whether the ip record contains correct 'misp_event' (only the match is checked, record isn't loaded)
+        misp_event = {'misp_instance': misp_url, 'event_id': sighting['event_id']}
+        if db.find("ip", {'_id': ipstr2int(ip_addr), 'misp_events': {'$elemMatch': misp_event}}, limit=1):
+            # correct 'misp_event' found, rewrite sightings via update request is enough
+            tq_writer.put_task("ip", ip_addr, [('array_upsert', 'misp_events', misp_event, [('set', 'sightings',
+                                                get_sightings_for_nerd(sighting_list))])], "misp_receiver")
+            return
         # ip address not even in NERD or not found correct 'misp_event', create new 'misp_event'
         # find correct attribute to pass it to event creation
         attributes = misp_inst.search(controller='attributes', values=ip_addr)['response']['Attribute']
@@ -520,13 +531,10 @@ def receive_events():
         elif notification_prefix == "misp_json_event":
             if notification['action'] == "delete":
                 # deletion of MISP event
-                # find all ip records, which contains deleted MISP event
-                outdated_records = db.aggregate('ip', {'$match': {"misp_events.event_id": notification['Event']['id']}})
-                for ip_record in outdated_records:
-                    # from every ip record delete outdated misp record
-                    # first id of ip record has to be converted to string IP address
-                    ip_address = int2ipstr(ip_record['_id'])
-                    remove_misp_event(ip_address, notification['Event']['id'])
+                # delete the MISP event from all ip records, which contain it
+                num_records = remove_misp_event_from_all(notification['Event']['id'])
+                logger.debug("MISP event {} removed from {} IP records".format(notification['Event']['id'],
+                                                                               num_records))
 
 
 if __name__ == "__main__":
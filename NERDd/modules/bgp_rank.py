@@ -8,7 +8,6 @@ from core.basemodule import NERDModule
 import g
 
 import logging
-import requests
 
 from fake_useragent import UserAgent
 
@@ -25,6 +24,9 @@ class CIRCL_BGPRank(NERDModule):
     def __init__(self):
         self.log = logging.getLogger('CIRCL_BGPRank')
         #self.log.setLevel("DEBUG")
+        # Queries are made by the lookup executor, so they don't block worker threads
+        g.lookups.register_provider('bgp_rank')
+        self.requests_session = g.lookups.get_session('bgp_rank')
         g.um.register_handler(
             self.set_bgprank,  # function (or bound method) to call
             'asn',                # entity type
@@ -43,6 +45,22 @@ class CIRCL_BGPRank(NERDModule):
           their new values (or events and their parameters) as a list of
           2-tuples: [(attr, val), (!event, param), ...]
 
+        Returns:
+        None, the query is made by the lookup executor (see query_bgprank)
+        """
+        etype, key = ekey
+
+        if etype != 'asn':
+            return None
+
+        return g.lookups.submit('bgp_rank', ekey, self.query_bgprank, key)
+
+    def query_bgprank(self, key):
+        """
+        Query BGP Ranking API for the ASN.
+
+        Called by the lookup executor (in a separate thread).
+
         Returns:
         List of update requests (3-tuples describing requested attribute updates
         or events).
@@ -50,16 +68,11 @@ class CIRCL_BGPRank(NERDModule):
         In particular, the following update is requested
           ('set', 'circl_bgprank', RANK_NUM)
         """
-        etype, key = ekey
-
-        if etype != 'asn':
-            return None
 
         #query = json.dumps({'asn': key, 'address_family': 'v4'})
         # query = '{"asn": ' + str(key) + ', "address_family": "v4"}'
         query = '{"asn":' + str(key) + '}'
         try:
-            self.requests_session = requests.session()
             headers= {'User-Agent':str(UserAgent().random)}
             # the return format is:
             # {'meta': {'asn': integer, 'address_family': 'v4'},
@@ -85,11 +98,8 @@ class CIRCL_BGPRank(NERDModule):
         except Exception as e:
             self.log.error("Can't get BGPRank of ASN {}: {}:{}".format(query, headers, e))
             return None             # could be connection error etc.
-        
-
-        g.um.update(('ip', key), [('set', 'circl_bgprank', rank),('set', 'asn_description', asn_description),('set', 'position', pos), ('set', 'total_know_asns', total_known_asns)])
 
-        return None
+        return [('set', 'circl_bgprank', rank),('set', 'asn_description', asn_description),('set', 'position', pos), ('set', 'total_know_asns', total_known_asns)]
 if __name__ == '__main__':
     bgprank = CIRCL_BGPRank()
     ret = bgprank.set_bgprank((asn, 4538), [], [])
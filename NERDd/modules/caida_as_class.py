@@ -5,6 +5,7 @@ NERD module tries to classify IPs according to their business type. It uses ASN
 from core.basemodule import NERDModule
 
 import g
+from common import refdata
 
 import datetime
 import logging
@@ -26,9 +27,12 @@ class CaidaASclass(NERDModule):
             self.log.warning("Configuration for CaidaASclass module not found - module is disabled.")
             return
         
-        self.caida_dict = self.parse_list(self.caida.get("caida_file"))
-        if not self.caida_dict:
+        self.caida_file = self.caida.get("caida_file")
+        self.refdata_dir = g.config.get("refdata_dir", "/data/refdata")
+        self.caida_table = self.load_list()
+        if self.caida_table is None:
             return
+        g.scheduler.register(self.reload_list, minute="*/10")
 
         g.um.register_handler(
             self.determine_type,
@@ -37,65 +41,57 @@ class CaidaASclass(NERDModule):
             ('caida_as_class.v', 'caida_as_class.c')
         )
     
-    def parse_list(self, path):
+    def load_list(self):
         """
-        Parses caida list from given file and returns it as a dictionary.
-        
-        Arguments:
-        path -- path of file with list of ASes, their sources and classes
+        Loads caida list of ASes, their sources and classes (compiled into a memory-mapped table shared by all
+        workers, see common/refdata.py).
         
         Return:
-        Dictionary with AS number as a key and dictionary with source and class (class name from configuration file is used if is set) as a value
+        RefTable with AS number as a key and [source, class] as a value, None on error
         """
 
-        self.log.debug("Start parsing Caida list stored at path {}.".format(path))
-        ASN_dictionary = {}
-        
+        self.log.debug("Loading Caida list stored at path {}.".format(self.caida_file))
         try:
-            with open(path) as f :
-                for line in f:
-                    if not line.startswith("#"):
-                        line = line.strip() 
-                        data = line.split("|")
-                        ASN_data = {}
-                        if "classes" in self.caida and data[2] in self.caida["classes"] and "value" in self.caida["classes"][data[2]]:
-                            ASN_data = {"source": data[1] , "class": self.caida["classes"][data[2]]["value"]}
-                        else:
-                            ASN_data = {"source": data[1] , "class": data[2]}
-                        try:
-                            asn_num = int(data[0])
-                            ASN_dictionary[asn_num] = ASN_data
-                        except ValueError:
-                            self.log.error("Can't parse line starting with '{}' - it's not number.".format(data[0]))
+            table = refdata.load('caida_as2types', self.caida_file, self.refdata_dir)
         except Exception as e:
-            self.log.error("Can't parse Caida list file ({}): {} .".format(path, str(e)))
-            return {}
+            self.log.error("Can't parse Caida list file ({}): {} .".format(self.caida_file, str(e)))
+            return None
        
-        self.log.info("Parsed Caida ASN list (path: {}) as dictionary with {} ASNs.".format(path, len(ASN_dictionary))) 
-        return ASN_dictionary
+        self.log.info("Loaded Caida ASN list (path: {}) with {} ASNs.".format(self.caida_file, len(table)))
+        return table
 
+    def reload_list(self):
+        # Called periodically, reload the list if the file was changed
+        if self.caida_table.is_outdated():
+            table = self.load_list()
+            if table is not None:
+                self.caida_table = table
 
     def search_in_dict(self, asn):
         """
-        Searches given AS number in dictionary and returns source, class and confidence
+        Searches given AS number in the Caida list and returns source, class and confidence
         
         Arguments:
         asn -- AS number
         
         Return:
-        Dictionary with source, class and confidence (can be specified in configuration file for each class- otherwise confidence set to 1) for AS
-        returns None if AS is not found in dict  
+        Dictionary with source, class (class name from configuration file is used if is set) and confidence (can be
+        specified in configuration file for each class- otherwise confidence set to 1) for AS
+        returns None if AS is not found in the list
         """
 
-        if asn in self.caida_dict:
-            res = self.caida_dict[asn]
-            if "sources" in self.caida and res["source"] in self.caida["sources"] and "confidence" in self.caida["sources"][res["source"]]:
-                res["confidence"] = self.caida["sources"][res["source"]]["confidence"]
-                return res
-            else:
-                res["confidence"] = 1
-                return res
-        return None
+        data = self.caida_table.find('int', int(asn))
+        if data is None:
+            return None
+        source, as_class = data
+        if "classes" in self.caida and as_class in self.caida["classes"] and "value" in self.caida["classes"][as_class]:
+            as_class = self.caida["classes"][as_class]["value"]
+        res = {"source": source, "class": as_class}
+        if "sources" in self.caida and source in self.caida["sources"] and "confidence" in self.caida["sources"][source]:
+            res["confidence"] = self.caida["sources"][source]["confidence"]
+        else:
+            res["confidence"] = 1
+        return res
 
     def determine_type(self, ekey, rec, updates):
         """
@@ -13,7 +13,8 @@ class Cleaner(NERDModule):
     Module clearing old entries from entity records.
 
     Event flow specification:
-      !every1d -> clear_events -> []
+      !every1d -> clear_events -> events_meta.total
+      !DELETE -> remove_events -> []
     """
 
     def __init__(self):
@@ -27,7 +28,13 @@ class Cleaner(NERDModule):
             self.clear_events,
             'ip',
             ('!every1d',),
-            tuple() # No key is changed; some are removed, but there's no way to specify list of keys to delete in advance; anyway it shouldn't be a problem in this case.
+            tuple() # No key is changed directly, new events_meta.total is set by a separate task
+        )
+        g.um.register_handler(
+            self.remove_events,
+            'ip',
+            ('!DELETE',),
+            tuple()
         )
         g.um.register_handler(
             self.clear_dshield,
@@ -56,36 +63,59 @@ class Cleaner(NERDModule):
 
     def clear_events(self, ekey, rec, updates):
         """
-        Handler function to clear old Warden events metadata.
-        
-        Remove all items under events with "date" older then current
-        day minus 'max_event_history' days.
+        Handler function to update total number of Warden events (and lists of nodes and categories) after old
+        ones expired.
+
+        Events are stored in buckets per day outside of the IP record (see common/event_store.py), buckets older than
+        'max_event_history' days are removed by MongoDB (TTL index). Here, only events_meta.total, nodes and cats
+        are set according to the remaining buckets (newer than current day minus 'max_event_history' days, in case
+        the expired ones weren't removed yet).
         """
         etype, key = ekey
         if etype != 'ip':
             return None
 
+        events_meta = rec.get('events_meta', {})
+        if 'total' not in events_meta:
+            return None # No Warden event, nothing to do
+
         today = datetime.utcnow().date()
         cut_day = (today - self.max_event_history).strftime("%Y-%m-%d")
 
-        # Remove all event-records with day before cut_day
-        actions = []
         num_events = 0
-        for evtrec in rec.get('events', []):
-            if evtrec['date'] < cut_day: # Thanks to ISO format it's OK to compare dates as strings
-                actions.append( ('array_remove', 'events', {'date': evtrec['date'], 'node': evtrec['node'], 'cat': evtrec['cat']}) )
-            else:
+        nodes = set()
+        cats = set()
+        for evtrec in g.event_store.get(key, events_meta['total']):
+            if evtrec['date'] >= cut_day: # Thanks to ISO format it's OK to compare dates as strings
                 num_events += evtrec['n']
-        
-        # Set new total number of events
-        if actions:
+                nodes.add(evtrec['node'])
+                cats.add(evtrec['cat'])
+
+        # Set new total number of events and lists of nodes and categories (if some of them are only in old events)
+        actions = []
+        if num_events != events_meta['total']:
+            self.log.debug("Cleaning {}: Number of warden events changed from {} to {}".format(
+                key, events_meta['total'], num_events))
             actions.append(('set', 'events_meta.total', num_events))
-        
-        self.log.debug("Cleaning {}: Removing {} old warden event records".format(key, len(actions)-1))
+        if sorted(nodes) != sorted(events_meta.get('nodes', [])):
+            actions.append(('set', 'events_meta.nodes', sorted(nodes)))
+        if sorted(cats) != sorted(events_meta.get('cats', [])):
+            actions.append(('set', 'events_meta.cats', sorted(cats)))
+        if actions:
+            g.um.update(('ip', key), actions)
+        return None
 
-        g.um.update(('ip', key), actions)
+    def remove_events(self, ekey, rec, updates):
+        """
+        Handler function to remove all Warden events of a deleted IP record (they would be counted again if the IP
+        appeared again before they expire).
+        """
+        etype, key = ekey
+        if etype != 'ip' or 'events_meta' not in rec:
+            return None
+        num_removed = g.event_store.remove(key)
+        self.log.debug("Cleaning {}: Removed {} buckets of warden events of deleted record".format(key, num_removed))
         return None
- 
 
     def clear_dshield(self, ekey, rec, updates):
         """
@@ -102,14 +132,17 @@ class Cleaner(NERDModule):
         cut_day = (today - self.max_event_history).strftime("%Y-%m-%d")
         # Remove all dshield-records with day before cut_day
         actions = []
+        num_removed = 0
         for item in rec.get('dshield', []):
             try:
                 if item['date'] < cut_day:
-                    actions.append(('array_remove', 'dshield', {'date' : item['date']}))
+                    num_removed += 1
             except Exception as e: # xxx 兼容旧的数据
                 continue
+        if num_removed:
+            actions.append(('array_remove_many', 'dshield', {'date': {'$lt': cut_day}}))
 
-        self.log.debug("Cleaning {}: Removing {} old dshield records".format(key, len(actions)))
+        self.log.debug("Cleaning {}: Removing {} old dshield records".format(key, num_removed))
         g.um.update(('ip', key), actions)
         return None
 
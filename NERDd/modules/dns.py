@@ -2,33 +2,67 @@
 NERD module resolving hostnames of IP addresses using reverse DNS queries.
 
 Requirements:
-- "dnspython" package
+- "pycares" package
+- "dnspython" package (only to construct reverse names)
 """
 
 from core.basemodule import NERDModule
 import g
 
 import logging
-from dns import resolver,reversename
-from dns.exception import *
+import threading
+import queue
+import select
+import socket
+import time
+import collections
+import pycares
+from dns import reversename
 
 
 class DNSResolver(NERDModule):
     """
     DNS resolver module.
-    
+
     Reoslves newly added IP addresses to hostnames using reverse DNS queries
     (PTR records).
-    
+
+    Queries are sent asynchronously by a separate thread using pycares (many
+    queries may be outstanding at once), so a slow PTR lookup never blocks
+    a worker thread. Result of a query is sent back as an update task (with
+    a weak operation, ignored if the record doesn't exist anymore).
+    Results are cached - positive ones for the TTL of the record (if known,
+    'dns.cache_ttl' otherwise), negative ones (NXDOMAIN, no PTR record) for
+    'dns.negative_ttl' seconds. Cached results are returned directly by the
+    handler.
+
     Event flow specification:
       !NEW -> get_hostname -> hostname
     """
-    
+
     def __init__(self):
         self.log = logging.getLogger("DNSResolver")
-        self._resolver = resolver.Resolver()
-        self._resolver.timeout = g.config.get('dns.timeout', 1)
-        self._resolver.lifetime = 3 # Socket is open up to 3 seconds and will perform up to 3 queries in case of 1 second timeout occurence.
+        self._timeout = g.config.get('dns.timeout', 1)
+        self._tries = 3 # Up to 3 queries will be performed in case of 1 second timeout occurence.
+        self._nameservers = g.config.get('dns.nameservers', [])
+        self._max_outstanding = g.config.get('dns.max_outstanding', 100) # max number of queries sent at once
+        self._cache_size = g.config.get('dns.cache_size', 100000)
+        self._cache_ttl = g.config.get('dns.cache_ttl', 3600) # used when TTL of the record is not known
+        self._negative_ttl = g.config.get('dns.negative_ttl', 3600)
+
+        # Cache of results: ip -> (hostname_or_none, expiration_time), the least recently stored first
+        self._cache = collections.OrderedDict()
+        # IPs waiting for a query to be sent (put by worker threads, read by resolver thread)
+        self._requests = queue.Queue()
+        # IPs which are waiting or being resolved (to not query the same IP multiple times at once)
+        self._pending = set()
+        self._lock = threading.Lock() # protects _cache and _pending
+        # Pair of sockets used to wake up resolver thread waiting in select()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._outstanding = 0 # number of sent queries without answer (used only by resolver thread)
+        self._running = False
+        self._thread = None
 
         g.um.register_handler(
             self.get_hostname, # function (or bound method) to call
@@ -36,44 +70,140 @@ class DNSResolver(NERDModule):
             ('!NEW','!every1w'), # tuple/list/set of attributes to watch (their update triggers call of the registered method)
             ('hostname',) # tuple/list/set of attributes the method may change
         )
-        
-    
+
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._resolver_thread, name="DNSResolver")
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup()
+        self._thread.join()
+
+
     def get_hostname(self, ekey, rec, updates):
         """
-        Set a 'hostname' attribute as a result of DNS PTR query on the IP 
+        Set a 'hostname' attribute as a result of DNS PTR query on the IP
         address (key).
         If the hostname cannot be resolved (due to NXDOMAIN, timeout or other
         error), None is stored to 'hostname' attribute.
-        
+
         Arguments:
         ekey -- two-tuple of entity type and key, e.g. ('ip', '192.0.2.42')
         rec -- record currently assigned to the key
-        updates -- list of all attributes whose update triggered this call and  
-          their new values (or events and their parameters) as a list of 
+        updates -- list of all attributes whose update triggered this call and
+          their new values (or events and their parameters) as a list of
           2-tuples: [(attr, val), (!event, param), ...]
-        
+
         Returns:
         List of update requests (3-tuples describing requested attribute updates
         or events).
-        In particular, the following update is requested:
+        In particular, the following update is requested if the result is cached:
           ('set', 'hostname', hostname_or_none)
+        Otherwise, a query is planned and the same update (as weak '*set', so
+        a record deleted meanwhile isn't created again) is requested as a
+        separate task when the answer is received.
         """
         etype, key = ekey
         if etype != 'ip':
             return None
-        
-        addr = reversename.from_address(key) # create .in-addr.arpa address
-        try:
-            answer = self._resolver.query(addr,"PTR")
-            result = str(answer.rrset[0]) # get first (it should be only) answer
-            if result[-1] == '.':
-                result = result[:-1] # trim trailing '.'
-        except Timeout as e:
-            self.log.debug("PTR query for {} timed out".format(key))
-            result = None
-        except DNSException as e:
-            result = None # set result to None if NXDOMAIN, Timeout or other error
-        
-        g.um.update(('ip', key), [('set', 'hostname', result)])
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[1] > time.time():
+                return [('set', 'hostname', cached[0])]
+            if key in self._pending:
+                return None # query is already in progress
+            self._pending.add(key)
+        self._requests.put(key)
+        self._wakeup()
         return None
-        
+
+
+    def _wakeup(self):
+        """Wake up resolver thread (if it's waiting in select)"""
+        try:
+            self._wakeup_send.send(b'\0')
+        except OSError:
+            pass # buffer full - the thread will be woken up anyway
+
+    def _resolver_thread(self):
+        """
+        Main function of resolver thread.
+
+        Sends queries for IPs in _requests (at most _max_outstanding at once),
+        processes answers and handles timeouts.
+        """
+        channel = pycares.Channel(servers=self._nameservers, timeout=self._timeout, tries=self._tries)
+        wakeup_fd = self._wakeup_recv.fileno()
+        while self._running:
+            # Send new queries
+            while self._outstanding < self._max_outstanding:
+                try:
+                    ip = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                revname = reversename.from_address(ip).to_text(omit_final_dot=True)
+                channel.query(revname, pycares.QUERY_TYPE_PTR, self._make_result_handler(ip))
+                self._outstanding += 1
+
+            # Wait for answers, timeouts or new requests
+            read_fds, write_fds = channel.getsock()
+            if self._outstanding:
+                timeout = channel.timeout()
+                if not timeout:
+                    # some query timed out
+                    channel.process_fd(pycares.ARES_SOCKET_BAD, pycares.ARES_SOCKET_BAD)
+                    continue
+            else:
+                timeout = None # nothing to do until new request comes
+            rlist, wlist, xlist = select.select(read_fds + [wakeup_fd], write_fds, [], timeout)
+            for fd in rlist:
+                if fd == wakeup_fd:
+                    try:
+                        self._wakeup_recv.recv(4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    channel.process_fd(fd, pycares.ARES_SOCKET_BAD)
+            for fd in wlist:
+                channel.process_fd(pycares.ARES_SOCKET_BAD, fd)
+            if not rlist and not wlist and self._outstanding:
+                channel.process_fd(pycares.ARES_SOCKET_BAD, pycares.ARES_SOCKET_BAD) # process timeouts
+        channel.cancel()
+
+    def _make_result_handler(self, ip):
+        """Create callback processing result of PTR query for given IP"""
+        def handler(result, error):
+            self._outstanding -= 1
+            if error is None:
+                hostname = result.name
+                if hostname and hostname[-1] == '.':
+                    hostname = hostname[:-1] # trim trailing '.'
+                ttl = result.ttl if result.ttl is not None and result.ttl >= 0 else self._cache_ttl
+            elif error in (pycares.errno.ARES_ENOTFOUND, pycares.errno.ARES_ENODATA):
+                hostname = None
+                ttl = self._negative_ttl
+            else:
+                # Timeout or other error, set result to None but don't cache it
+                if error == pycares.errno.ARES_ETIMEOUT:
+                    self.log.debug("PTR query for {} timed out".format(ip))
+                elif error != pycares.errno.ARES_ECANCELLED:
+                    self.log.debug("PTR query for {} failed: {}".format(ip, pycares.errno.strerror(error)))
+                hostname = None
+                ttl = None
+
+            with self._lock:
+                self._pending.discard(ip)
+                if ttl:
+                    self._cache[ip] = (hostname, time.time() + ttl)
+                    self._cache.move_to_end(ip)
+                    while len(self._cache) > self._cache_size:
+                        self._cache.popitem(last=False)
+
+            if error != pycares.errno.ARES_ECANCELLED:
+                # Weak - the record may have been deleted while the query was running
+                g.um.update(('ip', ip), [('*set', 'hostname', hostname)])
+        return handler
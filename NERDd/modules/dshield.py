@@ -13,7 +13,6 @@ Note: Base URL can also be https://www.dshield.org/api/, it seems to be complete
 from core.basemodule import NERDModule
 import g
 
-import requests
 import logging
 import json
 import time
@@ -42,6 +41,10 @@ class DShield(NERDModule):
         # count the success get count
         self.success_count = 0
 
+        # Queries are made by the lookup executor, so they don't block worker threads
+        g.lookups.register_provider('dshield', concurrency=2, rate=2)
+        self.session = g.lookups.get_session('dshield')
+
         g.um.register_handler(
             self.set_dshield,  # function (or bound method) to call
             'ip',                # entity type
@@ -56,7 +59,7 @@ class DShield(NERDModule):
 
     def set_dshield(self, ekey, rec, updates):
         """
-        Gets data from DShield api, parses them and returns them.
+        Submits a query to DShield api, the result is stored by query_dshield.
         """
 
         etype, key = ekey
@@ -64,12 +67,21 @@ class DShield(NERDModule):
         if etype != 'ip':
             return None
 
+        return g.lookups.submit('dshield', ekey, self.query_dshield, key)
+
+    def query_dshield(self, key):
+        """
+        Gets data from DShield api, parses them and returns them.
+
+        Called by the lookup executor (in a separate thread).
+        Returns list of update requests or None in case of error.
+        """
         # headers= {'user-agent':str(UserAgent().random + ", contact: {}".format(self.fake.ascii_company_email()))}
         #headers= {'user-agent':self.user_agent}
         try:
             headers= {'user-agent':str(UserAgent().random)}
             # get response from server
-            response = requests.get(f"{BASE_URL}/ip/{key}?json", timeout=(1,3), headers=headers)
+            response = self.session.get(f"{BASE_URL}/ip/{key}?json", timeout=(1,3), headers=headers)
             self.log.debug(f"{BASE_URL}/ip/{key}?json  -->  '{response.text}'")
             if response.text.startswith("<html><body>Too Many Requests"):
                 self.log.info(f"Can't get DShield data for IP {key}: Rate-limit exceeded")
@@ -110,6 +122,4 @@ class DShield(NERDModule):
         #self.log.debug("DShield record for IP {}: {}".format(key, dshield_record))
         self.success_count += 1
 
-        
-        g.um.update(('ip', key), [('set', 'dshield_total', dshield_record)])
-        return None
+        return [('set', 'dshield_total', dshield_record)]
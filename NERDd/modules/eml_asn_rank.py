@@ -6,7 +6,6 @@ from core.basemodule import NERDModule
 import g
 
 import logging
-import requests
 
 class EML_ASN_rank(NERDModule):
     """
@@ -27,6 +26,9 @@ class EML_ASN_rank(NERDModule):
             self.log.warning("API URL or key not set, EML ASN rank module disabled.")
             return
         self.log.debug("EML ASN Rank module initialized")
+        # Queries are made by the lookup executor, so they don't block worker threads
+        g.lookups.register_provider('eml_asn_rank')
+        self.session = g.lookups.get_session('eml_asn_rank')
         
         g.um.register_handler(
             self.get_rank,
@@ -48,14 +50,23 @@ class EML_ASN_rank(NERDModule):
 
         
         Returns:
-        List of update requests.
+        None, the query is made by the lookup executor (see query_rank).
         """
         etype, key = ekey
         if etype != 'asn':
             return None
         
+        return g.lookups.submit('eml_asn_rank', ekey, self.query_rank, key)
+    
+    def query_rank(self, key):
+        """
+        Query the EML API (called by the lookup executor in a separate thread).
+        
+        Returns:
+        List of update requests or None in case of error.
+        """
         try:
-            r = requests.get('{}asn/{}?key={}'.format(self.url, key, self.apikey))
+            r = self.session.get('{}asn/{}?key={}'.format(self.url, key, self.apikey), timeout=5)
             r.raise_for_status()
             data = r.json()
             rank = float(data['asnrankinfo']['asnrank'])
@@ -64,5 +75,4 @@ class EML_ASN_rank(NERDModule):
             self.log.error("Can't get rank for AS{}: {}".format(key, repr(e)))
             return None
         
-        g.um.update(('ip', key), [('set', 'eml_rank', rank)])
-        return None
\ No newline at end of file
+        return [('set', 'eml_rank', rank)]
\ No newline at end of file
@@ -5,20 +5,84 @@ Should be triggered at least once a day for every address.
 """
 
 from core.basemodule import NERDModule
+from common.event_store import DAYS_KEPT, unescape_name
 import g
 
 import datetime
+import functools
 
 EWMA_ALPHA = 0.25 # a parameter (there's no strong reason for the value selected, I just feel that 0.25 gives reasonable weights for the 7 day long period)
 EWMA_WEIGHTS = [(EWMA_ALPHA * (1 - EWMA_ALPHA)**i) for i in range(7)]
 
-# TODO - (re)compute sets of nodes for 1, 7 and 30 days as well (or do it in frontend?)
+
+@functools.lru_cache(maxsize=2)
+def day_offsets(today):
+    """Return dict 'YYYY-MM-DD' -> number of days before today (datetime.date) for the last DAYS_KEPT days"""
+    return {(today - datetime.timedelta(days=d)).strftime("%Y-%m-%d"): d for d in range(DAYS_KEPT)}
+
+
+def summarize_days(days, today):
+    """
+    Compute numbers of events and nodes in the last 1, 7 and 30 days and EWMAs from per-day counters
+    (events_meta.days, see common/event_store.py).
+
+    Return dict attribute of events_meta -> value and list of days (keys of 'days') which are too old to be kept.
+    """
+    offsets = day_offsets(today)
+    today_str = today.strftime("%Y-%m-%d")
+
+    total1 = 0
+    total7 = 0
+    total30 = 0
+    nodes1 = set()
+    nodes7 = set()
+    nodes30 = set()
+    alerts_per_day = [0]*7
+    old_days = []
+
+    for date, day in days.items():
+        d = offsets.get(date)
+        if d is None:
+            if date > today_str:
+                d = 0 # event from future (wrong clock of a detector), count it to the current day
+            else:
+                old_days.append(date)
+                continue
+        n = day['n']
+        if d <= 1:
+            total1 += n
+            nodes1.update(day['nodes'])
+        if d <= 7:
+            total7 += n
+            nodes7.update(day['nodes'])
+        total30 += n
+        nodes30.update(day['nodes'])
+        if d < 7:
+            alerts_per_day[d] += n
+
+    values = {
+        'total1': total1,
+        'total7': total7,
+        'total30': total30,
+        'nodes_1d': len(nodes1),
+        'nodes_7d': len(nodes7),
+        'nodes_30d': len(nodes30),
+        'ewma': sum(n*w for n,w in zip(alerts_per_day, EWMA_WEIGHTS)),
+        'bin_ewma': sum((w if n else 0) for n,w in zip(alerts_per_day, EWMA_WEIGHTS)),
+    }
+    return values, old_days
+
 
 class EventCounter(NERDModule):
     """
     Module counting number of recent events.
 
     Periodically updates number of events in the last 1, 7 and 30 days.
+    The values are derived from per-day counters in the IP record
+    (events_meta.days, see common/event_store.py), which are updated by each
+    task with new events - no list of events is scanned. Days older than 30
+    days are removed from the counters and new nodes and categories are added
+    to lists of all nodes and categories the IP was reported by/with.
     
     It's always the number of events in the current day (since 00:00 UTC) plus
     number of events in 1, 7 or 30 previous days.
@@ -29,8 +93,8 @@ class EventCounter(NERDModule):
     the IP for more than 24 hours.
 
     Event flow specification:
-      events.total -> count_events -> events_meta.{total1,total7,total30}
-      !every1d -> count_events -> events_meta.{total1,total7,total30}
+      events_meta.total -> count_events -> events_meta.{total1,total7,total30,nodes,cats,...}
+      !every1d -> count_events -> events_meta.{total1,total7,total30,nodes,cats,...}
 
     # TODO: for now this hooks on events.total which is updated by event_receiver on every new event
       since it can't be hooked on events.<date> because date is changing.
@@ -45,6 +109,7 @@ class EventCounter(NERDModule):
             ('events_meta.total','!every1d'), # tuple/list/set of attributes to watch (their update triggers call of the registered method)
             ('events_meta.total1','events_meta.total7','events_meta.total30',
              'events_meta.nodes_1d','events_meta.nodes_7d','events_meta.nodes_30d',
+             'events_meta.nodes','events_meta.cats',
              'ewma','bin_ewma') # tuple/list/set of attributes the method may change
         )
 
@@ -66,54 +131,40 @@ class EventCounter(NERDModule):
         In particular, the following updates are requested:
           ('set', 'events_meta.total{1,7,30}', number_of_events)
           ('set', 'events_meta.nodes_{1,7,30}d', number_of_unique_nodes)
+          ('set', 'events_meta.{ewma,bin_ewma}', ewma_of_last_7_days)
+          ('remove', 'events_meta.days.<date>') for days older than 30 days
+          ('extend_set', 'events_meta.{nodes,cats}', new_nodes_or_categories)
         """
         etype, key = ekey
         if etype != 'ip':
             return None
 
-        if 'events' not in rec:
+        events_meta = rec.get('events_meta', {})
+        if 'total' not in events_meta:
             return None # No Warden event, nothing to do
 
-        today = datetime.datetime.utcnow().date()
-        
-        total1 = 0
-        total7 = 0
-        total30 = 0
-        nodes1 = set()
-        nodes7 = set()
-        nodes30 = set()
-
-        alerts_per_day = [0]*7;
-
-        for evtrec in rec['events']:
-            n = evtrec['n']
-            date = evtrec['date']
-            date = datetime.date(int(date[0:4]), int(date[5:7]), int(date[8:10]))
-            days_diff = (today - date).days
-
-            if days_diff <= 1:
-                total1 += n
-                nodes1.add(evtrec['node'])
-            if days_diff <= 7:
-                total7 += n
-                nodes7.add(evtrec['node'])
-            if days_diff <= 30:
-                total30 += n
-                nodes30.add(evtrec['node'])
-
-            if days_diff < 7:
-                alerts_per_day[days_diff] += n;
-
-        g.um.update(('ip', key), [
-            ('set', 'events_meta.total1', total1),
-            ('set', 'events_meta.total7', total7),
-            ('set', 'events_meta.total30', total30),
-            ('set', 'events_meta.nodes_1d', len(nodes1)),
-            ('set', 'events_meta.nodes_7d', len(nodes7)),
-            ('set', 'events_meta.nodes_30d', len(nodes30)),
-            ('set', 'events_meta.ewma', sum(n*w for n,w in zip(alerts_per_day, EWMA_WEIGHTS))),
-            ('set', 'events_meta.bin_ewma', sum((w if n else 0) for n,w in zip(alerts_per_day, EWMA_WEIGHTS)))
-        ])
+        days = events_meta.get('days', {})
+        values, old_days = summarize_days(days, datetime.datetime.utcnow().date())
+        actions = [('set', 'events_meta.' + attr, value) for attr, value in values.items()]
+
+        # Rotate per-day counters (remove days which are too old)
+        for date in old_days:
+            actions.append(('remove', 'events_meta.days.' + date))
+
+        # Add newly seen nodes and categories to the lists of all of them (they are recomputed from the event store
+        # daily by Cleaner, when old events expire)
+        nodes = set()
+        cats = set()
+        for date, day in days.items():
+            if date not in old_days:
+                nodes.update(day['nodes'])
+                cats.update(day['cats'])
+        new_nodes = set(map(unescape_name, nodes)).difference(events_meta.get('nodes', []))
+        new_cats = set(map(unescape_name, cats)).difference(events_meta.get('cats', []))
+        if new_nodes:
+            actions.append(('extend_set', 'events_meta.nodes', sorted(new_nodes)))
+        if new_cats:
+            actions.append(('extend_set', 'events_meta.cats', sorted(new_cats)))
+
+        g.um.update(('ip', key), actions)
         return None
-
-
@@ -3,6 +3,7 @@ NERD module determines main types of attack going from IP according to given par
 """
 
 from core.basemodule import NERDModule
+from common.event_store import DAYS_KEPT, unescape_name
 
 import g
 
@@ -61,7 +62,8 @@ class EventTypeCounter(NERDModule):
         if etype != 'ip':
             return None
 
-        if 'events' not in rec:
+        events_meta = rec.get('events_meta', {})
+        if 'total' not in events_meta:
             return None # No Warden event, nothing to do
 
         ret = []
@@ -76,16 +78,26 @@ class EventTypeCounter(NERDModule):
             # Let's compare days as strings - it works thanks to ISO format 
             # and it's faster than to convert all string keys in DB to datetime
             minday = minday.strftime("%Y-%m-%d")
-        for evtrec in rec['events']:
-            if minday and evtrec['date'] < minday:
-                continue
-            cat = evtrec['cat']
-            n = evtrec['n']
-            total_events += n
-            if cat not in types:
-                types[cat] = n
-            else:
-                types[cat] += n
+        if minday and self.event_days < DAYS_KEPT:
+            # The period is covered by per-day counters in the record, no need to load events
+            for date, day in events_meta.get('days', {}).items():
+                if date < minday:
+                    continue
+                for cat, n in day['cats'].items():
+                    cat = unescape_name(cat)
+                    total_events += n
+                    types[cat] = types.get(cat, 0) + n
+        else:
+            for evtrec in g.event_store.get(key, events_meta['total']):
+                if minday and evtrec['date'] < minday:
+                    continue
+                cat = evtrec['cat']
+                n = evtrec['n']
+                total_events += n
+                if cat not in types:
+                    types[cat] = n
+                else:
+                    types[cat] += n
 
         if total_events < self.event_min:
 #             if self.event_days is not None:
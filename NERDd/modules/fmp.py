@@ -10,6 +10,7 @@ from datetime import datetime, timedelta, timezone
 import re
 import os
 import fcntl
+import threading
 
 import xgboost as xgb
 
@@ -62,14 +63,13 @@ class FMP(NERDModule):
         # Load paths where trained data models are stored.
         self.modelsPaths = g.config.get("fmp.models", {"general" : "/data/fmp/models/general.bin"})
         self.models = {}
+        self.models_lock = threading.Lock()
 
-        # Load trained data models.
+        # Trained data models are loaded lazily on first use (see getModel), so they don't slow down start of the worker.
         for fmptype, filename in self.modelsPaths.items():
             # xgb.load_model can segfault if file does not exist, so check it in advance
             if os.path.exists(filename):
-                self.models[fmptype] = xgb.Booster({'nthread': 4})
-                self.models[fmptype].load_model(filename)
-                self.log.info("Successfully loaded xgBoost model '{}' from file {}".format(fmptype, filename))
+                self.models[fmptype] = None
             else:
                 self.log.warning('Unable to find model file "{}" for type "{}".'.format(filename, fmptype))
 
@@ -91,12 +91,26 @@ class FMP(NERDModule):
         }
 
         # Register all necessary handlers.
-        g.um.register_handler(
-            self.updateFMPGeneral,
-            'ip',
-            ('!every1d',),
-            ('fmp',)
-        )
+        # (if 'batch_rescoring' and 'batch_rescoring_fmp' are enabled, FMP of all IPs is computed daily by
+        # scripts/rescore_ips.py instead)
+        if not (g.config.get('batch_rescoring', False) and g.config.get('batch_rescoring_fmp', False)):
+            g.um.register_handler(
+                self.updateFMPGeneral,
+                'ip',
+                ('!every1d',),
+                ('fmp',)
+            )
+
+    def getModel(self, fmptype):
+        """Return trained data model of given type, load it from file on first call."""
+        with self.models_lock:
+            if self.models[fmptype] is None:
+                filename = self.modelsPaths[fmptype]
+                model = xgb.Booster({'nthread': 4})
+                model.load_model(filename)
+                self.log.info("Successfully loaded xgBoost model '{}' from file {}".format(fmptype, filename))
+                self.models[fmptype] = model
+            return self.models[fmptype]
 
     def updateFMPGeneral(self, ekey, rec, updates):
         etype, ip = ekey
@@ -189,7 +203,7 @@ class FMP(NERDModule):
 
         # Insert transformed feature vector to the trained model.
         dtest = xgb.DMatrix(np.array([transFeatV]))
-        fmp = float(self.models['general'].predict(dtest))
+        fmp = float(self.getModel('general').predict(dtest))
 
         # Update fmp.general in the IP record.
         actions.append(('set', 'fmp.general', fmp))
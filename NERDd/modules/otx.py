@@ -7,7 +7,6 @@ Note: Base URL can also be https://otx.alienvault.com/api, it seems to be comple
 from core.basemodule import NERDModule
 import g
 
-import requests
 import logging
 import json
 import threading
@@ -30,6 +29,8 @@ class OTX(NERDModule):
 
         self.apikey = g.config.get('otx_api_key', None)
         self.otx = OTXv2(self.apikey, server=OTX_SERVER)
+        # Queries are made by the lookup executor, so they don't block worker threads
+        g.lookups.register_provider('otx')
 
         g.um.register_handler(
             self.set_otx_general,  # function (or bound method) to call
@@ -40,7 +41,7 @@ class OTX(NERDModule):
 
     def set_otx_general(self, ekey, rec, updates):
         """
-        Gets data from DShield api, parses them and returns them.
+        Submits a query to OTX api, the result is stored by query_otx.
         """
 
         etype, key = ekey
@@ -48,6 +49,15 @@ class OTX(NERDModule):
         if etype != 'ip':
             return None
 
+        return g.lookups.submit('otx', ekey, self.query_otx, key)
+
+    def query_otx(self, key):
+        """
+        Gets data from OTX api, parses them and returns them.
+
+        Called by the lookup executor (in a separate thread).
+        Returns list of update requests or None in case of error.
+        """
         self.log.debug("Querying OTX for {}".format(key))
         relate_pulses = []
         try:
@@ -57,11 +67,9 @@ class OTX(NERDModule):
             self.log.error("Error occured in OTX {}".format(e))
             return None
         if relate_pulses == []:
-            return None
-
-        g.um.update(('ip', key), [('set', 'otx.relate_pulses', relate_pulses)])
+            return []
 
-        return None
+        return [('set', 'otx.relate_pulses', relate_pulses)]
 
 
 """
@@ -8,7 +8,6 @@ import g
 import logging
 import redis
 from datetime import datetime 
-import requests
 import json
 import os.path
 
@@ -77,6 +76,10 @@ class PassiveDNSResolver(NERDModule):
         
         self.log.info("Loaded {} domain blacklists: {}".format(len(blnames), ', '.join(blnames)))
 
+        # Queries are made by the lookup executor, so they don't block worker threads
+        g.lookups.register_provider('passive_dns')
+        self.session = g.lookups.get_session('passive_dns')
+
         itemlist = ['dbl.' + id for id in blnames]
         self.log.debug("Registering {0}".format(itemlist))
         g.um.register_handler(
@@ -99,18 +102,27 @@ class PassiveDNSResolver(NERDModule):
           2-tuples: [(attr, val), (!event, param), ...]
 
         Returns:
-        List of update requests.
+        None, the query is made by the lookup executor (see query_domains).
         """
         etype, key = ekey
         if etype != 'ip':
             return None
 
+        return g.lookups.submit('passive_dns', ekey, self.query_domains, key)
+
+    def query_domains(self, key):
+        """
+        Query Passive DNS and blacklists (called by the lookup executor in a separate thread).
+
+        Returns:
+        List of update requests or None in case of error.
+        """
         # Get all domain names related to the IP
         actions = []
         response = None
         url = "{}ip/{}?token={}".format(self.base_url, key, self.token)
         try:
-            response = requests.get(url, timeout=5)
+            response = self.session.get(url, timeout=5)
         except Exception as e: # Connection error
             self.log.error("Can't query '{}': {}".format(url, e)) 
             return None
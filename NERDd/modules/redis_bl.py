@@ -93,9 +93,10 @@ class RedisBlacklist(NERDModule):
         #   bl:<id>:time -> time of last blacklist update (in ISO format)
         #   bl:<id>:list -> SET of IPs that are on the blacklist
         # where <id> is unique name of the blacklist (should't contains spaces ' ' or colons ':')
-        bl_names = [key[3:-5].decode('ascii') for key in self.redis.keys("bl:*:name")]
+        # (SCAN is used instead of KEYS, which blocks Redis while going through the whole keyspace)
+        bl_names = sorted(key[3:-5].decode('ascii') for key in self.redis.scan_iter("bl:*:name", count=1000))
         # pbl means prefix blacklist (192.168.0.0 - 192.168.0.255)
-        pbl_names = [key[4:-5].decode('ascii') for key in self.redis.keys("pbl:*:name")]
+        pbl_names = sorted(key[4:-5].decode('ascii') for key in self.redis.scan_iter("pbl:*:name", count=1000))
 
         # create all normal blacklists
         self.blacklists = [Blacklist(self.redis, bl_name) for bl_name in bl_names]
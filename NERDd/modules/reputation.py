@@ -30,10 +30,14 @@ class Reputation(NERDModule):
     """
 
     def __init__(self):
+        triggers = ('events_meta.total','!every1d',)
+        if g.config.get('batch_rescoring', False):
+            # Daily update of all IPs is done by scripts/rescore_ips.py
+            triggers = ('events_meta.total',)
         g.um.register_handler(
             self.estimate_reputation, # function (or bound method) to call
             'ip', # entity type
-            ('events_meta.total','!every1d',), # tuple/list/set of attributes to watch (their update triggers call of the registered method)
+            triggers, # tuple/list/set of attributes to watch (their update triggers call of the registered method)
             ('rep',) # tuple/list/set of attributes the method may change
         )
 
@@ -54,7 +58,8 @@ class Reputation(NERDModule):
         if etype != 'ip':
             return None
 
-        if 'events' not in rec:
+        events_meta = rec.get('events_meta', {})
+        if 'total' not in events_meta:
             return None # No Warden event, nothing to do
 
         today = datetime.datetime.utcnow().date()
@@ -64,14 +69,14 @@ class Reputation(NERDModule):
         # (index 'd' of arrays is 'number of days before today')
         num_events = [0 for _ in range(DATE_RANGE)]
         set_nodes = [set() for _ in range(DATE_RANGE)]
-        for evtrec in rec['events']:
-            date = evtrec['date']
+        # (taken from per-day counters in the record, see common/event_store.py)
+        for date, day in events_meta.get('days', {}).items():
             date = datetime.date(int(date[0:4]), int(date[5:7]), int(date[8:10]))
             d = (today - date).days
             if d >= DATE_RANGE:
                 continue
-            num_events[d] += evtrec['n']
-            set_nodes[d].add(evtrec['node'])
+            num_events[d] += day['n']
+            set_nodes[d].update(day['nodes'])
         
         # Compute reputation score
         sum_weight = 0
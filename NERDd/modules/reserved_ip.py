@@ -1,36 +1,32 @@
 """
-NERD module checks whether the ip address is reserved or not, based on the list:
-https://en.wikipedia.org/wiki/Reserved_IP_addresses
+NERD module checks whether the ip address is reserved or not, based on the IANA special-purpose address registries:
+https://www.iana.org/assignments/iana-ipv4-special-registry/
+https://www.iana.org/assignments/iana-ipv6-special-registry/
+(see common/special_ranges.py)
 """
 
 import logging
-import re
 
 from core.basemodule import NERDModule
+from common.special_ranges import SpecialRangeClassifier
 import g
 
 
 class ReservedIPTags(NERDModule):
-    # these prefixes stands for 0.0.0.0 - 0.255.255.255, 10.0.0.0 - 10.255.255.255, ...
-    # https://en.wikipedia.org/wiki/Reserved_IP_addresses
-    reserved_ip_prefix_list = ["0.", "10.", "127.", "169.254.", "192.0.0.", "192.0.2", "192.168.", "198.51.100.",
-                               "203.0.113.", "255.255.255.255"]
-
-    # list of regular expressions for more complicated ip ranges. The first one is:
-    #                       100.64.0.0 - 100.127.255.255
-    #                       100. 64-69|70-99|100-119|120-127 .0-255.0-255
-    # The rest is in the same format, so only ranges are in the comment. The end of range (0-255 = \d{1,3}) is not
-    # absolutely correct part of the regular expression, but should be totally fine in this use case.
-    reserved_ip_re_list = [re.compile("100\.(6[4-9]|[7-9][0-9]|1[0-1][0-9]|12[0-7])\.\d{1,3}\.\d{1,3}"),
-                           # 172.16.0.0 - 172.31.255.255
-                           re.compile("172\.(1[6-9]|2[0-9]|3[0-1])\.\d{1,3}\.\d{1,3}"),
-                           # 198.18.0.0 - 198.19.255.255
-                           re.compile("198\.1[8-9]\.\d{1,3}\.\d{1,3}]"),
-                           # 224.0.0.0 - 255.255.255.255
-                           re.compile("2(2[4-9]|[3-4][0-9]|5[0-5])\.\d{1,3}\.\d{1,3}\.\d{1,3}")]
 
     def __init__(self):
-        # self.logger = logging.getLogger("ReservedIPTags")
+        self.log = logging.getLogger("ReservedIPTags")
+        # Registries in CSV format (optional, built-in copy of the registries is used if not set)
+        registry_files = g.config.get('reserved_ip.iana_registries', [])
+        try:
+            if registry_files:
+                self.classifier = SpecialRangeClassifier.from_files(registry_files)
+            else:
+                self.classifier = SpecialRangeClassifier()
+        except (OSError, ValueError, KeyError) as e:
+            self.log.error("Can't load IANA special-purpose registries ({}), using the built-in copy.".format(e))
+            self.classifier = SpecialRangeClassifier()
+
         g.um.register_handler(
             self.is_reserved,
             'ip',
@@ -58,20 +54,11 @@ class ReservedIPTags(NERDModule):
         if etype != 'ip':
             return None
 
-        # Go through all the prefixes and try to match the IP (key) with prefix. When match found, then tag it. If no
-        # match found, try the rest of reserved ranges (regular expressions)
-        for ip_prefix in ReservedIPTags.reserved_ip_prefix_list:
-            if key.startswith(ip_prefix):
-                # tag it, set 1 as True, because IP is in reserved range
-                g.um.update(('ip', key), [('set', 'reserved_range', 1)])
-                return None
-        else:
-            for re_ip in ReservedIPTags.reserved_ip_re_list:
-                if re_ip.search(key):
-                    # tag it, set 1 as True, because IP is in reserved range
-                    g.um.update(('ip', key), [('set', 'reserved_range', 1)])
-                    return None
+        try:
+            reserved_block = self.classifier.classify(key)
+        except ValueError:
+            self.log.error("Invalid IP address: {}".format(key))
+            return None
 
-        g.um.update(('ip', key), [('set', 'reserved_range', 0)])
-        return None
-        # set 0 as False, because IP is not in reserved range
+        # set 1 as True if IP is in reserved range, 0 as False otherwise
+        return [('set', 'reserved_range', 1 if reserved_block else 0)]
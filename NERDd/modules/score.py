@@ -31,17 +31,22 @@ class Score(NERDModule):
     TODO better description
     
     Event flow specification:
-      !every1d -> estimate_reputation -> rep
+      !NEW, !every1d, !refresh_rep -> estimate_reputation -> rep, rep_history
+    (!every1d is not used if 'batch_rescoring' is enabled)
     """
     # decay function's factor
     decay_factor = 1
 
     def __init__(self):
         self.log = logging.getLogger("Scoremodule")
+        triggers = ('!NEW','!every1d','!refresh_rep')
+        if g.config.get('batch_rescoring', False):
+            # Daily update of all IPs is done by scripts/rescore_ips.py
+            triggers = ('!NEW','!refresh_rep')
         g.um.register_handler(
             self.estimate_reputation, # function (or bound method) to call
             'ip', # entity type
-            ('!NEW','!every1d','!refresh_rep'), # tuple/list/set of attributes to watch (their update triggers call of the registered method)
+            triggers, # tuple/list/set of attributes to watch (their update triggers call of the registered method)
             ('rep',) # tuple/list/set of attributes the method may change
         )
 
@@ -10,21 +10,8 @@ import g
 
 import time
 import logging
-import threading
 import shodan
 
-# *** Global lock disabling parallel querying ***
-# Shodan API has a limit on query rate. Normally API response is so slow
-# (there is probably an artifically added delay) that the threshold can not be
-# exceeded by sequential querying. If we would send queries by more threads in
-# parallel, the rate limit would be easily exceeded and API would return errors.
-#
-# IMPORTANT: The API query takes around 0.7 second (according to my experiments 
-# at the time of writing), so maximal rate of queries is ~1.4/s.
-# THIS LIMITS THE MAXIMAL RATE OF NEW IPs NERD CAN PROCESS and also MAXIMAL 
-# NUMBER OF IPs IN DATABASE (since Shodan info of IPs is updated every week)
-shodan_api_lock = threading.Lock()
-
 
 class Shodan(NERDModule):
     """
@@ -56,6 +43,20 @@ class Shodan(NERDModule):
             self.log.error("Shodan module disabled.")
             return
 
+        # *** No parallel querying ***
+        # Shodan API has a limit on query rate. Normally API response is so slow
+        # (there is probably an artifically added delay) that the threshold can not be
+        # exceeded by sequential querying. If we would send queries by more threads in
+        # parallel, the rate limit would be easily exceeded and API would return errors.
+        # So queries are made by the lookup executor using a single thread.
+        #
+        # IMPORTANT: The API query takes around 0.7 second (according to my experiments 
+        # at the time of writing), so maximal rate of queries is ~1.4/s.
+        # THIS LIMITS THE MAXIMAL RATE OF NEW IPs NERD CAN QUERY and also MAXIMAL 
+        # NUMBER OF IPs IN DATABASE (since Shodan info of IPs is updated every week)
+        # (but worker threads are not blocked by the queries)
+        g.lookups.register_provider('shodan', concurrency=1)
+
         g.um.register_handler(
             self.getShodanInfo, # function (or bound method) to call
             'ip', # entity type
@@ -77,6 +78,23 @@ class Shodan(NERDModule):
           their new values (or events and their parameters) as a list of 
           2-tuples: [(attr, val), (!event, param), ...]
         
+        Returns:
+        None, the query is made by the lookup executor (see queryShodan).
+        """
+        if not self.enabled:
+            return None
+        
+        etype, key = ekey
+        if etype != 'ip':
+            return None
+        
+        return g.lookups.submit('shodan', ekey, self.queryShodan, key)
+    
+    
+    def queryShodan(self, ip):
+        """
+        Query Shodan API (called by the lookup executor in a separate thread).
+        
         Returns:
         List of the following update requests (some may not be present):
           ('set', 'shodan.ports', [list_of_numbers])
@@ -84,21 +102,15 @@ class Shodan(NERDModule):
           ('set', 'shodan.devicetype', 'device_type')
           ('set', 'shodan.linktype', 'link_type')
           ('set', 'shodan.tags', 'tags')  # e.g. "vpn" or "tor"
+        None in case of error.
         """
         if not self.enabled:
             return None
         
-        etype, key = ekey
-        if etype != 'ip':
-            return None
-        
-        ip = key
-
         self.log.debug("Querying Shodan for {}".format(ip))
         
         try:
-            with shodan_api_lock: # This ensures only one thread can process the query at a time
-                data = self.client.host(ip, minify=True)
+            data = self.client.host(ip, minify=True)
         except shodan.exception.APIError as e:
             if str(e) == "No information available for that IP.":
                 self.log.debug("Shodan info for {}: Not found".format(ip))
@@ -158,6 +170,4 @@ class Shodan(NERDModule):
         
         self.log.debug("Shodan update requests for {}: {}".format(ip, update_requests))
         
-        
-        g.um.update(('ip', key), update_requests)
-        return None
+        return update_requests
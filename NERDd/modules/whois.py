@@ -3,31 +3,34 @@ NERD module getting information about IPs, IP blocks, BGP prefixes, autonomous s
 
 Requirements:
 - "dnspython" package
+- "numpy" package (for local prefix table and reference data)
 """
 
 from core.basemodule import NERDModule
 import g
 
-import socket
 import sys
 import logging
 import io
-import csv
-import bisect
 import ipaddress
 
 from dns import resolver
 from dns.exception import *
 
-from collections import defaultdict
 import IPy
 
+from common.prefix_table import PrefixTable
+from common import refdata
+from common.whois_client import WhoisClient
+
 class WhoIS(NERDModule):
     """
     WhoIS module.
 
     Queries RIRs and whois.cymru.com about newly added IPs,
     it also gathers information about corresponding IP blocks, BGP prefixes, autonomous systems and organizations.
+    BGP prefix and origin ASNs of an IP are taken from a local prefix table (compiled from RouteViews pfx2as dumps,
+    see 'whois.pfx2as_file' config) if it's available, whois.cymru.com is queried only for IPs not found there.
 
     Stores the following attributes:
 
@@ -75,24 +78,48 @@ class WhoIS(NERDModule):
         !NEW ip -> getIPInfo -> getBGPPrefInfo
                              -> getASNInfo      -> getOrgInfo
                              -> getBlockInfo    -> getOrgInfo
+
+    Reference counters (_ref_cnt) are changed through g.um.counters, i.e. changes are accumulated and applied
+    periodically by one task per record (see core/delta_counters.py), so check* handlers deleting unreferenced records
+    are called once per such task.
     """
 
     def __init__(self):
-        # Load files used for mapping IPv4 to RIR and ASN to RIR to the program memory.
-        # Both files have to be already sorted.
+        # Map reference data used for mapping IPv4 to RIR and ASN to RIR etc. (the files are compiled into memory-mapped
+        # tables shared by all workers, see common/refdata.py). ASN and IPv4 files have to be already sorted.
         self.log = logging.getLogger("WhoISmodule")
-        asnFile = g.config.get("whois.asn_file", "/tmp/nerd-whois-asn.csv")
-        ipv4File = g.config.get("whois.ipv4_file", "/tmp/nerd-whois-ipv4.csv")
-        asdbFile = g.config.get("whois.asdb_file", "/tmp/asdb.csv")
-        cloudipsFile = g.config.get("whois.cloudips_file", "/tmp/cloudips.csv")
+        self.refdata_dir = g.config.get("refdata_dir", "/data/refdata")
+        self.refdata_sources = {
+            'whois_asn': g.config.get("whois.asn_file", "/tmp/nerd-whois-asn.csv"),
+            'whois_ipv4': g.config.get("whois.ipv4_file", "/tmp/nerd-whois-ipv4.csv"),
+            'asdb': g.config.get("whois.asdb_file", "/tmp/asdb.csv"),
+            'cloudips': g.config.get("whois.cloudips_file", "/tmp/cloudips.csv"),
+        }
+        self.refdata = {}
         try:
-            self.asn_array = self.loadASN(asnFile)
-            self.ipv4_array = self.loadIPv4(ipv4File)
-            self.asdb_dict= self.loadASdb(asdbFile)
-            self.cloudips_dict= self.loadCloudips(cloudipsFile)
-        except OSError as e:
+            for name in self.refdata_sources:
+                self.loadRefData(name)
+        except (OSError, ValueError) as e:
             self.log.error(str(e) + ' -> Unable to start the WhoIS module.')
             return
+        g.scheduler.register(self.reloadRefData, minute="*/10")
+
+        # Load local table of BGP prefixes (if configured), it's reloaded automatically when the file changes
+        self.pfx2as_file = g.config.get("whois.pfx2as_file", None)
+        self.prefix_table = None
+        if self.pfx2as_file:
+            self.loadPrefixTable()
+            g.scheduler.register(self.reloadPrefixTable, minute="*/10")
+
+        # Client for queries to RIR whois servers, responses are cached in a local database shared by all workers
+        self.whois_client = WhoisClient(
+            cache_file=g.config.get("whois.cache_file", None),
+            cache_ttl=g.config.get("whois.cache_ttl", 7*24*3600),
+            servers=g.config.get("whois.servers", {}),
+            timeout=g.config.get("whois.timeout", 5),
+            rate_limit_backoff=g.config.get("whois.rate_limit_backoff", 60),
+        )
+        g.scheduler.register(self.whois_client.purge_cache, hour=3, minute=15)
 
         # Initialize DNS resolver (for queries to asn.cymru.com)
         self.dnsresolver = resolver.Resolver()
@@ -170,72 +197,45 @@ class WhoIS(NERDModule):
             tuple()
         )
 
-    def loadASN(self, asnFile):
-        self.log.info('Loading information about ASN allocation from file: {}.'.format(asnFile))
-        dataFile = open(asnFile, 'r')
-        datareader = csv.reader(dataFile, delimiter=',')
-
-        # Create a tuple of 2 arrays: row:([ASN], [RIR])
-        data = ([],[])
-        for row in datareader:
-            data[0].append(int(row[0]))
-            data[1].append(row[1])
-
-        return data
-
-    def loadCloudips(self, cloudipsFile):
-        self.log.info('Loading information about cloudips from file: {}.'.format(cloudipsFile))
-        cloudips_dict = defaultdict()
-        with open(cloudipsFile, "r") as f:
-            for line in f:
-                ip, netmask, provider, comment  = line.strip().split(",")
-                ip_int = IPy.IP(ip).int()
-                ipcidr = IPy.IP("{}/{}".format(ip, netmask))
-                cloudips_dict[ipcidr] = [ip, netmask,  provider, comment]
-        return cloudips_dict
-
-    def loadASdb(self, asdbFile):
-        self.log.info('Loading information about ASdb from file: {}.'.format(asdbFile))
-        asn_dict = defaultdict()
-        with open(asdbFile, "r") as f:
-            for line in f:
-                line = line.strip().split(',"')
-                asn = line[0]
-                if asn == "ASN":
-                    continue
-                categories = line[1:]
-                cat	= [(cat_subcat[0].strip('"'), cat_subcat[1].strip('"')) for cat_subcat in zip(categories[0::2], categories[1::2])]
-                asn_dict[asn[2:]] = cat
-        return asn_dict
-
-    def loadIPv4(self, ipv4File):
-        self.log.info('Loading information about IP blocks allocation from file: {}.'.format(ipv4File))
-        dataFile = open(ipv4File, 'r')
-        datareader = csv.reader(dataFile, delimiter=',')
-
-        # Create a tuple of 2 arrays: row:([IP], [RIR])
-        # IPs are in numeric form (long int)
-        data = ([],[],[])
-        for row in datareader:
-            data[0].append(int(row[0]))
-            data[1].append(int(row[1]))
-            data[2].append(row[2])
-
-        return data
+    def loadRefData(self, name):
+        source = self.refdata_sources[name]
+        self.log.info('Loading reference data "{}" from file: {}.'.format(name, source))
+        self.refdata[name] = refdata.load(name, source, self.refdata_dir)
+
+    def reloadRefData(self):
+        # Called periodically, reload the tables whose source files were changed (by download_data_files.sh etc.)
+        for name, table in list(self.refdata.items()):
+            if table.is_outdated():
+                try:
+                    self.loadRefData(name)
+                except (OSError, ValueError) as e:
+                    self.log.error('Unable to reload reference data "{}": {}'.format(name, e))
+
+    def loadPrefixTable(self):
+        self.log.info('Loading BGP prefix table from file: {}.'.format(self.pfx2as_file))
+        try:
+            self.prefix_table = PrefixTable(self.pfx2as_file)
+        except (OSError, ValueError) as e:
+            self.log.error(str(e) + ' -> BGP prefixes will be queried at origin.asn.cymru.com only.')
+            return
+        self.log.info('Loaded {} BGP prefixes.'.format(self.prefix_table.num_prefixes))
+
+    def reloadPrefixTable(self):
+        # Called periodically, reload the table if the file was changed (by scripts/download_pfx2as.sh)
+        if self.prefix_table is None or self.prefix_table.is_outdated():
+            self.loadPrefixTable()
 
     def findIPBlockData(self, ip):
-        int_ip = int(ipaddress.ip_address(ip))
-        pos = bisect.bisect_left(self.ipv4_array[0], int_ip)
-        try:
-            if self.ipv4_array[0][pos] != int_ip:
-                pos -= 1
-        except IndexError as e:
-                pos -= 1
+        addr = ipaddress.ip_address(ip)
+        block = self.refdata['whois_ipv4'].find('v4', int(addr)) if addr.version == 4 else None
+        if block is None:
+            self.log.debug('IP address {} is not in any known IP block.'.format(ip))
+            return None, False
 
         d = {
-            'first_ip' : str(ipaddress.ip_address(self.ipv4_array[0][pos])),
-            'last_ip' : str(ipaddress.ip_address(self.ipv4_array[1][pos])),
-            'rir' : self.ipv4_array[2][pos]
+            'first_ip' : str(ipaddress.ip_address(block[0])),
+            'last_ip' : str(ipaddress.ip_address(block[1])),
+            'rir' : block[2]
         }
 
         if d['rir'][0] == 'R':
@@ -250,14 +250,10 @@ class WhoIS(NERDModule):
         return d, False
 
     def findASNRIR(self, asn):
-        pos = bisect.bisect_left(self.asn_array[0], asn)
-        try:
-            if self.asn_array[0][pos] != asn:
-                pos -= 1
-        except IndexError as e:
-                pos -= 1
-
-        rir = self.asn_array[1][pos]
+        rir = self.refdata['whois_asn'].find('int', int(asn))
+        if rir is None:
+            self.log.warning('Observed ASN {} not in any known range. Querying impossible.'.format(asn))
+            return None, True
         if rir[0] == 'R':
             rir = rir.split(':')[1]
             self.log.warning('Observed reserved ASN {}. Querying still possible to: {}.'.format(asn, rir))
@@ -274,9 +270,9 @@ class WhoIS(NERDModule):
             return None
 
         if 'bgppref' in rec:
-            g.um.update(('bgppref', rec['bgppref']), [('*sub', '_ref_cnt', 1)])
+            g.um.counters.sub(('bgppref', rec['bgppref']), '_ref_cnt')
         if 'ipblock' in rec:
-            g.um.update(('ipblock', rec['ipblock']), [('*sub', '_ref_cnt', 1)])
+            g.um.counters.sub(('ipblock', rec['ipblock']), '_ref_cnt')
 
         return None
 
@@ -302,7 +298,7 @@ class WhoIS(NERDModule):
         if len(rec.get('bgppref', [])) < 1:
             actions.append(('event', '!DELETE'))
             if 'org' in rec:
-                g.um.update(('org', rec['org']), [('*sub', '_ref_cnt', 1)])
+                g.um.counters.sub(('org', rec['org']), '_ref_cnt')
 
         return actions
 
@@ -316,7 +312,7 @@ class WhoIS(NERDModule):
         if rec['_ref_cnt'] < 1:
             actions.append(('event', '!DELETE'))
             if 'org' in rec:
-                g.um.update(('org', rec['org']), [('*sub', '_ref_cnt', 1)])
+                g.um.counters.sub(('org', rec['org']), '_ref_cnt')
 
         return actions
 
@@ -333,10 +329,7 @@ class WhoIS(NERDModule):
         return actions
 
     def check_cloudips(self, ip):
-        for item in self.cloudips_dict.keys():
-            if ip in item:
-                return self.cloudips_dict[item]
-        return []
+        return self.refdata['cloudips'].find_ip(ip, [])
 
     def getIPInfo(self, ekey, rec, updates):
         etype, ip = ekey
@@ -352,16 +345,73 @@ class WhoIS(NERDModule):
             actions.append(('set', 'cloudips', cloudips))
 
         # ** BGP prefixes and ASNs **
-        # Perform query to whois.cymru.com server to get BGP prefix and list of ASNs
+        if IPy.IP(ip).version() == 4:
+            actions.append(('set', 'ipversion', "4"))
+        else:
+            actions.append(('set', 'ipversion', "6"))
+            self.log.info(' get an IPv6 address: {}.'.format(ip))
+
+        # Find BGP prefix and list of ASNs in the local table, or query whois.cymru.com server if it's not there
+        route = self.prefix_table.lookup(ip) if self.prefix_table is not None else None
+        if route is not None:
+            prefix, asn_list = route
+            cymru_rir = None
+            cymru_ok = True
+        else:
+            route = self.queryCymru(ip)
+            if route is not None:
+                prefix, asn_list, cymru_rir = route
+                cymru_ok = True
+
+        if cymru_ok:
+            #self.log.info("IP: {}, prefix: {}, asn_list: {}".format(ip, prefix, asn_list))
+            # Create/update corresponding records
+            for asn in asn_list:
+                # Create a new ASN record (if not already present) and add BGP prefix to its list.
+                g.um.update(('asn', asn), [('add_to_set', 'bgppref', prefix)])
+            # Create a new BGP prefix record (if not already present) and add all ASNs to its list.
+            g.um.update(('bgppref', prefix), [('extend_set', 'asn', asn_list)])
+            g.um.counters.add(('bgppref', prefix), '_ref_cnt')
+            # Add BGP prefix to the IP record
+            actions.append(('set', 'bgppref', prefix))
+
+
+        # ** IP block allocation **
+        # Get IP block from IANA list
+        ip_block_data, reserved = self.findIPBlockData(ip)
+        if ip_block_data == None:
+            g.um.update(('ip', ip), actions)
+            return None
+
+
+        if cymru_ok and cymru_rir is not None and ip_block_data['rir'] != cymru_rir:
+            self.log.warning('RIRs according to IANA and asn.cymru.com doesn\'t match for ip {}. IANA: "{}", Cymru: "{}" (using the IANA one)'.format(ip, ip_block_data['rir'], cymru_rir))
+
+        # Set IP block id.
+        inet = ip_block_data['first_ip'] + " - " + ip_block_data['last_ip']
+
+        # Add IP block to the IP record
+        actions.append(('set', 'ipblock', inet))
+
+        # Create new IP block record (if not already present) - by the first change of its reference counter
+        g.um.counters.add(('ipblock', inet), '_ref_cnt')
+        g.um.update(('ip', ip), actions)
+        return None
+
+
+    def queryCymru(self, ip):
+        """
+        Perform query to whois.cymru.com server to get BGP prefix and list of ASNs.
+
+        Returns:
+        tuple (prefix, [asn, ...], rir) or None if the query fails
+        """
         if IPy.IP(ip).version() == 4:
             reverse_ip = ".".join(ip.split(".")[::-1])
             query = reverse_ip + ".origin.asn.cymru.com"
-            actions.append(('set', 'ipversion', "4"))
         else:
             reverse_ip = ".".join([x for x in str(IPy.IP(ip).strHex())[2:][::-1]])
             query = reverse_ip + ".origin6.asn.cymru.com"
-            actions.append(('set', 'ipversion', "6"))
-            self.log.info(' get an IPv6 address: {}.'.format(ip))
         try:
             resp_list = self.dnsresolver.query(query, "TXT").rrset
             # Expected format of response (may be multiple lines):
@@ -389,47 +439,13 @@ class WhoIS(NERDModule):
                 cymru_rir = "ripe"
             asn_list = list(map(int, asns.split()))
             ipaddress.ip_network(prefix) # Test prefix validity
-            cymru_ok = True
+            return prefix, asn_list, cymru_rir
         except DNSException as e:
             self.log.warning('Unable to acquire BGP prefix or ASN from origin.asn.cymru.com. IP: {}. Aborting ASN and BGP prefix record creation.'.format(ip))
         except Exception as e:
             self.log.error('Unable to parse answer from origin.asn.cymru.com. Query: "{} TXT", Response: {}, Error: "{}"'.format(query, [str(resp) for resp in resp_list], str(e)))
-
-        if cymru_ok:
-            #self.log.info("IP: {}, prefix: {}, asn_list: {}".format(ip, prefix, asn_list))
-            # Create/update corresponding records
-            for asn in asn_list:
-                # Create a new ASN record (if not already present) and add BGP prefix to its list.
-                g.um.update(('asn', asn), [('add_to_set', 'bgppref', prefix)])
-            # Create a new BGP prefix record (if not already present) and add all ASNs to its list.
-            g.um.update(('bgppref', prefix), [('extend_set', 'asn', asn_list), ('add', '_ref_cnt', 1)])
-            # Add BGP prefix to the IP record
-            actions.append(('set', 'bgppref', prefix))
-
-
-        # ** IP block allocation **
-        # Get IP block from IANA list
-        ip_block_data, reserved = self.findIPBlockData(ip)
-        if ip_block_data == None:
-            g.um.update(('ip', ip), actions)
-            return None
-
-
-        if cymru_ok and ip_block_data['rir'] != cymru_rir:
-            self.log.warning('RIRs according to IANA and asn.cymru.com doesn\'t match for ip {}. IANA: "{}", Cymru: "{}" (using the IANA one)'.format(ip, ip_block_data['rir'], cymru_rir))
-
-        # Set IP block id.
-        inet = ip_block_data['first_ip'] + " - " + ip_block_data['last_ip']
-
-        # Add IP block to the IP record
-        actions.append(('set', 'ipblock', inet))
-
-        # Create new IP block record (if not already present).
-        g.um.update(('ipblock', inet), [('add', '_ref_cnt', 1)])
-        g.um.update(('ip', ip), actions)
         return None
 
-
     def getBGPPrefInfo(self, ekey, rec, updates):
         etype, bgp_pref = ekey
         if etype != 'bgppref':
@@ -455,9 +471,10 @@ class WhoIS(NERDModule):
         actions = []
         actions.append(('set', 'rep', 0))
 	# add as categories from asdb
-        try:
-            actions.append(('set', 'category', self.asdb_dict[str(asn)]))
-        except:
+        category = self.refdata['asdb'].find('int', int(asn))
+        if category is not None:
+            actions.append(('set', 'category', category))
+        else:
             self.log.error("Unable to find ASN:{} in asdb".format(asn))
 
         if reserved:
@@ -502,7 +519,7 @@ class WhoIS(NERDModule):
         for key in data_dict.keys():
             if key == 'org':
                 # Create a new record of the organization, if not already present.
-                g.um.update(('org', rir + ':' + data_dict[key]), [('add', '_ref_cnt', 1)])
+                g.um.counters.add(('org', rir + ':' + data_dict[key]), '_ref_cnt')
                 actions.append(('set', key, rir + ':' + data_dict[key]))
             else:
                 actions.append(('set', key, data_dict[key]))
@@ -573,7 +590,7 @@ class WhoIS(NERDModule):
         for key in data_dict.keys():
             if key == 'org':
                 # Create a new record of the organization, if not already present.
-                g.um.update(('org', rir + ':' + data_dict[key]), [('add', '_ref_cnt', 1)])
+                g.um.counters.add(('org', rir + ':' + data_dict[key]), '_ref_cnt')
                 actions.append(('set', key, rir + ':' + data_dict[key]))
             else:
                 actions.append(('set', key, data_dict[key]))
@@ -651,7 +668,7 @@ class WhoIS(NERDModule):
         """
         Wrapper function for communicating and parsing information from whois servers.
         Function attempts to connect and receive data from the whois server for a second time
-        in case of a connection failure.
+        in case of a connection failure. Responses are cached (see common/whois_client.py).
 
         Arguments:
         query -- string to be sent to the whois server
@@ -794,41 +811,4 @@ class WhoIS(NERDModule):
         return result_dict
 
     def sendRequest(self, query, hostname, port = 43):
-        try:
-            # Find IPv6 and IPv4 address.
-            info = socket.getaddrinfo(hostname, port, 0, 0, socket.SOL_TCP)
-            ipv6 = None
-            ipv4 = None
-            for i in info:
-                if not ipv6 and len(i[4]) == 4:
-                    ipv6 = i[4]
-                if not ipv4 and len(i[4]) == 2:
-                    ipv4 = i[4]
-
-            try:
-                # It is possible that host does not have IPv6 address or it is not possible to create IPv6 socket.
-                s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-                s.settimeout(5)
-                s.connect(ipv6)
-            except (socket.error, TypeError) as e:
-                # Create IPv4 socket if IPv6 socket is not an option.
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(5)
-                s.connect(ipv4)
-
-            s.send((query).encode('idna') + b"\r\n")
-            response = b''
-            while True:
-                tmp = s.recv(4096)
-                response += tmp
-                if not tmp:
-                    break
-        except socket.error as e:
-            self.log.error('Socket error: ' + str(e))
-            if 's' in locals():
-                s.close()
-            return None
-
-        s.close()
-        response = response.decode('utf-8', errors = 'replace')
-        return response
+        return self.whois_client.query(query, hostname, port)
@@ -39,6 +39,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(
 
 from common.config import read_config
 from common.task_queue import TaskQueueWriter
+from common.task_aggregator import TaskAggregator
 
 LOGFORMAT = "%(asctime)-15s,%(name)s [%(levelname)s] %(message)s"
 LOGDATEFORMAT = "%Y-%m-%dT%H:%M:%S"
@@ -84,6 +85,9 @@ rabbit_config = config.get("rabbitmq")
 num_processes = config.get('worker_processes')
 tq_writer = TaskQueueWriter(num_processes, rabbit_config)
 tq_writer.connect()
+# tasks of the same IP (e.g. from multiple pulses) are merged before they are sent
+task_aggregator = TaskAggregator(tq_writer, config.get('task_aggregation.max_age', 1.0),
+                                 config.get('task_aggregation.max_entities', 1000))
 
 scheduler = BlockingScheduler(timezone='UTC')
 
@@ -129,7 +133,7 @@ def upsert_new_pulse(pulse, indicator):
         live_till = current_time + timedelta(days=inactive_pulse_time)
     else:
         live_till = datetime.strptime(indicator['expiration'], '%Y-%m-%dT%H:%M:%S') + timedelta(days=inactive_pulse_time)
-    tq_writer.put_task('ip', ip_addr, [
+    task_aggregator.put_task('ip', ip_addr, [
         ('array_upsert', 'otx_pulses', {'pulse_id': pulse['id']}, updates),
         ('setmax', '_ttl.otx', live_till),
         ('setmax', 'last_activity', current_time)
@@ -177,6 +181,8 @@ def process_pulses(pulses):
         
         logger.info("{}/{} done, pulse {}, {} IPv4 indicators and {} IPv6 indicators added/updated".format(i+1, len(pulses), pulse.get('id', "(no id?)"), ipv4_counter, ipv6_counter))
         # logger.info("{}/{} done, pulse {}, {} IPv4 indicators added/updated".format(i+1, len(pulses), pulse.get('id', "(no id?)"), ipv4_counter))
+    task_aggregator.flush()
+    task_aggregator.log_stats()
 
 
 def get_new_pulses():
@@ -37,7 +37,6 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(
 import common.task_queue
 import common.config
 import NERDd.core.db
-import NERDd.core.mongodb
 from common.utils import parse_rfc_time
 
 CONFIG_FILE_NAME = "updater_events" # name of the file with additional events to issue
@@ -202,7 +201,12 @@ if __name__ == "__main__":
     task_queue_writer.connect()
 
     # Configure database
-    db = NERDd.core.mongodb.MongoEntityDatabase(config)
+    if config.get('entity_db', 'mongodb') == 'embedded':
+        import NERDd.core.embedded_db
+        db = NERDd.core.embedded_db.EmbeddedEntityDatabase(config)
+    else:
+        import NERDd.core.mongodb
+        db = NERDd.core.mongodb.MongoEntityDatabase(config)
 
     # Create scheduler
     scheduler = BlockingScheduler(timezone="UTC")
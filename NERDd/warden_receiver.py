@@ -7,7 +7,9 @@ detected security events.
 Fetches IDEA messages dropped to a specified directory and updates entity
 records accordingly.
 
-This module can safely run in multiple instances.
+Only one instance may read the same directory (files left in "temp" by a
+crashed instance are returned to "incoming" on start), use more worker
+processes ('warden_receiver.processes') instead.
 """
 
 import time
@@ -17,6 +19,10 @@ import json
 import logging
 import signal
 import sys
+import re
+import queue
+import threading
+import multiprocessing
 from datetime import datetime, timedelta
 import jsonpath_rw_ext
 
@@ -26,13 +32,14 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(
 from common.utils import parse_rfc_time
 import common.config
 import common.eventdb_psql
+import common.event_store
+import common.mongo
 import common.task_queue
+import common.task_aggregator
 
 # script global variables
 
-running_flag = True  # read_dir function terminates when this is set to False
-
-db_queue = [] # queue of events waiting to be written do DB in a batch
+running_flag = True  # scan_dir function terminates when this is set to False
 
 LOGFORMAT = "%(asctime)-15s,%(name)s [%(levelname)s] %(message)s"
 LOGDATEFORMAT = "%Y-%m-%dT%H:%M:%S"
@@ -43,140 +50,142 @@ log = logging.getLogger('WardenReceiver')
 ###############################################################################
 # Code for reading directory of "filer protocol"
 
-def read_dir(path, call_when_waiting=None):
+class NamedFile(object):
+    """ Wrapper class for file objects, which allows and tracks filename
+        changes.
     """
-    Indefinitely watches given directory for new files. Each incoming file is
-    read, parsed as JSON, and yield to caller (function behaves as a generator).
 
-    call_when_waiting - function to call before going to "poll wait" when there
-        are no new files.
-    """
+    def __init__(self, pth, name, fd=None):
+        self.name = name
+        self.path = pth
+        if fd:
+            self.f = os.fdopen(fd, "w+b")
+        else:
+            self.f = None
 
-    class NamedFile(object):
-        """ Wrapper class for file objects, which allows and tracks filename
-            changes.
-        """
+    def __str__(self):
+        return "%s(%s, %s)" % (type(self).__name__, self.path, self.name)
 
-        def __init__(self, pth, name, fd=None):
-            self.name = name
-            self.path = pth
-            if fd:
-                self.f = os.fdopen(fd, "w+b")
-            else:
-                self.f = None
+    def get_path(self, basepath=None, name=None):
+        return os.path.join(basepath or self.path, name or self.name)
 
-        def __str__(self):
-            return "%s(%s, %s)" % (type(self).__name__, self.path, self.name)
+    def open(self, mode):
+        return open(self.get_path(), mode)
 
-        def get_path(self, basepath=None, name=None):
-            return os.path.join(basepath or self.path, name or self.name)
+    def moveto(self, destpath):
+        os.rename(self.get_path(), self.get_path(basepath=destpath))
+        self.path = destpath
 
-        def open(self, mode):
-            return open(self.get_path(), mode)
+    def rename(self, newname):
+        os.rename(self.get_path(), self.get_path(name=newname))
+        self.name = newname
 
-        def moveto(self, destpath):
-            os.rename(self.get_path(), self.get_path(basepath=destpath))
-            self.path = destpath
+    def remove(self):
+        os.remove(self.get_path())
 
-        def rename(self, newname):
-            os.rename(self.get_path(), self.get_path(name=newname))
-            self.name = newname
 
-        def remove(self):
-            os.remove(self.get_path())
+class SafeDir(object):
+    """ Maildir like directory for safe file exchange.
+        - Producers are expected to drop files into "temp" under globally unique
+          filename and rename it into "incoming" atomically (newfile method)
+        - Workers pick files in "incoming", rename them into "temp",
+          do whatever they want, and either discard them or move into
+          "errors" directory
+    """
 
-    class SafeDir(object):
-        """ Maildir like directory for safe file exchange.
-            - Producers are expected to drop files into "temp" under globally unique
-              filename and rename it into "incoming" atomically (newfile method)
-            - Workers pick files in "incoming", rename them into "temp",
-              do whatever they want, and either discard them or move into
-              "errors" directory
-        """
+    def __init__(self, p):
+        self.path = self._ensure_path(p)
+        self.incoming = self._ensure_path(os.path.join(self.path, "incoming"))
+        self.errors = self._ensure_path(os.path.join(self.path, "errors-worker"))
+        self.temp = self._ensure_path(os.path.join(self.path, "temp-worker"))
+        self.hostname = socket.gethostname()
+        self.pid = os.getpid()
 
-        def __init__(self, p):
-            self.path = self._ensure_path(p)
-            self.incoming = self._ensure_path(os.path.join(self.path, "incoming"))
-            self.errors = self._ensure_path(os.path.join(self.path, "errors-worker"))
-            self.temp = self._ensure_path(os.path.join(self.path, "temp-worker"))
-            self.hostname = socket.gethostname()
-            self.pid = os.getpid()
+    def __str__(self):
+        return "%s(%s)" % (type(self).__name__, self.path)
 
-        def __str__(self):
-            return "%s(%s)" % (type(self).__name__, self.path)
+    def _ensure_path(self, p):
+        os.makedirs(p, exist_ok=True)
+        return p
 
-        def _ensure_path(self, p):
-            os.makedirs(p, exist_ok=True)
-            return p
+    def get_incoming(self):
+        return [NamedFile(self.incoming, n) for n in os.listdir(self.incoming)]
+
+    def requeue_temp(self):
+        """
+        Move all files from "temp" back to "incoming" (files left there when the previous run was killed or failed).
+        Returns number of moved files.
+        """
+        n = 0
+        for name in os.listdir(self.temp):
+            try:
+                NamedFile(self.temp, name).moveto(self.incoming)
+                n += 1
+            except Exception:
+                continue
+        return n
 
-        def get_incoming(self):
-            return [NamedFile(self.incoming, n) for n in os.listdir(self.incoming)]
 
-    def get_dir_list(sdir, owait_poll_time, owait_timeout, nfchunk):
+def get_dir_list(sdir, owait_poll_time, owait_timeout, nfchunk):
+    nflist = sdir.get_incoming()
+    timeout = time.time() + owait_timeout
+    while len(nflist) < nfchunk and time.time() < timeout and running_flag:
+        time.sleep(owait_poll_time)
         nflist = sdir.get_incoming()
-        timeout = time.time() + owait_timeout
-        while len(nflist) < nfchunk and time.time() < timeout and running_flag:
-            time.sleep(owait_poll_time)
-            nflist = sdir.get_incoming()
-        return nflist
+    return nflist
 
-    #######
-    # End of definitions of auxiliary classes and functions.
-    # Body of read_dir function follows ...
 
-    sdir = SafeDir(path)
+def scan_dir(sdir, chunk_size=100):
+    """
+    Indefinitely watches "incoming" directory of given SafeDir for new files.
+    Each new file is moved to "temp" directory (so no other instance of the
+    receiver can take it) and names of such files are yielded to caller in
+    chunks of at most chunk_size names (function behaves as a generator).
+
+    Files in "temp" must be removed or moved to "errors" by the caller.
+    """
     poll_time = 1  # config.get("poll_time", 5)
     owait_poll_time = 1  # config.get("owait_poll_time", 1)
     owait_timeout = poll_time  # config.get("owait_timeout", poll_time)
-    done_dir = None  # config.get("done_dir", None)
     nfchunk = 100  # min number of files read at once by get_dir_list
-    oneshot = False
 
     while running_flag:
         nflist = get_dir_list(sdir, owait_poll_time, owait_timeout, nfchunk)
         while running_flag and not nflist:
             # No new files, wait and try again
-            if call_when_waiting is not None:
-                call_when_waiting()
             time.sleep(poll_time)
             nflist = get_dir_list(sdir, owait_poll_time, owait_timeout, nfchunk)
 
-        # nfindex = 0
-        # count_ok = count_err = count_local = 0
+        chunk = []
         for nf in nflist:
             if not running_flag:
                 break
-            # prepare event array from files
             try:
                 nf.moveto(sdir.temp)
             except Exception:
                 continue  # Silently go to next filename, somebody else might have interfered
-            try:
-                # Read file and yield record
-                with nf.open("r") as fd:
-                    data = fd.read()
-                event = json.loads(data)
-                yield (data, event)
-                # Cleanup
-                if done_dir:
-                    nf.moveto(done_dir)
-                else:
-                    nf.remove()
-            except Exception as e:
-                log.exception("Exception during loading event, file={}".format(str(nf)))
-                nf.moveto(sdir.errors)
-                # count_local += 1
+            chunk.append(nf.name)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
 
 ##############################################################################
-# Test of read_dir
+# Test of scan_dir
 
-def read_dir_test():
+def scan_dir_test():
     path = "./drop_events_here"
     print("Watching for files in {}".format(os.path.join(path, "incoming")))
-    for event in read_dir(path):
-        print("------------------------------------------------------------")
-        print(json.dumps(event, indent=2))
+    sdir = SafeDir(path)
+    for chunk in scan_dir(sdir):
+        for name in chunk:
+            nf = NamedFile(sdir.temp, name)
+            print("------------------------------------------------------------")
+            with nf.open("r") as fd:
+                print(json.dumps(json.load(fd), indent=2))
+            nf.remove()
 
 
 ##############################################################################
@@ -202,22 +211,120 @@ class Sample():
             return False
 
 
+# Pattern of "simple" paths, which consist only of field names and [*] or [N] subscripts (e.g. 'Source.[*].IP4.[*]',
+# 'Node[0].Name'). These are compiled into direct dict/list accessors, other paths are evaluated by jsonpath_rw_ext.
+SIMPLE_PATH_RE = re.compile(r"^(?:[a-zA-Z_@][a-zA-Z0-9_@\-]*|\[(?:\*|[0-9]+)\])"
+                            r"(?:\.?\[(?:\*|[0-9]+)\]|\.[a-zA-Z_@][a-zA-Z0-9_@\-]*)*$")
+SIMPLE_PATH_STEP_RE = re.compile(r"\[(\*|[0-9]+)\]|([a-zA-Z_@][a-zA-Z0-9_@\-]*)")
+# Words with special meaning in JSONPath grammar, paths containing them are always passed to jsonpath_rw_ext
+JSONPATH_KEYWORDS = {"where"}
+
+
+def _field_step(name):
+    # jsonpath_rw: value of the field if the datum is a dict containing it, nothing otherwise
+    def step(values):
+        return [value[name] for value in values if isinstance(value, dict) and name in value]
+    return step
+
+
+def _slice_step(values):
+    # jsonpath_rw: all items of a list, dicts and scalars are treated as single-element lists
+    result = []
+    for value in values:
+        if isinstance(value, (dict, int, str)):
+            result.append(value)
+        else:
+            result.extend(value)
+    return result
+
+
+def _index_step(index):
+    # jsonpath_rw: N-th item of a list, nothing if the list is shorter
+    def step(values):
+        return [value[index] for value in values if len(value) > index]
+    return step
+
+
+def compile_path(pattern, fast_path=True):
+    """
+    Compiles JSONPath pattern (without the leading '$.') into a function returning list of all matched values
+    :param pattern: JSONPath pattern (e.g. 'Source.[*].IP4.[*]')
+    :param fast_path: if False, jsonpath_rw_ext is always used (for testing and benchmarking)
+    :return: function taking IDEA message and returning list of matched values
+    :raise Exception in case of wrong pattern
+    """
+    if fast_path and SIMPLE_PATH_RE.match(pattern):
+        steps = []
+        for subscript, name in SIMPLE_PATH_STEP_RE.findall(pattern):
+            if name in JSONPATH_KEYWORDS:
+                break
+            if subscript == "*":
+                steps.append(_slice_step)
+            elif subscript:
+                steps.append(_index_step(int(subscript)))
+            else:
+                steps.append(_field_step(name))
+        else:
+            def find_values(idea_message):
+                values = [idea_message]
+                for step in steps:
+                    values = step(values)
+                return values
+            return find_values
+    # general JSONPath pattern
+    parsed_pattern = jsonpath_rw_ext.parse("$." + pattern)
+
+    def find_values(idea_message):
+        return [match.value for match in parsed_pattern.find(idea_message)]
+    return find_values
+
+
+class WardenFilterRule():
+    """
+    One parsed rule of WardenFilter together with counters of its evaluations (used for reordering of rules and for
+    performance debugging).
+    """
+    def __init__(self, text, rule_list, action):
+        self.text = text
+        self.rule_list = rule_list
+        self.action = action
+        self.evaluated = 0  # number of evaluations of the rule
+        self.matched = 0  # number of messages the rule matched
+        self.time = 0.0  # total time spent by evaluation of the rule (seconds)
+
+    def cost_per_match(self):
+        """Average time spent by evaluation of the rule per one match (infinity if the rule never matched)"""
+        return self.time / self.matched if self.matched else float('inf')
+
+    def get_stats(self):
+        return {'rule': self.text, 'evaluated': self.evaluated, 'matched': self.matched, 'time': self.time}
+
+
 class WardenFilter():
     """
     Warden filter, which allows to configure, which IDEA messages are allowed to pass to NERD and which are not.
+
+    Rules are compiled when the filter is created. Consecutive rules with the same action (except 'sample') may be
+    evaluated in any order without changing the result, so they are periodically reordered by observed cost per match
+    (the cheapest and most often matching rules first).
     """
     # '!=' has to be before '='! Because if '=' would be first in case of '!=', then pattern would be split on '=' and
     # remaining '!' in pattern would be unexpected character
     SUPPORTED_OPERATORS = ('!=', "=")
     SUPPORTED_ACTIONS = ("pass", "drop", "sample")
+    # Number of filtered messages after which the rules are reordered
+    REORDER_INTERVAL = 10000
 
-    def __init__(self, rules_list):
+    def __init__(self, rules_list, fast_path=True):
         """
         Parses warden filter rules from NERD configuration (/etc/nerdd.yml) and allows to filter IDEA messages based
         on these parsed rules
         :param rules_list: Raw Warden filter rules from configuration
+        :param fast_path: compile simple patterns into direct dict/list accessors (use jsonpath_rw_ext otherwise)
         :raise: WardenFilterRuleFormatError
         """
+        self.fast_path = fast_path
+        self.messages_filtered = 0
         # check if default action is used
         self.default_action = WardenFilter._pass
         if rules_list[-1].strip().startswith(";"):
@@ -252,43 +359,42 @@ class WardenFilter():
                 rule_list = self._parse_rule(rule)
             else:
                 raise WardenFilterRuleFormatError("Logical operators AND and OR cannot be mixed!")
-            # result will be list of rules, compared values and actions -->
-            # [ ( [(rule1, operator1, compared_value1), ...], action1 ), ... ]
+            # result will be list of rules, each with list of compiled patterns, compared values and action -->
+            # [ WardenFilterRule([(rule1, operator1, compared_value1), ...], action1), ... ]
             if action.strip().startswith("sample"):
                 _, max_sample_count = action.strip().split(' ')
                 # if the action is sample, save action as Sample callable object
-                self.filter_list.append((rule_list, Sample(int(max_sample_count))))
+                action_func = Sample(int(max_sample_count))
             elif action.strip() in WardenFilter.SUPPORTED_ACTIONS:
                 if action.strip() == "pass":
-                    self.filter_list.append((rule_list, WardenFilter._pass))
+                    action_func = WardenFilter._pass
                 else:
-                    self.filter_list.append((rule_list, WardenFilter._drop))
+                    action_func = WardenFilter._drop
             else:
                 raise WardenFilterRuleFormatError("Rule uses unsupported action! Supported actions "
                                                   "are {}".format(", ".join(WardenFilter.SUPPORTED_ACTIONS)))
+            self.filter_list.append(WardenFilterRule(warden_filter_rule.strip(), rule_list, action_func))
 
-    @classmethod
-    def _parse_operator(cls, rule_operator_value):
+    def _parse_operator(self, rule_operator_value):
         """
         Parses part of rule, which contains rule, operator and comparison value
         :param rule_operator_value: string which contains rule, operator and comparison value
-        :return: pattern, operator, comparison_value, parsed pattern
+        :return: compiled pattern, operator, comparison_value
         :raise Exception in case of wrong pattern or WardenFilterRuleFormatError
         """
         # go through all supported operators and split rule with operator, which was used
-        for operator in cls.SUPPORTED_OPERATORS:
+        for operator in self.SUPPORTED_OPERATORS:
             if operator in rule_operator_value:
                 # operator found, get pattern and compared value by split and return it with found operator
                 pattern, comparison_value = rule_operator_value.split(operator)
-                # parse pattern
-                parsed_pattern = jsonpath_rw_ext.parse("$." + pattern.strip())
-                return parsed_pattern, operator, comparison_value.strip()
+                # compile pattern
+                compiled_pattern = compile_path(pattern.strip(), self.fast_path)
+                return compiled_pattern, operator, comparison_value.strip()
         else:
             raise WardenFilterRuleFormatError("Rule uses unsupported operator! Supported opperators "
-                                              "are {}!".format(", ".join(cls.SUPPORTED_OPERATORS)))
+                                              "are {}!".format(", ".join(self.SUPPORTED_OPERATORS)))
 
-    @classmethod
-    def _parse_rule(cls, rule, logical_operator=None):
+    def _parse_rule(self, rule, logical_operator=None):
         """
         Parses one whole Warden filter rule, which can consist of multiple logical operators and rules
         :param rule: Warden filter rule
@@ -303,11 +409,11 @@ class WardenFilter():
             # save the name of logical operator for future use
             rule_list = [logical_operator]
             for pattern_operator_value in rule_list_raw:
-                pattern, operator, comparison_value = cls._parse_operator(pattern_operator_value)
+                pattern, operator, comparison_value = self._parse_operator(pattern_operator_value)
                 rule_list.append((pattern, operator, comparison_value))
         else:
             # only one rule is present, there is no need to split on logical operator, just split on normal operator
-            pattern, operator, comparison_value = cls._parse_operator(rule)
+            pattern, operator, comparison_value = self._parse_operator(rule)
             rule_list = [(pattern, operator, comparison_value)]
         return rule_list
 
@@ -319,6 +425,11 @@ class WardenFilter():
     def _drop():
         return False
 
+    @staticmethod
+    def _pattern_values(pattern, idea_message):
+        # some values in IDEA message can be of type int, but compared value is always string
+        return [value if value.__class__ is str else str(value) for value in pattern(idea_message)]
+
     @staticmethod
     def _evaluate_rule(rule_list, idea_message):
         """
@@ -335,9 +446,7 @@ class WardenFilter():
             if rule_list[0] == "AND" or rule_list[0] == "OR":
                 # rule_list[1:] because 0th index is logical operator
                 for pattern, operator, compared_value in rule_list[1:]:
-                    pattern_values = [match.value for match in pattern.find(idea_message)]
-                    # some values in IDEA message can be of type int, but compared value is always string
-                    pattern_values = [str(pattern_value) for pattern_value in pattern_values]
+                    pattern_values = WardenFilter._pattern_values(pattern, idea_message)
                     if operator == "!=":
                         if compared_value in pattern_values:
                             # If operator is '!=' and compared_value was found (means '='), then return false if logic
@@ -365,9 +474,7 @@ class WardenFilter():
         else:
             # single rule with action
             pattern, operator, compared_value = rule_list[0]
-            pattern_values = [match.value for match in pattern.find(idea_message)]
-            # some values in IDEA message can be of type int, but compared value is always string
-            pattern_values = [str(pattern_value) for pattern_value in pattern_values]
+            pattern_values = WardenFilter._pattern_values(pattern, idea_message)
             if operator == "!=":
                 if compared_value not in pattern_values:
                     return True
@@ -383,115 +490,350 @@ class WardenFilter():
         :return: True if any rule passes else False
         :raise WardenFilterRuleFormatError
         """
+        self.messages_filtered += 1
+        if self.messages_filtered % self.REORDER_INTERVAL == 0:
+            self._reorder_rules()
         # go through every defined rule
-        for rule_list, action in self.filter_list:
+        for rule in self.filter_list:
+            start_time = time.perf_counter()
             try:
-                rule_passed = self._evaluate_rule(rule_list, idea_message)
-                if rule_passed:
-                    # rule matched, do the action
-                    return action()
+                rule_passed = self._evaluate_rule(rule.rule_list, idea_message)
             except Exception:
                 raise WardenFilterRuleFormatError("Warden filter rules are not in correct format!")
+            rule.time += time.perf_counter() - start_time
+            rule.evaluated += 1
+            if rule_passed:
+                # rule matched, do the action
+                rule.matched += 1
+                return rule.action()
         else:
             # if no rule matched, then do default action
             return self.default_action()
 
+    def _reorder_rules(self):
+        """
+        Sorts each run of consecutive rules with the same action by cost per match.
+
+        Rules with 'sample' action are never moved, since each of them has its own sampling counter.
+        """
+        reordered = []
+        group = []
+        for rule in self.filter_list:
+            # each Sample is a unique object, so rules with 'sample' action always form a group of their own
+            if group and rule.action is not group[0].action:
+                reordered.extend(sorted(group, key=WardenFilterRule.cost_per_match))
+                group = []
+            group.append(rule)
+        reordered.extend(sorted(group, key=WardenFilterRule.cost_per_match))
+        self.filter_list = reordered
+
+    def get_stats(self):
+        """
+        Returns list of per-rule counters (in current order of evaluation)
+        :return: list of dicts with keys 'rule', 'evaluated', 'matched' and 'time'
+        """
+        return [rule.get_stats() for rule in self.filter_list]
+
+    def log_stats(self):
+        log.info("Warden filter statistics ({} messages filtered):".format(self.messages_filtered))
+        for stats in self.get_stats():
+            log.info("  {rule!r}: evaluated {evaluated}x, matched {matched}x, {time:.3f}s total".format(**stats))
 
 ##############################################################################
-# Main module code
+# Processing of IDEA messages (done in parallel by worker processes)
 
-def put_to_db_queue(event):
+def get_event_updates(event, life_span):
     """
-    Function for writing events to EventDB
+    Extracts information needed to update records of all source IPv4 addresses of an IDEA message
+    :param event: parsed IDEA message
+    :param life_span: timedelta, how long should be the record kept since the end of the event
+    :return: list of tuples (ipv4, date, node, cat, end_time, live_till)
+    """
+    updates = []
+    for src in event.get("Source", []):
+        for ipv4 in src.get("IP4", []):
+            # TODO check IP address validity
+
+            log.debug("Updating IPv4 record {}".format(ipv4))
+            cat = '+'.join(event["Category"]).replace('.', '')
+            # Parse and reformat detect time
+            detect_time = parse_rfc_time(event["DetectTime"])  # Parse DetectTime
+            date = detect_time.strftime("%Y-%m-%d")  # Get date as a string
+
+            # Get end time of event
+            if "CeaseTime" in event:
+                end_time = parse_rfc_time(event["CeaseTime"])
+            elif "WinEndTime" in event:
+                end_time = parse_rfc_time(event["WinEndTime"])
+            elif "EventTime" in event:
+                end_time = parse_rfc_time(event["EventTime"])
+            else:
+                end_time = detect_time
+
+            node = event["Node"][-1]["Name"]
+
+            # calculate the timestamp, to which the record should be kept
+            live_till = end_time + life_span
+
+            updates.append((ipv4, date, node, cat, end_time, live_till))
+        for ipv6 in src.get("IP6", []):
+            log.debug(
+                "IPv6 address in Source found - skipping since IPv6 is not implemented yet.")  # The record follows:\n{}".format(str(event)), file=sys.stderr)
+    return updates
+
+
+def process_chunk(sdir, chunk, life_span, warden_filter, eventdb):
+    """
+    Load, store and filter events from given chunk of files (in sdir.temp), return tuple
+    (list_of_processed_files, list_of_updates).
+    """
+    processed_files = []
+    events = []
+    updates = []
+    for name in chunk:
+        nf = NamedFile(sdir.temp, name)
+        try:
+            with nf.open("r") as fd:
+                data = fd.read()
+            event = json.loads(data)
+        except Exception:
+            log.exception("Exception during loading event, file={}".format(str(nf)))
+            nf.moveto(sdir.errors)
+            continue
+        processed_files.append(name)
+        events.append(event)
+        try:
+            if warden_filter and not warden_filter.should_pass(event):
+                log.debug("event {} ignored".format(event["ID"]))
+                continue
+            updates.extend(get_event_updates(event, life_span))
+        except Exception as e:
+            log.error("ERROR in parsing event '{}': {}".format(event.get('ID', 'no-ID'), str(e)))
+
+    # Store the events to EventDB
+    if eventdb is not None and events:
+        log.debug("Writing a set of {} IDEA messages to database.".format(len(events)))
+        eventdb.put(events)
+
+    return processed_files, updates
+
+
+def parse_worker(sdir, file_queue, result_queue, life_span, warden_filter=None, eventdb_config=None):
+    """
+    Main function of a worker process.
+
+    Reads chunks of file names (files in sdir.temp) from file_queue, parses the IDEA messages, stores them to EventDB
+    (if enabled), filters them and puts a tuple (list_of_processed_files, list_of_updates) to result_queue for each
+    chunk. Files which can't be loaded are moved to sdir.errors, as well as all files of a chunk whose processing
+    failed (e.g. EventDB is not available). Exits when None is read from file_queue.
+
+    Note: each process has its own copy of warden_filter, so 'sample' actions are evaluated independently in each
+    process.
+    """
+    # Worker processes are stopped by the main process (by putting None to file_queue)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # Each process needs its own connection to EventDB
+    eventdb = None
+    if eventdb_config is not None:
+        eventdb = common.eventdb_psql.PSQLEventDatabase(eventdb_config)
+
+    while True:
+        chunk = file_queue.get()
+        if chunk is None:
+            break
+        try:
+            result = process_chunk(sdir, chunk, life_span, warden_filter, eventdb)
+        except Exception:
+            # Don't let the process die (the files would stay in "temp"), move the files to "errors" instead
+            log.exception("Exception during processing a chunk of {} files, moving them to {}".format(
+                len(chunk), sdir.errors))
+            for name in chunk:
+                try:
+                    NamedFile(sdir.temp, name).moveto(sdir.errors)
+                except Exception:
+                    pass # already moved (file couldn't be loaded)
+            continue
+        result_queue.put(result)
+
+    if warden_filter:
+        warden_filter.log_stats()
+
 
-    Pull new events from Queue and stores them to EventDB.
+##############################################################################
+# Main module code
+
+class EventAggregator():
     """
-    #log.debug("IDEA message enqueued".format(len(db_queue)))
-    db_queue.append(event)
-    if len(db_queue) >= 100:
-        put_set_to_database()
+    Sends updates of IP records extracted from events to the main task queue through TaskAggregator, so updates of
+    the same IP received within the aggregation window are merged into one task.
 
+    Numbers of events per (date, node, cat) are not part of the tasks, they are added to buckets in the event store
+    (see common/event_store.py) by one bulk write for each batch of updates, before the tasks are put. The tasks only
+    increment events_meta.total (which triggers recomputation of aggregated values by modules) and per-day counters
+    in events_meta.days and set last_activity and TTL token.
 
-def put_set_to_database():
+    Files the events were read from are removed only after all tasks are sent (i.e. confirmed by RabbitMQ), so no
+    event can be lost when the receiver is killed (but events of files processed at that time may be counted twice,
+    see add).
     """
-    Function for sending db_queue to database.
-    :return:
+    def __init__(self, sdir, task_aggregator, event_store, window=1.0):
+        """
+        :param sdir: SafeDir the processed files are in ("temp" subdirectory)
+        :param task_aggregator: TaskAggregator to send tasks to
+        :param event_store: EventStore to add numbers of events to
+        :param window: max time (in seconds) the files are kept before all tasks are sent and the files removed
+        """
+        self.sdir = sdir
+        self.task_aggregator = task_aggregator
+        self.event_store = event_store
+        self.window = window
+        self.files = []  # files whose updates may be still in the buffer of task_aggregator
+        self.first_added = None  # time the oldest file was added
+
+    def add(self, files, updates):
+        """Send updates extracted from given files"""
+        if self.first_added is None:
+            self.first_added = time.time()
+        self.files.extend(files)
+        counts = {}  # (ip, date, node, cat) -> number of events
+        for ipv4, date, node, cat, end_time, live_till in updates:
+            key = (ipv4, date, node, cat)
+            counts[key] = counts.get(key, 0) + 1
+        # Events must be in the store before the tasks triggering their processing are sent. The buckets can't be
+        # written at flush time, since task_aggregator may send some tasks already in put_task (expired or too many
+        # IPs buffered).
+        # Note: this is "at least once" - the files are removed only in flush(), so if the receiver crashes in
+        # between, the files are processed again after restart (see SafeDir.requeue_temp) and their events are
+        # counted twice in the buckets (and in events_meta of the records whose tasks were already sent).
+        self.event_store.add_many(counts)
+        for ipv4, date, node, cat, end_time, live_till in updates:
+            self.task_aggregator.put_task('ip', ipv4,
+                [('add', 'events_meta.total', 1)] +
+                common.event_store.day_counter_updates(date, node, cat) +
+                [
+                    ('setmax', 'last_activity', end_time),
+                    ('setmax', '_ttl.warden', live_till),
+                ],
+                "warden_receiver"
+            )
+
+    def should_flush(self):
+        """Return True if the oldest file was added before more than the aggregation window"""
+        return self.first_added is not None and time.time() - self.first_added >= self.window
+
+    def flush(self):
+        """Send all buffered tasks and then remove all the files the updates were read from"""
+        self.task_aggregator.flush()
+        # All tasks are sent, files can be removed
+        for name in self.files:
+            NamedFile(self.sdir.temp, name).remove()
+        self.files = []
+        self.first_added = None
+
+
+def scanner_func(sdir, file_queue, num_workers):
+    """
+    Main function of the scanner thread - puts chunks of new files to file_queue (blocks when the queue is full).
+
+    When stopped, puts None to the queue for each worker process to tell them to exit.
     """
-    if eventdb is None:
-        return
-    if len(db_queue) > 0:
-        log.debug("Writing a set of {} IDEA messages to database.".format(len(db_queue)))
-        eventdb.put(db_queue)
-        db_queue.clear()
+    for chunk in scan_dir(sdir):
+        file_queue.put(chunk)
+    for _ in range(num_workers):
+        file_queue.put(None)
 
 
 def stop(signal, frame):
     """
     Stop receiving events.
 
-    Will be evoked on catching SIGINT signal.
+    Will be evoked on catching SIGINT or SIGTERM signal.
     """
     global running_flag
     running_flag = False
-    put_set_to_database()
     log.info("exiting")
 
 
-def receive_events(filer_path, eventdb, task_queue_writer, inactive_ip_lifetime, warden_filter=None):
-    # Infinite loop reading events as files in given directory
-    # This loop stops on SIGINT
+def receive_events(filer_path, task_queue_writer, mongo_config, inactive_ip_lifetime, warden_filter=None,
+                   eventdb_config=None, num_workers=1, aggregation_window=1.0, aggregation_max_ips=1000):
+    """
+    Read events as files in given directory and update records of IPs in them until stopped by SIGINT/SIGTERM.
+
+    Events are processed by a pipeline of three stages connected by bounded queues:
+    - scanner thread - takes new files from the directory and passes their names to worker processes in chunks,
+    - worker processes - parse, store to EventDB (if eventdb_config is given) and filter the events,
+    - main thread - adds numbers of events to the event store (in MongoDB, see mongo_config) and sends the updates
+      as tasks, updates of the same IP are merged (see EventAggregator).
+    """
     log.info("Reading IDEA files from {}/incoming".format(filer_path))
     life_span = timedelta(days=inactive_ip_lifetime)
+    sdir = SafeDir(filer_path)
+    n = sdir.requeue_temp()
+    if n:
+        log.info("{} files left from the previous run moved back to {}".format(n, sdir.incoming))
+
+    file_queue = multiprocessing.Queue(2 * num_workers)
+    result_queue = multiprocessing.Queue(2 * num_workers)
+
+    log.info("Starting {} worker processes".format(num_workers))
+    workers = [
+        multiprocessing.Process(target=parse_worker, name="WardenReceiverWorker-{}".format(i),
+                                args=(sdir, file_queue, result_queue, life_span, warden_filter, eventdb_config))
+        for i in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # Connect to RabbitMQ and MongoDB after worker processes are forked
+    task_queue_writer.connect()
+    event_store = common.event_store.EventStore(common.mongo.get_database(mongo_config, 'worker'))
+
+    scanner = threading.Thread(target=scanner_func, args=(sdir, file_queue, num_workers), name="Scanner")
+    scanner.start()
 
-    for (rawdata, event) in read_dir(filer_path, call_when_waiting=put_set_to_database):
-        # Store the event to EventDB
-        if eventdb is not None:
-            put_to_db_queue(event)
+    task_aggregator = common.task_aggregator.TaskAggregator(task_queue_writer, aggregation_window, aggregation_max_ips)
+    aggregator = EventAggregator(sdir, task_aggregator, event_store, aggregation_window)
+    # Loop until all workers exit (they exit when the scanner is stopped and all files read are processed)
+    while True:
+        workers_alive = any(worker.is_alive() for worker in workers)
         try:
-            if warden_filter and not warden_filter.should_pass(event):
-                log.debug("event {} ignored".format(event["ID"]))
-                continue
-            for src in event.get("Source", []):
-                for ipv4 in src.get("IP4", []):
-                    # TODO check IP address validity
-
-                    log.debug("Updating IPv4 record {}".format(ipv4))
-                    cat = '+'.join(event["Category"]).replace('.', '')
-                    # Parse and reformat detect time
-                    detect_time = parse_rfc_time(event["DetectTime"])  # Parse DetectTime
-                    date = detect_time.strftime("%Y-%m-%d")  # Get date as a string
-
-                    # Get end time of event
-                    if "CeaseTime" in event:
-                        end_time = parse_rfc_time(event["CeaseTime"])
-                    elif "WinEndTime" in event:
-                        end_time = parse_rfc_time(event["WinEndTime"])
-                    elif "EventTime" in event:
-                        end_time = parse_rfc_time(event["EventTime"])
-                    else:
-                        end_time = detect_time
-
-                    node = event["Node"][-1]["Name"]
-
-                    # calculate the timestamp, to which the record should be kept
-                    live_till = end_time + life_span
-
-                    task_queue_writer.put_task('ip', ipv4,
-                        [
-                            ('array_upsert', 'events',
-                             {'date': date, 'node': node, 'cat': cat},
-                             [('add', 'n', 1)]),
-                            ('add', 'events_meta.total', 1),
-                            ('setmax', 'last_activity', end_time),
-                            ('setmax', '_ttl.warden', live_till),
-                        ],
-                        "warden_receiver"
-                    )
-                for ipv6 in src.get("IP6", []):
-                    log.debug(
-                        "IPv6 address in Source found - skipping since IPv6 is not implemented yet.")  # The record follows:\n{}".format(str(event)), file=sys.stderr)
-        except Exception as e:
-            log.error("ERROR in parsing event '{}': {}".format(event.get('ID', 'no-ID'), str(e)))
+            processed_files, updates = result_queue.get(timeout=0.1)
+        except queue.Empty:
+            # Results are always passed before a worker exits, so nothing can be left in the queue if the workers
+            # weren't alive before reading
+            if not workers_alive:
+                break
+        else:
+            aggregator.add(processed_files, updates)
+        if aggregator.should_flush():
+            aggregator.flush()
+    aggregator.flush()
+    task_aggregator.log_stats()
+
+    global running_flag
+    if running_flag:
+        log.error("All worker processes exited unexpectedly, stopping")
+        running_flag = False
+    # If the workers died, the scanner may be blocked on the full file_queue - take the chunks nobody would process
+    # and return their files back to "incoming"
+    while True:
+        scanner_alive = scanner.is_alive()
+        try:
+            chunk = file_queue.get(timeout=0.1)
+        except queue.Empty:
+            if not scanner_alive:
+                break
+            continue
+        for name in chunk or []:
+            try:
+                NamedFile(sdir.temp, name).moveto(sdir.incoming)
+            except Exception:
+                pass
+    scanner.join()
+    for worker in workers:
+        worker.join()
 
 
 if __name__ == "__main__":
@@ -523,6 +865,10 @@ if __name__ == "__main__":
     warden_filter_rules = config.get('warden_filter', None)
     rabbit_config = config.get("rabbitmq")
     filer_path = config.get('warden_filer_path')
+    num_workers = config.get('warden_receiver.processes', 1)
+    aggregation_window = config.get('warden_receiver.aggregation_window', 1.0)
+    aggregation_max_ips = config.get('warden_receiver.aggregation_max_ips', 1000)
+    assert (isinstance(num_workers, int) and num_workers > 0), "Number of processes ('warden_receiver.processes' in config) must be a positive integer"
 
     if warden_filter_rules:
         try:
@@ -537,14 +883,15 @@ if __name__ == "__main__":
     num_processes = config.get('worker_processes')
     assert (isinstance(num_processes,int) and num_processes > 0), "Number of processes ('num_processes' in config) must be a positive integer"
 
-    # Instantiate PSQLEventDatabase if enabled
-    eventdb = None # By default, events are not stored anywhere (they are either read from Mentat or not stored at all)
+    # Store events to PSQLEventDatabase if enabled (each worker process creates its own connection)
+    eventdb_config = None # By default, events are not stored anywhere (they are either read from Mentat or not stored at all)
     if config.get('eventdb', None) == 'psql':
-        eventdb = common.eventdb_psql.PSQLEventDatabase(config)
+        eventdb_config = config
     
-    # Create main task queue
+    # Create main task queue (connected in receive_events)
     task_queue_writer = common.task_queue.TaskQueueWriter(num_processes, rabbit_config)
-    task_queue_writer.connect()
 
     signal.signal(signal.SIGINT, stop)
-    receive_events(filer_path, eventdb, task_queue_writer, inactive_ip_lifetime, warden_filter)
+    signal.signal(signal.SIGTERM, stop)
+    receive_events(filer_path, task_queue_writer, config, inactive_ip_lifetime, warden_filter, eventdb_config,
+                   num_workers, aggregation_window, aggregation_max_ips)
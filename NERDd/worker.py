@@ -6,10 +6,44 @@ from time import sleep
 import logging
 import threading
 import signal
+import time
+import importlib
+import functools
+import concurrent.futures
 
 # EventCountLogger - count number of events across multiple processes using shared counters in Redis
 from event_count_logger import EventCountLogger
 
+# Plug-in modules (module in "modules" package, class name), handlers of modules are called in this order
+# TODO load all modules automatically (or just modules specified in config)
+MODULES = [
+    ('update_planner', 'UpdatePlanner'),
+    ('cleaner', 'Cleaner'),
+    ('event_counter', 'EventCounter'),
+    ('dns', 'DNSResolver'),
+    ('geolocation', 'Geolocation'),
+    ('whois', 'WhoIS'),
+    ('dnsbl', 'DNSBLResolver'),
+    ('redis_bl', 'RedisBlacklist'),
+    ('eml_asn_rank', 'EML_ASN_rank'),
+    # ('reputation', 'Reputation'),
+    ('hostname', 'HostnameClass'),
+    ('caida_as_class', 'CaidaASclass'),
+    ('bgp_rank', 'CIRCL_BGPRank'),
+    ('event_type_counter', 'EventTypeCounter'),
+    ('tags', 'Tags'),
+    # ('passive_dns', 'PassiveDNSResolver'),
+    # ('fmp', 'FMP'),
+    ('reserved_ip', 'ReservedIPTags'),
+    ('ttl_updater', 'TTLUpdater'),
+
+    ('score', 'Score'),
+    # ('refresher', 'Refresher'),
+    # ('otx', 'OTX'),
+    # ('shodan', 'Shodan'),
+    # ('dshield', 'DShield'),
+]
+
 def main(cfg_file, process_index):
 
     ################################################
@@ -33,9 +67,11 @@ def main(cfg_file, process_index):
     
     import common.config
     import common.eventdb_mentat
-    import core.mongodb
+    import common.event_store
+    import common.mongo
     import core.update_manager
     import core.scheduler
+    import core.lookup_executor
     
     ################################################
     # Load configuration
@@ -76,8 +112,30 @@ def main(cfg_file, process_index):
     g.ecl_config_file = ecl_config_file
     g.ecl = EventCountLogger(g.ecl_config.get("groups"), g.ecl_config.get("redis"))
     g.scheduler = core.scheduler.Scheduler()
-    g.db = core.mongodb.MongoEntityDatabase(config)
+    # Entity database may be MongoDB (default) or a local embedded database (single-node deployments, benchmarks)
+    ENTITY_DB_TYPE = config.get('entity_db', 'mongodb')
+    if ENTITY_DB_TYPE == 'mongodb':
+        import core.mongodb
+        g.db = core.mongodb.MongoEntityDatabase(config)
+    elif ENTITY_DB_TYPE == 'embedded':
+        import core.embedded_db
+        g.db = core.embedded_db.EmbeddedEntityDatabase(config)
+    else:
+        log.error("Unknown 'entity_db' configured: '{}' (should be 'mongodb' or 'embedded')".format(ENTITY_DB_TYPE))
+        sys.exit(1)
+    # Numbers of Warden events of IPs are stored separately in MongoDB (regardless of entity_db)
+    g.event_store = common.event_store.EventStore(common.mongo.get_database(config, 'worker'))
+    if process_index == 0:
+        g.event_store.ensure_indexes(config.get('max_event_history'))
     g.um = core.update_manager.UpdateManager(config, g.db, process_index, num_processes)
+    if hasattr(g.db, 'get_pool_stats'):
+        # Log state of connection pool(s) to database every 10 minutes
+        def log_pool_stats():
+            for address, stats in g.db.get_pool_stats().items():
+                log.info("DB connection pool {}: {open} open, {in_use} in use, {created} created, {checkouts} checkouts, "
+                         "{checkout_failures} checkout failures, {pool_clears} pool clears".format(address, **stats))
+        g.scheduler.register(log_pool_stats, minute="*/10")
+    g.lookups = core.lookup_executor.LookupExecutor(config)
     
     # EventDB may be local PSQL (default), external Mentat instance or None
     # (commented out, it's currently only used in warden_receiver, which not a part of worker)
@@ -102,62 +160,62 @@ def main(cfg_file, process_index):
     # Load all plug-in modules
     # (all modules can now use core components in "g")
     
-    # TODO load all modules automatically (or just modules specified in config)
-    import modules.update_planner
-    import modules.cleaner
-    import modules.dns
-    import modules.geolocation
-    import modules.dnsbl
-    import modules.redis_bl
-    import modules.shodan
-    import modules.eml_asn_rank
-    import modules.event_counter
-    import modules.hostname
-    import modules.caida_as_class
-    import modules.bgp_rank
-    import modules.event_type_counter
-    import modules.tags
-    import modules.reputation
-    import modules.whois
-    import modules.passive_dns
-    import modules.fmp
-    import modules.reserved_ip
-    import modules.ttl_updater
-    import modules.otx
-    import modules.score
-    import modules.refresher
-    # import modules.dshield
-    
-    # Instantiate modules
-    # TODO create all modules automatically (loop over all modules.* and find all objects derived from NERDModule)
-    #  or take if from configuration
-    module_list = [
-        modules.update_planner.UpdatePlanner(),
-        modules.cleaner.Cleaner(),
-        modules.event_counter.EventCounter(),
-        modules.dns.DNSResolver(),
-        modules.geolocation.Geolocation(),
-        modules.whois.WhoIS(),
-        modules.dnsbl.DNSBLResolver(),
-        modules.redis_bl.RedisBlacklist(),
-        modules.eml_asn_rank.EML_ASN_rank(),
-        # modules.reputation.Reputation(),
-        modules.hostname.HostnameClass(),
-        modules.caida_as_class.CaidaASclass(),
-        modules.bgp_rank.CIRCL_BGPRank(),
-        modules.event_type_counter.EventTypeCounter(),
-        modules.tags.Tags(),
-        # modules.passive_dns.PassiveDNSResolver(),
-        # modules.fmp.FMP(),
-        modules.reserved_ip.ReservedIPTags(),
-        modules.ttl_updater.TTLUpdater(),
-
-        modules.score.Score(),
-        # modules.refresher.Refresher(),
-        # modules.otx.OTX(),
-        # modules.shodan.Shodan(),
-        # modules.dshield.DShield(),
-    ]
+    # Modules are imported and instantiated in parallel by a pool of threads, so slow initialization of one module
+    # (loading of large data files, network queries) doesn't delay the others. Handlers are registered in the order
+    # of the MODULES list anyway (see UpdateManager.registration_order).
+    # Modules listed in 'late_start_modules' are not waited for - task processing starts without them and they
+    # register their handlers once they are ready.
+    t_start = time.time()
+    init_times = {} # class name -> (import time, init time)
+    late_modules = set(config.get('late_start_modules', []) or [])
+    
+    def init_module(rank, module_name, class_name):
+        t1 = time.time()
+        module = importlib.import_module('modules.' + module_name)
+        t2 = time.time()
+        with g.um.registration_order(rank):
+            instance = getattr(module, class_name)()
+        init_times[class_name] = (t2 - t1, time.time() - t2)
+        return instance
+    
+    init_pool = concurrent.futures.ThreadPoolExecutor(config.get('worker_init_threads', 4), thread_name_prefix="ModuleInit")
+    futures = [init_pool.submit(init_module, rank, module_name, class_name)
+               for rank, (module_name, class_name) in enumerate(MODULES)]
+    module_list = []
+    late_futures = []
+    for (module_name, class_name), future in zip(MODULES, futures):
+        if class_name in late_modules:
+            late_futures.append((class_name, future))
+        else:
+            module_list.append(future.result()) # (exception in module initialization stops the worker)
+    init_pool.shutdown(wait=False)
+    
+    log.info("Modules initialized in {:.2f}s (import + init time): {}".format(
+        time.time() - t_start,
+        ", ".join("{} {:.2f}+{:.2f}s".format(name, t_imp, t_init)
+                  for name, (t_imp, t_init) in sorted(list(init_times.items()), key=lambda x: -sum(x[1])))
+    ))
+    if late_futures:
+        log.info("Modules initialized later (not waited for): {}".format(", ".join(name for name, _ in late_futures)))
+    
+    # Guards module_list and g.running against late modules finishing during shutdown
+    # (a module must not be started after the others were stopped, nor be left running)
+    module_list_lock = threading.Lock()
+    
+    def late_module_ready(class_name, future):
+        try:
+            module = future.result()
+        except Exception:
+            log.exception("Initialization of module {} failed:".format(class_name))
+            return
+        t_imp, t_init = init_times[class_name]
+        with module_list_lock:
+            if not g.running:
+                log.info("Module {} initialized late ({:.2f}+{:.2f}s), but the worker is stopping, not starting it".format(class_name, t_imp, t_init))
+                return
+            log.info("Module {} initialized late ({:.2f}+{:.2f}s), its handlers are now active".format(class_name, t_imp, t_init))
+            module.start()
+            module_list.append(module)
     
     
     # Lock used to control when the program stops.
@@ -189,8 +247,13 @@ def main(cfg_file, process_index):
     for module in module_list:
         module.start()
     
+    g.lookups.start()
     g.um.start()
     
+    # Modules which are still being initialized are started when ready
+    for class_name, future in late_futures:
+        future.add_done_callback(functools.partial(late_module_ready, class_name))
+    
     # Run scheduler
     g.scheduler.start()
     
@@ -213,11 +276,14 @@ def main(cfg_file, process_index):
     signal.signal(signal.SIGABRT, signal.SIG_DFL)
     
     log.info("Stopping running components ...")
-    g.running = False
+    with module_list_lock:
+        g.running = False
     g.scheduler.stop()
     g.um.stop()
-    for module in module_list:
-        module.stop()
+    g.lookups.stop()
+    with module_list_lock:
+        for module in module_list:
+            module.stop()
     
     log.info("***** Finished, main thread exiting. *****")
     logging.shutdown()
@@ -27,6 +27,8 @@ from event_count_logger import EventCountLogger, EventGroup, DummyEventGroup
 # Add to path the "one directory above the current file location"
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
 import common.config
+import common.mongo
+import common.event_store
 import common.task_queue
 import common.StatsRIPE
 from common.utils import ipstr2int, int2ipstr, parse_rfc_time
@@ -175,13 +177,17 @@ mongo_host = config.get('mongodb.host', 'localhost:27017')
 if isinstance(mongo_host, list):
     mongo_host = ','.join(mongo_host)
 mongo_uri = "mongodb://{}/{}".format(mongo_host, mongo_dbname)
-mongo_rs = config.get('mongodb.rs', None)
-if mongo_rs:
-    mongo_uri += '?replicaSet='+mongo_rs
 app.config['MONGO_URI'] = mongo_uri
-print("MongoDB: Connecting to: {}".format(mongo_uri))
+# Client options (pool size, timeouts, read preference, ...) are set in "mongodb.client" and "mongodb.client_web"
+# (replica-set name is passed among them)
+mongo_options = common.mongo.client_options(config, 'web')
+mongo_pool_stats = common.mongo.PoolStatsListener()
+print("MongoDB: Connecting to: {} (options: {})".format(mongo_uri, mongo_options))
 
-mongo = PyMongo(app)
+mongo = PyMongo(app, mongo_uri, event_listeners=[mongo_pool_stats], **mongo_options)
+
+# Numbers of Warden events of IPs (stored outside IP records)
+event_store = common.event_store.EventStore(mongo.db)
 
 # Configuration of MAIL extension
 app.config['MAIL_SERVER'] = config.get('mail.server', 'localhost')
@@ -850,10 +856,10 @@ def create_query(form):
             queries.append( {'_id': {'$exists': False}} ) # ASN not in DB, add query which is always false to get no results
     if form.cat.data:
         op = '$and' if (form.cat_op.data == "and") else '$or'
-        queries.append( {op: [{'events.cat': cat} for cat in form.cat.data]} )
+        queries.append( {op: [{'events_meta.cats': cat} for cat in form.cat.data]} )
     if form.node.data:
         op = '$and' if (form.node_op.data == "and") else '$or'
-        queries.append( {op: [{'events.node': node} for node in form.node.data]} )
+        queries.append( {op: [{'events_meta.nodes': node} for node in form.node.data]} )
     if form.blacklist.data:
         op = '$and' if (form.bl_op.data == "and") else '$or'
         array = [{('dbl' if t == 'd' else 'bl'): {'$elemMatch': {'n': id, 'v': 1}}} for t,_,id in map(lambda s: s.partition(':'), form.blacklist.data)]
@@ -922,8 +928,9 @@ def ips():
                 ip['asn'] = asn_list # List of full ASN records
 
         # Add metainfo about events for easier creation of event table in the template
+        events_by_ip = event_store.get_many(ip['_id'] for ip in results if 'events_meta' in ip)
         for ip in results:
-            events = ip.get('events', [])
+            events = events_by_ip.get(ip['_id'], [])
             # Get sets of all dates, cats and nodes
             dates = set()
             cats = set()
@@ -1051,6 +1058,7 @@ def ip(ipaddr=None):
             
             asn_list = []
             if ipinfo:
+                ipinfo['events'] = event_store.get(ipaddr)
                 if 'bgppref' in ipinfo:
                     bgppref = mongo.db.bgppref.find_one({'_id': ipinfo['bgppref']})
                     if bgppref and 'asn' in bgppref:
@@ -1344,7 +1352,8 @@ def get_status():
         cnt_ipblock=cnt_ipblock,
         cnt_org=cnt_org,
         idea_queue=idea_queue_len,
-        disk_usage=disk_usage
+        disk_usage=disk_usage,
+        mongo_pool=mongo_pool_stats.get_stats()
     )
 
 
@@ -1760,7 +1769,7 @@ def get_full_info(ipaddr=None):
                 'last_result': True if bl['v'] else False,
                 'history': [t.strftime("%Y-%m-%dT%H:%M:%S") for t in bl['h']]
             } for bl in val.get('bl', []) ],
-        'events' : val.get('events', []),
+        'events' : event_store.get(val['_id']),
         'misp_events' : val.get('misp_events', []),
         'events_meta' : {
             'total': val.get('events_meta', {}).get('total', 0.0),
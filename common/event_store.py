@@ -0,0 +1,207 @@
+"""
+NERD - storage of numbers of Warden events of IP addresses.
+
+Numbers of events reported for an IP address are counted per day, node and
+category. They used to be kept as an array ('events') in the IP record, which
+grew with every new (date, node, cat) combination - and the whole record is
+written back on each update. Now they are stored in a separate collection
+"ip_events" with one small document ("bucket") per IP address and day:
+  {
+    _id: "<ip>|<YYYY-MM-DD>",
+    date: <the day as datetime (00:00 UTC)>,
+    c: {<node>: {<cat>: <number of events>}}
+  }
+Buckets are created and incremented by warden_receiver directly by $inc (before
+the task updating the IP record is sent), the IP record keeps only aggregated
+values in 'events_meta' (total, total1/7/30, nodes, cats, ...) computed by
+modules from the buckets.
+
+Buckets older than 'max_event_history' days are removed by MongoDB itself
+thanks to TTL index on "date" (see ensure_indexes).
+
+Values computed over the last 30 days (total1/7/30, nodes_1d/7d/30d, ewma,
+...) don't need the buckets at all - each task of warden_receiver also adds
+the events to compact per-day counters in the IP record (see
+day_counter_updates):
+  events_meta.days.<YYYY-MM-DD> = {n: <number of events>,
+                                   nodes: {<node>: n}, cats: {<cat>: n}}
+Only the last DAYS_KEPT days are kept, older days are removed by EventCounter.
+
+All buckets of an IP address form a continuous range of _id (the address
+followed by '|' and the date), so they are found by a range query on _id, no
+other index is needed.
+
+Names of nodes and categories may contain '.' (and theoretically '$'), which
+can't be used in field names, so these characters are escaped as '%2E' and
+'%24' ('%' itself as '%25').
+"""
+
+import threading
+from datetime import datetime
+
+import pymongo
+
+COLLECTION = 'ip_events'
+TTL_INDEX_NAME = 'date_ttl'
+
+# Max number of IPs in one query of get_many
+CHUNK_SIZE = 100
+
+# Number of days (including the current one) kept in per-day counters in IP records (events_meta.days)
+DAYS_KEPT = 31
+
+_ESCAPES = (('%', '%25'), ('.', '%2E'), ('$', '%24'))
+
+
+def escape_name(name):
+    """Escape characters not allowed in field names of MongoDB documents"""
+    for char, esc in _ESCAPES:
+        name = name.replace(char, esc)
+    return name
+
+
+def unescape_name(name):
+    """Reverse escape_name"""
+    if '%' not in name:
+        return name
+    for char, esc in reversed(_ESCAPES):
+        name = name.replace(esc, char)
+    return name
+
+
+def day_counter_updates(date, node, cat, n=1):
+    """
+    Return update requests adding n events to per-day counters in the IP record (events_meta.days).
+
+    Only 'add' operations are used, so tasks of the same IP can be merged by TaskAggregator.
+    """
+    prefix = 'events_meta.days.' + date
+    return [
+        ('add', prefix + '.n', n),
+        ('add', prefix + '.nodes.' + escape_name(node), n),
+        ('add', prefix + '.cats.' + escape_name(cat), n),
+    ]
+
+
+def day_counters(events, since):
+    """
+    Return per-day counters (as stored in events_meta.days) of given events (as returned by EventStore.get) since
+    given date ('YYYY-MM-DD').
+    """
+    days = {}
+    for evtrec in events:
+        if evtrec['date'] < since:
+            continue
+        day = days.get(evtrec['date'])
+        if day is None:
+            day = days[evtrec['date']] = {'n': 0, 'nodes': {}, 'cats': {}}
+        n = evtrec['n']
+        node = escape_name(evtrec['node'])
+        cat = escape_name(evtrec['cat'])
+        day['n'] += n
+        day['nodes'][node] = day['nodes'].get(node, 0) + n
+        day['cats'][cat] = day['cats'].get(cat, 0) + n
+    return days
+
+
+def _id_range(ip, since=None):
+    """Return query on _id matching all buckets of the IP (since given date, 'YYYY-MM-DD')"""
+    return {'$gte': ip + '|' + (since or ''), '$lt': ip + '}'} # ('}' follows '|' in ASCII)
+
+
+def _bucket_items(doc):
+    """Convert a bucket document to list of items {date, node, cat, n} (as in the former 'events' array)"""
+    date = doc['_id'].rpartition('|')[2]
+    return [{'date': date, 'node': unescape_name(node), 'cat': unescape_name(cat), 'n': n}
+            for node, cats in doc.get('c', {}).items() for cat, n in cats.items()]
+
+
+class EventStore:
+    """
+    Access to numbers of events of IP addresses in "ip_events" collection.
+
+    Events are returned in the same format as items of the former 'events' array
+    of IP records - list of dicts {date: 'YYYY-MM-DD', node, cat, n}, sorted by
+    date.
+    """
+
+    def __init__(self, db):
+        """
+        :param db: pymongo Database (see common.mongo.get_database)
+        """
+        self._coll = db[COLLECTION]
+        self._cache = threading.local()
+
+    def ensure_indexes(self, max_event_history):
+        """
+        Create TTL index removing buckets older than max_event_history days (or change its expiration if it
+        doesn't match).
+        """
+        # A bucket of day D is kept until the end of day D + max_event_history
+        expire = (max_event_history + 1) * 86400
+        for index in self._coll.list_indexes():
+            if index['name'] == TTL_INDEX_NAME:
+                if index.get('expireAfterSeconds') != expire:
+                    self._coll.database.command('collMod', COLLECTION,
+                                                index={'name': TTL_INDEX_NAME, 'expireAfterSeconds': expire})
+                return
+        self._coll.create_index('date', name=TTL_INDEX_NAME, expireAfterSeconds=expire)
+
+    def add_many(self, counts):
+        """
+        Add numbers of events to buckets (by one bulk write).
+
+        :param counts: dict (ip, date, node, cat) -> number of events (date as 'YYYY-MM-DD')
+        :return: number of buckets updated
+        """
+        buckets = {} # (ip, date) -> $inc part of the update
+        for (ip, date, node, cat), n in counts.items():
+            inc = buckets.setdefault((ip, date), {})
+            field = 'c.' + escape_name(node) + '.' + escape_name(cat)
+            inc[field] = inc.get(field, 0) + n
+        if not buckets:
+            return 0
+        ops = [pymongo.UpdateOne({'_id': ip + '|' + date},
+                                 {'$inc': inc, '$setOnInsert': {'date': datetime.strptime(date, "%Y-%m-%d")}},
+                                 upsert=True)
+               for (ip, date), inc in buckets.items()]
+        self._coll.bulk_write(ops, ordered=False)
+        return len(ops)
+
+    def get(self, ip, version=None):
+        """
+        Return list of events of the IP address (all stored days).
+
+        If version is given (e.g. current value of events_meta.total of the IP record), the result is cached (one
+        IP per thread) and returned again for the same IP and version without a query. So all handlers called within
+        one task need only one query. The returned list must not be modified then.
+        """
+        if version is not None:
+            cached = getattr(self._cache, 'entry', None)
+            if cached is not None and cached[0] == (ip, version):
+                return cached[1]
+        events = []
+        for doc in self._coll.find({'_id': _id_range(ip)}).sort('_id', 1):
+            events.extend(_bucket_items(doc))
+        if version is not None:
+            self._cache.entry = ((ip, version), events)
+        return events
+
+    def get_many(self, ips, since=None):
+        """
+        Return events of given IP addresses (since given date, 'YYYY-MM-DD') as dict ip -> list of events.
+
+        IPs without any events are not included.
+        """
+        ips = list(ips)
+        result = {}
+        for i in range(0, len(ips), CHUNK_SIZE):
+            query = {'$or': [{'_id': _id_range(ip, since)} for ip in ips[i:i+CHUNK_SIZE]]}
+            for doc in self._coll.find(query).sort('_id', 1):
+                ip = doc['_id'].rpartition('|')[0]
+                result.setdefault(ip, []).extend(_bucket_items(doc))
+        return result
+
+    def remove(self, ip):
+        """Remove all buckets of the IP address, return the number of removed buckets"""
+        return self._coll.delete_many({'_id': _id_range(ip)}).deleted_count
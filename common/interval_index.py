@@ -0,0 +1,124 @@
+"""
+NERD: index of integer intervals (e.g. IP address ranges) with attached values
+
+IntervalIndex is built from a list of (possibly overlapping) intervals, which
+are flattened into a sorted table of non-overlapping ranges, so a point is
+looked up by a single binary search (bisect). Many points may be looked up at
+once by find_many(), which uses numpy.searchsorted.
+
+It's used for IP ranges loaded from files (e.g. cloud provider ranges and IP
+block allocations in the whois module), addresses are represented as integers.
+"""
+
+import bisect
+import heapq
+import ipaddress
+
+import numpy as np
+
+
+def network_range(network):
+    """Return the first and the last address of given network (str or ipaddress object) as integers"""
+    net = ipaddress.ip_network(network, strict=False)
+    return int(net.network_address), int(net.broadcast_address)
+
+
+class IntervalIndex():
+    """
+    Sorted table of non-overlapping integer intervals with attached values.
+    """
+    def __init__(self, intervals):
+        """
+        Build the index from an iterable of (first, last, value), where first
+        and last are integers (both inclusive).
+
+        Where intervals overlap, the one given first wins. So to get the most
+        specific match of nested networks, pass them sorted by prefix length
+        (descending).
+        """
+        intervals = [iv for iv in intervals if iv[0] <= iv[1]]
+        # Sweep over all boundaries of the intervals; between each two boundaries the range is covered by the same set
+        # of intervals, the one with the lowest order (index) wins. Intervals covering current position are kept in
+        # a heap of (order, last), those already ended are removed lazily when they get to the top.
+        starts = sorted((first, i) for i, (first, _, _) in enumerate(intervals))
+        bounds = sorted(set([iv[0] for iv in intervals] + [iv[1] + 1 for iv in intervals]))
+        firsts = []
+        lasts = []
+        values = []
+        active = []
+        si = 0
+        for bi in range(len(bounds) - 1):
+            pos = bounds[bi]
+            while si < len(starts) and starts[si][0] == pos:
+                i = starts[si][1]
+                heapq.heappush(active, (i, intervals[i][1]))
+                si += 1
+            while active and active[0][1] < pos:
+                heapq.heappop(active)
+            if not active:
+                continue
+            end = bounds[bi + 1] - 1
+            value = intervals[active[0][0]][2]
+            if lasts and lasts[-1] == pos - 1 and values[-1] is value:
+                lasts[-1] = end  # merge with the previous range with the same value
+            else:
+                firsts.append(pos)
+                lasts.append(end)
+                values.append(value)
+
+        self.firsts = firsts
+        self.lasts = lasts
+        self.values = values
+        self._np_firsts = None
+        self._np_lasts = None
+
+    def __len__(self):
+        return len(self.firsts)
+
+    def find(self, x, default=None):
+        """Return value of the interval containing integer x, or default if there is no such interval"""
+        pos = bisect.bisect_right(self.firsts, x) - 1
+        if pos < 0 or x > self.lasts[pos]:
+            return default
+        return self.values[pos]
+
+    def find_range(self, x):
+        """Return (first, last, value) of the interval containing integer x, or None if there is no such interval"""
+        pos = bisect.bisect_right(self.firsts, x) - 1
+        if pos < 0 or x > self.lasts[pos]:
+            return None
+        return self.firsts[pos], self.lasts[pos], self.values[pos]
+
+    def find_many(self, xs, default=None):
+        """
+        Return list of values of intervals containing integers in xs (list or numpy array), default for those not in
+        any interval.
+        """
+        positions = self.find_positions(xs)
+        return [self.values[pos] if pos >= 0 else default for pos in positions.tolist()]
+
+    def find_positions(self, xs):
+        """
+        Return numpy array with index (into self.firsts/lasts/values) of the interval containing each of integers in xs,
+        or -1 for those not in any interval.
+        """
+        if self._np_firsts is None:
+            # Values over 64 bits (IPv6 addresses) can't be stored in numpy integer types, compare them as objects
+            dtype = np.uint64 if not self.lasts or self.lasts[-1] < 2**64 else object
+            self._np_firsts = np.array(self.firsts, dtype=dtype)
+            self._np_lasts = np.array(self.lasts, dtype=dtype)
+        np_firsts, np_lasts = self._np_firsts, self._np_lasts
+        if len(np_firsts) == 0:
+            return np.full(len(xs), -1, dtype=np.int64)
+        if not isinstance(xs, np.ndarray) or xs.dtype != np_firsts.dtype:
+            try:
+                xs = np.asarray(xs, dtype=np_firsts.dtype)
+            except (OverflowError, TypeError):
+                # Some of the values doesn't fit into uint64 (e.g. IPv6 addresses in an IPv4 table)
+                xs = np.array(list(xs), dtype=object)
+                np_firsts, np_lasts = np_firsts.astype(object), np_lasts.astype(object)
+        positions = np.searchsorted(np_firsts, xs, side='right').astype(np.int64) - 1
+        found = positions >= 0
+        found[found] = xs[found] <= np_lasts[positions[found]]
+        positions[~found] = -1
+        return positions
@@ -0,0 +1,167 @@
+"""
+NERD - creation of MongoDB clients (connection pools) according to configuration.
+
+All NERD components connecting to MongoDB (workers, web, scripts) should get
+their client here, so connection options are set in one place (config section
+"mongodb", see etc/nerd.yml):
+  host, rs, dbname  - where to connect
+  client            - options of all clients (any keyword arguments of
+                      pymongo.MongoClient, e.g. maxPoolSize, socketTimeoutMS,
+                      serverSelectionTimeoutMS, compressors)
+  client_<role>     - options of clients of given role (overriding "client"),
+                      roles used are "worker" (NERDd workers and other daemons
+                      writing records), "web" (NERDweb) and "script"
+
+Clients are shared within a process (one per role) and collect statistics of
+their connection pools (see pool_stats()).
+"""
+
+import logging
+import threading
+from collections import defaultdict
+
+import pymongo
+import pymongo.monitoring
+
+# Defaults (may be overridden by config values mongodb.host, mongodb.dbname)
+DEFAULT_MONGO_HOST = 'localhost:27017'
+DEFAULT_MONGO_DBNAME = 'nerd'
+
+# Python modules needed for wire compression methods (methods whose module isn't installed are skipped)
+_COMPRESSOR_MODULES = {'zstd': 'zstandard', 'snappy': 'snappy', 'zlib': 'zlib'}
+
+log = logging.getLogger("MongoClient")
+
+_clients = {} # role -> MongoClient
+_listeners = {} # role -> PoolStatsListener
+_clients_lock = threading.Lock()
+
+
+class PoolStatsListener(pymongo.monitoring.ConnectionPoolListener):
+    """Collects statistics of connection pools of a client (per server address)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'open': 0, 'in_use': 0, 'created': 0, 'closed': 0,
+                                           'checkouts': 0, 'checkout_failures': 0, 'pool_clears': 0})
+
+    def _inc(self, address, **counts):
+        with self._lock:
+            stats = self._stats["{}:{}".format(*address)]
+            for name, n in counts.items():
+                stats[name] += n
+
+    def get_stats(self):
+        """Return dict "host:port" -> dict of counters"""
+        with self._lock:
+            return {address: dict(stats) for address, stats in self._stats.items()}
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._inc(event.address, pool_clears=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._inc(event.address, open=1, created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._inc(event.address, open=-1, closed=1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._inc(event.address, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._inc(event.address, in_use=1, checkouts=1)
+
+    def connection_checked_in(self, event):
+        self._inc(event.address, in_use=-1)
+
+
+def client_options(config, role=None):
+    """
+    Return keyword arguments for pymongo.MongoClient according to the config ("mongodb.client" and
+    "mongodb.client_<role>").
+    """
+    options = dict(config.get('mongodb.client', None) or {})
+    if role:
+        options.update(config.get('mongodb.client_' + role, None) or {})
+    rs = config.get('mongodb.rs', None)
+    if rs:
+        options['replicaset'] = rs
+    compressors = options.get('compressors')
+    if compressors:
+        if isinstance(compressors, str):
+            compressors = compressors.split(',')
+        available = []
+        for method in compressors:
+            try:
+                __import__(_COMPRESSOR_MODULES.get(method, method))
+                available.append(method)
+            except ImportError:
+                log.warning("Module needed for '{}' compression is not installed, compression method skipped".format(method))
+        if available:
+            options['compressors'] = ','.join(available)
+        else:
+            del options['compressors']
+    return options
+
+
+def get_client(config, role=None):
+    """
+    Return MongoClient for given role, shared by all callers in the process.
+    """
+    with _clients_lock:
+        client = _clients.get(role)
+        if client is None:
+            host = config.get('mongodb.host', DEFAULT_MONGO_HOST)
+            rs = config.get('mongodb.rs', None)
+            if isinstance(host, list):
+                assert rs is not None, "Replica-set name ('mongo.rs' parameter) must be set if multiple MongoDB hosts are specified."
+            options = client_options(config, role)
+            listener = PoolStatsListener()
+            if rs:
+                log.info("Connecting to MongoDB replica set '{}' at {} ({} client, options: {})".format(rs, host, role, options))
+            else:
+                log.info("Connecting to standalone MongoDB instance at {} ({} client, options: {})".format(host, role, options))
+            client = pymongo.MongoClient(host, event_listeners=[listener], **options)
+            _clients[role] = client
+            _listeners[role] = listener
+        return client
+
+
+def get_database(config, role=None):
+    """
+    Return the NERD database ("mongodb.dbname") using the shared client of given role.
+    """
+    return get_client(config, role)[config.get('mongodb.dbname', DEFAULT_MONGO_DBNAME)]
+
+
+def close_client(role=None):
+    """Close the shared client of given role (if it exists)."""
+    with _clients_lock:
+        client = _clients.pop(role, None)
+        _listeners.pop(role, None)
+    if client is not None:
+        client.close()
+
+
+def pool_stats(role=None):
+    """
+    Return statistics of connection pools of the shared client of given role:
+    dict "host:port" -> {open, in_use, created, closed, checkouts, checkout_failures, pool_clears}
+    (numbers of currently open connections and connections in use, counters since the client was created).
+    """
+    listener = _listeners.get(role)
+    return listener.get_stats() if listener else {}
@@ -0,0 +1,185 @@
+"""
+NERD: local table of BGP prefixes and their origin ASNs (longest-prefix match)
+
+The table is built from prefix-to-AS dumps in the format of CAIDA's RouteViews
+pfx2as datasets (https://www.caida.org/catalog/datasets/routeviews-prefix2as/),
+one prefix per line:
+  <network address> <prefix length> <ASN>
+where ASN may be a MOAS list ("123_456") or an AS-set ("123,456").
+
+The dump is compiled (by build(), see scripts/compile_pfx2as.py) into a binary
+file (in the format of common/refdata.py) which contains the prefixes flattened
+into sorted, non-overlapping ranges of addresses, each pointing to the longest
+prefix covering it. So a lookup is
+a single binary search. The file is memory-mapped by PrefixTable, i.e. all
+processes using the same file share one copy of it in the page cache.
+
+IPv6 prefixes are indexed by the upper 64 bits of the address, longer IPv6
+prefixes (not used in global routing) are ignored.
+"""
+
+import ipaddress
+import logging
+
+import numpy as np
+
+from common.refdata import write_arrays, MappedArrays
+
+MAGIC = b'NERDPFX1'
+
+# dtypes of addresses of each IP version (IPv6 addresses are shifted to 64 bits)
+ADDR_DTYPES = {4: np.uint32, 6: np.uint64}
+V6_SHIFT = 64
+
+
+def parse_pfx2as(lines):
+    """
+    Parse lines of a pfx2as dump, yield tuples (version, network_int, prefix_len, [asn, ...]).
+
+    Invalid lines are skipped (with a warning logged).
+    """
+    log = logging.getLogger('PrefixTable')
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+        try:
+            addr, length, asns = line.split()
+            net = ipaddress.ip_network('{}/{}'.format(addr, length))
+            asn_list = [int(asn) for asn in asns.replace('_', ',').split(',')]
+        except ValueError:
+            log.warning('Invalid line in pfx2as dump: {!r}'.format(line))
+            continue
+        yield net.version, int(net.network_address), net.prefixlen, asn_list
+
+
+def flatten(prefixes):
+    """
+    Flatten (nested) prefixes into a list of non-overlapping ranges.
+
+    prefixes - list of (first_addr, last_addr, index) sorted by first_addr and
+      for equal first_addr by last_addr descending (less specific prefix first)
+
+    Return list of (first_addr, last_addr, index) where index is the index of
+    the longest prefix covering the range; addresses not covered by any prefix
+    are not included.
+    """
+    ranges = []
+    stack = []  # prefixes containing current position, the most specific on top
+    cur = 0  # first address not assigned to any range yet
+    for first, last, index in prefixes:
+        # Close prefixes ending before the beginning of this one
+        while stack and stack[-1][1] < first:
+            _, top_last, top_index = stack.pop()
+            if cur <= top_last:
+                ranges.append((cur, top_last, top_index))
+                cur = top_last + 1
+        # Part of the enclosing prefix before this one
+        if stack and cur < first:
+            ranges.append((cur, first - 1, stack[-1][2]))
+        cur = first
+        stack.append((first, last, index))
+    while stack:
+        _, top_last, top_index = stack.pop()
+        if cur <= top_last:
+            ranges.append((cur, top_last, top_index))
+            cur = top_last + 1
+    return ranges
+
+
+def build(pfx2as_files, out_file):
+    """
+    Compile pfx2as dumps (IPv4 and/or IPv6) into a binary file usable by PrefixTable.
+
+    The file is written to a temporary file and renamed, so processes which have
+    the old file mapped are not affected.
+    Return numbers of prefixes of each IP version as a dict.
+    """
+    # (version, network, length) -> list of ASNs (merged from duplicate lines)
+    prefixes = {}
+    for path in pfx2as_files:
+        with open(path, 'r') as f:
+            for version, net, length, asn_list in parse_pfx2as(f):
+                if version == 6:
+                    if length > V6_SHIFT:
+                        continue
+                    net >>= V6_SHIFT
+                key = (version, net, length)
+                current = prefixes.setdefault(key, [])
+                current.extend(asn for asn in asn_list if asn not in current)
+
+    arrays = {}
+    asns = []
+    counts = {}
+    for version in (4, 6):
+        bits = 32 if version == 4 else V6_SHIFT
+        keys = sorted((k for k in prefixes if k[0] == version), key=lambda k: (k[1], k[2]))
+        counts[version] = len(keys)
+        net_arr = np.zeros(len(keys), dtype=ADDR_DTYPES[version])
+        len_arr = np.zeros(len(keys), dtype=np.uint8)
+        asn_off = np.zeros(len(keys), dtype=np.uint32)
+        asn_cnt = np.zeros(len(keys), dtype=np.uint16)
+        spans = []
+        for i, key in enumerate(keys):
+            _, net, length = key
+            net_arr[i] = net
+            len_arr[i] = length
+            asn_off[i] = len(asns)
+            asn_cnt[i] = len(prefixes[key])
+            asns.extend(prefixes[key])
+            spans.append((net, net | ((1 << (bits - length)) - 1), i))
+        ranges = flatten(spans)
+        arrays['v{}_first'.format(version)] = np.array([r[0] for r in ranges], dtype=ADDR_DTYPES[version])
+        arrays['v{}_last'.format(version)] = np.array([r[1] for r in ranges], dtype=ADDR_DTYPES[version])
+        arrays['v{}_prefix'.format(version)] = np.array([r[2] for r in ranges], dtype=np.uint32)
+        arrays['v{}_net'.format(version)] = net_arr
+        arrays['v{}_len'.format(version)] = len_arr
+        arrays['v{}_asn_off'.format(version)] = asn_off
+        arrays['v{}_asn_cnt'.format(version)] = asn_cnt
+    arrays['asns'] = np.array(asns, dtype=np.uint32)
+
+    write_arrays(out_file, arrays, magic=MAGIC)
+    return counts
+
+
+class PrefixTable():
+    """
+    Memory-mapped table of BGP prefixes and their origin ASNs (compiled by build()).
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = MappedArrays(path, magic=MAGIC)
+        self._arrays = self._file.arrays
+        self.num_prefixes = len(self._arrays['v4_net']) + len(self._arrays['v6_net'])
+
+    def is_outdated(self):
+        """Return True if the file was changed since it was loaded"""
+        return self._file.is_outdated()
+
+    def lookup(self, ip):
+        """
+        Find the longest prefix containing given IP address (str).
+
+        Return tuple (prefix, [asn, ...]) with prefix in CIDR format (e.g. "192.0.2.0/24"),
+        or None if the address is not covered by any prefix.
+        """
+        addr = ipaddress.ip_address(ip)
+        version = addr.version
+        value = int(addr)
+        if version == 6:
+            value >>= V6_SHIFT
+        v = 'v{}_'.format(version)
+        first = self._arrays[v + 'first']
+        pos = int(np.searchsorted(first, first.dtype.type(value), side='right')) - 1
+        if pos < 0 or value > int(self._arrays[v + 'last'][pos]):
+            return None
+        i = int(self._arrays[v + 'prefix'][pos])
+        net = int(self._arrays[v + 'net'][i])
+        length = int(self._arrays[v + 'len'][i])
+        if version == 6:
+            prefix = ipaddress.IPv6Network((net << V6_SHIFT, length))
+        else:
+            prefix = ipaddress.IPv4Network((net, length))
+        off = int(self._arrays[v + 'asn_off'][i])
+        asn_list = self._arrays['asns'][off:off + int(self._arrays[v + 'asn_cnt'][i])].tolist()
+        return str(prefix), asn_list
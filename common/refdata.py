@@ -0,0 +1,401 @@
+"""
+NERD: memory-mapped reference datasets shared by all worker processes
+
+Reference data (whois allocation files, ASdb, cloud IP ranges, CAIDA AS
+classification, ...) used to be parsed into Python lists and dicts by each
+worker process, which cost N times the memory and start-up time with N workers.
+
+Here each source file is compiled into a binary file with sorted numpy arrays
+and a string table, which is memory-mapped read-only by the workers, so all of
+them share one copy in the page cache and "loading" it is instantaneous.
+
+A dataset (RefTable) consists of "spaces" of integer keys ('v4' and 'v6' for IP
+addresses, 'int' for ASNs etc.), each is a sorted table of non-overlapping
+ranges [first, last] with a value (any JSON-serializable object). Exact-key
+tables are just ranges with first == last.
+
+Compiled files are written to a temporary file and renamed (an atomic swap),
+processes having the old file mapped continue to use it until they call
+load() again (see RefTable.is_outdated()). The compiled file stores mtime and
+size of its source, so it's recompiled automatically when the source file is
+refreshed (e.g. by download_data_files.sh); scripts/compile_refdata.py
+compiles all datasets in advance, so workers never have to do it themselves.
+
+Usage:
+  table = refdata.load('cloudips', '/data/cloudips.csv', '/data/refdata')
+  table.find_ip('192.0.2.1')
+"""
+
+import os
+import csv
+import json
+import mmap
+import ipaddress
+import logging
+
+import numpy as np
+
+from common.interval_index import IntervalIndex, network_range
+
+MAGIC = b'NERDREF1'
+HEADER_LEN_SIZE = 8  # size of the number holding length of the JSON header
+ALIGNMENT = 8
+META_KEY = '_meta'
+
+# dtypes of keys of each space (IPv6 addresses don't fit into numpy integers, they are stored as big-endian bytes,
+# whose ordering is the same as of the numbers)
+KEY_DTYPES = {'v4': np.dtype(np.uint32), 'v6': np.dtype('S16'), 'int': np.dtype(np.uint64)}
+KEY_BYTES = {'v6': 16}
+
+
+# ***** Generic file format *****
+
+def write_arrays(path, arrays, meta=None, magic=MAGIC):
+    """
+    Write numpy arrays (dict name -> array) into a binary file loadable by MappedArrays.
+
+    File format: magic, length of header (8B little endian), JSON header with dtype, offset and length of each array
+    (and optional meta information), arrays (each aligned to 8 bytes).
+    The file is written to a temporary file and renamed, so processes which have the old file mapped are not affected.
+    """
+    header = {}
+    offset = 0
+    for name, arr in arrays.items():
+        header[name] = [arr.dtype.str, offset, len(arr)]
+        offset += arr.nbytes
+        offset += -offset % ALIGNMENT
+    if meta is not None:
+        header[META_KEY] = meta
+    header_bytes = json.dumps(header).encode('ascii')
+    header_bytes += b' ' * (-(len(magic) + HEADER_LEN_SIZE + len(header_bytes)) % ALIGNMENT)
+    data_start = len(magic) + HEADER_LEN_SIZE + len(header_bytes)
+
+    tmp_file = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        f.write(magic)
+        f.write(len(header_bytes).to_bytes(HEADER_LEN_SIZE, 'little'))
+        f.write(header_bytes)
+        for name, arr in arrays.items():
+            f.seek(data_start + header[name][1])
+            f.write(arr.tobytes())
+    os.replace(tmp_file, path)
+
+
+class MappedArrays():
+    """
+    Read-only memory-mapped arrays from a file written by write_arrays().
+
+    Attributes:
+      arrays - dict name -> numpy array (backed by the mapped file)
+      meta - meta information stored in the file (or None)
+    """
+    def __init__(self, path, magic=MAGIC):
+        self.path = path
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self._stat = (st.st_ino, st.st_mtime)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(magic)] != magic:
+            raise ValueError("{} is not a file of expected format".format(path))
+        header_len = int.from_bytes(self._mmap[len(magic):len(magic) + HEADER_LEN_SIZE], 'little')
+        header_start = len(magic) + HEADER_LEN_SIZE
+        header = json.loads(self._mmap[header_start:header_start + header_len].decode('ascii'))
+        self.meta = header.pop(META_KEY, None)
+        data_start = header_start + header_len
+        self.arrays = {
+            name: np.frombuffer(self._mmap, dtype=np.dtype(dtype), count=count, offset=data_start + offset)
+            for name, (dtype, offset, count) in header.items()
+        }
+
+    def is_outdated(self):
+        """Return True if the file was replaced since it was loaded"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_mtime) != self._stat
+
+
+def encode_strings(strings):
+    """Encode list of strings into two arrays: offsets (len(strings) + 1) and UTF-8 data"""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, data
+
+
+def decode_string(offsets, data, i):
+    """Return i-th string from arrays created by encode_strings()"""
+    return data[int(offsets[i]):int(offsets[i + 1])].tobytes().decode('utf-8')
+
+
+# ***** Reference tables *****
+
+def _key_to_np(space, x):
+    if space in KEY_BYTES:
+        return np.bytes_(x.to_bytes(KEY_BYTES[space], 'big'))
+    return KEY_DTYPES[space].type(x)
+
+
+def _key_from_np(space, x):
+    if space in KEY_BYTES:
+        # (numpy strips trailing zero bytes)
+        return int.from_bytes(bytes(x).ljust(KEY_BYTES[space], b'\0'), 'big')
+    return int(x)
+
+
+def build_table(path, spaces, meta=None):
+    """
+    Compile a reference table and write it into a file.
+
+    spaces - dict space -> iterable of (first, last, value), where first and last are integers (both inclusive) and
+      value is any JSON-serializable object; where ranges overlap, the one given first wins (see IntervalIndex)
+    meta - JSON-serializable information stored in the file
+    Return number of (non-overlapping) ranges in each space as a dict.
+    """
+    arrays = {}
+    values = [] # unique values (JSON-encoded)
+    value_ids = {}
+    counts = {}
+    for space, intervals in spaces.items():
+        if space not in KEY_DTYPES:
+            raise ValueError("Unknown key space '{}'".format(space))
+        index = IntervalIndex((first, last, json.dumps(value)) for first, last, value in intervals)
+        counts[space] = len(index)
+        ids = np.zeros(len(index), dtype=np.uint32)
+        for i, value in enumerate(index.values):
+            ids[i] = value_ids.setdefault(value, len(values))
+            if ids[i] == len(values):
+                values.append(value)
+        if space in KEY_BYTES:
+            firsts = np.array([x.to_bytes(KEY_BYTES[space], 'big') for x in index.firsts], dtype=KEY_DTYPES[space])
+            lasts = np.array([x.to_bytes(KEY_BYTES[space], 'big') for x in index.lasts], dtype=KEY_DTYPES[space])
+        else:
+            firsts = np.array(index.firsts, dtype=KEY_DTYPES[space])
+            lasts = np.array(index.lasts, dtype=KEY_DTYPES[space])
+        arrays[space + '_first'] = firsts
+        arrays[space + '_last'] = lasts
+        arrays[space + '_value'] = ids
+    arrays['values_off'], arrays['values_data'] = encode_strings(values)
+    write_arrays(path, arrays, meta)
+    return counts
+
+
+class RefTable():
+    """
+    Memory-mapped reference table (compiled by build_table()).
+    """
+    def __init__(self, path):
+        self._file = MappedArrays(path)
+        self.path = path
+        self.meta = self._file.meta or {}
+        a = self._file.arrays
+        self._spaces = {
+            name[:-len('_first')]: (a[name], a[name[:-len('_first')] + '_last'], a[name[:-len('_first')] + '_value'])
+            for name in a if name.endswith('_first')
+        }
+        self._values_off = a['values_off']
+        self._values_data = a['values_data']
+
+    def __len__(self):
+        return sum(len(first) for first, _, _ in self._spaces.values())
+
+    def is_outdated(self):
+        """Return True if the compiled file was replaced or its source file was changed since the table was loaded"""
+        if self._file.is_outdated():
+            return True
+        source = self.meta.get('source')
+        return source is not None and _source_stat(source) != self.meta.get('source_stat')
+
+    def _position(self, space, x):
+        if space not in self._spaces:
+            return None
+        first, last, _ = self._spaces[space]
+        key = _key_to_np(space, x)
+        pos = int(np.searchsorted(first, key, side='right')) - 1
+        if pos < 0 or last[pos] < key:
+            return None
+        return pos
+
+    def _value(self, space, pos):
+        return json.loads(decode_string(self._values_off, self._values_data, int(self._spaces[space][2][pos])))
+
+    def find(self, space, x, default=None):
+        """Return value of the range containing integer x in given space, or default if there is no such range"""
+        pos = self._position(space, x)
+        if pos is None:
+            return default
+        return self._value(space, pos)
+
+    def find_range(self, space, x):
+        """Return (first, last, value) of the range containing integer x in given space, or None"""
+        pos = self._position(space, x)
+        if pos is None:
+            return None
+        first, last, _ = self._spaces[space]
+        return _key_from_np(space, first[pos]), _key_from_np(space, last[pos]), self._value(space, pos)
+
+    def find_ip(self, ip, default=None):
+        """Return value of the range containing given IP address (str or ipaddress object), or default"""
+        addr = ipaddress.ip_address(ip)
+        return self.find('v{}'.format(addr.version), int(addr), default)
+
+
+# ***** Parsers of source files *****
+# Each returns a dict space -> list of (first, last, value) for build_table()
+
+def parse_whois_asn(path):
+    """
+    File with allocation of ASNs to RIRs (created by scripts/get_iana_assignment_files.py), sorted lines: first ASN,RIR
+    Each ASN maps to the RIR of the nearest lower (or equal) listed ASN.
+    """
+    with open(path, 'r') as f:
+        rows = [(int(row[0]), row[1]) for row in csv.reader(f, delimiter=',')]
+    ranges = []
+    for i, (asn, rir) in enumerate(rows):
+        last = rows[i + 1][0] - 1 if i + 1 < len(rows) else 2**32 - 1
+        ranges.append((asn, last, rir))
+    return {'int': ranges}
+
+
+def parse_whois_ipv4(path):
+    """
+    File with allocation of IPv4 blocks to RIRs (created by scripts/get_iana_assignment_files.py), lines:
+    first IP,last IP,RIR (IPs as integers). Value is [first IP, last IP, RIR] of the most specific block.
+    """
+    with open(path, 'r') as f:
+        blocks = [(int(row[0]), int(row[1]), row[2]) for row in csv.reader(f, delimiter=',')]
+    # Where blocks overlap, the one starting later (i.e. the nested one) is used
+    return {'v4': [(first, last, [first, last, rir]) for first, last, rir in reversed(blocks)]}
+
+
+def parse_asdb(path):
+    """ASdb (https://asdb.stanford.edu/) CSV file, value is list of [category, subcategory] of the ASN"""
+    ranges = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip().split(',"')
+            asn = line[0]
+            if asn == "ASN":
+                continue
+            categories = line[1:]
+            cat = [[c.strip('"'), s.strip('"')] for c, s in zip(categories[0::2], categories[1::2])]
+            try:
+                asn = int(asn[2:])
+            except ValueError:
+                continue
+            ranges.append((asn, asn, cat))
+    # (if an ASN is listed more times, the last entry is used)
+    return {'int': ranges[::-1]}
+
+
+def parse_cloudips(path):
+    """
+    Cloud provider IP ranges (from DShield), lines: ip,netmask,provider,comment
+    Value is [ip, netmask, provider, comment].
+    """
+    log = logging.getLogger('RefData')
+    # (if a network is listed more times, the last entry is used; if networks overlap, the first one is used)
+    networks = {}
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                ip, netmask, provider, comment = line.strip().split(",")
+                net = ipaddress.ip_network("{}/{}".format(ip, netmask), strict=False)
+            except ValueError:
+                log.warning('Invalid line in cloudips file: {!r}'.format(line))
+                continue
+            networks[net] = [ip, netmask, provider, comment]
+    return {
+        'v{}'.format(version): [(*network_range(net), value) for net, value in networks.items() if net.version == version]
+        for version in (4, 6)
+    }
+
+
+def parse_caida_as2types(path):
+    """CAIDA AS classification (https://www.caida.org/catalog/datasets/as-classification/), value is [source, class]"""
+    log = logging.getLogger('RefData')
+    ranges = []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            data = line.strip().split("|")
+            if len(data) < 3:
+                continue
+            try:
+                asn = int(data[0])
+            except ValueError:
+                log.error("Can't parse line starting with '{}' - it's not number.".format(data[0]))
+                continue
+            ranges.append((asn, asn, [data[1], data[2]]))
+    return {'int': ranges[::-1]}
+
+
+# Known datasets: name -> parser of the source file
+DATASETS = {
+    'whois_asn': parse_whois_asn,
+    'whois_ipv4': parse_whois_ipv4,
+    'asdb': parse_asdb,
+    'cloudips': parse_cloudips,
+    'caida_as2types': parse_caida_as2types,
+}
+
+
+# ***** Compilation and loading *****
+
+def _source_stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def compiled_path(name, refdata_dir):
+    return os.path.join(refdata_dir, name + '.bin')
+
+
+def compile_dataset(name, source, refdata_dir):
+    """Compile source file of given dataset into refdata_dir, return path of the compiled file"""
+    path = compiled_path(name, refdata_dir)
+    os.makedirs(refdata_dir, exist_ok=True)
+    stat = _source_stat(source)  # (before parsing, so a change during parsing is detected next time)
+    spaces = DATASETS[name](source)
+    counts = build_table(path, spaces, {'name': name, 'source': os.path.abspath(source), 'source_stat': stat})
+    logging.getLogger('RefData').info("Dataset '{}' compiled from {} ({} ranges)".format(
+        name, source, sum(counts.values())))
+    return path
+
+
+def _is_current(meta, source):
+    return bool(meta) and meta.get('source') == os.path.abspath(source) and meta.get('source_stat') == _source_stat(source)
+
+
+def is_up_to_date(name, source, refdata_dir):
+    """Return True if the compiled dataset exists and was compiled from the current version of the source file"""
+    try:
+        meta = MappedArrays(compiled_path(name, refdata_dir)).meta
+    except (OSError, ValueError):
+        return False
+    return _is_current(meta, source)
+
+
+def load(name, source, refdata_dir):
+    """
+    Load (map) given dataset compiled from the source file, compile it first if it's missing or outdated.
+
+    If the source file doesn't exist, the last compiled version is used.
+    Raises OSError if neither the source file nor the compiled dataset can be read.
+    """
+    path = compiled_path(name, refdata_dir)
+    try:
+        table = RefTable(path)
+    except (OSError, ValueError):
+        table = None
+    if table is not None and (_is_current(table.meta, source) or not os.path.exists(source)):
+        return table
+    compile_dataset(name, source, refdata_dir)
+    return RefTable(path)
@@ -0,0 +1,166 @@
+"""
+NERD: classification of IP addresses by IANA special-purpose address registries
+
+The registries list address blocks reserved for special purposes (private
+networks, loopback, documentation, etc.), each with a flag whether addresses
+from the block are globally reachable:
+  https://www.iana.org/assignments/iana-ipv4-special-registry/
+  https://www.iana.org/assignments/iana-ipv6-special-registry/
+They can be downloaded in CSV format and loaded by load_registry(), otherwise
+a built-in copy (DEFAULT_BLOCKS) is used.
+
+An address is classified as reserved if the most specific block containing it
+is not globally reachable. Multicast ranges (which are in separate registries)
+are always classified as reserved.
+
+The blocks are converted to integer range tables (IntervalIndex), so an
+address is classified by a single bisect and many addresses at once by numpy.
+"""
+
+import csv
+import re
+import ipaddress
+
+from common.interval_index import IntervalIndex, network_range
+
+# Built-in copy of the IANA special-purpose registries: (block, name, globally_reachable)
+# (None = the registry says "N/A", such blocks are not classified as reserved)
+DEFAULT_BLOCKS = [
+    # IPv4
+    ("0.0.0.0/8", "This network", False),
+    ("0.0.0.0/32", "This host on this network", False),
+    ("10.0.0.0/8", "Private-Use", False),
+    ("100.64.0.0/10", "Shared Address Space", False),
+    ("127.0.0.0/8", "Loopback", False),
+    ("169.254.0.0/16", "Link Local", False),
+    ("172.16.0.0/12", "Private-Use", False),
+    ("192.0.0.0/24", "IETF Protocol Assignments", False),
+    ("192.0.0.0/29", "IPv4 Service Continuity Prefix", False),
+    ("192.0.0.8/32", "IPv4 dummy address", False),
+    ("192.0.0.9/32", "Port Control Protocol Anycast", True),
+    ("192.0.0.10/32", "Traversal Using Relays around NAT Anycast", True),
+    ("192.0.0.170/32", "NAT64/DNS64 Discovery", False),
+    ("192.0.0.171/32", "NAT64/DNS64 Discovery", False),
+    ("192.0.2.0/24", "Documentation (TEST-NET-1)", False),
+    ("192.31.196.0/24", "AS112-v4", True),
+    ("192.52.193.0/24", "AMT", True),
+    ("192.88.99.0/24", "Deprecated (6to4 Relay Anycast)", None),
+    ("192.168.0.0/16", "Private-Use", False),
+    ("192.175.48.0/24", "Direct Delegation AS112 Service", True),
+    ("198.18.0.0/15", "Benchmarking", False),
+    ("198.51.100.0/24", "Documentation (TEST-NET-2)", False),
+    ("203.0.113.0/24", "Documentation (TEST-NET-3)", False),
+    ("240.0.0.0/4", "Reserved", False),
+    ("255.255.255.255/32", "Limited Broadcast", False),
+    # IPv6
+    ("::1/128", "Loopback Address", False),
+    ("::/128", "Unspecified Address", False),
+    ("::ffff:0:0/96", "IPv4-mapped Address", False),
+    ("64:ff9b::/96", "IPv4-IPv6 Translat.", True),
+    ("64:ff9b:1::/48", "IPv4-IPv6 Translat.", False),
+    ("100::/64", "Discard-Only Address Block", False),
+    ("2001::/23", "IETF Protocol Assignments", False),
+    ("2001::/32", "TEREDO", None),
+    ("2001:1::1/128", "Port Control Protocol Anycast", True),
+    ("2001:1::2/128", "Traversal Using Relays around NAT Anycast", True),
+    ("2001:1::3/128", "DNS-SD Service Registration Protocol Anycast", True),
+    ("2001:2::/48", "Benchmarking", False),
+    ("2001:3::/32", "AMT", True),
+    ("2001:4:112::/48", "AS112-v6", True),
+    ("2001:20::/28", "ORCHIDv2", True),
+    ("2001:30::/28", "Drone Remote ID Protocol Entity Tags (DETs) Prefix", True),
+    ("2001:db8::/32", "Documentation", False),
+    ("2002::/16", "6to4", None),
+    ("2620:4f:8000::/48", "Direct Delegation AS112 Service", True),
+    ("3fff::/20", "Documentation", False),
+    ("5f00::/16", "Segment Routing (SRv6) SIDs", False),
+    ("fc00::/7", "Unique-Local", False),
+    ("fe80::/10", "Link-Local Unicast", False),
+]
+
+# Blocks which are always classified as reserved (not in special-purpose registries)
+MULTICAST_BLOCKS = [
+    ("224.0.0.0/4", "Multicast", False),
+    ("ff00::/8", "Multicast", False),
+]
+
+prefix_re = re.compile(r"[0-9a-fA-F:.]+/[0-9]+")
+
+
+def load_registry(path):
+    """
+    Load IANA special-purpose address registry in CSV format (iana-ipv4-special-registry-1.csv or
+    iana-ipv6-special-registry-1.csv).
+
+    Return list of (block, name, globally_reachable), where globally_reachable is True, False or None (N/A).
+    """
+    blocks = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            # Values may contain footnote references, e.g. "192.0.0.0/24 [2]" or "False [1]"
+            reachable = row.get("Globally Reachable", "").split()
+            reachable = {"True": True, "False": False}.get(reachable[0] if reachable else None)
+            # Address Block may contain more blocks separated by commas
+            for block in prefix_re.findall(row["Address Block"]):
+                blocks.append((block, row["Name"].strip(), reachable))
+    return blocks
+
+
+class SpecialRangeClassifier():
+    """
+    Classifier of IPv4 and IPv6 addresses by special-purpose address blocks.
+    """
+    def __init__(self, blocks=None):
+        """
+        blocks - list of (block, name, globally_reachable) (default: DEFAULT_BLOCKS), multicast blocks are added
+        """
+        if blocks is None:
+            blocks = DEFAULT_BLOCKS
+        networks = [(ipaddress.ip_network(block), name, reachable) for block, name, reachable in blocks + MULTICAST_BLOCKS]
+        # The most specific block wins, so pass them to IntervalIndex sorted by prefix length (descending)
+        networks.sort(key=lambda n: n[0].prefixlen, reverse=True)
+        # Value of a range is name of the block if it's reserved, None otherwise
+        self._index = {
+            version: IntervalIndex(
+                (*network_range(net), name if reachable is False else None)
+                for net, name, reachable in networks if net.version == version
+            )
+            for version in (4, 6)
+        }
+
+    @classmethod
+    def from_files(cls, paths):
+        """Create classifier from IANA registries in CSV format (one file per IP version)"""
+        blocks = []
+        for path in paths:
+            blocks += load_registry(path)
+        return cls(blocks)
+
+    def classify(self, ip):
+        """Return name of the reserved block containing given IP address (str), or None if the address is not reserved"""
+        addr = ipaddress.ip_address(ip)
+        return self._index[addr.version].find(int(addr))
+
+    def classify_ints(self, ints, version):
+        """
+        Classify many addresses of the same IP version given as integers (list or numpy array) at once.
+
+        Return list of names of reserved blocks (or None for addresses which are not reserved).
+        """
+        return self._index[version].find_many(ints)
+
+    def classify_many(self, ips):
+        """
+        Classify many IP addresses (str, both IPv4 and IPv6) at once.
+
+        Return list of names of reserved blocks (or None for addresses which are not reserved).
+        """
+        addrs = [ipaddress.ip_address(ip) for ip in ips]
+        result = [None] * len(addrs)
+        for version in (4, 6):
+            positions = [i for i, addr in enumerate(addrs) if addr.version == version]
+            if positions:
+                names = self.classify_ints([int(addrs[i]) for i in positions], version)
+                for i, name in zip(positions, names):
+                    result[i] = name
+        return result
@@ -0,0 +1,240 @@
+"""
+NERD - aggregation of tasks before they are written to the main task queue
+
+Sources like warden_receiver often send many tasks for the same entity within
+a short time (e.g. a scanner reported in thousands of IDEA messages). Each task
+costs a full worker cycle (load record, call handlers, store record), although
+most of these tasks only contain commutative operations which can be merged.
+
+TaskAggregator is a drop-in replacement of TaskQueueWriter.put_task which keeps
+tasks in a buffer (keyed by entity) and merges tasks of the same entity:
+- 'add'/'sub' - values are summed,
+- 'setmax'/'setmin' - the larger/smaller value is kept,
+- 'set' - the last value is kept,
+- 'array_upsert' - actions of items with the same query are merged recursively
+  (items with different queries are kept as separate operations).
+
+Tasks containing any other operation (including weak '*' operations and
+events), priority tasks and tasks which would change the same key by a
+different operation or change a key and its sub-key (e.g. 'x' and 'x.n',
+whose order matters) are never merged - pending task of the entity is sent first
+and then the task itself, so the order of tasks of each entity is preserved.
+
+Buffered tasks are sent when the buffer reaches the maximal number of entities
+(the oldest entity first), when they are older than the maximal age (checked on
+each put_task call or by calling flush_expired()) and by calling flush(), which
+must be called before exit.
+"""
+
+import time
+import logging
+import collections
+
+# Operations which may be merged and the function merging two values
+MERGE_FUNCTIONS = {
+    'add': lambda old, new: old + new,
+    'sub': lambda old, new: old + new,
+    'setmax': max,
+    'setmin': min,
+    'set': lambda old, new: new,
+}
+
+
+def upsert_key(req):
+    """Return hashable identification of the array item selected by given array_upsert request"""
+    return (req[1], tuple(sorted(req[2].items())))
+
+
+def key_prefixes(key):
+    """Return all strict dotted prefixes of the key ('a.b.c' -> ['a', 'a.b'])"""
+    parts = key.split('.')
+    return ['.'.join(parts[:i]) for i in range(1, len(parts))]
+
+
+def is_mergeable(requests):
+    """Return True if all given update requests (incl. actions of array_upsert) can be merged"""
+    for req in requests:
+        if req[0] == 'array_upsert':
+            try:
+                hash(upsert_key(req))
+            except TypeError:
+                return False  # query contains unhashable values (e.g. lists)
+            if not is_mergeable(req[3]):
+                return False
+        elif req[0] not in MERGE_FUNCTIONS:
+            return False
+    return True
+
+
+class MergedRequests():
+    """
+    List of update requests merged from multiple tasks of one entity (or actions of one array_upsert item)
+    """
+    def __init__(self):
+        self.by_key = {}  # key -> [op, key, value] or ['array_upsert', key, query, MergedRequests]
+        self.upserts = {}  # (key, query as sorted tuple of items) -> ['array_upsert', key, query, MergedRequests]
+        self.order = []  # all merged requests in the order of their first occurrence
+        self.parents = set()  # strict dotted prefixes of keys in by_key
+
+    @staticmethod
+    def _overlaps(key, keys, parents):
+        """Return True if the key is a strict prefix or an extension of some of the keys (parents are their prefixes)"""
+        return key in parents or any(prefix in keys for prefix in key_prefixes(key))
+
+    def conflicts(self, requests):
+        """
+        Return True if any of given (mergeable) requests changes a key by a different operation than another request
+        (already merged or given), or changes a key which is a prefix or an extension of a key changed by another
+        request (e.g. 'x' and 'x.n' - merging would change the order of the requests)
+        """
+        ops = {}  # key -> operation used by given requests
+        parents = set()  # strict prefixes of keys of given requests
+        upsert_actions = {}  # upsert key -> actions of given requests
+        for req in requests:
+            op, key = req[0], req[1]
+            current = self.by_key.get(key)
+            if ops.setdefault(key, op) != op or (current is not None and current[0] != op):
+                return True
+            if self._overlaps(key, self.by_key, self.parents) or self._overlaps(key, ops, parents):
+                return True
+            parents.update(key_prefixes(key))
+            if op == 'array_upsert':
+                upsert_actions.setdefault(upsert_key(req), []).extend(req[3])
+        for ukey, actions in upsert_actions.items():
+            item = self.upserts.get(ukey)
+            if (item[3] if item is not None else MergedRequests()).conflicts(actions):
+                return True
+        return False
+
+    def merge(self, requests):
+        """Merge given (mergeable and non-conflicting) requests into this object"""
+        for req in requests:
+            op, key = req[0], req[1]
+            if op == 'array_upsert':
+                ukey = upsert_key(req)
+                item = self.upserts.get(ukey)
+                if item is None:
+                    item = ['array_upsert', key, req[2], MergedRequests()]
+                    self.upserts[ukey] = item
+                    self.by_key[key] = item
+                    self.parents.update(key_prefixes(key))
+                    self.order.append(item)
+                item[3].merge(req[3])
+            else:
+                current = self.by_key.get(key)
+                if current is None:
+                    current = [op, key, req[2]]
+                    self.by_key[key] = current
+                    self.parents.update(key_prefixes(key))
+                    self.order.append(current)
+                else:
+                    current[2] = MERGE_FUNCTIONS[op](current[2], req[2])
+
+    def get_requests(self):
+        """Return merged requests as a list of tuples (in the format accepted by UpdateManager)"""
+        return [
+            ('array_upsert', req[1], req[2], req[3].get_requests()) if req[0] == 'array_upsert' else tuple(req)
+            for req in self.order
+        ]
+
+
+class TaskAggregator():
+    def __init__(self, task_queue_writer, max_age=1.0, max_entities=1000):
+        """
+        Create a buffer merging tasks of the same entity in front of a TaskQueueWriter.
+
+        :param task_queue_writer: TaskQueueWriter to send (merged) tasks to
+        :param max_age: Max time (in seconds) a task may be kept in the buffer
+        :param max_entities: Max number of entities in the buffer
+        """
+        self.log = logging.getLogger('TaskAggregator')
+
+        self.task_queue_writer = task_queue_writer
+        self.max_age = max_age
+        self.max_entities = max_entities
+
+        # (etype, eid) -> [src, MergedRequests, time of the first task, number of merged tasks];
+        # ordered by time of the first task
+        self._buffer = collections.OrderedDict()
+
+        # Metrics
+        self.tasks_received = 0  # number of tasks passed to put_task
+        self.tasks_sent = 0  # number of tasks sent to the task queue
+        self.tasks_buffered = 0  # number of received tasks waiting (merged) in the buffer
+
+    def put_task(self, etype, eid, requested_changes, src, priority=False):
+        """Put task (update_request) to the buffer, or send it immediately if it can't be merged"""
+        self.tasks_received += 1
+        ekey = (etype, eid)
+        pending = self._buffer.get(ekey)
+
+        if priority or not is_mergeable(requested_changes):
+            # Send pending task of the entity first to keep the order of tasks
+            if pending is not None:
+                self._flush_entity(ekey)
+            self._send(etype, eid, requested_changes, src, priority)
+            return
+
+        if pending is not None and (pending[0] != src or pending[1].conflicts(requested_changes)):
+            self._flush_entity(ekey)
+            pending = None
+
+        if pending is None and MergedRequests().conflicts(requested_changes):
+            # The task itself changes the same key by different operations, it can't be merged at all
+            self._send(etype, eid, requested_changes, src, priority)
+            return
+
+        if pending is None:
+            if len(self._buffer) >= self.max_entities:
+                self._flush_entity(next(iter(self._buffer)))
+            pending = [src, MergedRequests(), time.time(), 0]
+            self._buffer[ekey] = pending
+        pending[1].merge(requested_changes)
+        pending[3] += 1
+        self.tasks_buffered += 1
+
+        self.flush_expired()
+
+    def flush_expired(self):
+        """Send all tasks that are in the buffer longer than max_age"""
+        limit = time.time() - self.max_age
+        while self._buffer:
+            ekey, (_, _, first_time, _) = next(iter(self._buffer.items()))
+            if first_time > limit:
+                break
+            self._flush_entity(ekey)
+
+    def flush(self):
+        """Send all tasks in the buffer"""
+        if self._buffer:
+            self.log.debug("Flushing {} buffered tasks".format(len(self._buffer)))
+        while self._buffer:
+            self._flush_entity(next(iter(self._buffer)))
+
+    def get_stats(self):
+        """
+        Return metrics of the aggregation as a dict:
+        - tasks_received - number of tasks passed to put_task
+        - tasks_sent - number of tasks actually sent to the task queue
+        - tasks_buffered - number of received tasks currently waiting in the buffer
+        - compression_ratio - number of received tasks which were already sent (possibly merged) / tasks_sent
+        """
+        return {
+            'tasks_received': self.tasks_received,
+            'tasks_sent': self.tasks_sent,
+            'tasks_buffered': self.tasks_buffered,
+            'compression_ratio': (self.tasks_received - self.tasks_buffered) / self.tasks_sent if self.tasks_sent else 1.0,
+        }
+
+    def log_stats(self):
+        self.log.info("{tasks_received} tasks received, {tasks_sent} tasks sent, {tasks_buffered} in buffer "
+                      "(compression ratio {compression_ratio:.2f})".format(**self.get_stats()))
+
+    def _flush_entity(self, ekey):
+        src, merged, _, count = self._buffer.pop(ekey)
+        self.tasks_buffered -= count
+        self._send(ekey[0], ekey[1], merged.get_requests(), src)
+
+    def _send(self, etype, eid, requested_changes, src, priority=False):
+        self.task_queue_writer.put_task(etype, eid, requested_changes, src, priority)
+        self.tasks_sent += 1
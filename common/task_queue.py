@@ -64,8 +64,12 @@ HASH = lambda x: int(hashlib.sha1(x.encode('utf8')).hexdigest()[-4:], 16)
 
 # When reading, pre-fetch only a limited amount of messages
 # (because pre-fetched messages are not counted to queue length limit)
+# (default, TaskQueueReader may set its own)
 PREFETCH_COUNT = 50
 
+# Acknowledgements of processed messages are collected and sent at most after this time (seconds)
+ACK_INTERVAL = 0.1
+
 
 RECONNECT_DELAYS = [1, 2, 5, 10, 30] # number of seconds to wait for the i-th attempt to reconnect after error
 
@@ -137,6 +141,7 @@ class RobustAMQPConnection:
         }
         self.connection = None
         self.channel = None
+        self.prefetch_count = PREFETCH_COUNT
 
     def __del__(self):
         self.disconnect()
@@ -160,7 +165,7 @@ class RobustAMQPConnection:
 
                 self.channel = self.connection.channel()
                 self.channel.confirm_deliveries()
-                self.channel.basic.qos(PREFETCH_COUNT)
+                self.channel.basic.qos(self.prefetch_count)
                 break
             except amqpstorm.AMQPError as e:
                 sleep_time = RECONNECT_DELAYS[min(attempts, len(RECONNECT_DELAYS))-1]
@@ -252,14 +257,17 @@ class TaskQueueWriter(RobustAMQPConnection):
 
 
 class TaskQueueReader(RobustAMQPConnection):
-    def __init__(self, callback, worker_index=0, rabbit_config={}, queue=DEFAULT_QUEUE, priority_queue=DEFAULT_PRIORITY_QUEUE):
+    def __init__(self, callback, worker_index=0, rabbit_config={}, queue=DEFAULT_QUEUE, priority_queue=DEFAULT_PRIORITY_QUEUE,
+                 prefetch_count=PREFETCH_COUNT, ack_interval=ACK_INTERVAL):
         """
         Create an object for reading tasks from the main Task Queue.
 
         It consumes messages from two RabbitMQ queues (normal and priority one for given worker) and passes them to
         the given callback function. Tasks from the priority queue are passed before the normal ones.
 
-        Each received message must be acknowledged by calling .ack(msg_tag).
+        Each received message must be acknowledged by calling .ack(msg_tag). Acknowledgements are not sent
+        immediately, a separate thread sends them in batches (one "multiple" ack of the highest delivery tag below
+        which all messages were acknowledged) every ack_interval seconds or when half of prefetch_count is waiting.
 
         :param callback: Function called when a message is received, prototype: func(msg_tag, etype, eid, ops)
         :param worker_index: index of this worker (filled into DEFAULT_QUEUE string using .format() method)
@@ -267,6 +275,9 @@ class TaskQueueReader(RobustAMQPConnection):
             host, port, virtual_host, username, password
         :param queue: Name of RabbitMQ queue to read from (should contain "{}" to fill in worker_index)
         :param priority_queue: Name of RabbitMQ queue to read from (priority messages) (should contain "{}" to fill in worker_index)
+        :param prefetch_count: Max number of received messages not acknowledged yet (in both queues together), this
+            limits the number of messages buffered locally
+        :param ack_interval: Max time (seconds) to wait before sending acknowledgements
         """
         assert callable(callback)
         assert isinstance(worker_index, int) and worker_index >= 0
@@ -281,17 +292,41 @@ class TaskQueueReader(RobustAMQPConnection):
         self.callback = callback
         self.queue_name = queue.format(worker_index)
         self.priority_queue_name = priority_queue.format(worker_index)
+        self.prefetch_count = prefetch_count
+        self.ack_interval = ack_interval
+        self.ack_batch = max(1, prefetch_count // 2)
 
         self.running = False
 
         self._consuming_thread = None
         self._processing_thread = None
+        self._ack_thread = None
 
-        # Receive messages into 2 temporary queues (max length should be equal to prefetch_count set in RabbitMQReader)
+        # Receive messages into 2 temporary queues (together, they can't contain more than prefetch_count messages,
+        # as the server doesn't send more unacknowledged messages)
+        # Items are (channel generation, message)
         self.cache = collections.deque()
         self.cache_pri = collections.deque()
         self.cache_full = threading.Event()  # signalize there's something in the cache
 
+        # Acknowledgements
+        # Delivery tags are sequence numbers of messages within a channel, so acks are valid only in the channel
+        # the message was received from - tags passed to callback are (channel generation, delivery tag)
+        self._ack_lock = threading.Lock()
+        self._ack_generation = 0 # incremented with each new channel
+        self._ack_floor = 0 # highest delivery tag acknowledged to server (all lower ones are acknowledged too)
+        self._completed = set() # delivery tags of acknowledged messages above _ack_floor (not sent to server yet)
+        self._ack_needed = threading.Event()
+        self._ack_stop = threading.Event()
+
+        # Statistics (see get_stats())
+        self._n_received = 0
+        self._n_passed = 0
+        self._n_completed = 0
+        self._n_acked = 0
+        self._n_ack_frames = 0
+        self._n_discarded = 0
+
 
     def __del__(self): #TODO is this needed?
         self.log.debug("Destructor called")
@@ -319,6 +354,12 @@ class TaskQueueReader(RobustAMQPConnection):
         self._processing_thread = threading.Thread(None, self._msg_processing_thread_func)
         self._processing_thread.start()
 
+        # Start thread sending acknowledgements
+        if not self._ack_thread:
+            self._ack_stop.clear()
+            self._ack_thread = threading.Thread(None, self._ack_thread_func, name="TaskQueueAck", daemon=True)
+            self._ack_thread.start()
+
 
     def stop(self):
         """Stop receiving tasks."""
@@ -330,12 +371,100 @@ class TaskQueueReader(RobustAMQPConnection):
         self.log.info("TaskQueueReader stopped")
 
 
+    def connect(self):
+        """Create a connection (or reconnect after error), set prefetch limit for the whole channel."""
+        super().connect()
+        if self.channel:
+            self.channel.basic.qos(self.prefetch_count, global_=True)
+        with self._ack_lock:
+            # New channel - unacknowledged messages of the old one will be redelivered, drop the local copies
+            self._ack_generation += 1
+            self._ack_floor = 0
+            self._n_discarded += len(self._completed) + len(self.cache) + len(self.cache_pri)
+            self._completed.clear()
+            self.cache.clear()
+            self.cache_pri.clear()
+
+    def disconnect(self):
+        """Send all pending acknowledgements and close the connection."""
+        self._stop_ack_thread()
+        super().disconnect()
+
     def ack(self, msg_tag):
         """Acknowledge processing of the message/task
 
+        The acknowledgement is sent to the server later, in a batch with others.
+        Thread-safe (may be called from any thread).
+
         :param msg_tag: Message tag received as the first param of the callback function.
         """
-        self.channel.basic.ack(delivery_tag=msg_tag)
+        generation, tag = msg_tag
+        with self._ack_lock:
+            self._n_completed += 1
+            if generation != self._ack_generation:
+                # Message from a previous channel (before reconnection), it's redelivered anyway
+                self._n_discarded += 1
+                return
+            self._completed.add(tag)
+            n_waiting = len(self._completed)
+        if n_waiting >= self.ack_batch:
+            self._ack_needed.set()
+
+    def _flush_acks(self):
+        """Send acknowledgement of all messages up to the highest delivery tag with all lower tags acknowledged"""
+        with self._ack_lock:
+            floor = self._ack_floor
+            while floor + 1 in self._completed:
+                floor += 1
+                self._completed.remove(floor)
+            if floor == self._ack_floor:
+                return
+            n = floor - self._ack_floor
+            self._ack_floor = floor
+            channel = self.channel
+        try:
+            channel.basic.ack(delivery_tag=floor, multiple=True)
+            self._n_acked += n
+            self._n_ack_frames += 1
+        except (amqpstorm.AMQPError, AttributeError) as e:
+            # (messages will be redelivered after reconnection)
+            self.log.error("Can't acknowledge messages: {}".format(e))
+
+    def _ack_thread_func(self):
+        while not self._ack_stop.is_set():
+            self._ack_needed.wait(self.ack_interval)
+            self._ack_needed.clear()
+            self._flush_acks()
+        self._flush_acks()
+
+    def _stop_ack_thread(self):
+        if self._ack_thread:
+            self._ack_stop.set()
+            self._ack_needed.set()
+            self._ack_thread.join()
+        self._ack_thread = None
+
+    def get_stats(self):
+        """
+        Return statistics of received messages (dict):
+          received - number of messages received from server
+          buffered - number of messages in local cache (not passed to callback yet)
+          in_flight - number of messages passed to callback and not acknowledged by it yet
+          waiting_ack - number of messages acknowledged by callback but not yet to server
+          acked - number of messages acknowledged to server
+          ack_frames - number of acknowledgements sent (each may acknowledge multiple messages)
+          discarded - number of messages which were dropped due to reconnection (they are redelivered)
+        """
+        with self._ack_lock:
+            return {
+                'received': self._n_received,
+                'buffered': len(self.cache) + len(self.cache_pri),
+                'in_flight': self._n_passed - self._n_completed,
+                'waiting_ack': len(self._completed),
+                'acked': self._n_acked,
+                'ack_frames': self._n_ack_frames,
+                'discarded': self._n_discarded,
+            }
 
 
     def _consuming_thread_func(self):
@@ -353,12 +482,16 @@ class TaskQueueReader(RobustAMQPConnection):
                 self.connect()
 
     # These two callbacks are called when a new message is received - they only put the message into a local queue
+    # (deque operations are thread-safe, the processing thread re-checks both queues after each wake-up, so no
+    # signal can be lost)
     def _on_message(self, message):
-        self.cache.append(message)
+        self._n_received += 1
+        self.cache.append((self._ack_generation, message))
         self.cache_full.set()
 
     def _on_message_pri(self, message):
-        self.cache_pri.append(message)
+        self._n_received += 1
+        self.cache_pri.append((self._ack_generation, message))
         self.cache_full.set()
 
 
@@ -366,19 +499,23 @@ class TaskQueueReader(RobustAMQPConnection):
         # Reads local queues and passes tasks to the user callback.
         while self.running:
             # Get task from a local queue (try the priority one first)
-            if len(self.cache_pri) > 0:
-                msg = self.cache_pri.popleft()
-                pri = True
-            elif len(self.cache) > 0:
-                msg = self.cache.popleft()
-                pri = False
-            else:
-                self.cache_full.wait()
-                self.cache_full.clear()
-                continue
+            try:
+                if len(self.cache_pri) > 0:
+                    generation, msg = self.cache_pri.popleft()
+                    pri = True
+                elif len(self.cache) > 0:
+                    generation, msg = self.cache.popleft()
+                    pri = False
+                else:
+                    self.cache_full.wait()
+                    self.cache_full.clear()
+                    continue
+            except IndexError:
+                continue # cache was cleared by reconnection in the meantime
 
             body = msg.body
-            tag = msg.delivery_tag
+            tag = (generation, msg.delivery_tag)
+            self._n_passed += 1
 
             self.log.debug("Received {}message: {} (tag: {})".format("priority " if pri else "", body, tag))
 
@@ -0,0 +1,308 @@
+"""
+NERD: client for whois servers (RIRs) with a persistent response cache
+
+Many IPs share the same IP block, AS and organization, so the same queries are
+sent to the whois servers over and over. WhoisClient therefore:
+- caches responses in a local SQLite database keyed by (server, query), so the
+  cache is shared by all worker processes and survives restarts (responses are
+  kept for 'ttl' seconds),
+- sends each query only once if more threads ask for it at the same time (the
+  others wait for the result),
+- limits the number of concurrent connections and the rate of queries to each
+  server, and backs off for a while when a server reports that the rate limit
+  was exceeded,
+- caches resolved addresses of servers (and the address family which works),
+- optionally keeps connections to servers supporting the persistent mode of
+  RIPE-like databases ("-k" flag) open and sends more queries over them.
+
+Limits of each server may be set by 'servers' parameter, e.g.:
+  {'whois.arin.net': {'concurrency': 1, 'rate': 2}, 'whois.ripe.net': {'persistent': True}}
+"""
+
+import logging
+import socket
+import sqlite3
+import threading
+import time
+
+# Default limits of a server (if not set in 'servers')
+DEFAULT_SERVER_PARAMS = {
+    'concurrency': 2,    # max number of queries running at once
+    'rate': 0,           # max number of queries started per second (0 = unlimited)
+    'persistent': False, # use persistent connections ("-k" flag, supported by RIPE, APNIC and AFRINIC databases)
+}
+
+RATE_LIMIT_MSG = "Query rate limit exceeded"
+
+# In persistent mode, each response is terminated by two empty lines
+PERSISTENT_TERMINATOR = b"\n\n\n"
+
+
+class WhoisCache():
+    """
+    Persistent cache of responses of whois servers (SQLite database).
+
+    The database may be opened by more processes at once, each process should
+    use its own instance (it can be shared by threads).
+    """
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        # Write-ahead log allows readers in other processes to work while one of them is writing
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "server TEXT NOT NULL, query TEXT NOT NULL, response TEXT NOT NULL, expires REAL NOT NULL, "
+            "PRIMARY KEY (server, query))"
+        )
+
+    def get(self, server, query):
+        """Return cached response or None if it's not cached (or it's expired)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE server = ? AND query = ? AND expires > ?",
+                (server, query, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, server, query, response):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (server, query, response, expires) VALUES (?, ?, ?, ?)",
+                (server, query, response, time.time() + self.ttl)
+            )
+
+    def purge(self):
+        """Remove expired responses, return their number"""
+        with self._lock:
+            return self._conn.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class WhoisServer():
+    """State of one whois server (limits, resolved addresses, idle persistent connections)"""
+    def __init__(self, host, port, concurrency, rate, persistent):
+        self.host = host
+        self.port = port
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.min_interval = 1.0 / rate if rate else 0.0
+        self.persistent = persistent
+        self.lock = threading.Lock() # protects attributes below
+        self.next_start = 0.0  # time when next query may be started (rate limiting)
+        self.blocked_until = 0.0 # time until which no queries are sent (after "rate limit exceeded")
+        self.addresses = None  # list of (family, sockaddr), the one which worked last time is first
+        self.idle_conns = []   # open persistent connections not used at the moment
+
+    def wait_for_rate_limit(self):
+        """Sleep until the next query may be started according to the rate limit"""
+        if not self.min_interval:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start + self.min_interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class WhoisClient():
+    """
+    Client sending queries to whois servers, see the module docstring.
+    """
+    def __init__(self, cache_file=None, cache_ttl=7*24*3600, servers=None, timeout=5, rate_limit_backoff=60):
+        """
+        cache_file - path to SQLite database with cached responses (no caching if None)
+        cache_ttl - time (in seconds) to keep cached responses
+        servers - dict hostname -> dict of parameters (see DEFAULT_SERVER_PARAMS)
+        timeout - socket timeout (in seconds)
+        rate_limit_backoff - time (in seconds) to stop sending queries to a server which reported exceeded rate limit
+        """
+        self.log = logging.getLogger("WhoisClient")
+        self.cache = WhoisCache(cache_file, cache_ttl) if cache_file else None
+        self.server_params = servers or {}
+        self.timeout = timeout
+        self.rate_limit_backoff = rate_limit_backoff
+        self._servers = {}
+        self._lock = threading.Lock() # protects _servers and _in_progress
+        self._in_progress = {} # (host, query) -> [threading.Event, response] of queries being sent
+
+        # Metrics
+        self.queries = 0
+        self.cache_hits = 0
+        self.deduplicated = 0
+
+    def _get_server(self, host, port):
+        with self._lock:
+            server = self._servers.get((host, port))
+            if server is None:
+                params = dict(DEFAULT_SERVER_PARAMS)
+                params.update(self.server_params.get(host) or {})
+                server = WhoisServer(host, port, **params)
+                self._servers[(host, port)] = server
+            return server
+
+    def query(self, query, host, port=43):
+        """
+        Return response of the whois server to the query (str), or None if an error occurred.
+
+        The response is taken from the cache if possible. If the same query is being sent by another thread, wait for
+        its result.
+        """
+        self.queries += 1
+        if self.cache:
+            try:
+                response = self.cache.get(host, query)
+            except sqlite3.Error as e:
+                self.log.error("Can't read from whois cache: {}".format(e))
+                response = None
+            if response is not None:
+                self.cache_hits += 1
+                return response
+
+        key = (host, query)
+        with self._lock:
+            waiting = self._in_progress.get(key)
+            if waiting is None:
+                waiting = self._in_progress[key] = [threading.Event(), None]
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            self.deduplicated += 1
+            waiting[0].wait()
+            return waiting[1]
+
+        response = None
+        try:
+            response = self._send(query, self._get_server(host, port))
+            if response is not None and self.cache and RATE_LIMIT_MSG not in response:
+                try:
+                    self.cache.put(host, query, response)
+                except sqlite3.Error as e:
+                    self.log.error("Can't write to whois cache: {}".format(e))
+        finally:
+            waiting[1] = response
+            with self._lock:
+                del self._in_progress[key]
+            waiting[0].set()
+        return response
+
+    def purge_cache(self):
+        """Remove expired responses from the cache (should be called periodically)"""
+        if self.cache:
+            try:
+                n = self.cache.purge()
+            except sqlite3.Error as e:
+                self.log.error("Can't purge whois cache: {}".format(e))
+                return
+            self.log.debug("{} expired responses removed from cache".format(n))
+
+    def _send(self, query, server):
+        """Send query to the server respecting its limits, return response or None"""
+        if server.blocked_until > time.time():
+            self.log.debug('Query "{}" to {} not sent, rate limit was exceeded recently'.format(query, server.host))
+            return None
+        with server.semaphore:
+            server.wait_for_rate_limit()
+            if server.persistent:
+                response = self._send_persistent(query, server)
+            else:
+                response = self._send_single(query, server)
+        if response is not None and RATE_LIMIT_MSG in response:
+            self.log.warning("Query rate limit exceeded at {}, no queries will be sent there for {} s".format(
+                server.host, self.rate_limit_backoff))
+            server.blocked_until = time.time() + self.rate_limit_backoff
+        return response
+
+    def _connect(self, server):
+        """Open a connection to the server (IPv6 is preferred, then the address which worked last time is used)"""
+        with server.lock:
+            addresses = server.addresses
+        if addresses is None:
+            info = socket.getaddrinfo(server.host, server.port, 0, socket.SOCK_STREAM, socket.SOL_TCP)
+            addresses = [(i[0], i[4]) for i in info if i[0] == socket.AF_INET6]
+            addresses += [(i[0], i[4]) for i in info if i[0] == socket.AF_INET]
+            if not addresses:
+                raise socket.error("No address of {} found".format(server.host))
+        last_error = None
+        for i, (family, sockaddr) in enumerate(addresses):
+            s = socket.socket(family, socket.SOCK_STREAM)
+            s.settimeout(self.timeout)
+            try:
+                s.connect(sockaddr)
+            except socket.error as e:
+                s.close()
+                last_error = e
+                continue
+            # Remember the working address (e.g. IPv4 when IPv6 connectivity is not available)
+            with server.lock:
+                server.addresses = [addresses[i]] + addresses[:i] + addresses[i+1:]
+            return s
+        with server.lock:
+            server.addresses = None # resolve again next time
+        raise last_error
+
+    def _send_single(self, query, server):
+        """Send the query over a new connection and read the response until the server closes it"""
+        s = None
+        try:
+            s = self._connect(server)
+            s.sendall(query.encode('idna') + b"\r\n")
+            response = b''
+            while True:
+                tmp = s.recv(4096)
+                response += tmp
+                if not tmp:
+                    break
+        except (socket.error, UnicodeError) as e:
+            self.log.error('Socket error ({}): {}'.format(server.host, e))
+            return None
+        finally:
+            if s is not None:
+                s.close()
+        return response.decode('utf-8', errors='replace')
+
+    def _send_persistent(self, query, server):
+        """Send the query over a persistent connection (an idle one or a new one)"""
+        with server.lock:
+            s = server.idle_conns.pop() if server.idle_conns else None
+        reused = s is not None
+        try:
+            if s is None:
+                s = self._connect(server)
+                # "-k" in the first query switches the connection to persistent mode ("-k" in next queries would
+                # switch it off)
+                data = b"-k " + query.encode('idna') + b"\r\n"
+            else:
+                data = query.encode('idna') + b"\r\n"
+            s.sendall(data)
+            response = b''
+            while not response.endswith(PERSISTENT_TERMINATOR):
+                tmp = s.recv(4096)
+                if not tmp:
+                    # Server closed the connection - fine if we got something, but it can't be reused
+                    s.close()
+                    s = None
+                    break
+                response += tmp
+        except (socket.error, UnicodeError) as e:
+            if s is not None:
+                s.close()
+            if reused:
+                # Idle connection was probably closed by the server meanwhile, try a new one
+                return self._send_persistent(query, server)
+            self.log.error('Socket error ({}): {}'.format(server.host, e))
+            return None
+        if s is not None:
+            with server.lock:
+                server.idle_conns.append(s)
+        if not response:
+            if reused:
+                return self._send_persistent(query, server)
+            return None
+        return response.decode('utf-8', errors='replace')
@@ -28,6 +28,11 @@ if ! [ -f /data/nerd-whois-asn.csv -a -f /data/nerd-whois-ipv4.csv ]; then
     cd -
 fi
 
+if ! [ -f /data/pfx2as.bin ]; then
+    echo "Downloading and compiling prefix-to-AS data"
+    bash /nerd/scripts/download_pfx2as.sh
+fi
+
 if ! [ -f /data/asdb.csv]; then
     echo "Downloading and processing asdb data"
     cd /data/
@@ -40,4 +45,7 @@ if ! [ -f /data/cloudips.csv]; then
     wget -q --no-check-certificate "://asdb.stanford.edu/data/ases.cs://isc.sans.edu/api/cloudips\?csv" -O cloudips.csv
     cd -
 fi
+
+echob "** Compiling reference data tables **"
+python3 /nerd/scripts/compile_refdata.py -c /etc/nerd/nerdd.yml
 EOF
@@ -13,6 +13,14 @@ db.ip.createIndex({"ipblock":1},{background: true})
 db.asn.createIndex({"org":1},{background: true})
 db.ipblock.createIndex({"org":1},{background: true})
 
+// Reverse lookup of MISP events (event_id -> IPs), used by misp_receiver (which creates the index itself if missing);
+// it is partial, so queries must contain a top-level condition on "misp_events.event_id" to use it
+db.ip.createIndex({"misp_events.event_id": 1},{name: "misp_event_id", partialFilterExpression: {"misp_events.event_id": {$exists: true}}, background: true})
+
+// Buckets of Warden events (common/event_store.py) expire after max_event_history + 1 days (default 90 -> 91 days),
+// NERDd worker creates (or updates) the index itself according to the configuration
+db.ip_events.createIndex({"date": 1},{name: "date_ttl", expireAfterSeconds: 7862400, background: true})
+
 // Needed by Updater
 //db.ip.createIndex({"_nru4h": 1},{background: true})
 db.ip.createIndex({"_nru1d": 1},{background: true})
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Set 'reserved_range' attribute of all IP records in NERD database according to IANA special-purpose address registries
+(the same classification as in the reserved_ip module, see common/special_ranges.py).
+
+Records are read from MongoDB in one pass and classified in batches, tasks are sent only for records whose attribute
+would change.
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+import numpy as np
+
+# Add to path the "one directory above the current file location" to find modules from "common"
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+from common.config import read_config
+from common.mongo import get_database
+from common.special_ranges import SpecialRangeClassifier
+from common.task_queue import TaskQueueWriter
+from common.utils import int2ipstr
+
+LOGFORMAT = "%(asctime)-15s,%(name)s [%(levelname)s] %(message)s"
+LOGDATEFORMAT = "%Y-%m-%dT%H:%M:%S"
+logging.basicConfig(level=logging.INFO, format=LOGFORMAT, datefmt=LOGDATEFORMAT)
+
+logger = logging.getLogger('ReservedIPBackfill')
+
+# parse arguments
+parser = argparse.ArgumentParser(
+    prog="backfill_reserved_ip.py",
+    description="Set 'reserved_range' attribute of all IP records according to IANA special-purpose address registries."
+)
+parser.add_argument('-c', '--config', metavar='CONFIG_FILE', default='/etc/nerd/nerdd.yml',
+                    help='Path to configuration file (default: /etc/nerd/nerdd.yml)')
+parser.add_argument('-b', '--batch-size', metavar='N', type=int, default=100000,
+                    help='Number of records classified at once (default: 100000)')
+parser.add_argument('-n', '--dry-run', action='store_true',
+                    help="Only count records which would be changed, don't send any tasks")
+parser.add_argument("-v", dest="verbose", action="store_true",
+                    help="Verbose mode")
+args = parser.parse_args()
+
+if args.verbose:
+    logger.setLevel("DEBUG")
+
+# config - load nerdd.yml and nerd.yml
+logger.info("Loading config file {}".format(args.config))
+config = read_config(args.config)
+config_base_path = os.path.dirname(os.path.abspath(args.config))
+common_cfg_file = os.path.join(config_base_path, config.get('common_config'))
+logger.info("Loading config file {}".format(common_cfg_file))
+config.update(read_config(common_cfg_file))
+
+registry_files = config.get('reserved_ip.iana_registries', [])
+classifier = SpecialRangeClassifier.from_files(registry_files) if registry_files else SpecialRangeClassifier()
+
+db = get_database(config, 'script')
+
+tqw = None
+if not args.dry_run:
+    tqw = TaskQueueWriter(config.get('worker_processes'), config.get('rabbitmq'))
+    tqw.connect()
+
+
+def process_batch(batch):
+    """Classify a batch of (ip_int, current_value) and send tasks for changed records, return number of changes"""
+    changed = 0
+    ints = np.array([ip for ip, _ in batch], dtype=object)
+    # IPs are stored as integers, those lower than 2^32 are IPv4 (the same as in int2ipstr)
+    is_ipv4 = ints < 2**32
+    values = np.zeros(len(batch), dtype=np.int8)
+    for version, mask in ((4, is_ipv4), (6, ~is_ipv4)):
+        if mask.any():
+            names = classifier.classify_ints(ints[mask], version)
+            values[mask] = [1 if name else 0 for name in names]
+    for (ip, current), value in zip(batch, values.tolist()):
+        if current != value:
+            changed += 1
+            if tqw is not None:
+                tqw.put_task('ip', int2ipstr(ip), [('set', 'reserved_range', value)], "reserved_ip_backfill")
+    return changed
+
+
+total = 0
+changed = 0
+batch = []
+for rec in db['ip'].find({}, projection={'_id': 1, 'reserved_range': 1}, batch_size=10000):
+    batch.append((int(rec['_id']), rec.get('reserved_range')))
+    if len(batch) >= args.batch_size:
+        changed += process_batch(batch)
+        total += len(batch)
+        batch = []
+        logger.debug("{} records processed, {} changed".format(total, changed))
+if batch:
+    changed += process_batch(batch)
+    total += len(batch)
+
+if tqw is not None:
+    tqw.disconnect()
+logger.info("{} records processed, 'reserved_range' {} in {} of them".format(
+    total, "would be changed" if args.dry_run else "changed", changed))
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Compile prefix-to-AS dumps (CAIDA RouteViews pfx2as format) into a binary
+prefix table used by the whois module (see common/prefix_table.py).
+
+Usage:
+  compile_pfx2as.py /data/pfx2as.bin routeviews-prefix2as.txt routeviews6-prefix2as.txt
+"""
+
+import sys
+import os
+import argparse
+import logging
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+from common.prefix_table import build, PrefixTable
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="compile_pfx2as.py",
+        description="Compile prefix-to-AS dumps into a binary prefix table used by the whois module."
+    )
+    parser.add_argument('output', metavar='OUTPUT_FILE', help='Compiled prefix table (e.g. /data/pfx2as.bin)')
+    parser.add_argument('dumps', metavar='PFX2AS_FILE', nargs='+', help='Prefix-to-AS dump (IPv4 and/or IPv6)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(name)s [%(levelname)s] %(message)s")
+
+    counts = build(args.dumps, args.output)
+    PrefixTable(args.output) # check the file can be loaded
+    print("{}: {} IPv4 and {} IPv6 prefixes".format(args.output, counts[4], counts[6]))
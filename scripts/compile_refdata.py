@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Compile reference data files (whois allocation files, ASdb, cloud IP ranges,
+CAIDA AS classification) into memory-mapped tables used by NERDd modules
+(see common/refdata.py).
+
+The modules compile the files themselves when they find the compiled version
+missing or outdated, but then each worker process does it, so this should be
+run whenever the source files are updated. Datasets whose compiled version is
+up to date are skipped (unless -f is given).
+
+Usage:
+  compile_refdata.py [-c /etc/nerd/nerdd.yml] [-f]
+"""
+
+import sys
+import os
+import argparse
+import logging
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+from common.config import read_config
+from common import refdata
+
+# Dataset name -> (config key of the source file, default path used by the modules)
+SOURCES = {
+    'whois_asn': ('whois.asn_file', "/tmp/nerd-whois-asn.csv"),
+    'whois_ipv4': ('whois.ipv4_file', "/tmp/nerd-whois-ipv4.csv"),
+    'asdb': ('whois.asdb_file', "/tmp/asdb.csv"),
+    'cloudips': ('whois.cloudips_file', "/tmp/cloudips.csv"),
+    'caida_as2types': ('caida.caida_file', None),
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="compile_refdata.py",
+        description="Compile reference data files into memory-mapped tables used by NERDd modules."
+    )
+    parser.add_argument('-c', '--config', metavar='CONFIG_FILE', default='/etc/nerd/nerdd.yml',
+                        help='Path to configuration file (default: /etc/nerd/nerdd.yml)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Compile all datasets, even those which are up to date')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(name)s [%(levelname)s] %(message)s")
+
+    config = read_config(args.config)
+    refdata_dir = config.get('refdata_dir', "/data/refdata")
+
+    errors = 0
+    for name, (key, default) in SOURCES.items():
+        source = config.get(key, default)
+        if not source:
+            print("{}: not configured, skipped".format(name))
+            continue
+        if not args.force and refdata.is_up_to_date(name, source, refdata_dir):
+            print("{}: up to date".format(name))
+            continue
+        try:
+            path = refdata.compile_dataset(name, source, refdata_dir)
+            table = refdata.RefTable(path) # check the file can be loaded
+        except (OSError, ValueError) as e:
+            print("{}: ERROR: {}".format(name, e), file=sys.stderr)
+            errors += 1
+            continue
+        print("{}: {} ranges compiled from {}".format(name, len(table), source))
+    sys.exit(1 if errors else 0)
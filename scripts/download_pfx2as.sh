@@ -0,0 +1,39 @@
+#!/bin/bash
+
+# Download the latest RouteViews prefix-to-AS datasets (IPv4 and IPv6) from CAIDA
+# and compile them into /data/pfx2as.bin (local prefix table of the whois module).
+# Running workers load the new table automatically.
+#
+# Usage:
+#   ./download_pfx2as.sh
+#
+
+user=$(whoami)
+if [[ "$user" != "nerd" && "$user" != "root" ]]; then
+  echo "Run as user 'nerd' or root." >&2
+  exit 2
+fi
+
+# exit when any command fails
+set -e
+
+BASE_URL="https://publicdata.caida.org/datasets/routing"
+TMPDIR=$(mktemp -d)
+trap "rm -rf $TMPDIR" EXIT
+
+for dataset in routeviews-prefix2as routeviews6-prefix2as; do
+  echo "Downloading the latest $dataset dataset"
+  # The last line of the creation log contains path to the latest file (3rd column)
+  path=$(wget -q "$BASE_URL/$dataset/pfx2as-creation.log" -O - | tail -n 1 | cut -f 3)
+  wget -q "$BASE_URL/$dataset/$path" -O - | gunzip > "$TMPDIR/$dataset.txt"
+done
+
+echo "Compiling /data/pfx2as.bin"
+python3 $(dirname $0)/compile_pfx2as.py /data/pfx2as.bin "$TMPDIR/routeviews-prefix2as.txt" "$TMPDIR/routeviews6-prefix2as.txt"
+
+if [[ "$user" == "root" ]]; then
+  echo "Setting ownership to 'nerd' account"
+  chown nerd:nerd /data/pfx2as.bin
+fi
+
+echo "Done"
@@ -5,6 +5,7 @@
 //
 // IMPORTANT: Stop NERDd before running the script! Database must not be 
 // changed while the script is running.
+// (To fix just reference counters while NERDd is running, use reconcile_ref_cnt.py.)
 //
 // Note: JavaScript (and MongoShell) treats all numbers as floats. To store int
 // it must be written as NumberInt(0).
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Move numbers of Warden events from 'events' arrays of IP records to buckets in "ip_events" collection (see
+common/event_store.py).
+
+For each IP record with 'events', buckets of all its days are written (whole counters are set, so the script can be
+safely run again after an interruption) and then 'events' is removed from the record and events_meta.nodes,
+events_meta.cats and per-day counters of the last days (events_meta.days) are set.
+
+NERDd workers and warden_receiver must NOT run during the migration (records are modified directly in the database).
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+from datetime import datetime, timedelta
+
+import pymongo
+
+# Add to path the "one directory above the current file location" to find modules from "common"
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+from common.config import read_config
+from common.mongo import get_database
+from common.event_store import EventStore, COLLECTION, DAYS_KEPT, escape_name, day_counters
+from common.utils import int2ipstr
+
+LOGFORMAT = "%(asctime)-15s,%(name)s [%(levelname)s] %(message)s"
+LOGDATEFORMAT = "%Y-%m-%dT%H:%M:%S"
+logging.basicConfig(level=logging.INFO, format=LOGFORMAT, datefmt=LOGDATEFORMAT)
+
+logger = logging.getLogger('MigrateEvents')
+
+# parse arguments
+parser = argparse.ArgumentParser(
+    prog="migrate_events_to_buckets.py",
+    description="Move Warden events from 'events' arrays of IP records to \"ip_events\" collection."
+)
+parser.add_argument('-c', '--config', metavar='CONFIG_FILE', default='/etc/nerd/nerdd.yml',
+                    help='Path to configuration file (default: /etc/nerd/nerdd.yml)')
+parser.add_argument('-b', '--batch', metavar='N', type=int, default=1000,
+                    help='Number of IP records migrated in one batch (default: 1000)')
+parser.add_argument('-k', '--keep', action='store_true',
+                    help="Keep 'events' in IP records (only write the buckets and set the new fields)")
+parser.add_argument('-n', '--dry-run', action='store_true',
+                    help="Only count records and buckets to migrate, don't write anything")
+parser.add_argument("-v", dest="verbose", action="store_true",
+                    help="Verbose mode")
+args = parser.parse_args()
+
+if args.verbose:
+    logger.setLevel("DEBUG")
+
+# config - load nerdd.yml and nerd.yml
+logger.info("Loading config file {}".format(args.config))
+config = read_config(args.config)
+config_base_path = os.path.dirname(os.path.abspath(args.config))
+common_cfg_file = os.path.join(config_base_path, config.get('common_config'))
+logger.info("Loading config file {}".format(common_cfg_file))
+config.update(read_config(common_cfg_file))
+
+max_event_history = config.get('max_event_history')
+# Events older than this would expire immediately, don't migrate them
+cut_day = (datetime.utcnow().date() - timedelta(days=max_event_history)).strftime("%Y-%m-%d")
+# The first day of per-day counters in records
+first_counted_day = (datetime.utcnow().date() - timedelta(days=DAYS_KEPT - 1)).strftime("%Y-%m-%d")
+
+db = get_database(config, 'script')
+if not args.dry_run:
+    EventStore(db).ensure_indexes(max_event_history)
+
+
+def convert(rec):
+    """Return list of bucket documents, sorted list of nodes and sorted list of categories of given IP record"""
+    ip = int2ipstr(rec['_id'])
+    buckets = {} # date -> counters {node: {cat: n}}
+    nodes = set()
+    cats = set()
+    for evtrec in rec['events']:
+        if evtrec['date'] < cut_day:
+            continue
+        cats_of_node = buckets.setdefault(evtrec['date'], {}).setdefault(escape_name(evtrec['node']), {})
+        cat = escape_name(evtrec['cat'])
+        cats_of_node[cat] = cats_of_node.get(cat, 0) + evtrec['n']
+        nodes.add(evtrec['node'])
+        cats.add(evtrec['cat'])
+    docs = [{'_id': ip + '|' + date, 'date': datetime.strptime(date, "%Y-%m-%d"), 'c': counters}
+            for date, counters in buckets.items()]
+    return docs, sorted(nodes), sorted(cats)
+
+
+def write_batch(bucket_ops, ip_ops):
+    # Buckets first, so records are changed only when their events are stored
+    if bucket_ops:
+        db[COLLECTION].bulk_write(bucket_ops, ordered=False)
+    if ip_ops:
+        db.ip.bulk_write(ip_ops, ordered=False)
+
+
+t_start = time.time()
+num_records = 0
+num_buckets = 0
+bucket_ops = []
+ip_ops = []
+for rec in db.ip.find({'events': {'$exists': True}}, {'events': 1}, batch_size=args.batch):
+    docs, nodes, cats = convert(rec)
+    num_records += 1
+    num_buckets += len(docs)
+    logger.debug("{}: {} buckets".format(int2ipstr(rec['_id']), len(docs)))
+    if args.dry_run:
+        continue
+    for doc in docs:
+        bucket_ops.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': {'date': doc['date'], 'c': doc['c']}},
+                                            upsert=True))
+    update = {'$set': {'events_meta.nodes': nodes,
+                       'events_meta.cats': cats,
+                       'events_meta.days': day_counters(rec['events'], first_counted_day)}}
+    if not args.keep:
+        update['$unset'] = {'events': 1}
+    ip_ops.append(pymongo.UpdateOne({'_id': rec['_id']}, update))
+    if num_records % args.batch == 0:
+        write_batch(bucket_ops, ip_ops)
+        bucket_ops = []
+        ip_ops = []
+        logger.info("{} records migrated ({} buckets, {:.1f}s)".format(num_records, num_buckets, time.time() - t_start))
+
+if not args.dry_run:
+    write_batch(bucket_ops, ip_ops)
+
+logger.info("Done, {} records, {} buckets {} ({:.1f}s)".format(
+    num_records, num_buckets, "would be written" if args.dry_run else "written", time.time() - t_start))
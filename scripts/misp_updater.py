@@ -20,6 +20,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(
 from common.config import read_config
 import NERDd.core.mongodb as mongodb
 from common.task_queue import TaskQueueWriter
+from common.task_aggregator import TaskAggregator
 
 DEFAULT_MONGO_HOST = 'localhost'
 DEFAULT_MONGO_PORT = 27017
@@ -72,6 +73,9 @@ rabbit_config = config.get("rabbitmq")
 num_processes = config.get('worker_processes')
 tq = TaskQueueWriter(num_processes, rabbit_config)
 tq.connect()
+# tasks of the same IP are merged before they are sent
+task_aggregator = TaskAggregator(tq, config.get('task_aggregation.max_age', 1.0),
+                                 config.get('task_aggregation.max_entities', 1000))
 
 # load MISP instance configuration
 try:
@@ -376,12 +380,12 @@ def process_ip(ip_addr, ip_info):
                 # construct new update request and send it
                 update_requests = [('set', 'misp_events', events), ('set', '_ttl.misp', live_till),
                                    ('setmax', 'last_activity', youngest_date)]
-                tq.put_task('ip', ip_addr, update_requests, "misp_updater")
+                task_aggregator.put_task('ip', ip_addr, update_requests, "misp_updater")
         else:
             # ip address not even in NERD --> insert it
             update_requests = [('set', 'misp_events', events), ('set', '_ttl.misp', live_till), ('setmax',
                                                                 'last_activity', youngest_date)]
-            tq.put_task('ip', ip_addr, update_requests, "misp_updater")
+            task_aggregator.put_task('ip', ip_addr, update_requests, "misp_updater")
 
 
 def main():
@@ -404,7 +408,7 @@ def main():
             "{} NERD IPs don't have a (recent) entry in MISP anymore, removing corresponding misp_events keys...".format(
                 len(db_ip_misp_events)))
         for ip in db_ip_misp_events:
-            tq.put_task('ip', ip, [('remove', 'misp_events')], "misp_updater")
+            task_aggregator.put_task('ip', ip, [('remove', 'misp_events')], "misp_updater")
 
     logger.info("Step 2: Create or update NERD records for all IPs present in MISP ...")
     logger.info("Loading a list of all IPs in MISP (in given time interval) ...")
@@ -418,6 +422,8 @@ def main():
     for ip_addr, role in error_ip.items():
         process_ip(ip_addr, role)
 
+    task_aggregator.flush()
+    task_aggregator.log_stats()
     logger.info("Done")
 
 
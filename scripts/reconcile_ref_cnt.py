@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Check reference counters ("_ref_cnt") of bgppref, ipblock and org records and fix those which don't match the number
+of records actually pointing to them (as fix_ref_cnt.js, but it can be run while NERD is running).
+
+References are counted by aggregations in MongoDB and compared with the stored counters. Since changes of counters
+are applied with some delay (see NERDd/core/delta_counters.py), records with a wrong counter are checked once more
+after a while and only those whose counter is still wrong by the same difference are fixed - by sending a task adding
+the difference (so it's correct even if other changes are being processed at the same time). Records whose counter
+drops to zero are then removed by the handlers of the whois module as usual.
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+
+# Add to path the "one directory above the current file location" to find modules from "common"
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+from common.config import read_config
+from common.mongo import get_database
+from common.task_queue import TaskQueueWriter
+
+LOGFORMAT = "%(asctime)-15s,%(name)s [%(levelname)s] %(message)s"
+LOGDATEFORMAT = "%Y-%m-%dT%H:%M:%S"
+logging.basicConfig(level=logging.INFO, format=LOGFORMAT, datefmt=LOGDATEFORMAT)
+
+logger = logging.getLogger('ReconcileRefCnt')
+
+# Entity type -> list of (entity type, attribute) of records pointing to it
+REFERENCES = {
+    'bgppref': [('ip', 'bgppref')],
+    'ipblock': [('ip', 'ipblock')],
+    'org': [('asn', 'org'), ('ipblock', 'org')],
+}
+
+# Max number of IDs in one $in query
+CHUNK_SIZE = 10000
+
+# parse arguments
+parser = argparse.ArgumentParser(
+    prog="reconcile_ref_cnt.py",
+    description="Check reference counters of bgppref, ipblock and org records and fix the wrong ones."
+)
+parser.add_argument('-c', '--config', metavar='CONFIG_FILE', default='/etc/nerd/nerdd.yml',
+                    help='Path to configuration file (default: /etc/nerd/nerdd.yml)')
+parser.add_argument('-t', '--types', metavar='ETYPE', nargs='+', choices=list(REFERENCES), default=list(REFERENCES),
+                    help='Entity types to check (default: all - bgppref ipblock org)')
+parser.add_argument('-d', '--delay', metavar='SECONDS', type=int, default=60,
+                    help='Time to wait before the second check of records with a wrong counter (default: 60)')
+parser.add_argument('-n', '--dry-run', action='store_true',
+                    help="Only count records with a wrong counter, don't send any tasks")
+parser.add_argument("-v", dest="verbose", action="store_true",
+                    help="Verbose mode")
+args = parser.parse_args()
+
+if args.verbose:
+    logger.setLevel("DEBUG")
+
+# config - load nerdd.yml and nerd.yml
+logger.info("Loading config file {}".format(args.config))
+config = read_config(args.config)
+config_base_path = os.path.dirname(os.path.abspath(args.config))
+common_cfg_file = os.path.join(config_base_path, config.get('common_config'))
+logger.info("Loading config file {}".format(common_cfg_file))
+config.update(read_config(common_cfg_file))
+
+db = get_database(config, 'script')
+
+
+def chunks(ids):
+    ids = list(ids)
+    for i in range(0, len(ids), CHUNK_SIZE):
+        yield ids[i:i+CHUNK_SIZE]
+
+
+def count_references(etype, ids=None):
+    """Return dict id -> number of records pointing to the entity (only given IDs if ids is not None)"""
+    counts = {}
+    for src_etype, attr in REFERENCES[etype]:
+        matches = [{attr: {'$exists': True}}] if ids is None else [{attr: {'$in': chunk}} for chunk in chunks(ids)]
+        for match in matches:
+            pipeline = [
+                {'$match': match},
+                {'$group': {'_id': '$' + attr, 'cnt': {'$sum': 1}}},
+            ]
+            for doc in db[src_etype].aggregate(pipeline, allowDiskUse=True):
+                counts[doc['_id']] = counts.get(doc['_id'], 0) + doc['cnt']
+    return counts
+
+
+def stored_counters(etype, ids=None):
+    """Return dict id -> stored _ref_cnt (None if missing) (only given IDs if ids is not None)"""
+    queries = [{}] if ids is None else [{'_id': {'$in': chunk}} for chunk in chunks(ids)]
+    stored = {}
+    for query in queries:
+        for doc in db[etype].find(query, {'_ref_cnt': 1}):
+            stored[doc['_id']] = doc.get('_ref_cnt')
+    return stored
+
+
+def find_differences(etype, ids=None):
+    """
+    Return dict id -> (stored counter, number of references) of records with a wrong counter and number of
+    referenced records which don't exist.
+    """
+    counts = count_references(etype, ids)
+    stored = stored_counters(etype, ids)
+    wrong = {eid: (cnt, counts.get(eid, 0)) for eid, cnt in stored.items() if cnt != counts.get(eid, 0)}
+    missing = sum(1 for eid in counts if eid not in stored)
+    return wrong, missing
+
+
+tqw = None
+if not args.dry_run:
+    tqw = TaskQueueWriter(config.get('worker_processes'), config.get('rabbitmq'))
+    tqw.connect()
+
+first_pass = {}
+for etype in args.types:
+    t_start = time.time()
+    wrong, missing = find_differences(etype)
+    logger.info("{}: {} records with a wrong counter, {} referenced records don't exist ({:.1f}s)".format(
+        etype, len(wrong), missing, time.time() - t_start))
+    first_pass[etype] = wrong
+
+if any(first_pass.values()):
+    logger.info("Waiting {}s before the second check ...".format(args.delay))
+    time.sleep(args.delay)
+
+total_fixed = 0
+for etype, wrong in first_pass.items():
+    if not wrong:
+        continue
+    wrong2, _ = find_differences(etype, wrong.keys())
+    fixed = 0
+    for eid, (stored, actual) in wrong2.items():
+        if wrong.get(eid) != (stored, actual):
+            continue # changed in the meantime, it will be checked next time
+        logger.debug("{}/{}: _ref_cnt {}, number of references {}".format(etype, eid, stored, actual))
+        diff = actual - (stored or 0)
+        if stored is None or diff >= 0:
+            updreq = [('*add', '_ref_cnt', diff)]
+        else:
+            updreq = [('*sub', '_ref_cnt', -diff)]
+        if tqw:
+            tqw.put_task(etype, eid, updreq, "reconcile_ref_cnt")
+        fixed += 1
+    logger.info("{}: {} counters {}".format(etype, fixed, "would be fixed" if args.dry_run else "fixed"))
+    total_fixed += fixed
+
+if tqw:
+    tqw.disconnect()
+logger.info("Done, {} counters {}".format(total_fixed, "would be fixed" if args.dry_run else "fixed"))
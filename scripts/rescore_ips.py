@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Compute reputation score ('rep', 'rep_history') and FMP score ('fmp.general') of all IP records in one batch.
+
+It's a replacement of handlers of the Score and FMP modules called by !every1d for each IP separately (each of them
+parsing dates of the record and sending another task with the result). Set 'batch_rescoring: true' in nerdd.yml
+to disable these handlers (Score still computes the score of new IPs) and run this script daily from cron.
+FMP score is computed only with --fmp or if 'batch_rescoring_fmp: true' is set (the FMP handler is disabled only
+then, too).
+
+The ip collection is split to ranges of _id processed by a pool of processes. Each process reads its range in
+large batches (only the attributes needed), builds NumPy matrices of the inputs (numbers of reports per day, ...),
+computes the scores by vector operations and writes them by an unordered bulk write of $set operations. The same
+formulas as in modules/score.py and modules/fmp.py are used, except that reports with a date in the future are
+counted to the current day and missing/empty inputs give zero instead of an error.
+
+Records are updated directly in the database, so a result may be overwritten by a worker storing the same record
+at the same time (the score from the previous day remains then).
+"""
+
+import os
+import sys
+import time
+import fcntl
+import argparse
+import logging
+import multiprocessing
+from datetime import datetime, timedelta
+
+import numpy as np
+import pymongo
+
+# Add to path the "one directory above the current file location" to find modules from "common"
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+from common.config import read_config
+from common.mongo import get_database, close_client
+from common.utils import int2ipstr
+
+LOGFORMAT = "%(asctime)-15s,%(processName)s,%(name)s [%(levelname)s] %(message)s"
+LOGDATEFORMAT = "%Y-%m-%dT%H:%M:%S"
+logging.basicConfig(level=logging.INFO, format=LOGFORMAT, datefmt=LOGDATEFORMAT)
+
+logger = logging.getLogger('RescoreIPs')
+
+# Number of days of DShield reports and blacklist hits used by the score (as in modules/score.py)
+DATE_RANGE = 7
+# Weights of days (linearly decreasing)
+DAY_WEIGHTS = np.array([float(DATE_RANGE - d) / DATE_RANGE for d in range(DATE_RANGE)])
+
+# Blacklists used as features of the FMP model, in the order of features (as in modules/fmp.py)
+FMP_BLACKLISTS = ['tor', 'blocklist-de-ssh', 'uceprotect', 'sorbs-dul', 'sorbs-noserver', 'sorbs-spam', 'spamcop',
+                  'spamhaus-pbl', 'spamhaus-pbl-isp', 'spamhaus-xbl-cbl']
+FMP_EVENT_FEATURES = ['total1', 'nodes_1d', 'total7', 'nodes_7d', 'ewma', 'bin_ewma']
+NUM_FMP_FEATURES = 21
+
+# parse arguments
+parser = argparse.ArgumentParser(
+    prog="rescore_ips.py",
+    description="Compute reputation and FMP scores of all IP records in one batch."
+)
+parser.add_argument('-c', '--config', metavar='CONFIG_FILE', default='/etc/nerd/nerdd.yml',
+                    help='Path to configuration file (default: /etc/nerd/nerdd.yml)')
+parser.add_argument('-p', '--processes', metavar='N', type=int, default=4,
+                    help='Number of processes (default: 4)')
+parser.add_argument('-b', '--batch-size', metavar='N', type=int, default=10000,
+                    help='Number of records read and scored at once (default: 10000)')
+parser.add_argument('--fmp', action='store_true',
+                    help='Compute also FMP score (needs xgboost and the model configured in fmp.models.general), '
+                         'default if batch_rescoring_fmp is set in config')
+parser.add_argument('-n', '--dry-run', action='store_true',
+                    help="Only compute the scores, don't write anything")
+parser.add_argument("-v", dest="verbose", action="store_true",
+                    help="Verbose mode")
+args = parser.parse_args()
+
+if args.verbose:
+    logger.setLevel("DEBUG")
+
+# config - load nerdd.yml and nerd.yml
+logger.info("Loading config file {}".format(args.config))
+config = read_config(args.config)
+config_base_path = os.path.dirname(os.path.abspath(args.config))
+common_cfg_file = os.path.join(config_base_path, config.get('common_config'))
+logger.info("Loading config file {}".format(common_cfg_file))
+config.update(read_config(common_cfg_file))
+
+today = datetime.utcnow().date()
+today64 = np.datetime64(today, 'D')
+# Date of rep_history item (downloaded data dumps come from the previous day, as in modules/score.py)
+history_date = (today - timedelta(days=1)).strftime("%Y-%m-%d")
+
+# FMP is computed if requested or if the FMP module relies on this script (see modules/fmp.py)
+compute_fmp_scores = args.fmp or config.get('batch_rescoring_fmp', False)
+fmp_path = config.get('fmp.paths', {"general": "/data/fmp/general/"}).get('general')
+fmp_model_file = config.get('fmp.models', {}).get('general')
+
+projection = {
+    'dshield.date': 1, 'dshield.reports': 1,
+    'bl': 1,
+    'otx.relate_pulses.modified': 1, 'otx.relate_pulses.subscriber_count': 1,
+    'rep': 1,
+    'rep_history': {'$elemMatch': {'date': history_date}},
+}
+if compute_fmp_scores:
+    projection.update({'events_meta.' + name: 1 for name in FMP_EVENT_FEATURES})
+    projection.update({'last_activity': 1, 'hostname': 1, 'fmp': 1,
+                       'tags.staticIP': 1, 'tags.dynamicIP': 1, 'tags.dsl': 1, 'tags.ip_in_hostname': 1})
+
+
+def nonlin(val, coef=0.5, max=10000):
+    """Nonlinear transformation of [0,inf) to [0,1) (vectorized version of modules.score.nonlin)"""
+    value = np.log2(val + 1)
+    return np.where(value > max, 1.0, 1 - coef**value)
+
+
+def days_ago(dates):
+    """Return number of days before today of given dates (array of datetime64[D]), dates in future give 0"""
+    return np.maximum((today64 - dates).astype(np.int64), 0)
+
+
+def daily_score(rows, dates, counts, n):
+    """
+    Weighted average of nonlin(number of reports per day) over the last DATE_RANGE days for n records.
+
+    rows, dates, counts - arrays of record index, date (datetime64[D]) and number of reports of all reports
+    """
+    per_day = np.zeros((n, DATE_RANGE))
+    if len(rows):
+        d = days_ago(dates)
+        mask = d < DATE_RANGE
+        np.add.at(per_day, (rows[mask], d[mask]), counts[mask])
+    return (nonlin(per_day) @ DAY_WEIGHTS) / DAY_WEIGHTS.sum()
+
+
+def compute_rep(docs):
+    """Return array of reputation scores of given records (as Score.estimate_reputation)"""
+    n = len(docs)
+    ds_rows, ds_dates, ds_counts = [], [], []
+    bl_rows, bl_dates = [], []
+    otx_rows, otx_dates, otx_subs = [], [], []
+    for i, rec in enumerate(docs):
+        for day in rec.get('dshield', []):
+            if 'date' not in day or 'reports' not in day:
+                continue # (old format)
+            ds_rows.append(i)
+            ds_dates.append(day['date'][:10])
+            ds_counts.append(day['reports'])
+        if rec.get('bl'):
+            # (only the first blacklist is taken into account by Score.blacklist)
+            hist = rec['bl'][0].get('h', [])
+            bl_rows.extend([i] * len(hist))
+            bl_dates.extend(hist)
+        for pulse in rec.get('otx', {}).get('relate_pulses', []):
+            otx_rows.append(i)
+            otx_dates.append(pulse['modified'][:10])
+            otx_subs.append(pulse['subscriber_count'])
+
+    # DShield and blacklists - weighted average of daily scores
+    ds_score = daily_score(np.array(ds_rows, dtype=np.int64), np.array(ds_dates, dtype='datetime64[D]'),
+                           np.array(ds_counts, dtype=np.float64), n)
+    bl_score = daily_score(np.array(bl_rows, dtype=np.int64), np.array(bl_dates, dtype='datetime64[D]'),
+                           np.ones(len(bl_rows)), n)
+
+    # OTX - sum of decay2(age) * subscriber_count / (number of pulses * max subscriber_count)
+    otx_score = np.zeros(n)
+    if otx_rows:
+        rows = np.array(otx_rows, dtype=np.int64)
+        subs = np.array(otx_subs, dtype=np.float64)
+        d = (today64 - np.array(otx_dates, dtype='datetime64[D]')).astype(np.float64)
+        sums = np.zeros(n)
+        np.add.at(sums, rows, d / (d + 15) * subs)
+        cnt = np.bincount(rows, minlength=n)
+        max_sub = np.zeros(n)
+        np.maximum.at(max_sub, rows, subs)
+        denom = cnt * max_sub
+        np.divide(sums, denom, out=otx_score, where=denom > 0)
+
+    return (ds_score + bl_score + otx_score) / 3
+
+
+_fmp_model = None
+
+def get_fmp_model():
+    global _fmp_model
+    if _fmp_model is None:
+        import xgboost as xgb
+        _fmp_model = xgb.Booster({'nthread': 1})
+        _fmp_model.load_model(fmp_model_file)
+    return _fmp_model
+
+
+def compute_fmp(docs):
+    """
+    Return array of FMP scores of given records (NaN for records without events) and feature vectors
+    (as FMP.updateFMPGeneral).
+    """
+    import xgboost as xgb
+    n = len(docs)
+    feat = np.zeros((n, NUM_FMP_FEATURES))
+    has_events = np.zeros(n, dtype=bool)
+    now = datetime.utcnow()
+    bl_index = {name: 7 + i for i, name in enumerate(FMP_BLACKLISTS)}
+    for i, rec in enumerate(docs):
+        if 'events_meta' not in rec:
+            continue
+        has_events[i] = True
+        meta = rec['events_meta']
+        feat[i, 0:6] = [meta.get(name, 0) for name in FMP_EVENT_FEATURES]
+        feat[i, 6] = (now - rec['last_activity']).total_seconds() / 86400 if 'last_activity' in rec else np.inf
+        for bl in rec.get('bl', []):
+            if bl['n'] in bl_index and bl['v'] == 1:
+                feat[i, bl_index[bl['n']]] = 1
+        if rec.get('hostname') is not None:
+            feat[i, 17] = 1
+            if 'tags' in rec:
+                tags = rec['tags']
+                feat[i, 18] = 1 if 'staticIP' in tags else (-1 if 'dynamicIP' in tags else 0)
+                feat[i, 19] = 1 if 'dsl' in tags else 0
+                feat[i, 20] = 1 if 'ip_in_hostname' in tags else 0
+    feat[feat[:, 6] > 7.0, 6] = np.inf
+    trans = feat.copy()
+    np.log1p(feat[:, 0:6], out=trans[:, 0:6])
+    trans[:, 6] = np.exp(-feat[:, 6])
+
+    fmp = np.full(n, np.nan)
+    if has_events.any():
+        fmp[has_events] = get_fmp_model().predict(xgb.DMatrix(trans[has_events]))
+    return fmp, feat
+
+
+def log_fmp(docs, fmp, feat):
+    """Log feature vectors and FMP scores (in the same format as FMP.logFMP)"""
+    cur_time = datetime.utcnow()
+    log_time = cur_time.strftime("%Y-%m-%dT%H:%M:%S")
+    file_suffix = cur_time.strftime("%Y_%m_%d")
+    lines = []
+    results = []
+    for rec, score, fv in zip(docs, fmp.tolist(), feat):
+        if score != score: # NaN - no events
+            continue
+        prefix = log_time + ',' + int2ipstr(rec['_id']) + ','
+        lines.append(prefix + ','.join(
+            [str(int(f)) for f in fv[0:4]] + ['{:.4f}'.format(f) for f in fv[4:7]] + [str(int(f)) for f in fv[7:]]
+        ) + ",{:.4f}".format(score) + '\n')
+        results.append(prefix + ('1' if fv[0] > 0 else '0') + '\n')
+    for filename, data in ((os.path.join(fmp_path, file_suffix), lines),
+                           (os.path.join(fmp_path, 'results', file_suffix), results)):
+        try:
+            with open(filename, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.writelines(data)
+                fcntl.flock(f, fcntl.LOCK_UN)
+        except IOError:
+            logger.warning('Unable to log feature vectors to "{}".'.format(filename))
+
+
+def score_batch(db, docs):
+    """Compute scores of a batch of records and write them, return number of updated records"""
+    rep = compute_rep(docs).tolist()
+    if compute_fmp_scores:
+        fmp, feat = compute_fmp(docs)
+        log_fmp(docs, fmp, feat)
+        fmp = fmp.tolist()
+    else:
+        fmp = [None] * len(docs)
+
+    ops = []
+    for rec, rep_value, fmp_value in zip(docs, rep, fmp):
+        history = rec.get('rep_history')
+        update = {}
+        if rec.get('rep') != rep_value:
+            update['rep'] = rep_value
+        if fmp_value is not None and fmp_value == fmp_value and rec.get('fmp', {}).get('general') != fmp_value:
+            update['fmp.general'] = fmp_value
+        if history:
+            # Item of the day already exists
+            if history[0].get('reputation') != rep_value:
+                update['rep_history.$.reputation'] = rep_value
+            if update:
+                ops.append(pymongo.UpdateOne({'_id': rec['_id'], 'rep_history.date': history_date},
+                                             {'$set': update}))
+        else:
+            change = {'$push': {'rep_history': {'date': history_date, 'reputation': rep_value}}}
+            if update:
+                change['$set'] = update
+            ops.append(pymongo.UpdateOne({'_id': rec['_id'], 'rep_history.date': {'$ne': history_date}}, change))
+    if ops and not args.dry_run:
+        db.ip.bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def rescore_range(id_range):
+    """Process records with _id in given range (lower bound, upper bound or None), return (number of records, updated)"""
+    lower, upper = id_range
+    db = get_database(config, 'script')
+    query = {'_id': {'$gte': lower}} if lower is not None else {}
+    if upper is not None:
+        query.setdefault('_id', {})['$lt'] = upper
+    total = 0
+    updated = 0
+    docs = []
+    for rec in db.ip.find(query, projection, batch_size=args.batch_size):
+        docs.append(rec)
+        if len(docs) >= args.batch_size:
+            updated += score_batch(db, docs)
+            total += len(docs)
+            docs = []
+            logger.debug("{} records processed, {} updated".format(total, updated))
+    if docs:
+        updated += score_batch(db, docs)
+        total += len(docs)
+    return total, updated
+
+
+def split_ranges(db, n_ranges):
+    """Split ip collection to n_ranges ranges of _id with (roughly) the same number of records"""
+    count = db.ip.estimated_document_count()
+    bounds = [None]
+    for k in range(1, n_ranges):
+        doc = next(iter(db.ip.find({}, {'_id': 1}).sort('_id', 1).skip(k * count // n_ranges).limit(1)), None)
+        if doc is not None and doc['_id'] != bounds[-1]:
+            bounds.append(doc['_id'])
+    bounds.append(None)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+if compute_fmp_scores:
+    if not (fmp_model_file and os.path.exists(fmp_model_file)):
+        logger.error("FMP model file '{}' not found (fmp.models.general)".format(fmp_model_file))
+        sys.exit(1)
+    os.makedirs(os.path.join(fmp_path, 'results'), exist_ok=True)
+
+t_start = time.time()
+ranges = split_ranges(get_database(config, 'script'), args.processes * 4)
+# Each process must create its own connection
+close_client('script')
+logger.info("Rescoring IP records in {} ranges by {} processes".format(len(ranges), args.processes))
+
+total = 0
+updated = 0
+with multiprocessing.Pool(args.processes) as pool:
+    for n_total, n_updated in pool.imap_unordered(rescore_range, ranges):
+        total += n_total
+        updated += n_updated
+        logger.debug("{} records processed, {} updated".format(total, updated))
+
+logger.info("Done, {} records processed, {} {} ({:.1f}s)".format(
+    total, updated, "would be updated" if args.dry_run else "updated", time.time() - t_start))
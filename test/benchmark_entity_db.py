@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark of entity database backends (core/embedded_db.py, core/mongodb.py).
+
+Stores a number of synthetic IP records (similar to real ones - events, _ttl tokens,
+next-update times) and measures get, put (single and batch) and the queries used by
+updater.py and misp_receiver.py.
+
+Usage:
+  benchmark_entity_db.py -n 100000 /tmp/bench.sqlite
+  benchmark_entity_db.py -n 100000 --mongodb -c /etc/nerd/nerd.yml
+"""
+
+import sys
+import os
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NERDd')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import common.config
+from common.utils import int2ipstr
+
+
+def make_record(ip, now):
+    """Create a synthetic IP record"""
+    return {
+        '_id': ip,
+        'rep': random.random(),
+        'bgppref': '{}/16'.format(ip.rsplit('.', 2)[0] + '.0.0'),
+        'ts_added': now,
+        'last_activity': now,
+        '_nru1d': now + timedelta(seconds=random.randint(0, 86400)),
+        '_nru1w': now + timedelta(seconds=random.randint(0, 7 * 86400)),
+        '_ttl': {'warden': now + timedelta(days=random.randint(1, 14))},
+        'events': [{'date': (now - timedelta(days=d)).strftime('%Y-%m-%d'), 'node': 'cz.example.node',
+                    'cat': 'Recon.Scanning', 'n': random.randint(1, 100)} for d in range(random.randint(1, 10))],
+        'events_meta': {'total': 42, 'total1': 1, 'total7': 7, 'total30': 30},
+    }
+
+
+def timed(label, n, func):
+    start = time.perf_counter()
+    result = func()
+    duration = time.perf_counter() - start
+    print("{:24} {:10.2f} us/op ({:.0f} ops/s)".format(label, duration * 1e6 / n, n / duration))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="benchmark_entity_db.py",
+        description="Benchmark of entity database backends."
+    )
+    parser.add_argument('path', metavar='PATH', nargs='?', default='/tmp/nerd_benchmark.sqlite',
+        help='Database file of the embedded backend (default: /tmp/nerd_benchmark.sqlite, deleted before the test)')
+    parser.add_argument('--mongodb', action='store_true',
+        help='Test MongoDB backend instead of the embedded one (WARNING: uses the configured DB, use a test instance)')
+    parser.add_argument('-c', '--config', metavar='FILENAME', default=None,
+        help='Configuration file with MongoDB settings (e.g. /etc/nerd/nerd.yml)')
+    parser.add_argument('-n', '--records', metavar='N', type=int, default=10000,
+        help='Number of records (default: 10000)')
+    parser.add_argument('-b', '--batch', metavar='N', type=int, default=1000,
+        help='Batch size for put_many/get_many (default: 1000)')
+    args = parser.parse_args()
+
+    config = common.config.read_config(args.config) if args.config else common.config.HierarchicalDict({})
+    if args.mongodb:
+        from core.mongodb import MongoEntityDatabase
+        db = MongoEntityDatabase(config)
+    else:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.path + suffix):
+                os.remove(args.path + suffix)
+        config['embedded_db'] = {'path': args.path}
+        from core.embedded_db import EmbeddedEntityDatabase
+        db = EmbeddedEntityDatabase(config)
+
+    random.seed(1)
+    now = datetime.utcnow()
+    n = args.records
+    ips = [int2ipstr(random.randint(0x01000000, 0xdf000000)) for _ in range(n)]
+    records = [make_record(ip, now) for ip in ips]
+    half = n // 2
+
+    timed("put", half, lambda: [db.put('ip', ip, rec) for ip, rec in zip(ips[:half], records[:half])])
+    def put_batches():
+        for i in range(half, n, args.batch):
+            db.put_many('ip', zip(ips[i:i+args.batch], records[i:i+args.batch]))
+    timed("put_many", n - half, put_batches)
+
+    sample = random.sample(ips, min(n, 10000))
+    timed("get", len(sample), lambda: [db.get('ip', ip) for ip in sample])
+    timed("get_many", len(sample),
+          lambda: [db.get_many('ip', sample[i:i+args.batch]) for i in range(0, len(sample), args.batch)])
+
+    rounds = 10
+    t = now
+    def nru_queries():
+        global t
+        result = 0
+        for _ in range(rounds):
+            result += len(db.find('ip', {'_nru1d': {'$lte': t + timedelta(hours=1), '$gt': t}}, limit=100000))
+            t += timedelta(hours=1)
+        return result
+    found = timed("find _nru1d (1 hour)", rounds, nru_queries)
+    print("  ({} records found per query)".format(found // rounds))
+    found = timed("find rep > 0.99", 1, lambda: len(db.find('ip', {'rep': {'$gt': 0.99}})))
+    print("  ({} records found)".format(found))
+    timed("aggregate $match _ttl", 1, lambda: db.aggregate('ip', {'$match': {'_ttl.warden': {'$lt': now + timedelta(days=2)}}}))
+
+    timed("delete_many", n, lambda: db.delete_many('ip', ips))
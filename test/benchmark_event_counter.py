@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Benchmark of computation of events_meta values by EventCounter (modules/event_counter.py).
+
+Compares the former way - a scan of the whole list of events of the IP (with
+parsing of each date) on every change of events_meta.total - with derivation of
+the values from per-day counters (events_meta.days, see
+common/event_store.py). Also measures updating of the counters by the requests
+sent by warden_receiver for each event.
+
+Usage:
+  benchmark_event_counter.py -e 10000
+"""
+
+import sys
+import os
+import time
+import random
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NERDd')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+from common.event_store import day_counters, day_counter_updates, DAYS_KEPT
+from core.update_ops import perform_update
+from modules.event_counter import summarize_days, EWMA_WEIGHTS
+
+
+def make_events(today, n_events, n_days, n_nodes):
+    """Create a list of n_events events (as returned by EventStore.get) spread over n_days days"""
+    per_day = max(1, n_events // n_days)
+    cats = ['Recon.Scanning', 'Attempt.Login', 'Attempt.Exploit', 'Availability.DDoS']
+    events = []
+    for i in range(n_events):
+        date = (today - datetime.timedelta(days=i // per_day)).strftime('%Y-%m-%d')
+        events.append({'date': date, 'node': 'cz.example.node{}'.format(i % n_nodes),
+                       'cat': cats[(i // n_nodes) % len(cats)], 'n': random.randint(1, 100)})
+    return events
+
+
+def count_by_scan(events, today):
+    """The former computation in EventCounter.count_events"""
+    total1 = 0
+    total7 = 0
+    total30 = 0
+    nodes1 = set()
+    nodes7 = set()
+    nodes30 = set()
+    alerts_per_day = [0]*7
+    for evtrec in events:
+        n = evtrec['n']
+        date = evtrec['date']
+        date = datetime.date(int(date[0:4]), int(date[5:7]), int(date[8:10]))
+        days_diff = (today - date).days
+        if days_diff <= 1:
+            total1 += n
+            nodes1.add(evtrec['node'])
+        if days_diff <= 7:
+            total7 += n
+            nodes7.add(evtrec['node'])
+        if days_diff <= 30:
+            total30 += n
+            nodes30.add(evtrec['node'])
+        if days_diff < 7:
+            alerts_per_day[days_diff] += n
+    return {
+        'total1': total1,
+        'total7': total7,
+        'total30': total30,
+        'nodes_1d': len(nodes1),
+        'nodes_7d': len(nodes7),
+        'nodes_30d': len(nodes30),
+        'ewma': sum(n*w for n,w in zip(alerts_per_day, EWMA_WEIGHTS)),
+        'bin_ewma': sum((w if n else 0) for n,w in zip(alerts_per_day, EWMA_WEIGHTS)),
+    }
+
+
+def timed(label, n, func):
+    start = time.perf_counter()
+    result = func()
+    duration = time.perf_counter() - start
+    print("{:36} {:10.2f} us/op ({:.0f} ops/s)".format(label, duration * 1e6 / n, n / duration))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="benchmark_event_counter.py",
+        description="Benchmark of computation of events_meta values by EventCounter."
+    )
+    parser.add_argument('-e', '--events', metavar='N', type=int, default=10000,
+        help='Number of items (date, node, cat) in the list of events of the IP (default: 10000)')
+    parser.add_argument('-d', '--days', metavar='N', type=int, default=90,
+        help='Number of days the events are spread over (default: 90)')
+    parser.add_argument('--nodes', metavar='N', type=int, default=30,
+        help='Number of distinct nodes (default: 30)')
+    parser.add_argument('-n', '--repeat', metavar='N', type=int, default=100,
+        help='Number of computations measured (default: 100)')
+    args = parser.parse_args()
+
+    random.seed(1)
+    today = datetime.datetime.utcnow().date()
+    events = make_events(today, args.events, args.days, args.nodes)
+    first_day = (today - datetime.timedelta(days=DAYS_KEPT - 1)).strftime('%Y-%m-%d')
+    days = day_counters(events, first_day)
+    print("{} events over {} days, {} days in per-day counters".format(len(events), args.days, len(days)))
+
+    expected = count_by_scan(events, today)
+    values, _ = summarize_days(days, today)
+    assert values == expected, (values, expected)
+
+    timed("scan of the list of events", args.repeat,
+          lambda: [count_by_scan(events, today) for _ in range(args.repeat)])
+    timed("derived from per-day counters", args.repeat,
+          lambda: [summarize_days(days, today) for _ in range(args.repeat)])
+
+    # Updates of the counters by new events
+    n_updates = args.repeat * 100
+    rec = {'events_meta': {'total': 0, 'days': days}}
+    requests = [day_counter_updates(ev['date'], ev['node'], ev['cat']) for ev in random.sample(events, 100)]
+    def update_counters():
+        for _ in range(args.repeat):
+            for reqs in requests:
+                for updreq in reqs:
+                    perform_update(rec, updreq)
+    timed("update of per-day counters (event)", n_updates, update_counters)
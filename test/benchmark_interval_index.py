@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark of lookups of IPs in a list of IP ranges (e.g. cloud provider ranges in whois module).
+
+Compares the original linear scan over IPy networks (as in WhoIS.check_cloudips) with IntervalIndex (common/interval_index.py),
+both a single lookup by bisect and a batch lookup by numpy, and checks that all give the same results.
+
+Usage:
+  benchmark_interval_index.py                     (random ranges)
+  benchmark_interval_index.py /data/cloudips.csv  (real ranges, format: ip,netmask,provider,comment)
+"""
+
+import sys
+import os
+import time
+import random
+import ipaddress
+import argparse
+
+import IPy
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+from common.interval_index import IntervalIndex, network_range
+
+
+def load_ranges(path):
+    """Load ranges from a cloudips file as list of (network, value)"""
+    ranges = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                ip, netmask, provider, comment = line.strip().split(",")
+                ipaddress.ip_network("{}/{}".format(ip, netmask), strict=False)
+            except ValueError:
+                continue
+            ranges.append(("{}/{}".format(ip, netmask), [ip, netmask, provider, comment]))
+    return ranges
+
+
+def random_ranges(n):
+    """Generate n random (non-aligned to each other, possibly overlapping) IPv4 networks"""
+    ranges = []
+    for i in range(n):
+        length = random.randint(12, 28)
+        net = ipaddress.IPv4Network((random.getrandbits(32) >> (32 - length) << (32 - length), length))
+        ranges.append((str(net), [str(net.network_address), str(length), "provider{}".format(i % 10), ""]))
+    return ranges
+
+
+def timeit(func, ips, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        results = func(ips)
+    return results, (time.perf_counter() - start) / (rounds * len(ips))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="benchmark_interval_index.py",
+        description="Benchmark of lookups of IPs in a list of IP ranges."
+    )
+    parser.add_argument('path', metavar='CLOUDIPS_FILE', nargs='?', help='File with IP ranges (default: random ranges)')
+    parser.add_argument('-r', '--ranges', metavar='N', type=int, default=5000,
+        help='Number of random ranges (default: 5000)')
+    parser.add_argument('-n', '--ips', metavar='N', type=int, default=2000,
+        help='Number of looked up IPs (default: 2000)')
+    args = parser.parse_args()
+
+    ranges = load_ranges(args.path) if args.path else random_ranges(args.ranges)
+    ranges = [r for r in ranges if ipaddress.ip_network(r[0], strict=False).version == 4]
+    print("{} IPv4 ranges".format(len(ranges)))
+
+    # Half of the IPs from the ranges, half random
+    ips = []
+    for _ in range(args.ips // 2):
+        net = ipaddress.ip_network(random.choice(ranges)[0], strict=False)
+        ips.append(str(net.network_address + random.randrange(net.num_addresses)))
+    ips += [str(ipaddress.IPv4Address(random.getrandbits(32))) for _ in range(args.ips - len(ips))]
+
+    # Original implementation
+    t = time.perf_counter()
+    ipy_dict = {IPy.IP(net, make_net=True): value for net, value in ranges}
+    print("Build linear:  {:8.3f} s".format(time.perf_counter() - t))
+    def linear(ips):
+        results = []
+        for ip in ips:
+            for item in ipy_dict.keys():
+                if ip in item:
+                    results.append(ipy_dict[item])
+                    break
+            else:
+                results.append([])
+        return results
+
+    t = time.perf_counter()
+    # (if a network is listed more times, the last entry is used, like in the dict above)
+    index = IntervalIndex((*network_range(net), value) for net, value in dict(ranges).items())
+    print("Build index:   {:8.3f} s ({} non-overlapping ranges)".format(time.perf_counter() - t, len(index)))
+    def bisect_lookup(ips):
+        return [index.find(int(ipaddress.ip_address(ip)), []) for ip in ips]
+    def batch_lookup(ips):
+        return index.find_many([int(ipaddress.ip_address(ip)) for ip in ips], [])
+
+    res_linear, t_linear = timeit(linear, ips, 1)
+    res_bisect, t_bisect = timeit(bisect_lookup, ips, 10)
+    res_batch, t_batch = timeit(batch_lookup, ips, 10)
+
+    if not (res_linear == res_bisect == res_batch):
+        print("ERROR: Results differ!")
+    print("Found: {}/{}".format(sum(1 for r in res_bisect if r), len(ips)))
+    print("linear (IPy):  {:10.2f} us/IP".format(t_linear * 1e6))
+    print("bisect:        {:10.2f} us/IP  ({:.0f}x)".format(t_bisect * 1e6, t_linear / t_bisect))
+    print("numpy batch:   {:10.2f} us/IP  ({:.0f}x)".format(t_batch * 1e6, t_linear / t_batch))
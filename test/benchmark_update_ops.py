@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Benchmark of applying update requests to records (core/update_ops.py).
+
+Applies typical mixes of update requests to synthetic IP records and prints
+the number of requests applied per second:
+  warden  - requests sent by warden_receiver for each event (array_upsert of
+            events item, add to events_meta.total, setmax of last_activity and
+            _ttl.warden)
+  updater - requests sent by updater (weak event and next_step of _nru1d)
+Each mix is measured with perform_update (compiled operations looked up in the
+cache), with operations compiled in advance and with an empty cache (each
+request compiled again).
+
+Usage:
+  benchmark_update_ops.py -n 100000
+"""
+
+import sys
+import os
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NERDd')))
+
+import core.update_ops
+from core.update_ops import compile_op, perform_update
+from core.array_index import ArrayIndex
+
+NODES = ['cz.cesnet.nemea', 'cz.cesnet.hp.dionaea', 'cz.muni.csirt.sentinel', 'cz.cesnet.kippo']
+CATS = ['Recon.Scanning', 'Attempt.Login', 'Attempt.Exploit', 'Availability.DDoS']
+
+
+def make_record(now, n_events):
+    """Create a synthetic IP record with given number of items in events"""
+    events = []
+    for d in range(n_events):
+        events.append({'date': (now - timedelta(days=d // 16)).strftime('%Y-%m-%d'), 'node': NODES[d % 4],
+                       'cat': CATS[(d // 4) % 4], 'n': random.randint(1, 100)})
+    return {
+        '_id': '192.0.2.1',
+        'ts_added': now - timedelta(days=30),
+        'last_activity': now,
+        'events': events,
+        'events_meta': {'total': sum(e['n'] for e in events)},
+        '_ttl': {'warden': now},
+    }
+
+
+def warden_requests(now, n):
+    requests = []
+    for _ in range(n):
+        date = (now - timedelta(days=random.randint(0, 10))).strftime('%Y-%m-%d')
+        requests.extend([
+            ('array_upsert', 'events', {'date': date, 'node': random.choice(NODES), 'cat': random.choice(CATS)},
+             [('add', 'n', 1)]),
+            ('add', 'events_meta.total', 1),
+            ('setmax', 'last_activity', now),
+            ('setmax', '_ttl.warden', now + timedelta(days=14)),
+        ])
+    return requests
+
+
+def updater_requests(now, n):
+    requests = []
+    for _ in range(n):
+        requests.extend([
+            ('*next_step', '_nru1d', 'ts_added', now, timedelta(days=1)),
+            ('*next_step', '_nru1w', 'ts_added', now, timedelta(days=7)),
+        ])
+    return requests
+
+
+def timed(label, n, func):
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+    print("{:36} {:10.0f} requests/s".format(label, n / duration))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="benchmark_update_ops.py",
+        description="Benchmark of applying update requests to records."
+    )
+    parser.add_argument('-n', '--requests', metavar='N', type=int, default=100000,
+        help='Number of tasks of each mix (default: 100000)')
+    parser.add_argument('-e', '--events', metavar='N', type=int, default=200,
+        help='Number of items in events array of the record (default: 200)')
+    parser.add_argument('-t', '--task-size', metavar='N', type=int, default=20,
+        help='Number of tasks merged into one (i.e. sharing one ArrayIndex) (default: 20)')
+    args = parser.parse_args()
+
+    random.seed(1)
+    now = datetime.utcnow()
+
+    for name, requests in (('warden', warden_requests(now, args.requests)),
+                           ('updater', updater_requests(now, args.requests))):
+        chunk = args.task_size * len(requests) // args.requests # number of requests in one task
+        tasks = [requests[i:i+chunk] for i in range(0, len(requests), chunk)]
+        compiled = [[(compile_op(r[0], r[1]), r) for r in task] for task in tasks]
+
+        def run_perform_update():
+            rec = make_record(now, args.events)
+            for task in tasks:
+                index = ArrayIndex()
+                for updreq in task:
+                    perform_update(rec, updreq, index)
+
+        def run_precompiled():
+            rec = make_record(now, args.events)
+            for task in compiled:
+                index = ArrayIndex()
+                for op, updreq in task:
+                    op.apply(rec, updreq, index)
+
+        def run_uncached():
+            rec = make_record(now, args.events)
+            for task in tasks:
+                index = ArrayIndex()
+                for updreq in task:
+                    core.update_ops._cache.clear()
+                    perform_update(rec, updreq, index)
+
+        timed("{} - perform_update".format(name), len(requests), run_perform_update)
+        timed("{} - precompiled".format(name), len(requests), run_precompiled)
+        timed("{} - compiled every time".format(name), len(requests), run_uncached)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark of WardenFilter (warden_receiver.py) over a corpus of recorded IDEA messages.
+
+Compares the compiled filter (simple patterns evaluated by direct dict/list access) with evaluation of all patterns by
+jsonpath_rw_ext, checks that both give the same results and prints per-rule counters.
+
+Usage:
+  benchmark_warden_filter.py -c /etc/nerd/nerdd.yml /path/to/idea/files/
+  benchmark_warden_filter.py -r "Category.[*]=Test ; drop" -r "; pass" /path/to/idea/files/
+"""
+
+import sys
+import os
+import time
+import json
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NERDd')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import common.config
+from warden_receiver import WardenFilter
+
+
+def load_corpus(path):
+    """Load all IDEA messages from files in given directory (recursively), one message per file."""
+    messages = []
+    for dirpath, _, filenames in os.walk(path):
+        for filename in sorted(filenames):
+            with open(os.path.join(dirpath, filename), "r") as f:
+                try:
+                    messages.append(json.load(f))
+                except ValueError:
+                    print("Skipping {} (not a valid JSON)".format(filename), file=sys.stderr)
+    return messages
+
+
+def run(warden_filter, messages, rounds):
+    """Run the filter over all messages, return list of results and time per message"""
+    results = []
+    start = time.perf_counter()
+    for _ in range(rounds):
+        results = [warden_filter.should_pass(msg) for msg in messages]
+    duration = time.perf_counter() - start
+    return results, duration / (rounds * len(messages))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="benchmark_warden_filter.py",
+        description="Benchmark of Warden filter over a corpus of recorded IDEA messages."
+    )
+    parser.add_argument('path', metavar='PATH', help='Directory with IDEA messages (one message per file)')
+    parser.add_argument('-c', '--config', metavar='FILENAME', default=None,
+        help='Take filter rules from "warden_filter" in given configuration file (e.g. /etc/nerd/nerdd.yml)')
+    parser.add_argument('-r', '--rule', metavar='RULE', action='append', default=[],
+        help='Filter rule (may be used multiple times, overrides rules from config)')
+    parser.add_argument('-n', '--rounds', metavar='N', type=int, default=5,
+        help='Number of passes over the corpus (default: 5)')
+    args = parser.parse_args()
+
+    if args.rule:
+        rules = args.rule
+    elif args.config:
+        rules = common.config.read_config(args.config).get('warden_filter')
+    else:
+        parser.error("No filter rules specified, use -c or -r")
+
+    messages = load_corpus(args.path)
+    if not messages:
+        parser.error("No IDEA messages found in {}".format(args.path))
+    print("Loaded {} IDEA messages".format(len(messages)))
+
+    # WardenFilter modifies the list of rules passed (pops the default action), so pass a copy to each instance
+    jsonpath_filter = WardenFilter(list(rules), fast_path=False)
+    compiled_filter = WardenFilter(list(rules))
+
+    results_jsonpath, t_jsonpath = run(jsonpath_filter, messages, args.rounds)
+    results_compiled, t_compiled = run(compiled_filter, messages, args.rounds)
+
+    if results_jsonpath != results_compiled:
+        diff = sum(a != b for a, b in zip(results_jsonpath, results_compiled))
+        print("ERROR: Results differ for {} messages!".format(diff))
+
+    print("Passed: {}/{}".format(sum(results_compiled), len(messages)))
+    print("jsonpath_rw_ext: {:8.2f} us/message ({:.0f} messages/s)".format(t_jsonpath * 1e6, 1 / t_jsonpath))
+    print("compiled:        {:8.2f} us/message ({:.0f} messages/s)".format(t_compiled * 1e6, 1 / t_compiled))
+    print("Speed-up: {:.1f}x".format(t_jsonpath / t_compiled))
+    print("Per-rule statistics of the compiled filter:")
+    for stats in compiled_filter.get_stats():
+        print("  {rule!r}: evaluated {evaluated}x, matched {matched}x, {time:.3f}s total".format(**stats))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Tests of indexes of arrays used by perform_update (core/array_index.py).
+
+Random sequences of update requests on arrays are applied to two copies of a
+record - with an ArrayIndex shared by all requests (as within one task) and
+without it (linear search) - and the results must be the same.
+
+Usage (or run by pytest):
+  test_array_index.py
+"""
+
+import sys
+import os
+import copy
+import random
+import logging
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NERDd')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+from core.array_index import ArrayIndex, match_item
+from core.update_ops import perform_update
+
+DATES = ['2020-01-0{}'.format(d) for d in range(1, 6)]
+NODES = ['node1', 'node2', 'node3']
+CATS = ['Recon.Scanning', 'Attempt.Login']
+
+
+def make_record(rnd):
+    events = [{'date': rnd.choice(DATES), 'node': rnd.choice(NODES), 'cat': rnd.choice(CATS), 'n': 1}
+              for _ in range(rnd.randint(0, 20))]
+    return {
+        '_id': '192.0.2.1',
+        'events': events,
+        'tags': [rnd.choice('abcdef') for _ in range(rnd.randint(0, 5))],
+        'sub': {'bl': [{'n': name, 'v': 1} for name in rnd.sample(['bl1', 'bl2', 'bl3'], rnd.randint(0, 3))]},
+    }
+
+
+def random_request(rnd):
+    query = {'date': rnd.choice(DATES), 'node': rnd.choice(NODES), 'cat': rnd.choice(CATS)}
+    kind = rnd.randrange(12)
+    if kind == 0:
+        return ('array_upsert', 'events', query, [('add', 'n', 1)])
+    if kind == 1:
+        return ('array_update', 'events', query, [('add', 'n', rnd.randint(1, 3))])
+    if kind == 2:
+        # change of an indexed field of the item
+        return ('array_update', 'events', query, [('set', 'node', rnd.choice(NODES))])
+    if kind == 3:
+        # query by other set of fields
+        return ('array_update', 'events', {'date': query['date']}, [('add', 'n', 1)])
+    if kind == 4:
+        return ('array_remove', 'events', query)
+    if kind == 5:
+        return ('array_remove_many', 'events', {'date': {'$lt': rnd.choice(DATES)}})
+    if kind == 6:
+        return ('append', 'events', dict(query, n=1))
+    if kind == 7:
+        return ('add_to_set', 'tags', rnd.choice('abcdefgh'))
+    if kind == 8:
+        return ('extend_set', 'tags', [rnd.choice('abcdefgh') for _ in range(3)])
+    if kind == 9:
+        return ('rem_from_set', 'tags', [rnd.choice('abcdefgh')])
+    if kind == 10:
+        # direct access to an item by position
+        return ('set', 'events.0.node', rnd.choice(NODES))
+    return ('array_upsert', 'sub.bl', {'n': rnd.choice(['bl1', 'bl2', 'bl3', 'bl4'])}, [('add', 'v', 1)])
+
+
+def normalize(rec):
+    # rem_from_set doesn't keep order of values
+    rec = copy.deepcopy(rec)
+    rec['tags'] = sorted(rec.get('tags', []))
+    return rec
+
+
+def test_same_results_with_and_without_index():
+    rnd = random.Random(1)
+    for _ in range(2000):
+        rec = make_record(rnd)
+        rec_plain = copy.deepcopy(rec)
+        index = ArrayIndex()
+        for _ in range(rnd.randint(1, 30)):
+            updreq = random_request(rnd)
+            if updreq[1] == 'events.0.node' and not rec_plain['events']:
+                continue
+            result = perform_update(rec, copy.deepcopy(updreq), index)
+            result_plain = perform_update(rec_plain, copy.deepcopy(updreq))
+            if updreq[0] != 'rem_from_set':
+                assert result == result_plain, (updreq, result, result_plain)
+            assert normalize(rec) == normalize(rec_plain), updreq
+
+
+def test_unhashable_values():
+    # Arrays with unhashable values in indexed fields are searched linearly
+    rec = {'a': [{'k': [1, 2], 'v': 0}, {'k': 3, 'v': 0}], 's': [[1], [2]]}
+    index = ArrayIndex()
+    assert perform_update(rec, ('array_update', 'a', {'k': 3}, [('add', 'v', 1)]), index) == [('a[1].v', 1)]
+    assert perform_update(rec, ('array_update', 'a', {'k': [1, 2]}, [('add', 'v', 1)]), index) == [('a[0].v', 1)]
+    assert perform_update(rec, ('add_to_set', 's', [1]), index) is None
+    assert perform_update(rec, ('add_to_set', 's', [3]), index) == [('s', [[1], [2], [3]])]
+
+
+def test_changes_detected_by_length():
+    # Changes not done through perform_update are detected if they change length of the array or replace it
+    rec = {'a': [{'k': 1, 'v': 0}, {'k': 2, 'v': 0}]}
+    index = ArrayIndex()
+    assert index.find(rec['a'], {'k': 2}) == 1
+    rec['a'].insert(0, {'k': 0, 'v': 0})
+    assert index.find(rec['a'], {'k': 2}) == 2
+    rec['a'] = [{'k': 2, 'v': 0}]
+    assert index.find(rec['a'], {'k': 2}) == 0
+    rec['s'] = ['x']
+    assert index.contains(rec['s'], 'x')
+    rec['s'].append('y')
+    assert index.contains(rec['s'], 'y')
+
+
+def test_stale_index_after_change_in_place():
+    # A change of an item in place which keeps the length of the array is NOT detected - the index must be dropped
+    # (by reset or by using a new ArrayIndex, as UpdateManager does after each handler call)
+    rec = {'a': [{'k': 1, 'v': 0}, {'k': 2, 'v': 0}]}
+    index = ArrayIndex()
+    assert index.find(rec['a'], {'k': 1}) == 0
+    rec['a'][0]['k'] = 5
+    assert index.find(rec['a'], {'k': 1}) == 0 # stale
+    index.reset(rec['a'])
+    assert index.find(rec['a'], {'k': 1}) is None
+    assert index.find(rec['a'], {'k': 5}) == 0
+
+
+def test_handler_changing_array_in_place():
+    # UpdateManager must not use an index built before a handler changed the array in place
+    from core.update_manager import UpdateManager
+
+    class DummyDB:
+        def __init__(self):
+            self.rec = {'_id': '192.0.2.1', 'a': [{'k': 1, 'v': 0}, {'k': 2, 'v': 0}]}
+        def get(self, etype, eid):
+            return self.rec
+        def put(self, etype, eid, rec):
+            self.rec = rec
+
+    class DummyLog:
+        def log(self, name):
+            pass
+
+    def swap_keys(ekey, rec, updates):
+        # Swap the items in place (length of the array is not changed) and update the item with k=1
+        rec['a'][0]['k'], rec['a'][1]['k'] = rec['a'][1]['k'], rec['a'][0]['k']
+        return [('array_update', 'a', {'k': 1}, [('set', 'v', 'updated')])]
+
+    um = UpdateManager.__new__(UpdateManager)
+    um.log = logging.getLogger("UpdateManager")
+    um.db = DummyDB()
+    um.elog_op = DummyLog()
+    um.slow_task_threshold = float('inf')
+    um._attr2func = {'ip': {}}
+    um._func2attr = {'ip': {}}
+    um._func_triggers = {'ip': {}}
+    um._func_order = {}
+    um._registration_seq = 0
+    um._registration_lock = threading.Lock()
+    um._registration_rank = threading.local()
+    um._plans = {}
+    um.register_handler(swap_keys, 'ip', ('!swap',), ('a',))
+
+    # The index of 'a' by 'k' is built by the first request, then the handler is called
+    um._process_update_req('ip', '192.0.2.1', [('array_update', 'a', {'k': 1}, [('set', 'v', 1)]),
+                                               ('event', '!swap')])
+    assert um.db.rec['a'] == [{'k': 2, 'v': 1}, {'k': 1, 'v': 'updated'}]
+
+
+def test_match_item():
+    item = {'date': '2020-01-02', 'n': 5}
+    assert match_item(item, {'date': '2020-01-02'})
+    assert match_item(item, {'date': {'$lt': '2020-01-03'}, 'n': {'$gte': 5}})
+    assert not match_item(item, {'date': {'$gt': '2020-01-02'}})
+    assert match_item(item, {'node': {'$ne': 'x'}})
+    assert not match_item(item, {'node': {'$in': ['x']}})
+    assert match_item(item, {'n': {'$nin': [1, 2]}})
+    assert not match_item(item, {'n': {'$lt': 'abc'}}) # not comparable
+    assert not match_item('not an object', {'n': 5})
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print("{} OK".format(name))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Tests of merging of tasks of the same entity in worker queues (core/entity_queue.py)
+and of acknowledgement of all merged tasks by UpdateManager worker threads.
+
+Usage (or run by pytest):
+  test_entity_queue.py
+"""
+
+import sys
+import os
+import time
+import logging
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NERDd')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+from core.entity_queue import EntityTaskQueue
+
+
+def test_merge_same_entity():
+    q = EntityTaskQueue(10)
+    assert q.put(1, 'ip', '192.0.2.1', [('add', 'a', 1)], 'src1') is False
+    assert q.put(2, 'ip', '192.0.2.2', [('add', 'a', 1)], 'src1') is False
+    assert q.put(3, 'ip', '192.0.2.1', [('set', 'b', 2), ('add', 'a', 1)], 'src2') is True
+    assert len(q) == 2
+    task = q.get(0)
+    assert (task.etype, task.eid) == ('ip', '192.0.2.1')
+    # Requests of both tasks in one batch, in order
+    assert task.batches == [[('add', 'a', 1), ('set', 'b', 2), ('add', 'a', 1)]]
+    assert task.msg_ids == [1, 3]
+    assert task.srcs == ['src1', 'src2']
+    assert task.n_tasks == 2
+    task = q.get(0)
+    assert task.eid == '192.0.2.2' and task.msg_ids == [2]
+    assert q.get(0) is None
+
+
+def test_split_at_delete():
+    q = EntityTaskQueue(10)
+    q.put(1, 'ip', '192.0.2.1', [('add', 'a', 1)], None)
+    q.put(2, 'ip', '192.0.2.1', [('event', '!DELETE')], None)
+    q.put(3, 'ip', '192.0.2.1', [('add', 'a', 1)], None)
+    q.put(4, 'ip', '192.0.2.1', [('set', 'b', 1)], None)
+    task = q.get(0)
+    # Requests after !DELETE start a new batch (they create a new record), later ones are merged to it again
+    assert task.batches == [
+        [('add', 'a', 1), ('event', '!DELETE')],
+        [('add', 'a', 1), ('set', 'b', 1)],
+    ]
+    assert task.msg_ids == [1, 2, 3, 4]
+
+
+def test_split_at_delete_in_the_middle_of_task():
+    q = EntityTaskQueue(10)
+    q.put(1, 'ip', '192.0.2.1', [('event', '!DELETE'), ('add', 'a', 1)], None)
+    q.put(2, 'ip', '192.0.2.1', [('add', 'a', 1)], None)
+    task = q.get(0)
+    # A task is never split, the next one starts a new batch
+    assert task.batches == [[('event', '!DELETE'), ('add', 'a', 1)], [('add', 'a', 1)]]
+
+
+def test_split_weak_to_normal():
+    q = EntityTaskQueue(10)
+    q.put(1, 'ip', '192.0.2.1', [('*set', 'a', 1)], None)
+    q.put(2, 'ip', '192.0.2.1', [('*add', 'b', 1)], None)
+    q.put(3, 'ip', '192.0.2.1', [('set', 'c', 1)], None)
+    q.put(4, 'ip', '192.0.2.1', [('*set', 'd', 1)], None)
+    q.put(5, 'ip', '192.0.2.1', [('set', 'e', 1)], None)
+    task = q.get(0)
+    # Weak-only tasks are merged together; a normal task after them starts a new batch (the weak ones must not be
+    # applied if the record doesn't exist), weak and normal tasks after a normal one are merged to it
+    assert task.batches == [
+        [('*set', 'a', 1), ('*add', 'b', 1)],
+        [('set', 'c', 1), ('*set', 'd', 1), ('set', 'e', 1)],
+    ]
+    assert task.msg_ids == [1, 2, 3, 4, 5]
+
+
+def test_mixed_task_is_not_weak_only():
+    q = EntityTaskQueue(10)
+    q.put(1, 'ip', '192.0.2.1', [('*set', 'a', 1), ('set', 'b', 1)], None)
+    q.put(2, 'ip', '192.0.2.1', [('set', 'c', 1)], None)
+    task = q.get(0)
+    assert task.batches == [[('*set', 'a', 1), ('set', 'b', 1), ('set', 'c', 1)]]
+
+
+def test_maxsize_and_merge_when_full():
+    q = EntityTaskQueue(2)
+    q.put(1, 'ip', '192.0.2.1', [('add', 'a', 1)], None)
+    q.put(2, 'ip', '192.0.2.2', [('add', 'a', 1)], None)
+    # Queue is full, but a task of a waiting entity is always accepted
+    assert q.put(3, 'ip', '192.0.2.1', [('add', 'a', 1)], None) is True
+    # A task of a new entity blocks until an entry is taken
+    done = threading.Event()
+    def put_new():
+        q.put(4, 'ip', '192.0.2.3', [('add', 'a', 1)], None)
+        done.set()
+    t = threading.Thread(target=put_new)
+    t.start()
+    assert not done.wait(0.2)
+    assert q.get(0).msg_ids == [1, 3]
+    assert done.wait(2)
+    t.join()
+    assert [q.get(0).eid, q.get(0).eid] == ['192.0.2.2', '192.0.2.3']
+
+
+def test_merged_tasks_acked():
+    # UpdateManager worker thread must acknowledge all tasks merged into one PendingTask and process all batches
+    from core.update_manager import UpdateManager
+    from core.partitions import PartitionMap
+    from core.task_stats import TaskStats
+
+    acked = []
+    processed = []
+
+    class DummyReader:
+        def ack(self, msg_id):
+            acked.append(msg_id)
+
+    class DummyLog:
+        def log(self, name):
+            pass
+
+    um = UpdateManager.__new__(UpdateManager)
+    um.log = logging.getLogger("UpdateManager")
+    um.running = True
+    um._current_thread_data = threading.local()
+    um._queues = [EntityTaskQueue(10)]
+    um._partitions = PartitionMap(4, 1)
+    um._stats = [TaskStats()]
+    um.elog_by_src = DummyLog()
+    um._task_queue_reader = DummyReader()
+    um._process_update_req = lambda etype, eid, updreq, stats=None: processed.append((eid, updreq))
+
+    tasks = [
+        (('gen', 1), '192.0.2.1', [('add', 'a', 1)]),
+        (('gen', 2), '192.0.2.2', [('add', 'a', 1)]),
+        (('gen', 3), '192.0.2.1', [('event', '!DELETE')]),
+        (('gen', 4), '192.0.2.1', [('add', 'a', 1)]),
+    ]
+    for msg_id, eid, updreq in tasks:
+        um._distribute_task(msg_id, 'ip', eid, updreq, 'test')
+
+    worker = threading.Thread(target=um._worker_func, args=(0,))
+    worker.start()
+    deadline = time.time() + 5
+    while len(processed) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    um.running = False
+    worker.join()
+
+    assert sorted(acked) == [msg_id for msg_id, _, _ in tasks]
+    assert processed == [
+        ('192.0.2.1', [('add', 'a', 1), ('event', '!DELETE')]),
+        ('192.0.2.1', [('add', 'a', 1)]),
+        ('192.0.2.2', [('add', 'a', 1)]),
+    ]
+    # All tasks are marked as done in their partitions (so partitions can be moved)
+    assert um._partitions._pending == [0] * 4
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print("{} OK".format(name))
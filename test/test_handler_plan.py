@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Tests of compilation of handler call order (HandlerPlan in core/update_manager.py)
+and of the limit of handler calls per task.
+
+Usage (or run by pytest):
+  test_handler_plan.py
+"""
+
+import sys
+import os
+import logging
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NERDd')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+from core.update_manager import UpdateManager
+
+
+def make_handler(name, reqs=None, calls=None):
+    """Create a handler function with given name, returning given update requests and recording its calls"""
+    def handler(ekey, rec, updates):
+        if calls is not None:
+            calls.append(name)
+        return list(reqs or [])
+    handler.__name__ = handler.__qualname__ = name
+    return handler
+
+
+def make_um():
+    """UpdateManager with only the parts needed for registration of handlers and processing of tasks"""
+    class DummyDB:
+        def get(self, etype, eid):
+            return {'_id': eid}
+        def put(self, etype, eid, rec):
+            pass
+    class DummyLog:
+        def log(self, name):
+            pass
+    um = UpdateManager.__new__(UpdateManager)
+    um.log = logging.getLogger("UpdateManager")
+    um.db = DummyDB()
+    um.elog_op = DummyLog()
+    um.slow_task_threshold = float('inf')
+    um._attr2func = {'ip': {}}
+    um._func2attr = {'ip': {}}
+    um._func_triggers = {'ip': {}}
+    um._func_order = {}
+    um._registration_seq = 0
+    um._registration_lock = threading.Lock()
+    um._registration_rank = threading.local()
+    um._plans = {}
+    return um
+
+
+def make_plan(handlers):
+    """Register handlers given as list of (function, triggers, changes) and return the compiled HandlerPlan"""
+    um = make_um()
+    for func, triggers, changes in handlers:
+        um.register_handler(func, 'ip', triggers, changes)
+    return um._get_plan('ip')
+
+
+def names(funcs):
+    return [f.__name__ for f in funcs]
+
+
+def test_topological_order():
+    # Registered in reverse order of dependencies: c <- b <- a
+    c = make_handler('c')
+    b = make_handler('b')
+    a = make_handler('a')
+    plan = make_plan([
+        (c, ('z',), ()),
+        (b, ('y',), ('z',)),
+        (a, ('x',), ('y',)),
+    ])
+    assert names(plan.funcs) == ['a', 'b', 'c']
+    assert plan.rank == {a: 0, b: 1, c: 2}
+    assert plan.cycles == []
+
+
+def test_ties_by_registration_order():
+    # Independent handlers stay in the order of registration ...
+    funcs = [make_handler(name) for name in 'pqrs']
+    plan = make_plan([(f, ('attr_' + f.__name__,), ()) for f in funcs])
+    assert plan.funcs == funcs
+    # ... and a dependency moves only the dependent one (d must follow s, others keep their order)
+    d = make_handler('d')
+    plan = make_plan([(d, ('attr_d',), ())] + [(f, ('attr_' + f.__name__,), ()) for f in funcs[:3]] +
+                     [(funcs[3], ('attr_s',), ('attr_d',))])
+    assert names(plan.funcs) == ['p', 'q', 'r', 's', 'd']
+
+
+def test_ties_by_module_rank():
+    # Rank of the registering module takes precedence over the sequence of registration
+    um = make_um()
+    late = make_handler('late')
+    early = make_handler('early')
+    with um.registration_order(5):
+        um.register_handler(late, 'ip', ('a',), ())
+    with um.registration_order(1):
+        um.register_handler(early, 'ip', ('a',), ())
+    outside = make_handler('outside')
+    um.register_handler(outside, 'ip', ('a',), ())
+    plan = um._get_plan('ip')
+    assert names(plan.funcs) == ['early', 'late', 'outside']
+    assert names(plan.attr2func['a']) == ['early', 'late', 'outside']
+
+
+def test_own_trigger_is_not_cycle():
+    f = make_handler('f')
+    plan = make_plan([(f, ('x',), ('x',))])
+    assert plan.funcs == [f]
+    assert plan.cycles == []
+
+
+def test_cycles():
+    # a <-> b is a cycle, c depends on the cycle (but isn't part of it), e <-> f <-> g is another one,
+    # i is independent
+    a = make_handler('a')
+    b = make_handler('b')
+    c = make_handler('c')
+    e = make_handler('e')
+    f = make_handler('f')
+    g = make_handler('g')
+    i = make_handler('i')
+    plan = make_plan([
+        (a, ('x',), ('y',)),
+        (b, ('y',), ('x', 'w')),
+        (c, ('w',), ()),
+        (e, ('e1',), ('f1',)),
+        (f, ('f1',), ('g1',)),
+        (g, ('g1',), ('e1',)),
+        (i, ('i1',), ()),
+    ])
+    assert sorted(sorted(names(cycle)) for cycle in plan.cycles) == [['a', 'b'], ['e', 'f', 'g']]
+    # All functions are in the plan, those in or after cycles at the end (in registration order)
+    assert names(plan.funcs) == ['i', 'a', 'b', 'c', 'e', 'f', 'g']
+    assert set(plan.rank) == {a, b, c, e, f, g, i}
+
+
+def test_may_change():
+    a = make_handler('a')
+    b = make_handler('b')
+    c = make_handler('c')
+    plan = make_plan([
+        (a, ('x',), ('y',)),
+        (b, ('y',), ('z',)),
+        (c, ('other',), ('q',)),
+    ])
+    assert plan.may_change['x'] == {'y', 'z'}
+    assert plan.may_change['y'] == {'z'}
+    assert plan.may_change['other'] == {'q'}
+
+
+def test_max_calls():
+    # Small plans allow 20 calls, larger ones twice the number of functions
+    plan = make_plan([(make_handler('h{}'.format(n)), ('a{}'.format(n),), ()) for n in range(3)])
+    assert plan.max_calls == 20
+    plan = make_plan([(make_handler('h{}'.format(n)), ('a{}'.format(n),), ()) for n in range(15)])
+    assert plan.max_calls == 30
+
+
+def test_max_calls_stops_endless_loop():
+    # Two handlers changing each other's trigger forever - processing must stop after max_calls calls
+    calls = []
+    um = make_um()
+    um.register_handler(make_handler('ping', [('add', 'pong', 1)], calls), 'ip', ('ping',), ('pong',))
+    um.register_handler(make_handler('pong', [('add', 'ping', 1)], calls), 'ip', ('pong',), ('ping',))
+    um._process_update_req('ip', '192.0.2.1', [('add', 'ping', 1)])
+    plan = um._get_plan('ip')
+    assert len(calls) == plan.max_calls
+    assert calls[:4] == ['ping', 'pong', 'ping', 'pong']
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print("{} OK".format(name))
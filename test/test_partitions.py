@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Tests of rebalancing of entity partitions between worker threads (core/partitions.py).
+
+Usage (or run by pytest):
+  test_partitions.py
+"""
+
+import sys
+import os
+import random
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NERDd')))
+
+from core.partitions import PartitionMap
+
+
+def entity_in(pm, partition):
+    """Return an entity (etype, eid) falling into given partition"""
+    for i in range(100000):
+        eid = '192.0.{}.{}'.format(i // 256, i % 256)
+        if pm.partition('ip', eid) == partition:
+            return 'ip', eid
+    raise ValueError("No entity found for partition {}".format(partition))
+
+
+def add_time(pm, partition, duration):
+    """Record processing time of the partition (no task pending)"""
+    pm.done(partition, 0, duration)
+
+
+def owners(pm):
+    return list(pm._owner)
+
+
+def test_initial_assignment():
+    pm = PartitionMap(8, 3)
+    assert owners(pm) == [0, 1, 2, 0, 1, 2, 0, 1]
+    etype, eid = entity_in(pm, 4)
+    assert pm.assign(etype, eid) == (4, 1)
+
+
+def test_no_load_no_moves():
+    pm = PartitionMap(8, 2)
+    assert pm.rebalance() == []
+    assert owners(pm) == [0, 1] * 4
+
+
+def test_balanced_no_moves():
+    pm = PartitionMap(8, 2, threshold=1.5)
+    for p in range(8):
+        add_time(pm, p, 1.0)
+    assert pm.rebalance() == []
+    # Busiest thread 40% above average is below the threshold
+    for p in range(8):
+        add_time(pm, p, 1.0 if p % 2 else 2.5)
+    assert pm.rebalance() == []
+
+
+def test_moves_only_drained_partitions():
+    pm = PartitionMap(8, 2, threshold=1.2)
+    # All the load is on thread 0 (partitions 0, 2, 4, 6)
+    for p in (0, 2, 4, 6):
+        add_time(pm, p, 1.0)
+    # Partitions 0 and 2 have tasks waiting
+    entities = {p: entity_in(pm, p) for p in (0, 2)}
+    for p, (etype, eid) in entities.items():
+        assert pm.assign(etype, eid) == (p, 0)
+    moves = pm.rebalance()
+    assert moves
+    assert all(frm == 0 and to == 1 for _, frm, to in moves)
+    moved = {p for p, _, _ in moves}
+    assert moved <= {4, 6}
+    assert pm._owner[0] == 0 and pm._owner[2] == 0
+    for p in moved:
+        assert pm._owner[p] == 1
+    # New tasks of a pending partition still go to the old owner, so ordering is preserved
+    etype, eid = entities[0]
+    assert pm.assign(etype, eid) == (0, 0)
+
+
+def test_pending_partition_moved_after_drain():
+    pm = PartitionMap(6, 2, threshold=1.2)
+    # Thread 0 owns partitions 0, 2 and 4; 2 and 4 are loaded but have tasks pending, so only 0 can be moved
+    for p in (2, 4):
+        etype, eid = entity_in(pm, p)
+        pm.assign(etype, eid)
+    add_time(pm, 0, 0.1)
+    add_time(pm, 2, 1.0)
+    add_time(pm, 4, 1.0)
+    add_time(pm, 1, 0.1)
+    assert pm.rebalance() == [(0, 0, 1)]
+    # Once the task of partition 2 is done, the partition can be moved
+    pm.done(2, 1, 1.0)
+    add_time(pm, 4, 1.0)
+    assert pm.rebalance() == [(2, 0, 1)]
+    assert pm._owner == [1, 1, 1, 1, 0, 1]
+    assert pm._pending == [0, 0, 0, 0, 1, 0]
+
+
+def test_moves_improve_balance():
+    pm = PartitionMap(16, 4, threshold=1.1)
+    for p in range(16):
+        add_time(pm, p, 4.0 if pm._owner[p] == 0 else 1.0)
+    before = owners(pm)
+    moves = pm.rebalance()
+    # Loads per thread before: 16, 4, 4, 4 - each move goes from the busiest thread to the least busy one
+    assert moves
+    assert all(frm == 0 for _, frm, _ in moves)
+    loads = [0.0] * 4
+    for p in range(16):
+        loads[pm._owner[p]] += 4.0 if before[p] == 0 else 1.0
+    assert max(loads) < 16.0
+    assert pm.get_stats()['migrations'] == len(moves)
+
+
+def test_rebalance_terminates():
+    # Random loads (including partitions of equal or zero time and pending ones) - each call must finish, move only
+    # drained partitions and only ones with some load
+    # (it terminates since each move of a partition with time 0 < t < gap decreases the sum of squares of thread
+    # loads, so no assignment can repeat)
+    rnd = random.Random(42)
+    for _ in range(500):
+        num_threads = rnd.randint(1, 8)
+        pm = PartitionMap(rnd.randint(1, 64), num_threads, threshold=rnd.choice([1.0, 1.01, 1.5, 3.0]))
+        times = {}
+        pending = set()
+        for p in range(pm.num_partitions):
+            t = rnd.choice([0.0, 1.0, 1.0, rnd.random(), rnd.expovariate(0.1)])
+            times[p] = t
+            add_time(pm, p, t)
+            if rnd.random() < 0.2:
+                pm._pending[p] += 1
+                pending.add(p)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(pm.rebalance()), daemon=True)
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive(), "rebalance() doesn't terminate"
+        moves = result[0]
+        assert len(moves) <= pm.num_partitions * num_threads
+        for p, frm, to in moves:
+            assert p not in pending
+            assert times[p] > 0
+            assert frm != to
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print("{} OK".format(name))
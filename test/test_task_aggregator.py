@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Tests of merging of tasks by TaskAggregator (common/task_aggregator.py).
+
+Merged tasks must give the same record as the original tasks applied one by
+one (checked by perform_update).
+
+Usage (or run by pytest):
+  test_task_aggregator.py
+"""
+
+import sys
+import os
+import copy
+import random
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NERDd')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+from common.task_aggregator import TaskAggregator
+from core.update_ops import perform_update
+
+
+class DummyWriter:
+    """Records tasks sent by TaskAggregator"""
+    def __init__(self):
+        self.tasks = []
+
+    def put_task(self, etype, eid, requested_changes, src, priority=False):
+        self.tasks.append((etype, eid, list(requested_changes), src, priority))
+
+
+def apply_tasks(tasks, rec=None):
+    rec = copy.deepcopy(rec) if rec is not None else {}
+    for task in tasks:
+        for updreq in copy.deepcopy(task):
+            perform_update(rec, updreq)
+    return rec
+
+
+def aggregate(tasks, src='test'):
+    writer = DummyWriter()
+    aggregator = TaskAggregator(writer, max_age=3600)
+    for task in tasks:
+        aggregator.put_task('ip', '192.0.2.1', task, src)
+    aggregator.flush()
+    return writer.tasks
+
+
+def test_merge_commutative():
+    sent = aggregate([
+        [('add', 'n', 1), ('setmax', 'last', 5)],
+        [('add', 'n', 2), ('setmax', 'last', 3), ('set', 's', 'a')],
+        [('set', 's', 'b')],
+    ])
+    assert len(sent) == 1
+    assert sent[0][2] == [('add', 'n', 3), ('setmax', 'last', 5), ('set', 's', 'b')]
+
+
+def test_key_and_subkey_not_merged():
+    tasks = [
+        [('add', 'x.n', 1)],
+        [('set', 'x', {'n': 0})],
+        [('add', 'x.n', 1)],
+    ]
+    sent = aggregate(tasks)
+    assert [t[2] for t in sent] == tasks
+    assert apply_tasks(t[2] for t in sent) == apply_tasks(tasks) == {'x': {'n': 1}}
+
+
+def test_subkey_after_key_not_merged():
+    tasks = [
+        [('set', 'x', {'n': 5})],
+        [('add', 'x.n', 1)],
+        [('set', 'x', {'n': 0})],
+    ]
+    sent = aggregate(tasks)
+    assert apply_tasks(t[2] for t in sent) == apply_tasks(tasks) == {'x': {'n': 0}}
+
+
+def test_key_and_subkey_within_one_task():
+    # The task itself can't be merged with following ones (its requests would be reordered)
+    tasks = [
+        [('add', 'x.n', 1), ('set', 'x', {'n': 0})],
+        [('add', 'x.n', 1)],
+    ]
+    sent = aggregate(tasks)
+    assert apply_tasks(t[2] for t in sent) == apply_tasks(tasks) == {'x': {'n': 1}}
+
+
+def test_deeper_prefix():
+    tasks = [
+        [('add', 'a.b.c', 1)],
+        [('set', 'a', {})],
+        [('add', 'a.b.c', 1)],
+    ]
+    sent = aggregate(tasks)
+    assert apply_tasks(t[2] for t in sent) == apply_tasks(tasks) == {'a': {'b': {'c': 1}}}
+
+
+def test_similar_names_merged():
+    # 'x' and 'xy' are not prefixes of each other in terms of keys
+    sent = aggregate([
+        [('add', 'x', 1)],
+        [('add', 'xy', 1)],
+        [('add', 'x', 1)],
+    ])
+    assert len(sent) == 1
+    assert sent[0][2] == [('add', 'x', 2), ('add', 'xy', 1)]
+
+
+def test_upsert_actions():
+    tasks = [
+        [('array_upsert', 'events', {'d': 1}, [('add', 'n', 1)])],
+        [('array_upsert', 'events', {'d': 1}, [('add', 'n', 2)]), ('add', 'total', 1)],
+        [('array_upsert', 'events', {'d': 2}, [('add', 'n', 1)])],
+    ]
+    sent = aggregate(tasks)
+    assert len(sent) == 1
+    assert apply_tasks(t[2] for t in sent) == apply_tasks(tasks)
+    # Item key and its sub-key within the actions
+    tasks = [
+        [('array_upsert', 'events', {'d': 1}, [('add', 'c.x', 1)])],
+        [('array_upsert', 'events', {'d': 1}, [('set', 'c', {'x': 0})])],
+        [('array_upsert', 'events', {'d': 1}, [('add', 'c.x', 1)])],
+    ]
+    sent = aggregate(tasks)
+    assert apply_tasks(t[2] for t in sent) == apply_tasks(tasks)
+
+
+def test_random_tasks_same_result():
+    rnd = random.Random(7)
+    keys = ['x', 'x.n', 'x.m', 'x.n.k', 'y', 'z.a']
+    for _ in range(3000):
+        tasks = []
+        for _ in range(rnd.randint(1, 6)):
+            task = []
+            for _ in range(rnd.randint(1, 3)):
+                key = rnd.choice(keys)
+                op = rnd.choice(['add', 'set', 'setmax'])
+                value = rnd.randint(0, 5) if op != 'set' or rnd.random() < 0.5 else {}
+                task.append((op, key, value))
+            tasks.append(task)
+        try:
+            expected = apply_tasks(tasks)
+        except (TypeError, AttributeError, KeyError):
+            continue # invalid combination (e.g. add to a dict, sub-key of a number)
+        sent = aggregate(tasks)
+        assert apply_tasks(t[2] for t in sent) == expected, (tasks, sent)
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print("{} OK".format(name))